@@ -54,6 +54,9 @@ db_info = None
 # stores ItemInfo objects so we can quickly fetch them
 item_info_cache = None
 
+# N-gram index of the items in item_info_cache
+search_index = None
+
 # command line arguments for thumbnailer (linux)
 movie_data_program_info = None
 
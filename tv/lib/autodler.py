@@ -135,7 +135,8 @@ class Downloader:
         if self.dc or self.paused:
             return
         self.dc = eventloop.add_idle(self.start_downloads_idle,
-                                     "Start Downloads")
+                                     "Start Downloads",
+                                     priority=eventloop.PRIORITY_BACKGROUND)
 
     def pending_on_add(self, tracker, obj):
         feed = obj.get_feed()
@@ -0,0 +1,157 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.columncodec`` -- Encode python containers for database columns.
+
+Lists, dicts, tuples and timedelta objects don't have a SQLite equivalent.
+We used to store them using repr() and read them back with eval(), which
+made eval() one of the slowest parts of loading the database.  Now they get
+stored as a BLOB, using the marshal module.
+
+The first byte of the BLOB is a format code:
+
+- ``FORMAT_MARSHAL``: the rest of the data is a marshalled value.
+- ``FORMAT_MARSHAL_EXTENDED``: the value contained datetime, timedelta or
+  struct_time objects, which marshal can't handle.  Each of those was
+  replaced with a frozenset holding a single (type-tag, args) tuple before
+  marshalling.  frozensets are never valid values for our schema items, so
+  there's no chance of confusing them with real data.
+
+Values stored by older versions of Miro are strings created with repr().
+decode() still handles those, but databaseupgrade converts them when the
+database gets upgraded.
+"""
+
+import datetime
+import marshal
+import time
+
+FORMAT_MARSHAL = '\x01'
+FORMAT_MARSHAL_EXTENDED = '\x02'
+
+# version of the marshal format to use.  Version 2 is the newest that python
+# 2.5 supports and stores floats in binary form.
+MARSHAL_VERSION = 2
+
+class TimeModuleShadow:
+    """In Python 2.6, time.struct_time is a named tuple and evals poorly,
+    so we have struct_time_shadow which takes the arguments that struct_time
+    should have and returns a 9-tuple
+    """
+    def struct_time(self, tm_year=0, tm_mon=0, tm_mday=0, tm_hour=0,
+                    tm_min=0, tm_sec=0, tm_wday=0, tm_yday=0, tm_isdst=0):
+        return (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec,
+                tm_wday, tm_yday, tm_isdst)
+
+_TIME_MODULE_SHADOW = TimeModuleShadow()
+
+def encode(value):
+    """Encode a python value.
+
+    :returns: buffer object to store in the database
+    :raises ValueError: value contains objects that we can't encode
+    """
+    try:
+        return buffer(FORMAT_MARSHAL + marshal.dumps(value, MARSHAL_VERSION))
+    except ValueError:
+        # value contains objects that marshal doesn't support.  Fall through
+        # to the slower code.
+        pass
+    return buffer(FORMAT_MARSHAL_EXTENDED +
+                  marshal.dumps(_replace_special(value), MARSHAL_VERSION))
+
+def decode(data):
+    """Decode a value stored with encode().
+
+    Strings created by repr() are also supported.
+    """
+    if isinstance(data, buffer):
+        data = str(data)
+        format_code = data[:1]
+        if format_code == FORMAT_MARSHAL:
+            return marshal.loads(data[1:])
+        elif format_code == FORMAT_MARSHAL_EXTENDED:
+            return _restore_special(marshal.loads(data[1:]))
+        else:
+            raise ValueError("Unknown format code: %r" % format_code)
+    else:
+        return decode_repr(data)
+
+def decode_repr(data):
+    """Decode a value stored by older versions of Miro using repr()."""
+    return eval(data, __builtins__, {'datetime': datetime,
+                                     'time': _TIME_MODULE_SHADOW})
+
+def _replace_special(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise ValueError("Can't encode datetimes with a tzinfo")
+        return frozenset([('datetime', (value.year, value.month, value.day,
+                                        value.hour, value.minute,
+                                        value.second, value.microsecond))])
+    elif isinstance(value, datetime.timedelta):
+        return frozenset([('timedelta', (value.days, value.seconds,
+                                         value.microseconds))])
+    elif isinstance(value, time.struct_time):
+        return frozenset([('struct_time', tuple(value))])
+    elif isinstance(value, dict):
+        return dict((_replace_special(k), _replace_special(v))
+                    for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_replace_special(v) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(_replace_special(v) for v in value)
+    # marshal only handles the exact str/unicode types, not subclasses
+    elif isinstance(value, unicode):
+        return unicode(value)
+    elif isinstance(value, str):
+        return str(value)
+    else:
+        return value
+
+def _restore_special(value):
+    if isinstance(value, frozenset):
+        ((type_tag, args),) = value
+        if type_tag == 'datetime':
+            return datetime.datetime(*args)
+        elif type_tag == 'timedelta':
+            return datetime.timedelta(*args)
+        elif type_tag == 'struct_time':
+            return time.struct_time(args)
+        else:
+            raise ValueError("Unknown type tag: %r" % type_tag)
+    elif isinstance(value, dict):
+        return dict((_restore_special(k), _restore_special(v))
+                    for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_restore_special(v) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(_restore_special(v) for v in value)
+    else:
+        return value
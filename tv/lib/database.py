@@ -29,11 +29,14 @@
 
 import itertools
 import logging
+import time
 import traceback
 import threading
 
 from miro import app
 from miro import signals
+from miro import util
+from miro import viewpredicate
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -252,14 +255,6 @@ class ViewTrackerManager(object):
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj, can_change_views)
 
-    def bulk_update_view_trackers(self, table_name):
-        for tracker in self.trackers_for_table(table_name):
-            tracker.check_all_objects()
-
-    def bulk_remove_from_view_trackers(self, table_name, objects):
-        for tracker in self.trackers_for_table(table_name):
-            tracker.remove_objects(objects)
-
     def remove_from_view_trackers(self, obj):
         """Update view trackers based on an object change."""
 
@@ -279,6 +274,10 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        # predicate is used to check changed objects without going to the DB.
+        # It's None if we can't handle our where clause in python.
+        self.predicate = viewpredicate.compile_where(self.table_name,
+                where, values, joins, db_info)
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -298,6 +297,10 @@ class ViewTracker(signals.SignalEmitter):
 
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        if self.predicate is not None:
+            result = self.predicate.evaluate(obj)
+            if result is not viewpredicate.UNKNOWN:
+                return result
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -312,6 +315,20 @@ class ViewTracker(signals.SignalEmitter):
                                              self.where, self.values,
                                              joins=self.joins))
 
+    def _view_object_ids_in(self, id_list):
+        """Get the ids from id_list that are in our view."""
+        rv = set()
+        chunk_size = util.SQLITE_CHUNK_SIZE - len(self.values)
+        for id_chunk in util.split_values_for_sqlite(id_list, chunk_size):
+            where = '%s.id IN (%s)' % (self.table_name,
+                                       ', '.join('?' for i in id_chunk))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            values = tuple(id_chunk) + self.values
+            rv.update(self.db_info.db.query_ids(self.table_name, where,
+                                                values, joins=self.joins))
+        return rv
+
     def object_changed(self, obj, can_change_views):
         if can_change_views:
             self.check_object(obj)
@@ -323,11 +340,6 @@ class ViewTracker(signals.SignalEmitter):
             self.current_ids.remove(obj.id)
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
-    def remove_objects(self, objects):
-        for obj in [o for o in objects if o.id in self.current_ids]:
-            self.current_ids.remove(obj.id)
-            self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
-
     def check_object(self, obj):
         before = (obj.id in self.current_ids)
         now = self._obj_in_view(obj)
@@ -340,6 +352,48 @@ class ViewTracker(signals.SignalEmitter):
         elif before and now:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def check_objects(self, objects):
+        """Check a list of objects that have changed.
+
+        This works like calling check_object() for each object, but objects
+        that our predicate can't handle are checked with one query per chunk
+        of ids, rather than one query per object.
+        """
+        in_view = set()
+        unknown_ids = []
+        for obj in objects:
+            if not self.db_info.db.id_alive(obj.id, obj.__class__):
+                # object was removed
+                continue
+            elif self.predicate is not None:
+                result = self.predicate.evaluate(obj)
+            else:
+                result = viewpredicate.UNKNOWN
+            if result is viewpredicate.UNKNOWN:
+                unknown_ids.append(obj.id)
+            elif result:
+                in_view.add(obj.id)
+        if unknown_ids:
+            in_view.update(self._view_object_ids_in(unknown_ids))
+
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = (obj.id in in_view)
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif before and now:
+                changed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+        self._emit_for_objects('added', added)
+        self._emit_for_objects('removed', removed)
+        self._emit_for_objects('changed', changed)
+
     def _emit_for_objects(self, signal, objects):
         if self.bulk_mode:
             self.emit('bulk-' + signal, objects)
@@ -385,6 +439,11 @@ class BulkSQLManager(object):
         self.to_remove = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        # maps (table_name, where) for our view trackers to [call count,
+        # object count, total time].  This gets reported and reset by
+        # _check_tracker_times()
+        self.tracker_times = {}
+        self.tracker_times_start = time.time()
 
         self.last_call = None
 
@@ -433,6 +492,7 @@ class BulkSQLManager(object):
         self.to_remove = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        self._check_tracker_times()
 
     def _commit_sql(self, to_insert, to_remove):
         for table_name, objects in to_insert.items():
@@ -448,41 +508,59 @@ class BulkSQLManager(object):
                 obj.removed_from_db()
 
     def _update_view_trackers(self, to_insert, to_remove):
-        # figure out the total number of objects that have changed
-        changed_objs = set()
-        for table_name, objects in to_insert.items():
-            changed_objs.update(objects)
-        for table_name, objects in to_remove.items():
-            changed_objs.update(objects)
-        # Figure out which strategy is fastest based on the number of objects
-        # that have changed
-        if len(changed_objs) < 100:
-            self._update_view_trackers_by_object(changed_objs)
-        else:
-            self._update_view_trackers_by_table(to_insert, to_remove)
-
-    def _update_view_trackers_by_object(self, changed_objs):
-        """Update view trackers by checking each changed object.
-
-        This method is the fastest when there are not a lot of changed objects
+        # figure out which objects have changed for each table
+        changed_objs = {}
+        for table_name, objects in to_insert.items() + to_remove.items():
+            changed_objs.setdefault(table_name, []).extend(objects)
+        for table_name, objects in changed_objs.items():
+            trackers = self.view_tracker_manager.trackers_for_table(
+                table_name)
+            for tracker in list(trackers):
+                if tracker not in trackers:
+                    # unlinked by a signal handler for another tracker
+                    continue
+                start = time.time()
+                tracker.check_objects(objects)
+                self._record_tracker_time(tracker, len(objects),
+                                          time.time() - start)
+
+    def _record_tracker_time(self, tracker, object_count, check_time):
+        """Keep track of how much time we spend updating each tracker."""
+        SINGLE_CHECK_LIMIT = 0.5
+        if check_time > SINGLE_CHECK_LIMIT:
+            logging.timing("view tracker slow (%0.3f seconds, %d objects): "
+                           "%s WHERE %s", check_time, object_count,
+                           tracker.table_name, tracker.where)
+        key = (tracker.table_name, tracker.where)
+        stats = self.tracker_times.setdefault(key, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += object_count
+        stats[2] += check_time
+
+    def _check_tracker_times(self):
+        """Report tracker_times if it's been collecting for long enough or
+        has grown too big.
         """
-        for obj in changed_objs:
-            self.view_tracker_manager.update_view_trackers(obj)
-
-    def _update_view_trackers_by_table(self, to_insert, to_remove):
-        """Update view trackers by checking each table
-
-        This method is fastest when there are many changed objects
+        REPORT_INTERVAL = 600
+        MAX_TRACKERS = 500
+        if (time.time() - self.tracker_times_start >= REPORT_INTERVAL or
+                len(self.tracker_times) >= MAX_TRACKERS):
+            self.report_tracker_times()
+
+    def report_tracker_times(self):
+        """Log the view trackers we've spent the most time on, then reset
+        tracker_times.
         """
-        for table_name in to_insert:
-            self.view_tracker_manager.bulk_update_view_trackers(table_name)
-
-        for table_name, objects in to_remove.items():
-            if table_name in to_insert:
-                # already updated the view above
-                continue
-            self.view_tracker_manager.bulk_remove_from_view_trackers(
-                table_name, objects)
+        REPORT_COUNT = 10
+        stats = sorted(self.tracker_times.items(),
+                       key=lambda (key, stats): stats[2], reverse=True)
+        for (table_name, where), (calls, objects, total) in \
+                stats[:REPORT_COUNT]:
+            logging.timing("view tracker time (%0.3f seconds, %d calls, "
+                           "%d objects): %s WHERE %s", total, calls, objects,
+                           table_name, where)
+        self.tracker_times = {}
+        self.tracker_times_start = time.time()
 
     def add_insert(self, obj):
         table_name = self.db.table_name(obj.__class__)
@@ -515,6 +593,22 @@ class BulkSQLManager(object):
         self.pending_removes.add(obj.id)
         removes_for_table.append(obj)
 
+class LazyAttributeValue(object):
+    """Stand-in for a DDBObject attribute that hasn't been loaded yet.
+
+    The storage layer uses this for columns that are expensive to decode.
+    The first time the attribute is accessed, AttributeUpdateTracker calls
+    loader(obj, name, data) to get the real value and replaces us with it.
+    """
+    __slots__ = ('loader', 'data')
+
+    def __init__(self, loader, data):
+        self.loader = loader
+        self.data = data
+
+    def load(self, obj, name):
+        return self.loader(obj, name, self.data)
+
 class AttributeUpdateTracker(object):
     """Used by DDBObject to track changes to attributes."""
 
@@ -522,11 +616,12 @@ class AttributeUpdateTracker(object):
         self.name = name
 
     # Simple implementation of the python descriptor protocol.  We
-    # just want to update changed_attributes when attributes are set.
+    # just want to update changed_attributes when attributes are set and
+    # load LazyAttributeValues when they are first accessed.
 
     def __get__(self, instance, owner):
         try:
-            return instance.__dict__[self.name]
+            value = instance.__dict__[self.name]
         except KeyError:
             raise AttributeError(self.name)
         except AttributeError:
@@ -535,6 +630,11 @@ class AttributeUpdateTracker(object):
                     "Can't access '%s' as a class attribute" % self.name)
             else:
                 raise
+        if value.__class__ is LazyAttributeValue:
+            value = value.load(instance, self.name)
+            instance.__dict__[self.name] = value
+            instance.setup_restored_attribute(self.name, value)
+        return value
 
     def __set__(self, instance, value):
         if instance.__dict__.get(self.name, "BOGUS VALUE FOO") != value:
@@ -653,6 +753,16 @@ class DDBObject(signals.SignalEmitter):
         """Initialize an object restored from disk."""
         pass
 
+    def setup_restored_attribute(self, name, value):
+        """Initialize an attribute that was loaded lazily.
+
+        Some columns aren't decoded until they are accessed (see
+        LazyAttributeValue).  This gets called after that happens, so that
+        subclasses can fix up the value without forcing it to be loaded in
+        setup_restored().
+        """
+        pass
+
     def on_db_insert(self):
         """Called after an object has been inserted into the db."""
         pass
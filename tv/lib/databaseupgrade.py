@@ -51,6 +51,7 @@ from miro import schema
 from miro import util
 import types
 from miro import app
+from miro import columncodec
 from miro import dbupgradeprogress
 from miro import prefs
 
@@ -3800,3 +3801,54 @@ def upgrade178(cursor):
                    "WHERE item.deleted)")
     cursor.execute("DELETE FROM metadata_status WHERE path IN "
                    "(SELECT filename FROM item WHERE item.deleted)")
+
+def upgrade179(cursor):
+    """Convert pythonrepr columns from repr() strings to columncodec BLOBs."""
+    for table in get_object_tables(cursor):
+        cursor.execute("PRAGMA table_info('%s')" % table)
+        columns = [column_info[1] for column_info in cursor.fetchall()
+                   if column_info[2] == 'pythonrepr']
+        if not columns:
+            continue
+        cursor.execute("SELECT id, %s FROM %s" % (', '.join(columns), table))
+        updates = []
+        for row in cursor.fetchall():
+            values = []
+            for value in row[1:]:
+                if isinstance(value, basestring):
+                    try:
+                        value = columncodec.encode(
+                            columncodec.decode_repr(value))
+                    except StandardError:
+                        # Leave bad data alone.  The storedatabase code
+                        # will call the schema's malformed data handler
+                        # when it reads the value.
+                        logging.warn("upgrade179: can't convert %s (%r)",
+                                     table, value)
+                values.append(value)
+            values.append(row[0])
+            updates.append(values)
+        setters = ', '.join('%s=?' % column for column in columns)
+        cursor.executemany("UPDATE %s SET %s WHERE id=?" % (table, setters),
+                           updates)
+
+def upgrade180(cursor):
+    """Add the feed_update_history table."""
+    cursor.execute("CREATE TABLE feed_update_history ("
+                   "id integer PRIMARY KEY, feed_id integer, "
+                   "change_likelihood real, changed_count integer, "
+                   "unchanged_count integer, not_modified_count integer, "
+                   "same_body_count integer, unchanged_streak integer, "
+                   "new_entry_times pythonrepr, body_hashes pythonrepr)")
+    cursor.execute("CREATE INDEX feed_update_history_feed ON "
+                   "feed_update_history (feed_id)")
+
+def upgrade181(cursor):
+    """Add the metadata_result_cache table."""
+    cursor.execute("CREATE TABLE metadata_result_cache ("
+                   "id integer PRIMARY KEY, source text, dest_dir text, "
+                   "file_size integer, file_mtime integer, fingerprint text, "
+                   "cover_art text, screenshot text, result pythonrepr, "
+                   "last_used real)")
+    cursor.execute("CREATE INDEX metadata_result_cache_file ON "
+                   "metadata_result_cache (file_size, file_mtime)")
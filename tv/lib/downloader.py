@@ -354,7 +354,7 @@ class RemoteDownloader(DDBObject):
             self.contentType = u'application/x-magnet'
             return 
         httpclient.grab_headers(self.url, self.on_content_type,
-                                self.on_content_type_error)
+                                self.on_content_type_error, use_cache=True)
 
     @classmethod
     def initialize_daemon(cls):
@@ -878,9 +878,14 @@ class RemoteDownloader(DDBObject):
         if self.dlid == 'noid':
             # this won't happen nowadays, but it can for old databases
             self.dlid = generate_dlid()
-        self.status['rate'] = 0
-        self.status['upRate'] = 0
-        self.status['eta'] = 0
+        # status is decoded lazily, so we reset the transfer rates in
+        # setup_restored_attribute() instead of here.
+
+    def setup_restored_attribute(self, name, value):
+        if name == 'status':
+            value['rate'] = 0
+            value['upRate'] = 0
+            value['eta'] = 0
 
     def on_signal_change(self):
         self._recalc_state()
@@ -172,7 +172,7 @@ class _EchonestQuery(object):
         url = ('http://echonest.pculture.org/api/v4/song/search?' +
                 urllib.urlencode(url_data))
         httpclient.grab_url(url, self.echonest_callback,
-                            self.echonest_errback)
+                            self.echonest_errback, use_cache=True)
 
     def _make_echonest_query(self, code, version, metadata):
         echonest_metadata = {'version': version}
@@ -256,7 +256,7 @@ class _EchonestQuery(object):
             seven_digital_url = self._make_7digital_url(release_id)
             httpclient.grab_url(seven_digital_url,
                                 self.seven_digital_callback,
-                                self.seven_digital_errback)
+                                self.seven_digital_errback, use_cache=True)
         else:
             self.handle_7digital_cache_hit(release_id)
 
@@ -35,12 +35,17 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import bisect
+import collections
 import errno
 import heapq
 import logging
+import math
 import Queue
+import re
 import select
 import socket
+import sys
 import threading
 import traceback
 
@@ -54,6 +59,162 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+# Priority classes for idles and timeouts.
+#
+# PRIORITY_UI is for things that the user is waiting on.  These calls are run
+# as soon as possible, before anything else.
+# PRIORITY_NORMAL is for network I/O and most other work.
+# PRIORITY_BACKGROUND is for maintenance work that can wait, like updating
+# icons or starting auto-downloads.
+PRIORITY_UI = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# How much time, in seconds, we spend running idles for each priority class
+# in one iteration of the event loop.  Each class with pending idles gets to
+# run at least one of them per iteration, even if other classes used up all
+# the time.  After the idles, we go back to polling, so that socket
+# callbacks and timeouts don't get starved by a long queue of idles.
+IDLE_TIME_BUDGETS = {
+    PRIORITY_NORMAL: 0.1,
+    PRIORITY_BACKGROUND: 0.05,
+}
+
+# Upper bounds, in seconds, for the buckets of our latency histograms.  There's
+# an extra bucket at the end for anything slower.
+HISTOGRAM_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0)
+
+OBJECT_ADDRESS_RE = re.compile(r' at 0x[0-9a-fA-F]+')
+
+# Event flags for pollers
+POLL_READ = 1
+POLL_WRITE = 2
+
+class Histogram(object):
+    """Tracks the distribution of a set of latencies."""
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            'counts': list(self.counts),
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+        }
+
+class EventLoopStats(object):
+    """Collects statistics about what the event loop is doing.
+
+    For each callback name, we keep histograms of how long the callback ran
+    and how long it waited before it ran.  For idles, the wait time is the
+    time since add_idle() was called.  For timeouts it's the time since the
+    timeout expired.
+
+    We also count the times the poller returned, and keep track of the idle
+    and urgent queue sizes at those times.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = clock()
+        # maps callback names -> (run time Histogram, wait time Histogram)
+        self.calls = {}
+        self.wakeups = 0
+        self.ready_fds = 0
+        self.queue_depths = {'idle': [0, 0], 'urgent': [0, 0]}
+
+    def record_call(self, name, wait_time, run_time):
+        if ' at 0x' in name:
+            # Names that include object reprs would give us a new entry for
+            # each object.
+            name = OBJECT_ADDRESS_RE.sub('', name)
+        try:
+            run_histogram, wait_histogram = self.calls[name]
+        except KeyError:
+            run_histogram, wait_histogram = self.calls[name] = (
+                Histogram(), Histogram())
+        run_histogram.add(run_time)
+        if wait_time is not None:
+            wait_histogram.add(wait_time)
+
+    def record_wakeup(self, ready_fds, idle_depth, urgent_depth):
+        self.wakeups += 1
+        self.ready_fds += ready_fds
+        for name, depth in (('idle', idle_depth), ('urgent', urgent_depth)):
+            depths = self.queue_depths[name]
+            depths[0] = max(depths[0], depth)
+            depths[1] += depth
+
+    def snapshot(self):
+        """Get our statistics as a dict of simple python objects.
+
+        The dict can be passed in a message or to format_stats().
+        """
+        calls = {}
+        for name, (run_histogram, wait_histogram) in self.calls.items():
+            calls[name] = {
+                'run': run_histogram.snapshot(),
+                'wait': wait_histogram.snapshot(),
+            }
+        queues = {}
+        for name, (max_depth, total_depth) in self.queue_depths.items():
+            queues[name] = {
+                'max': max_depth,
+                'mean': total_depth / float(max(self.wakeups, 1)),
+            }
+        return {
+            'duration': clock() - self.start_time,
+            'wakeups': self.wakeups,
+            'ready_fds': self.ready_fds,
+            'queues': queues,
+            'calls': calls,
+        }
+
+def format_stats(stats, limit=20):
+    """Format a dict returned by EventLoopStats.snapshot() for display.
+
+    :param limit: show this many callbacks with the most total run time
+    """
+    lines = []
+    duration = max(stats['duration'], 0.001)
+    lines.append('%.1f seconds, %d wakeups (%.1f/sec), %d ready sockets' % (
+        stats['duration'], stats['wakeups'], stats['wakeups'] / duration,
+        stats['ready_fds']))
+    for name in ('urgent', 'idle'):
+        lines.append('%s queue: max %d, mean %.1f' % (name,
+            stats['queues'][name]['max'], stats['queues'][name]['mean']))
+    bucket_labels = ['<%gs' % bound for bound in HISTOGRAM_BUCKETS]
+    bucket_labels.append('>%gs' % HISTOGRAM_BUCKETS[-1])
+    lines.append('')
+    lines.append('%-40s %7s %8s %8s %8s %8s' % ('callback', 'calls',
+        'total', 'max', 'wait', 'max wait'))
+    calls = sorted(stats['calls'].items(),
+                   key=lambda item: item[1]['run']['total'], reverse=True)
+    for name, call in calls[:limit]:
+        run = call['run']
+        wait = call['wait']
+        mean_wait = wait['total'] / max(wait['count'], 1)
+        lines.append('%-40.40s %7d %8.3f %8.3f %8.3f %8.3f' % (name,
+            run['count'], run['total'], run['max'], mean_wait, wait['max']))
+        histogram = ['%s: %d' % (label, count) for (label, count)
+                in zip(bucket_labels, run['counts']) if count]
+        lines.append('    ' + ', '.join(histogram))
+    return '\n'.join(lines)
+
+stats = EventLoopStats()
+
 class DelayedCall(object):
     def __init__(self, function, name, args, kwargs):
         self.function = function
@@ -61,6 +222,8 @@ class DelayedCall(object):
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        # time we can start running, used to calculate how long we waited
+        self.ready_time = clock()
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -81,6 +244,7 @@ class DelayedCall(object):
             success = trapcall.trap_call(when, self.function, *self.args,
                     **self.kwargs)
             end = clock()
+            stats.record_call(self.name, start - self.ready_time, end - start)
             if end-start > 0.5:
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
@@ -101,13 +265,16 @@ class Scheduler(object):
     def __init__(self):
         self.heap = []
 
-    def add_timeout(self, delay, function, name, args=None, kwargs=None):
+    def add_timeout(self, delay, function, name, args=None, kwargs=None,
+                    priority=PRIORITY_NORMAL):
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
         scheduled_time = clock() + delay
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
+        dc.ready_time = scheduled_time
+        dc.priority = priority
         heapq.heappush(self.heap, (scheduled_time, dc))
         return dc
 
@@ -124,6 +291,17 @@ class Scheduler(object):
         time, dc = heapq.heappop(self.heap)
         return dc.dispatch()
 
+    def pop_expired_timeouts(self):
+        """Remove the timeouts that are ready to run.
+
+        :returns: list of DelayedCalls
+        """
+        expired = []
+        now = clock()
+        while self.heap and self.heap[0][0] < now:
+            expired.append(heapq.heappop(self.heap)[1])
+        return expired
+
 class CallQueue(object):
     def __init__(self):
         self.queue = Queue.Queue()
@@ -152,6 +330,10 @@ class CallQueue(object):
 
         return dc
 
+    def put(self, dc):
+        """Add a DelayedCall to the queue."""
+        self.queue.put(dc)
+
     def process_next_idle(self):
         dc = self.queue.get()
         return dc.dispatch()
@@ -159,11 +341,116 @@ class CallQueue(object):
     def has_pending_idle(self):
         return not self.queue.empty()
 
+    def qsize(self):
+        return self.queue.qsize()
+
+    def process_idles(self):
+        # Note: used for testing purposes
+        while self.has_pending_idle() and not self.quit_flag:
+            self.process_next_idle()
+
+class PriorityCallQueue(object):
+    """Queue of idle calls, split up by priority class.
+
+    Inside a priority class, we take turns between the different callback
+    names, so that a burst of calls with one name doesn't delay everything
+    else.  Calls with the same name run in the order they were added.
+
+    This can be used from any thread.
+    """
+    def __init__(self):
+        self.quit_flag = False
+        self.lock = threading.Lock()
+        # maps priority -> _PriorityClassQueue
+        self.classes = dict((priority, _PriorityClassQueue())
+                            for priority in IDLE_TIME_BUDGETS)
+        self.priorities = sorted(IDLE_TIME_BUDGETS)
+        self.queue_size_warning_count = 0
+        self.size = 0
+
+    def add_idle(self, function, name, args=None, kwargs=None,
+                 priority=PRIORITY_NORMAL):
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+        self.put(dc, priority)
+
+        # See CallQueue.add_idle()
+        if self.queue_size_warning_count < 5 and self.size > 1000:
+            logging.stacktrace("Queued called size too large")
+            self.queue_size_warning_count += 1
+        return dc
+
+    def put(self, dc, priority=PRIORITY_NORMAL):
+        """Add a DelayedCall to the queue."""
+        with self.lock:
+            self.classes[priority].put(dc)
+            self.size += 1
+
+    def get(self, priority=None):
+        """Remove the next DelayedCall from the queue.
+
+        :param priority: priority class to get the call from.  If None, we
+            use the highest priority class that has calls.
+        :raises IndexError: no calls are pending
+        """
+        with self.lock:
+            if priority is None:
+                for priority in self.priorities:
+                    if self.classes[priority]:
+                        break
+            dc = self.classes[priority].get()
+            self.size -= 1
+            return dc
+
+    def process_next_idle(self, priority=None):
+        return self.get(priority).dispatch()
+
+    def has_pending_idle(self, priority=None):
+        if priority is None:
+            return self.size > 0
+        else:
+            return bool(self.classes[priority])
+
+    def qsize(self):
+        return self.size
+
     def process_idles(self):
         # Note: used for testing purposes
         while self.has_pending_idle() and not self.quit_flag:
             self.process_next_idle()
 
+class _PriorityClassQueue(object):
+    """Calls for a single priority class, for PriorityCallQueue."""
+    def __init__(self):
+        # maps names -> deque of DelayedCalls
+        self.calls = {}
+        # names that have calls, in the order that we take turns in
+        self.names = collections.deque()
+
+    def __nonzero__(self):
+        return bool(self.names)
+
+    def put(self, dc):
+        try:
+            self.calls[dc.name].append(dc)
+        except KeyError:
+            self.calls[dc.name] = collections.deque([dc])
+            self.names.append(dc.name)
+
+    def get(self):
+        name = self.names.popleft()
+        calls = self.calls[name]
+        dc = calls.popleft()
+        if calls:
+            # let the other names go before our next call
+            self.names.append(name)
+        else:
+            del self.calls[name]
+        return dc
+
 
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
@@ -233,6 +520,155 @@ class ThreadPool(object):
                 pass
         self.threads = []
 
+class SelectPoller(object):
+    """Poller that uses select().
+
+    This works everywhere, but it can only handle FD_SETSIZE file descriptors
+    and it has to build the fd lists on each call.  We only use it when
+    there's nothing better.
+
+    All pollers share the same interface: register() sets the events
+    (POLL_READ/POLL_WRITE) that we want to hear about for a file descriptor,
+    unregister() stops listening to a file descriptor and poll() waits for
+    events.
+    """
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        self.fds.pop(fd, None)
+
+    def poll(self, timeout):
+        """Wait for events.
+
+        :param timeout: seconds to wait, or None to wait forever
+        :returns: list of (fd, events) tuples
+        """
+        fds = self.fds.items()
+        readfds = [fd for fd, events in fds if events & POLL_READ]
+        writefds = [fd for fd, events in fds if events & POLL_WRITE]
+        read_ready, write_ready, exc_ready = select.select(readfds, writefds,
+                                                           [], timeout)
+        results = dict.fromkeys(read_ready, POLL_READ)
+        for fd in write_ready:
+            results[fd] = results.get(fd, 0) | POLL_WRITE
+        return results.items()
+
+    def close(self):
+        self.fds = {}
+
+class PollPoller(SelectPoller):
+    """Poller that uses poll().
+
+    poll() doesn't have the FD_SETSIZE limit, and the kernel keeps track of
+    the fd list for us.
+    """
+    def __init__(self):
+        SelectPoller.__init__(self)
+        self._poll = select.poll()
+        self._read_mask = select.POLLIN | select.POLLPRI
+        self._write_mask = select.POLLOUT
+        self._error_mask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def _native_events(self, events):
+        native = 0
+        if events & POLL_READ:
+            native |= self._read_mask
+        if events & POLL_WRITE:
+            native |= self._write_mask
+        return native
+
+    def _convert_results(self, results):
+        converted = []
+        for fd, native in results:
+            events = 0
+            if native & self._read_mask:
+                events |= POLL_READ
+            if native & self._write_mask:
+                events |= POLL_WRITE
+            if native & self._error_mask:
+                # let the callbacks see the error when they try to use the
+                # socket
+                events |= self.fds.get(fd, 0)
+            if events:
+                converted.append((fd, events))
+        return converted
+
+    def register(self, fd, events):
+        self._poll.register(fd, self._native_events(events))
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        if self.fds.pop(fd, None) is not None:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout_ms = -1
+        else:
+            # round up, otherwise short timeouts turn into busy loops
+            timeout_ms = int(math.ceil(timeout * 1000))
+        return self._convert_results(self._poll.poll(timeout_ms))
+
+class EpollPoller(PollPoller):
+    """Poller that uses epoll(), available on Linux.
+
+    Each wakeup only costs us for the file descriptors that are ready, rather
+    than for every file descriptor that we're watching.
+    """
+    def __init__(self):
+        SelectPoller.__init__(self)
+        self._poll = select.epoll()
+        self._read_mask = select.EPOLLIN | select.EPOLLPRI
+        self._write_mask = select.EPOLLOUT
+        self._error_mask = select.EPOLLERR | select.EPOLLHUP
+
+    def register(self, fd, events):
+        native = self._native_events(events)
+        try:
+            self._poll.modify(fd, native)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._poll.register(fd, native)
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        if self.fds.pop(fd, None) is None:
+            return
+        try:
+            self._poll.unregister(fd)
+        except (IOError, ValueError):
+            # The file descriptor was already closed, which removes it from
+            # the epoll set.
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self._convert_results(self._poll.poll(timeout))
+
+    def close(self):
+        SelectPoller.close(self)
+        self._poll.close()
+
+def make_poller():
+    """Create the best poller for this platform."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    # poll() is broken for some file types on OS X, and doesn't exist on
+    # windows.
+    elif hasattr(select, 'poll') and sys.platform != 'darwin':
+        return PollPoller()
+    else:
+        return SelectPoller()
+
+def _is_eintr(error):
+    return error.args and error.args[0] == errno.EINTR
+
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
         signals.SignalEmitter.__init__(self, 'thread-will-start',
@@ -242,6 +678,8 @@ class SimpleEventLoop(signals.SignalEmitter):
                                        'end-loop')
         self.quit_flag = False
         self.wake_sender, self.wake_receiver = util.make_dummy_socket_pair()
+        self.poller = make_poller()
+        self.poller.register(self.wake_receiver.fileno(), POLL_READ)
         self.loop_ready = threading.Event()
 
     def loop(self):
@@ -253,23 +691,30 @@ class SimpleEventLoop(signals.SignalEmitter):
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
             try:
-                read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
-            except select.error, (err, detail):
-                if err == errno.EINTR:
-                    logging.warning ("eventloop: %s", detail)
+                events = self.poller.poll(timeout)
+            except (select.error, IOError), e:
+                if _is_eintr(e):
+                    logging.warning ("eventloop: %s", e)
+                    events = []
                 else:
                     self.emit('end-loop')
                     raise
             if self.quit_flag:
                 self.emit('end-loop')
                 break
-            if self.wake_receiver.fileno() in read_fds_ready:
-                self._slurp_waker_data()
-            self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
+            read_fds_ready = []
+            write_fds_ready = []
+            wake_fd = self.wake_receiver.fileno()
+            for fd, flags in events:
+                if fd == wake_fd:
+                    self._slurp_waker_data()
+                    continue
+                if flags & POLL_READ:
+                    read_fds_ready.append(fd)
+                if flags & POLL_WRITE:
+                    write_fds_ready.append(fd)
+            self.process_events(read_fds_ready, write_fds_ready, [])
             self.emit('end-loop')
 
     def wakeup(self):
@@ -286,7 +731,7 @@ class EventLoop(SimpleEventLoop):
         SimpleEventLoop.__init__(self)
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
-        self.idle_queue = CallQueue()
+        self.idle_queue = PriorityCallQueue()
         self.urgent_queue = CallQueue()
         self.threadpool = ThreadPool(self)
         self.read_callbacks = {}
@@ -299,29 +744,61 @@ class EventLoop(SimpleEventLoop):
         self.removed_write_callbacks = set()
 
     def add_read_callback(self, sock, callback):
-        self.read_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.read_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_read_callback(self, sock):
-        del self.read_callbacks[sock.fileno()]
-        self.removed_read_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.read_callbacks[fd]
+        self.removed_read_callbacks.add(fd)
+        self._update_poller(fd)
 
     def add_write_callback(self, sock, callback):
-        self.write_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.write_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_write_callback(self, sock):
-        del self.write_callbacks[sock.fileno()]
-        self.removed_write_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.write_callbacks[fd]
+        self.removed_write_callbacks.add(fd)
+        self._update_poller(fd)
+
+    def _update_poller(self, fd):
+        events = 0
+        if fd in self.read_callbacks:
+            events |= POLL_READ
+        if fd in self.write_callbacks:
+            events |= POLL_WRITE
+        if events:
+            self.poller.register(fd, events)
+        else:
+            self.poller.unregister(fd)
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
         self.threadpool.queue_call(callback, errback, function, name,
                                   *args, **kwargs)
 
-    def run_idle_next_loop(self, function, name, args=None, kwargs=None):
+    def run_idle_next_loop(self, function, name, args=None, kwargs=None,
+                           priority=PRIORITY_NORMAL):
         """Add an idle callback to be called on the next event loop."""
-        self.idles_for_next_loop.append((function, name, args, kwargs))
+        self.idles_for_next_loop.append((function, name, args, kwargs,
+                                         priority))
+
+    def add_idle(self, function, name, args=None, kwargs=None,
+                 priority=PRIORITY_NORMAL):
+        if priority == PRIORITY_UI:
+            return self.urgent_queue.add_idle(function, name, args, kwargs)
+        else:
+            return self.idle_queue.add_idle(function, name, args, kwargs,
+                                            priority)
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
+        stats.record_wakeup(len(read_fds_ready) + len(write_fds_ready),
+                            self.idle_queue.qsize(),
+                            self.urgent_queue.qsize())
         self._process_urgent_events()
         if self.quit_flag:
             return
@@ -334,10 +811,13 @@ class EventLoop(SimpleEventLoop):
             if self.quit_flag:
                 break
 
-    def calc_fds(self):
-        return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
-
     def calc_timeout(self):
+        if (self.idle_queue.has_pending_idle() or
+                self.urgent_queue.has_pending_idle()):
+            # we ran out of time for idles last iteration, or an urgent
+            # call came in while we weren't looking.  Don't wait for
+            # sockets to do the rest.
+            return 0
         return self.scheduler.next_timeout()
 
     def do_begin_loop(self):
@@ -347,8 +827,8 @@ class EventLoop(SimpleEventLoop):
     def _add_idles_for_next_loop(self):
         if not self.idles_for_next_loop:
             return
-        for func, name, args, kwargs in self.idles_for_next_loop:
-            self.idle_queue.add_idle(func, name, args, kwargs)
+        for func, name, args, kwargs, priority in self.idles_for_next_loop:
+            self.add_idle(func, name, args, kwargs, priority)
         self.idles_for_next_loop = []
         # call wakeup() to make sure we process the idles we just
         # added
@@ -365,6 +845,10 @@ class EventLoop(SimpleEventLoop):
         dealt with on this iteration of the event loop.  This includes
         all socket read/write callbacks, timeouts and idle calls.
 
+        Expired timeouts get added to the idle queues for their priority.
+        Idles run until each priority class uses up its time budget from
+        IDLE_TIME_BUDGETS.  Anything left over runs on the next iteration.
+
         "events" are implemented as functions that should be called
         with no arguments.
         """
@@ -376,10 +860,23 @@ class EventLoop(SimpleEventLoop):
                                                self.read_callbacks,
                                                self.removed_read_callbacks):
             yield callback
-        while self.scheduler.has_pending_timeout():
-            yield self.scheduler.process_next_timeout
-        while self.idle_queue.has_pending_idle():
-            yield self.idle_queue.process_next_idle
+        for dc in self.scheduler.pop_expired_timeouts():
+            if dc.priority == PRIORITY_UI:
+                self.urgent_queue.put(dc)
+            else:
+                self.idle_queue.put(dc, dc.priority)
+        # Run UI timeouts that just expired now.  If we don't yield any
+        # events below, nothing else would get to them this iteration.
+        self._process_urgent_events()
+        if self.quit_flag:
+            return
+        for priority in self.idle_queue.priorities:
+            budget = IDLE_TIME_BUDGETS[priority]
+            start = clock()
+            while self.idle_queue.has_pending_idle(priority):
+                yield lambda: self.idle_queue.process_next_idle(priority)
+                if clock() - start > budget:
+                    break
 
     def generate_callbacks(self, ready_list, map_, removed):
         for fd in ready_list:
@@ -394,9 +891,13 @@ class EventLoop(SimpleEventLoop):
                     continue
                 when = "While talking to the network"
                 def callback_event():
+                    start = clock()
                     success = trapcall.trap_call(when, function)
+                    stats.record_call(_socket_callback_name(function), None,
+                                      clock() - start)
                     if not success:
                         del map_[fd]
+                        self._update_poller(fd)
                     return success
                 yield callback_event
 
@@ -405,6 +906,13 @@ class EventLoop(SimpleEventLoop):
         self.idle_queue.quit_flag = True
         self.urgent_queue.quit_flag = True
 
+def _socket_callback_name(function):
+    try:
+        return "socket (%s.%s)" % (function.im_class.__name__,
+                                   function.__name__)
+    except AttributeError:
+        return "socket (%s)" % getattr(function, '__name__', function)
+
 _eventloop = EventLoop()
 
 def add_read_callback(sock, callback):
@@ -446,21 +954,30 @@ def stop_handling_socket(sock):
     except KeyError:
         pass
 
-def add_timeout(delay, function, name, args=None, kwargs=None):
+def add_timeout(delay, function, name, args=None, kwargs=None,
+                priority=PRIORITY_NORMAL):
     """Schedule a function to be called at some point in the future.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    Once the delay is over, the call gets scheduled like an idle with
+    the same priority.
     """
-    dc = _eventloop.scheduler.add_timeout(delay, function, name, args, kwargs)
+    dc = _eventloop.scheduler.add_timeout(delay, function, name, args, kwargs,
+                                          priority)
     _eventloop.wakeup()
     return dc
 
-def add_idle(function, name, args=None, kwargs=None):
+def add_idle(function, name, args=None, kwargs=None,
+             priority=PRIORITY_NORMAL):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    priority is one of PRIORITY_UI, PRIORITY_NORMAL or PRIORITY_BACKGROUND.
+    PRIORITY_UI is the same as using add_urgent_call().
     """
-    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.add_idle(function, name, args, kwargs, priority)
     _eventloop.wakeup()
     return dc
 
@@ -468,6 +985,8 @@ def add_urgent_call(function, name, args=None, kwargs=None):
     """Schedule a function to be called as soon as possible.  This
     method should be used for things like GUI actions, where the user
     is waiting on us.
+
+    This is the same as calling add_idle() with priority=PRIORITY_UI.
     """
     dc = _eventloop.urgent_queue.add_idle(function, name, args, kwargs)
     _eventloop.wakeup()
@@ -32,7 +32,10 @@
 FIXME - talk about Feed architecture here
 """
 
+import collections
+import hashlib
 import os
+import random
 import re
 import time
 import xml
@@ -56,6 +59,7 @@ from miro import databaselog
 from miro import dialogs
 from miro import download_utils
 from miro import eventloop
+from miro import feeddiff
 from miro import feedupdate
 from miro import models
 from miro import prefs
@@ -68,7 +72,7 @@ from miro import fileutil
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
 from miro.plat.filebundle import is_file_bundle
 from miro import filetypes
-from miro.item import FeedParserValues
+from miro.item import FeedParserValues, item_content_key
 from miro import searchengines
 from miro import workerprocess
 from miro.clock import clock
@@ -88,27 +92,9 @@ def default_feed_icon_url():
 def default_feed_icon_path():
     return resources.path(DEFAULT_FEED_ICON)
 
-class _RateLimiter(object):
-    """Helper class used by create_items_for_parsed() to avoid hogging the
-    GIL.
-
-    This class helps ensure that a potentially long-running operation doesn't
-    take more than a fixed-percentage of the CPU.  It's not really a great
-    solution, but it's the simplest way for 4.0.2
-    """
-    def __init__(self):
-        self.last_time = time.time()
-
-    def check_for_sleep(self):
-        elapsed = self.last_time - time.time()
-        if elapsed < 0.1:
-            return # don't sleep until a decent of time has passed.
-        # We want to yield at least 10% of the CPU.  Sleep for 10% of the time
-        # we took since the last check
-        sleep_time = elapsed / 10.0
-        time.sleep(sleep_time)
-        # get ready for the next check() call
-        self.last_time = time.time()
+# create_items_for_parsed() works in chunks that take about this many
+# seconds, then lets other idle callbacks run.
+MERGE_CHUNK_TIME = 0.1
 
 # Notes on character set encoding of feeds:
 #
@@ -226,21 +212,91 @@ def _on_config_change(obj, key, value):
                 pass
             feed.set_update_frequency(update_freq)
 
-def run_feedparser(html, callback, errback):
+def run_feed_diff(html, item_keys, callback, errback, body_path=None,
+                  charset=None):
+    """Parse feed data and compare it to the items we have.
+
+    callback gets passed a feeddiff.FeedDiff.  The feed gets parsed in the
+    worker process, unless _RUN_FEED_PARSER_INLINE is set.
+
+    :param html: feed data.  Ignored if body_path is given.
+    :param item_keys: snapshot of the feed's items from
+        feeddiff.item_keys()
+    :param body_path: file holding the feed data, from grab_url() with
+        spool_threshold.  We delete the file once we're done with it.
+    :param charset: charset for the data in body_path
+    """
     if _RUN_FEED_PARSER_INLINE:
         try:
-            rv = feedparserutil.parse(html)
+            if body_path is not None:
+                try:
+                    html = feedparserutil.read_feed_file(body_path, charset)
+                finally:
+                    _remove_body_file(body_path)
+            rv = feeddiff.diff_feed(feedparserutil.parse(html), item_keys)
         except StandardError, e:
             errback(e)
         else:
             callback(rv)
     else:
-        workerprocess.send(workerprocess.FeedparserTask(html),
-                           lambda msg, result: callback(result),
-                           lambda msg, error: errback(error))
+        def task_callback(msg, result):
+            _remove_body_file(body_path)
+            callback(result)
+        def task_errback(msg, error):
+            _remove_body_file(body_path)
+            errback(error)
+        task = workerprocess.FeedDiffTask(item_keys, html, body_path,
+                                          charset)
+        workerprocess.send(task, task_callback, task_errback)
+
+def _remove_body_file(body_path):
+    if body_path is None:
+        return
+    try:
+        fileutil.remove(body_path)
+    except OSError, e:
+        logging.warn("error removing feed data file: %s", e)
+
+def _hash_feed_data(info):
+    """Get a hash of the body from a grab_url() info dict."""
+    body_hash = hashlib.sha1()
+    body_path = info.get('body_path')
+    if body_path is None:
+        body_hash.update(info['body'])
+    else:
+        f = open(body_path, 'rb')
+        try:
+            while True:
+                data = f.read(FEED_SPOOL_THRESHOLD)
+                if not data:
+                    break
+                body_hash.update(data)
+        finally:
+            f.close()
+    return unicode(body_hash.hexdigest())
+
+def _feed_data_from_info(info):
+    """Get the feed data from a grab_url() info dict.
+
+    :returns: (html, body_path) tuple.  html is None if the data was spooled
+        to a file.
+    """
+    body_path = info.get('body_path')
+    if body_path is not None:
+        return None, body_path
+    html = info['body']
+    if info.has_key('charset'):
+        html = fix_xml_header(html, info['charset'])
+    return html, None
 
 # Wait X seconds before updating the feeds at startup
 INITIAL_FEED_UPDATE_DELAY = 5.0
+# Then spread the startup updates out over this many seconds, so they don't
+# all hit the update queue at once
+INITIAL_FEED_UPDATE_JITTER = 60.0
+# Feeds bigger than this many bytes get written to a temporary file while
+# we download them, then parsed from there.
+FEED_SPOOL_THRESHOLD = 64 * 1024
 
 class FeedImpl(DDBObject):
     """Actual implementation of a basic feed.
@@ -571,7 +627,8 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             self.loading = True
             eventloop.add_idle(lambda: self.generate_feed(True), "generate_feed")
         else:
-            self.schedule_update_events(INITIAL_FEED_UPDATE_DELAY)
+            self.schedule_update_events(INITIAL_FEED_UPDATE_DELAY +
+                    random.uniform(0, INITIAL_FEED_UPDATE_JITTER))
 
     def clean_old_items(self):
         if self.actualFeed:
@@ -1170,6 +1227,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         finally:
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
+        feedupdate.forget_feed(self)
         DDBObject.remove(self)
         self.actualFeed.remove()
         if self.in_folder():
@@ -1208,8 +1266,11 @@ class ThrottledUpdateFeedImpl(FeedImpl):
                     self.update)
         else:
             if self.updateFreq > 0:
-                feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                # updateFreq is the shortest time between updates.  The
+                # feed's history decides how much longer we wait.
+                delay = feedupdate.calc_update_interval(self.ufeed,
+                        self.updateFreq)
+                feedupdate.schedule_update(delay, self.ufeed, self.update)
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
@@ -1217,8 +1278,15 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
     def setup_new(self, url, ufeed, title):
         FeedImpl.setup_new(self, url, ufeed, title)
+        self.pending_merges = collections.deque()
+        self.merge_generation = 0
         self.schedule_update_events(0)
 
+    def setup_restored(self):
+        FeedImpl.setup_restored(self)
+        self.pending_merges = collections.deque()
+        self.merge_generation = 0
+
     def _handle_new_entry(self, entry, fp_values, channel_title):
         """Handle getting a new entry from a feed."""
         enclosure = fp_values.first_video_enclosure
@@ -1235,18 +1303,58 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                 item.remove()
 
     def remember_old_items(self):
-        self.old_items = set(self.items)
+        self.old_items = dict((item.id, item) for item in self.items)
 
-    def create_items_for_parsed(self, parsed):
-        """Update the feed using parsed XML passed in"""
-        app.bulk_sql_manager.start()
+    def _item_keys(self):
+        """Get the feeddiff.item_keys() snapshot for our items."""
+        return feeddiff.item_keys(
+                models.Item.feed_content_keys(self.ufeed_id))
+
+    def create_items_for_parsed(self, diff, callback):
+        """Update the feed using a feeddiff.FeedDiff
+
+        The work happens in idle callbacks, in chunks of about
+        MERGE_CHUNK_TIME seconds.  If we're already working on another
+        feed diff, we start on this one after that's done.
+
+        :param callback: function to call with the number of new entries
+            in diff once we're done.  It isn't called if the feed gets
+            removed first.
+        """
+        self.pending_merges.append((diff, callback, self.merge_generation))
+        if len(self.pending_merges) == 1:
+            self._start_next_merge()
+
+    def cancel_merges(self):
+        """Stop creating items for the parsed feeds that we have now.
+
+        Their callbacks won't be called.
+        """
+        self.merge_generation += 1
+
+    def _start_next_merge(self):
+        eventloop.idle_iterate(self._create_items_for_parsed,
+                "Create items for feed (%s)" % self.url,
+                args=self.pending_merges[0])
+
+    def _create_items_for_parsed(self, diff, callback, generation):
         try:
-            self._create_items_for_parsed(parsed)
+            for step in self._merge_entries(diff, callback, generation):
+                yield step
         finally:
-            app.bulk_sql_manager.finish()
+            self.pending_merges.popleft()
+            if self.pending_merges and self.ufeed.id_exists():
+                self._start_next_merge()
+
+    def _should_stop_merge(self, generation):
+        return (generation != self.merge_generation or
+                not self.ufeed.id_exists())
 
-    def _create_items_for_parsed(self, parsed):
-        rate_limiter = _RateLimiter()
+    def _merge_entries(self, diff, callback, generation):
+        if self._should_stop_merge(generation):
+            return
+        start = clock()
+        parsed = diff.parsed
         channel_title = None
         try:
             channel_title = parsed["feed"]["title"]
@@ -1275,55 +1383,73 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                 self.thumbURL = image_url
                 self.ufeed.icon_cache.request_update(is_vital=True)
 
-        items_byid = {}
-        items_byURLTitle = {}
-        items_nokey = []
-        for item in self.items:
-            rate_limiter.check_for_sleep()
+        new_entry_count = 0
+        # diff doesn't know about items created after its snapshot was
+        # taken, for example by the merge for another feed in a
+        # RSSMultiFeed.  Check new entries against those.
+        recent_items = models.Item.make_view('feed_id=? AND id>?',
+                (self.ufeed_id, diff.last_item_id))
+        recent_index = feeddiff.EntryIndex((item, item_content_key(item))
+                                           for item in recent_items)
+        entries = diff.entries
+        pos = 0
+        busy_time = 0.0
+        while True:
+            app.bulk_sql_manager.start()
             try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
-            by_url_title_key = (item.url, item.entry_title)
-            if by_url_title_key != (None, None):
-                items_byURLTitle[by_url_title_key] = item
-        for entry in parsed.entries:
-            rate_limiter.check_for_sleep()
-            entry = self.add_scraped_thumbnail(entry)
-            fp_values = FeedParserValues(entry)
-            new = True
-            if fp_values.data['rss_id'] is not None:
-                id_ = fp_values.data['rss_id']
-                if items_byid.has_key(id_):
-                    item = items_byid[id_]
-                    if not fp_values.compare_to_item(item):
-                        item.update_from_feed_parser_values(fp_values)
-                    new = False
-                    self.old_items.discard(item)
-            if new:
-                by_url_title_key = (fp_values.data['url'],
-                        fp_values.data['entry_title'])
-                if by_url_title_key != (None, None):
-                    if items_byURLTitle.has_key(by_url_title_key):
-                        item = items_byURLTitle[by_url_title_key]
-                        if not fp_values.compare_to_item(item):
-                            item.update_from_feed_parser_values(fp_values)
-                        new = False
-                        self.old_items.discard(item)
-            if new:
-                for item in items_nokey:
-                    if fp_values.compare_to_item(item):
-                        new = False
-                    else:
-                        try:
-                            if fp_values.compare_to_item_enclosures(item):
-                                item.update_from_feed_parser_values(fp_values)
-                                new = False
-                                self.old_items.discard(item)
-                        except StandardError:
-                            pass
-            if new and fp_values.first_video_enclosure is not None:
-                self._handle_new_entry(entry, fp_values, channel_title)
+                while pos < len(entries):
+                    if self._merge_entry(entries[pos], recent_index,
+                                         channel_title):
+                        new_entry_count += 1
+                    pos += 1
+                    if clock() - start > MERGE_CHUNK_TIME:
+                        break
+            finally:
+                app.bulk_sql_manager.finish()
+            busy_time += clock() - start
+            if pos >= len(entries):
+                break
+            yield
+            if self._should_stop_merge(generation):
+                return
+            start = clock()
+        if busy_time > 1.0:
+            logging.timing("creating items for %s too slow (%.3f secs)",
+                           self.url, busy_time)
+        callback(new_entry_count)
+
+    def _merge_entry(self, entry, recent_index, channel_title):
+        """Apply one of the entries from a FeedDiff.
+
+        :returns: True if we created a new item
+        """
+        status, item_id, fp_values = entry
+        if status == feeddiff.ENTRY_NEW:
+            item = recent_index.find(fp_values.content_key())
+        else:
+            item = self._get_old_item(item_id)
+        if item is not None:
+            # the item might have been removed while we were waiting to
+            # run our next chunk
+            if item.id_exists():
+                if (fp_values is not None and
+                        not fp_values.compare_to_item(item)):
+                    item.update_from_feed_parser_values(fp_values)
+                self.old_items.pop(item.id, None)
+            return False
+        if status != feeddiff.ENTRY_NEW:
+            return False
+        self._handle_new_entry(fp_values.entry, fp_values, channel_title)
+        return True
+
+    def _get_old_item(self, item_id):
+        try:
+            return self.old_items[item_id]
+        except KeyError:
+            try:
+                return models.Item.get_by_id(item_id)
+            except ObjectNotFoundError:
+                return None
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1382,23 +1508,13 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
             return
 
         candidates = []
-        for item in self.old_items:
+        for item in self.old_items.itervalues():
             if item.downloader is None:
                 candidates.append((item.creationTime, item))
         candidates.sort()
         for time_, item in candidates[:extra]:
             item.remove()
 
-    def add_scraped_thumbnail(self, entry):
-        # skip this if the entry already has a thumbnail.
-        if entry.has_key('thumbnail'):
-            return entry
-        if entry.has_key('enclosures'):
-            for enc in entry['enclosures']:
-                if enc.has_key('thumbnail'):
-                    return entry
-        return entry
-
 class RSSFeedImpl(RSSFeedImplBase):
     def setup_new(self, url, ufeed, title=None, initialHTML=None, etag=None,
                   modified=None):
@@ -1407,6 +1523,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.etag = etag
         self.modified = modified
         self.download = None
+        self.pending_body_hash = None
 
     @returns_unicode
     def get_base_href(self):
@@ -1434,20 +1551,27 @@ class RSSFeedImpl(RSSFeedImplBase):
         if not self.ufeed.id_exists():
             return
         logging.warning("Error updating feed: %s: %s", self.url, e)
+        self.pending_body_hash = None
         self.feedparser_finished()
 
-    def feedparser_callback(self, parsed):
+    def feedparser_callback(self, diff):
         self.ufeed.confirm_db_thread()
         if not self.ufeed.id_exists():
             return
-        if len(parsed.entries) == len(parsed.feed) == 0:
+        if diff.entry_count == len(diff.parsed.feed) == 0:
             logging.warn("Empty feed, not updating: %s", self.url)
+            self.pending_body_hash = None
             self.feedparser_finished()
             return
-        start = clock()
-        self.parsed = parsed
+        self.parsed = diff.parsed
         self.remember_old_items()
-        self.create_items_for_parsed(parsed)
+        self.create_items_for_parsed(diff, self._items_created)
+
+    def _items_created(self, new_entry_count):
+        feedupdate.record_update_result(self.ufeed, new_entry_count)
+        if self.pending_body_hash is not None:
+            feedupdate.record_body_hash(self.ufeed, *self.pending_body_hash)
+            self.pending_body_hash = None
 
         try:
             updateFreq = self.parsed["feed"]["ttl"]
@@ -1456,15 +1580,12 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.set_update_frequency(updateFreq)
 
         self.feedparser_finished()
-        end = clock()
-        if end - start > 1.0:
-            logging.timing("feed update for: %s too slow (%.3f secs)",
-                           self.url, end - start)
 
-    def call_feedparser(self, html):
+    def call_feedparser(self, html, body_path=None, charset=None):
         self.ufeed.confirm_db_thread()
-        run_feedparser(html, self.feedparser_callback,
-                self.feedparser_errback)
+        run_feed_diff(html, self._item_keys(),
+                self.feedparser_callback, self.feedparser_errback,
+                body_path, charset)
 
     def update(self):
         """Updates a feed
@@ -1493,7 +1614,8 @@ class RSSFeedImpl(RSSFeedImplBase):
             logging.debug("updating %s", self.url)
             self.download = grab_url(self.url, self._update_callback,
                     self._update_errback, etag=etag, modified=modified,
-                                    default_mime_type=u'application/rss+xml')
+                                    default_mime_type=u'application/rss+xml',
+                                    spool_threshold=FEED_SPOOL_THRESHOLD)
 
     def _update_errback(self, error):
         if not self.ufeed.id_exists():
@@ -1506,17 +1628,18 @@ class RSSFeedImpl(RSSFeedImplBase):
 
     def _update_callback(self, info):
         if not self.ufeed.id_exists():
+            _remove_body_file(info.get('body_path'))
             return
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            feedupdate.record_update_result(self.ufeed, 0, not_modified=True)
             self.schedule_update_events(-1)
             self.updating = False
             self.ufeed.signal_change()
             return
-        html = info['body']
-        if info.has_key('charset'):
-            html = fix_xml_header(html, info['charset'])
+        body_hash = _hash_feed_data(info)
+        request_url = self.url
 
         # FIXME HTML can be non-unicode here --NN
         self.url = unicodify(info['updated-url'])
@@ -1528,7 +1651,20 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
-        self.call_feedparser(html)
+        if feedupdate.check_body_hash(self.ufeed, request_url, body_hash):
+            # Same bytes as the last time we parsed the feed, so parsing it
+            # again won't give us anything new.  Treat it like a 304.
+            logging.debug("RSSFeedImpl: _update_callback: "
+                          "body unchanged (%s)", self.ufeed)
+            _remove_body_file(info.get('body_path'))
+            feedupdate.record_update_result(self.ufeed, 0)
+            self.schedule_update_events(-1)
+            self.updating = False
+            self.ufeed.signal_change()
+            return
+        self.pending_body_hash = (request_url, body_hash)
+        html, body_path = _feed_data_from_info(info)
+        self.call_feedparser(html, body_path, info.get('charset'))
 
     @returns_unicode
     def get_license(self):
@@ -1548,12 +1684,14 @@ class RSSFeedImpl(RSSFeedImplBase):
     def setup_restored(self):
         """Called by pickle during deserialization
         """
-        FeedImpl.setup_restored(self)
+        RSSFeedImplBase.setup_restored(self)
         self.download = None
+        self.pending_body_hash = None
 
     def clean_old_items(self):
         self.modified = None
         self.etag = None
+        feedupdate.forget_body_hashes(self.ufeed)
         self.update()
 
 class RSSMultiFeedBase(RSSFeedImplBase):
@@ -1563,6 +1701,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         self.modified = {}
         self.download_dc = {}
         self.updating = 0
+        self.new_entry_count = 0
+        self.pending_body_hashes = {}
         self.urls = self.calc_urls()
 
     def setup_restored(self):
@@ -1571,6 +1711,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         RSSFeedImplBase.setup_restored(self)
         self.download_dc = {}
         self.updating = 0
+        self.new_entry_count = 0
+        self.pending_body_hashes = {}
         self.urls = self.calc_urls()
 
     def calc_urls(self):
@@ -1582,6 +1724,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
 
     def check_update_finished(self):
         if self.updating == 0:
+            feedupdate.record_update_result(self.ufeed,
+                    self.new_entry_count)
             self.update_finished()
             self.schedule_update_events(-1)
 
@@ -1591,6 +1735,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
     def feedparser_finished(self, url, needs_save=False):
         if not self.ufeed.id_exists():
             return
+        self.pending_body_hashes.pop(url, None)
         self.updating -= 1
         self.check_update_finished()
         del self.download_dc[url]
@@ -1606,23 +1751,29 @@ class RSSMultiFeedBase(RSSFeedImplBase):
                             self.url, url)
         self.feedparser_finished(url, True)
 
-    def feedparser_callback(self, parsed, url):
+    def feedparser_callback(self, diff, url):
         self.ufeed.confirm_db_thread()
         if not self.ufeed.id_exists() or url not in self.download_dc:
             return
-        start = clock()
-        self.create_items_for_parsed(parsed)
+        self.create_items_for_parsed(diff,
+                lambda count, url=url: self._items_created(count, url))
+
+    def _items_created(self, new_entry_count, url):
+        if url not in self.download_dc:
+            # downloads were canceled while we were creating items
+            return
+        self.new_entry_count += new_entry_count
+        if url in self.pending_body_hashes:
+            feedupdate.record_body_hash(self.ufeed, url,
+                    self.pending_body_hashes[url])
         self.feedparser_finished(url)
-        end = clock()
-        if end - start > 1.0:
-            logging.timing("feed update for: %s too slow (%.3f secs)",
-                           self.url, end - start)
 
-    def call_feedparser(self, html, url):
+    def call_feedparser(self, html, url, body_path=None, charset=None):
         self.ufeed.confirm_db_thread()
-        run_feedparser(html,
-            lambda parsed, url=url: self.feedparser_callback(parsed, url),
-            lambda e, url=url: self.feedparser_errback(e, url))
+        run_feed_diff(html, self._item_keys(),
+            lambda diff, url=url: self.feedparser_callback(diff, url),
+            lambda e, url=url: self.feedparser_errback(e, url),
+            body_path, charset)
 
     def update(self):
         self.ufeed.confirm_db_thread()
@@ -1631,6 +1782,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         if self.updating:
             return
         self.remember_old_items()
+        self.new_entry_count = 0
         for url in self.urls:
             etag = self.etag.get(url)
             modified = self.modified.get(url)
@@ -1639,7 +1791,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
                 lambda x, url=url: self._update_callback(x, url),
                 lambda x, url=url: self._update_errback(x, url),
                 etag=etag, modified=modified,
-                default_mime_type=u'application/rss+xml',)
+                default_mime_type=u'application/rss+xml',
+                spool_threshold=FEED_SPOOL_THRESHOLD)
             self.updating += 1
         self.ufeed.signal_change(needs_save=False)
 
@@ -1655,6 +1808,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
 
     def _update_callback(self, info, url):
         if not self.ufeed.id_exists():
+            _remove_body_file(info.get('body_path'))
             return
         if info.get('status') == 304:
             logging.debug("RSSMultiFeedBase: _update_callback: "
@@ -1664,9 +1818,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             self.check_update_finished()
             self.ufeed.signal_change()
             return
-        html = info['body']
-        if info.has_key('charset'):
-            html = fix_xml_header(html, info['charset'])
+        body_hash = _hash_feed_data(info)
 
         # FIXME HTML can be non-unicode here --NN
         if info.get('updated-url') and url in self.urls:
@@ -1681,7 +1833,18 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             self.modified[url] = unicodify(info['last-modified'])
         else:
             self.modified[url] = None
-        self.call_feedparser(html, url)
+        if feedupdate.check_body_hash(self.ufeed, url, body_hash):
+            logging.debug("RSSMultiFeedBase: _update_callback: "
+                          "body unchanged (%s)", self.ufeed)
+            _remove_body_file(info.get('body_path'))
+            self.download_dc.pop(url, None)
+            self.updating -= 1
+            self.check_update_finished()
+            self.ufeed.signal_change()
+            return
+        self.pending_body_hashes[url] = body_hash
+        html, body_path = _feed_data_from_info(info)
+        self.call_feedparser(html, url, body_path, info.get('charset'))
 
     def on_remove(self):
         self._cancel_all_downloads()
@@ -1691,10 +1854,12 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             dc.cancel()
         self.download_dc = {}
         self.updating = 0
+        self.cancel_merges()
 
     def clean_old_items(self):
         self.modified = {}
         self.etag = {}
+        feedupdate.forget_body_hashes(self.ufeed)
         self.update()
 
 class SavedSearchFeedImpl(RSSMultiFeedBase):
@@ -2445,6 +2610,7 @@ class SearchFeedImpl(RSSMultiFeedBase):
         self.query = u''
         self.etag = {}
         self.modified = {}
+        feedupdate.forget_body_hashes(self.ufeed)
         self.ufeed.icon_cache.reset()
         self.thumbURL = None
         self.ufeed.icon_cache.request_update(is_vital=True)
@@ -2704,7 +2870,8 @@ def expire_items():
         for feed in Feed.make_view():
             feed.expire_items()
     finally:
-        eventloop.add_timeout(300, expire_items, "Expire Items")
+        eventloop.add_timeout(300, expire_items, "Expire Items",
+                              priority=eventloop.PRIORITY_BACKGROUND)
 
 def lookup_feed(url, search_term=None):
     try:
@@ -0,0 +1,190 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""feeddiff.py -- Match up feed entries with the items we already have.
+
+diff_feed() takes a parsed feed and a snapshot of a feed's items and
+figures out which entries are new, which update an existing item and
+which are unchanged.  It doesn't touch the database, so it can run in the
+worker process.  The backend then only has to apply the changes.
+
+The snapshot is a list of (item_id, key) tuples from item_keys().  Keys
+are FeedParserValues.content_key() tuples with the description replaced
+by a hash of it, since descriptions can be large and we only need to
+compare them.
+"""
+
+import hashlib
+
+from miro.feedparserutil import (FeedParserValues, CONTENT_KEYS,
+                                 ENCLOSURE_KEYS)
+
+# values for the status field of FeedDiff.entries
+ENTRY_NEW = 'new'
+ENTRY_UPDATED = 'updated'
+ENTRY_UNCHANGED = 'unchanged'
+
+_RSS_ID_INDEX = CONTENT_KEYS.index('rss_id')
+_URL_INDEX = CONTENT_KEYS.index('url')
+_TITLE_INDEX = CONTENT_KEYS.index('entry_title')
+_DESCRIPTION_INDEX = CONTENT_KEYS.index('entry_description')
+_ENCLOSURE_INDEXES = tuple(CONTENT_KEYS.index(key) for key in ENCLOSURE_KEYS)
+
+def compact_content_key(content_key):
+    """Replace the description in a content key with a hash of it."""
+    description = content_key[_DESCRIPTION_INDEX]
+    if description is None:
+        return content_key
+    if isinstance(description, unicode):
+        description = description.encode('utf-8')
+    return (content_key[:_DESCRIPTION_INDEX] +
+            (hashlib.sha1(description).hexdigest(),) +
+            content_key[_DESCRIPTION_INDEX+1:])
+
+def item_keys(content_keys):
+    """Get a snapshot of items to pass to diff_feed().
+
+    :param content_keys: list of (item_id, content_key) tuples, from
+        Item.feed_content_keys()
+    """
+    return [(item_id, compact_content_key(content_key))
+            for item_id, content_key in content_keys]
+
+class EntryIndex(object):
+    """Index of content keys, for matching them up with feed entries.
+
+    We look up keys by rss_id, then by (url, title).  Keys without an
+    rss_id are also indexed by the whole key and by the values that
+    FeedParserValues.compare_to_item_enclosures() checks.  Matching an
+    entry is a few dict lookups, no matter how many keys we have.
+
+    :param pairs: list of (value, content_key) tuples.  find() returns
+        the value for the key that matches.
+    """
+    def __init__(self, pairs):
+        self.by_id = {}
+        self.by_url_title = {}
+        self.keyless_by_content = {}
+        self.keyless_by_enclosure = {}
+        for value, content_key in pairs:
+            self.add(value, content_key)
+
+    def add(self, value, content_key):
+        rss_id = content_key[_RSS_ID_INDEX]
+        url = content_key[_URL_INDEX]
+        if rss_id is not None:
+            self.by_id[rss_id] = value
+        else:
+            try:
+                self.keyless_by_content.setdefault(content_key, value)
+            except TypeError:
+                pass # unhashable value, we can still match it other ways
+            if url is not None:
+                self.keyless_by_enclosure.setdefault(
+                        _enclosure_key(content_key), value)
+        by_url_title_key = (url, content_key[_TITLE_INDEX])
+        if by_url_title_key != (None, None):
+            self.by_url_title[by_url_title_key] = value
+
+    def find(self, content_key):
+        """Find the value for the key that matches content_key.
+
+        :returns: a value passed to add(), or None if nothing matches
+        """
+        rss_id = content_key[_RSS_ID_INDEX]
+        if rss_id is not None and rss_id in self.by_id:
+            return self.by_id[rss_id]
+        url = content_key[_URL_INDEX]
+        by_url_title_key = (url, content_key[_TITLE_INDEX])
+        if (by_url_title_key != (None, None) and
+                by_url_title_key in self.by_url_title):
+            return self.by_url_title[by_url_title_key]
+        try:
+            return self.keyless_by_content[content_key]
+        except (KeyError, TypeError):
+            pass
+        if url is not None:
+            return self.keyless_by_enclosure.get(_enclosure_key(content_key))
+        return None
+
+def _enclosure_key(content_key):
+    return tuple(content_key[i] for i in _ENCLOSURE_INDEXES)
+
+class FeedDiff(object):
+    """Result of diff_feed().
+
+    :attribute parsed: the parsed feed, without its entries
+    :attribute entry_count: number of entries in the feed
+    :attribute entries: list of (status, item_id, fp_values) tuples, in
+        feed order.  status is one of the ENTRY_* constants.  item_id is
+        None for new entries and fp_values is None for unchanged ones.
+        Entries without a video enclosure that don't match an item are
+        left out.
+    :attribute last_item_id: largest item id in the snapshot.  Items
+        with a larger id were created after the snapshot was taken.
+    """
+    def __init__(self, parsed, entry_count, entries, last_item_id):
+        self.parsed = parsed
+        self.entry_count = entry_count
+        self.entries = entries
+        self.last_item_id = last_item_id
+
+    def count(self, status):
+        """Count the entries with a given status."""
+        return len([e for e in self.entries if e[0] == status])
+
+def diff_feed(parsed, item_keys):
+    """Compare the entries in a parsed feed to a snapshot of our items.
+
+    :param parsed: result of feedparserutil.parse().  Its entries list
+        gets emptied.
+    :param item_keys: snapshot from item_keys()
+    :returns: FeedDiff
+    """
+    index = EntryIndex(((item_id, key), key) for item_id, key in item_keys)
+    entries = []
+    for entry in parsed.entries:
+        fp_values = FeedParserValues(entry)
+        key = compact_content_key(fp_values.content_key())
+        match = index.find(key)
+        if match is not None:
+            item_id, item_key = match
+            if item_key == key:
+                entries.append((ENTRY_UNCHANGED, item_id, None))
+            else:
+                entries.append((ENTRY_UPDATED, item_id, fp_values))
+        elif fp_values.first_video_enclosure is not None:
+            entries.append((ENTRY_NEW, None, fp_values))
+    entry_count = len(parsed.entries)
+    parsed['entries'] = []
+    if item_keys:
+        last_item_id = max(item_id for item_id, key in item_keys)
+    else:
+        last_item_id = 0
+    return FeedDiff(parsed, entry_count, entries, last_item_id)
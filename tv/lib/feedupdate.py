@@ -30,22 +30,298 @@
 """feedupdate.py -- Handles updating feeds.
 
 Our basic strategy is to limit the number of feeds that are
-simultaniously updating at any given time.  Right now the limit is set
-to 3.
+simultaniously updating at any given time.  The limit adapts to how well
+things are going.  It starts at MIN_UPDATES and goes up by one each time
+an update finishes quickly.  It gets cut in half when an update is slow or
+the worker process has a backlog of feeds to parse.  We also limit the
+number of updates running against a single host, so that subscribing to
+lots of feeds from one site doesn't hammer it.
+
+When there are more feeds waiting than we can run, the ones most likely to
+have changed go first.  We guess that from each feed's recent updates:
+whether they brought new items, or were 304 responses or had nothing new.
+
+That history is stored in the database (see FeedUpdateHistory) and also
+decides how often we update each feed.  Feeds that publish every few weeks
+don't need to be checked as often as ones that publish every day.  The
+interval we pick is never shorter than the feed's update frequency, and
+never longer than prefs.MAX_FEED_UPDATE_INTERVAL_MN.
 """
 
-import collections
+import heapq
+import time
+import urlparse
 
+from miro import app
 from miro import eventloop
+from miro import prefs
+from miro import workerprocess
+from miro.clock import clock
+from miro.database import DDBObject, ObjectNotFoundError
+
+# Bounds for the number of feeds we update at once
+MIN_UPDATES = 3
+MAX_UPDATES = 16
+# Max number of feeds that we update at once for a single host
+MAX_UPDATES_PER_HOST = 2
+# Updates that take less than this many seconds let us run more at once.
+# Ones that take longer than SLOW_UPDATE_TIME make us run fewer.
+FAST_UPDATE_TIME = 10.0
+SLOW_UPDATE_TIME = 60.0
+# If the worker process has more than this many feeds waiting to be
+# parsed, we run fewer updates at once.
+MAX_PARSE_BACKLOG = 4
+# How much weight the latest update gets when we calculate the chance of a
+# feed changing.  Feeds we haven't seen yet start at INITIAL_CHANGE_LIKELIHOOD
+CHANGE_LIKELIHOOD_WEIGHT = 0.3
+INITIAL_CHANGE_LIKELIHOOD = 0.5
+
+# Number of times we remember from updates that brought new items
+MAX_NEW_ENTRY_TIMES = 10
+# Number of gaps between new items that we need to predict when a feed will
+# change next
+MIN_NEW_ENTRY_GAPS = 2
+# We try to check feeds this many times between new items
+CHECKS_PER_NEW_ENTRY = 4
+# Each update in a row without new items makes us wait this much longer
+# before the next one
+UNCHANGED_BACKOFF = 1.5
+
+class FeedUpdateHistory(DDBObject):
+    """Tracks how a feed has changed over time.
+
+    We store the times of the updates that brought new items, counts of
+    updates that didn't (including 304 responses and responses with the
+    same body as last time) and a hash of the last body we parsed from each
+    URL.
+    """
+    def setup_new(self, feed_id):
+        self.feed_id = feed_id
+        self.change_likelihood = INITIAL_CHANGE_LIKELIHOOD
+        self.changed_count = 0
+        self.unchanged_count = 0
+        self.not_modified_count = 0
+        self.same_body_count = 0
+        self.unchanged_streak = 0
+        self.new_entry_times = []
+        self.body_hashes = {}
+
+    @classmethod
+    def feed_view(cls, feed_id):
+        return cls.make_view('feed_id=?', (feed_id,))
+
+    def record_result(self, new_entry_count, not_modified=False, now=None):
+        """Record the result of an update.
+
+        :param new_entry_count: number of new items that the update brought
+        :param not_modified: was the response a 304?
+        :param now: time of the update, defaults to time.time()
+        """
+        if new_entry_count > 0:
+            if now is None:
+                now = time.time()
+            self.changed_count += 1
+            self.unchanged_streak = 0
+            self.new_entry_times = (self.new_entry_times +
+                    [now])[-MAX_NEW_ENTRY_TIMES:]
+            value = 1.0
+        else:
+            self.unchanged_count += 1
+            self.unchanged_streak += 1
+            if not_modified:
+                self.not_modified_count += 1
+            value = 0.0
+        self.change_likelihood += (CHANGE_LIKELIHOOD_WEIGHT *
+                (value - self.change_likelihood))
+        self.signal_change()
+
+    def check_body_hash(self, url, body_hash):
+        """Check if a body is the same as the last one we parsed from url.
+
+        :returns: True if it is.  In that case, we count it in
+            same_body_count.
+        """
+        if self.body_hashes.get(url) == body_hash:
+            self.same_body_count += 1
+            self.signal_change()
+            return True
+        return False
+
+    def record_body_hash(self, url, body_hash):
+        """Record the hash of a body that we successfully parsed."""
+        if self.body_hashes.get(url) != body_hash:
+            self.body_hashes[url] = body_hash
+            self.signal_change()
+
+    def forget_body_hashes(self):
+        if self.body_hashes:
+            self.body_hashes = {}
+            self.signal_change()
+
+    def calc_update_interval(self, min_interval, max_interval):
+        return predict_update_interval(self.new_entry_times,
+                self.unchanged_streak, min_interval, max_interval)
+
+def predict_update_interval(new_entry_times, unchanged_streak,
+        min_interval, max_interval):
+    """Calculate how long to wait before updating a feed again.
+
+    If we've seen the feed change a few times, we aim to check it
+    CHECKS_PER_NEW_ENTRY times for each new item, based on the median
+    time between changes.  Each update in a row without new items pushes
+    the next one back, so feeds that have gone quiet get checked less.
+
+    :param new_entry_times: times of the updates that brought new items
+    :param unchanged_streak: number of updates since the last new items
+    :param min_interval: shortest interval to return, in seconds
+    :param max_interval: longest interval to return, in seconds
+    """
+    interval = min_interval * (UNCHANGED_BACKOFF ** min(unchanged_streak, 50))
+    if len(new_entry_times) > MIN_NEW_ENTRY_GAPS:
+        gaps = sorted(new_entry_times[i] - new_entry_times[i-1]
+                      for i in xrange(1, len(new_entry_times)))
+        median_gap = gaps[len(gaps) // 2]
+        interval = max(interval, median_gap / CHECKS_PER_NEW_ENTRY)
+    return max(min_interval, min(interval, max_interval))
+
+class _Tally(object):
+    """Keeps the count, total and max of a set of times."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / max(self.count, 1),
+            'max': self.max,
+        }
+
+class FeedUpdateStats(object):
+    """Collects statistics about feed updates.
+
+    We keep track of the queue depth, how long feeds wait in the queue, how
+    long the updates take and the total time to refresh a feed (from the
+    time it's due to the time the update finishes).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = clock()
+        self.max_queue_depth = 0
+        self.total_queue_depth = 0
+        self.queue_samples = 0
+        self.max_concurrency = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.parses_skipped = 0
+        self.wait_times = _Tally()
+        self.update_times = _Tally()
+        self.refresh_times = _Tally()
 
-MAX_UPDATES = 3
+    def record_queue_depth(self, depth):
+        self.queue_samples += 1
+        self.total_queue_depth += depth
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def record_started(self, wait_time, updating_count):
+        self.wait_times.add(wait_time)
+        if updating_count > self.max_concurrency:
+            self.max_concurrency = updating_count
+
+    def record_finished(self, update_time, refresh_time):
+        self.update_times.add(update_time)
+        self.refresh_times.add(refresh_time)
+
+    def record_result(self, changed):
+        if changed:
+            self.changed += 1
+        else:
+            self.unchanged += 1
+
+    def snapshot(self, queue):
+        """Get our statistics as a dict of simple python objects.
+
+        :param queue: FeedUpdateQueue to get the current state from
+        """
+        return {
+            'duration': clock() - self.start_time,
+            'queue_depth': len(queue.update_queue),
+            'max_queue_depth': self.max_queue_depth,
+            'mean_queue_depth': (self.total_queue_depth /
+                float(max(self.queue_samples, 1))),
+            'updating': len(queue.currently_updating),
+            'max_updates': queue.max_updates,
+            'max_concurrency': self.max_concurrency,
+            'changed': self.changed,
+            'unchanged': self.unchanged,
+            'parses_skipped': self.parses_skipped,
+            'wait': self.wait_times.snapshot(),
+            'update': self.update_times.snapshot(),
+            'refresh': self.refresh_times.snapshot(),
+        }
+
+def format_stats(stats):
+    """Format a dict returned by FeedUpdateStats.snapshot() for display."""
+    lines = [
+        '%.1f seconds, %d feeds changed, %d unchanged' % (
+            stats['duration'], stats['changed'], stats['unchanged']),
+        '%d parses skipped because the feed body was the same' % (
+            stats['parses_skipped'],),
+        'queue depth: %d (max %d, mean %.1f)' % (stats['queue_depth'],
+            stats['max_queue_depth'], stats['mean_queue_depth']),
+        'updating: %d (limit %d, max %d)' % (stats['updating'],
+            stats['max_updates'], stats['max_concurrency']),
+    ]
+    for name, label in (('wait', 'time in queue'),
+                        ('update', 'update time'),
+                        ('refresh', 'time to refresh')):
+        lines.append('%s: %d updates, mean %.1fs, max %.1fs' % (label,
+            stats[name]['count'], stats[name]['mean'], stats[name]['max']))
+    return '\n'.join(lines)
+
+def _host_for_feed(feed):
+    """Get the host that feed gets updated from.
+
+    Returns None for feeds that don't have a network URL.  Those don't count
+    against MAX_UPDATES_PER_HOST.
+    """
+    try:
+        host = urlparse.urlparse(feed.get_url())[1]
+    except StandardError:
+        return None
+    return host.lower() or None
 
 class FeedUpdateQueue(object):
     def __init__(self):
-        self.update_queue = collections.deque()
+        # heap of (priority, sequence number, feed, update_callback,
+        # queued time) tuples.  The sequence number keeps feeds with the same
+        # priority in FIFO order.
+        self.update_queue = []
+        self.sequence = 0
         self.timeouts = {}
         self.callback_handles = {}
         self.currently_updating = set()
+        # maps feed ids -> (start time, queued time)
+        self.update_times = {}
+        # maps hosts -> number of feeds we're updating from them
+        self.host_counts = {}
+        # maps feed ids -> hosts for feeds that we're updating
+        self.update_hosts = {}
+        # maps feed ids -> FeedUpdateHistory, loaded from the DB when we need
+        # them
+        self.history = {}
+        self.max_updates = MIN_UPDATES
+        self.stats = FeedUpdateStats()
 
     def schedule_update(self, delay, feed, update_callback):
         name = "Feed update (%s)" % feed.get_title()
@@ -60,31 +336,117 @@ class FeedUpdateQueue(object):
         else:
             timeout.cancel()
 
+    def get_history(self, feed):
+        try:
+            return self.history[feed.id]
+        except KeyError:
+            pass
+        try:
+            history = FeedUpdateHistory.feed_view(feed.id).get_singleton()
+        except ObjectNotFoundError:
+            history = FeedUpdateHistory(feed.id)
+        self.history[feed.id] = history
+        return history
+
+    def record_result(self, feed, new_entry_count, not_modified=False):
+        self.get_history(feed).record_result(new_entry_count, not_modified)
+        self.stats.record_result(new_entry_count > 0)
+
+    def check_body_hash(self, feed, url, body_hash):
+        if self.get_history(feed).check_body_hash(url, body_hash):
+            self.stats.parses_skipped += 1
+            return True
+        return False
+
+    def record_body_hash(self, feed, url, body_hash):
+        self.get_history(feed).record_body_hash(url, body_hash)
+
+    def forget_body_hashes(self, feed):
+        self.get_history(feed).forget_body_hashes()
+
+    def calc_update_interval(self, feed, min_interval):
+        max_interval = app.config.get(prefs.MAX_FEED_UPDATE_INTERVAL_MN) * 60
+        return self.get_history(feed).calc_update_interval(min_interval,
+                max_interval)
+
+    def forget_feed(self, feed):
+        """Remove the history for a feed that's being removed."""
+        self.history.pop(feed.id, None)
+        for history in FeedUpdateHistory.feed_view(feed.id):
+            history.remove()
+
     def do_update(self, feed, update_callback):
         del self.timeouts[feed.id]
-        self.update_queue.append((feed, update_callback))
+        priority = -self.get_history(feed).change_likelihood
+        heapq.heappush(self.update_queue, (priority, self.sequence, feed,
+            update_callback, clock()))
+        self.sequence += 1
+        self.stats.record_queue_depth(len(self.update_queue))
         self.run_update_queue()
 
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
         self.currently_updating.remove(feed)
+        host = self.update_hosts.pop(feed.id)
+        if host is not None:
+            self.host_counts[host] -= 1
+            if self.host_counts[host] == 0:
+                del self.host_counts[host]
+        start_time, queued_time = self.update_times.pop(feed.id)
+        now = clock()
+        self.stats.record_finished(now - start_time, now - queued_time)
+        self.adjust_max_updates(now - start_time)
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
 
+    def adjust_max_updates(self, update_time):
+        """Change how many feeds we update at once, based on how long the
+        last update took and how far behind the worker process is.
+        """
+        parse_backlog = workerprocess.pending_task_count(
+                workerprocess.FeedDiffTask)
+        if update_time > SLOW_UPDATE_TIME or parse_backlog > MAX_PARSE_BACKLOG:
+            self.max_updates = max(MIN_UPDATES, self.max_updates // 2)
+        elif update_time < FAST_UPDATE_TIME and self.update_queue:
+            self.max_updates = min(MAX_UPDATES, self.max_updates + 1)
+
     def run_update_queue(self):
+        # feeds that we can't update now because their host is busy
+        skipped = []
         while (len(self.update_queue) > 0 and 
-               len(self.currently_updating) < MAX_UPDATES):
-            feed, update_callback = self.update_queue.popleft()
+               len(self.currently_updating) < self.max_updates):
+            entry = heapq.heappop(self.update_queue)
+            feed, update_callback, queued_time = entry[2:]
             if feed in self.currently_updating:
                 continue
+            if not feed.id_exists():
+                # feed was removed while it was in the queue
+                continue
+            host = _host_for_feed(feed)
+            if (host is not None and
+                    self.host_counts.get(host, 0) >= MAX_UPDATES_PER_HOST):
+                skipped.append(entry)
+                continue
             handle = feed.connect('update-finished', self.update_finished)
             handle2 = feed.connect('removed', self.update_finished)
             self.callback_handles[feed.id] = (handle, handle2)
             self.currently_updating.add(feed)
+            self.update_hosts[feed.id] = host
+            if host is not None:
+                self.host_counts[host] = self.host_counts.get(host, 0) + 1
+            now = clock()
+            self.update_times[feed.id] = (now, queued_time)
+            self.stats.record_started(now - queued_time,
+                    len(self.currently_updating))
             update_callback()
+        for entry in skipped:
+            heapq.heappush(self.update_queue, entry)
+
+    def get_stats(self):
+        return self.stats.snapshot(self)
 
 global_update_queue = FeedUpdateQueue()
 
@@ -97,3 +459,58 @@ def schedule_update(delay, feed, update_callback):
     the future.
     """
     global_update_queue.schedule_update(delay, feed, update_callback)
+
+def record_update_result(feed, new_entry_count, not_modified=False):
+    """Record the result of updating a feed.
+
+    :param new_entry_count: number of new items that the update brought
+    :param not_modified: True for 304 responses
+    """
+    global_update_queue.record_result(feed, new_entry_count, not_modified)
+
+def check_body_hash(feed, url, body_hash):
+    """Check if a feed body is the same as the last one we parsed.
+
+    If this returns True, there's no need to parse the body again.  It won't
+    give us anything new.
+
+    :param url: URL that we downloaded the body from
+    """
+    return global_update_queue.check_body_hash(feed, url, body_hash)
+
+def record_body_hash(feed, url, body_hash):
+    """Record the hash of a feed body that we successfully parsed.
+
+    :param url: URL that we downloaded the body from
+    """
+    global_update_queue.record_body_hash(feed, url, body_hash)
+
+def forget_body_hashes(feed):
+    """Forget the body hashes for a feed.
+
+    Call this when the items we created from the last bodies might be gone,
+    so that we parse the next ones no matter what.
+    """
+    global_update_queue.forget_body_hashes(feed)
+
+def calc_update_interval(feed, min_interval):
+    """Calculate how long to wait before updating a feed again.
+
+    :param min_interval: the feed's update frequency, in seconds.  We never
+        return less than this.
+    """
+    return global_update_queue.calc_update_interval(feed, min_interval)
+
+def forget_feed(feed):
+    """Remove the update history for a feed."""
+    global_update_queue.forget_feed(feed)
+
+def get_stats():
+    """Get a dict of statistics about feed updates.
+
+    format_stats() can format it for display.
+    """
+    return global_update_queue.get_stats()
+
+def reset_stats():
+    global_update_queue.stats.reset()
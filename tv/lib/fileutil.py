@@ -32,6 +32,7 @@
 where file locking semantics can cause problems.
 """
 
+import hashlib
 import logging
 import os
 import shutil
@@ -40,6 +41,9 @@ from miro import u3info
 
 from miro.plat.filebundle import is_file_bundle
 
+# Bytes from the start and end of files that we use for fingerprints
+FINGERPRINT_CHUNK_SIZE = 16 * 1024
+
 def makedirs(path):
     path = expand_filename(path)
     return os.makedirs(path)
@@ -98,6 +102,48 @@ def open_file(path, *args, **kwargs):
     path = expand_filename(path)
     return file(path, *args, **kwargs)
 
+def calc_fingerprint(path, file_size):
+    """Calculate a fingerprint for a file's contents.
+
+    We hash the size and the first and last FINGERPRINT_CHUNK_SIZE bytes of
+    the file.  That's where audio and video containers keep their tags and
+    indexes, so it changes when the metadata changes, while only reading a
+    small part of large files.
+
+    :returns: hex digest, or None if we can't read the file
+    """
+    sha = hashlib.sha1(str(file_size))
+    try:
+        f = open_file(path, 'rb')
+        try:
+            sha.update(f.read(FINGERPRINT_CHUNK_SIZE))
+            if file_size > FINGERPRINT_CHUNK_SIZE:
+                f.seek(max(FINGERPRINT_CHUNK_SIZE,
+                           file_size - FINGERPRINT_CHUNK_SIZE))
+                sha.update(f.read(FINGERPRINT_CHUNK_SIZE))
+        finally:
+            f.close()
+    except EnvironmentError:
+        return None
+    return unicode(sha.hexdigest())
+
+def get_file_identity(path):
+    """Get the size, mtime and fingerprint of a file.
+
+    mtime is rounded down to whole seconds.
+
+    :returns: (size, mtime, fingerprint) tuple, or None if we can't read the
+        file
+    """
+    try:
+        stat_result = os.stat(expand_filename(path))
+    except EnvironmentError:
+        return None
+    fingerprint = calc_fingerprint(path, stat_result.st_size)
+    if fingerprint is None:
+        return None
+    return stat_result.st_size, int(stat_result.st_mtime), fingerprint
+
 def access(path, *args, **kwargs):
     path = expand_filename(path)
     return os.access(path, *args, **kwargs)
@@ -241,11 +287,11 @@ def delete(path, retry_after=10, retry_for=60, firsttime=True):
                     "Delete File Retry", args=(path, retry_after,
                         retry_for - retry_after, False))
             if firsttime:
-                from miro.workerprocess import _subprocess_manager
-                if _subprocess_manager.is_running:
-                    logging.debug('restarting subprocess_manager to hopefully '
+                from miro.workerprocess import _worker_pool
+                if _worker_pool.is_running:
+                    logging.debug('restarting worker processes to hopefully '
                                   'free file references')
-                    _subprocess_manager.restart(clean=True)
+                    _worker_pool.restart(clean=True)
 
     else:
         deletes_in_progress.discard(path)
@@ -103,7 +103,7 @@ def _scrape_youtube_url(url, callback):
         httpclient.grab_url(
             url,
             lambda x: _youtube_callback_step2(x, video_id, callback),
-            lambda x: _youtube_errback(x, callback))
+            lambda x: _youtube_errback(x, callback), use_cache=True)
 
     except StandardError:
         logging.exception("youtube_callback: unable to scrape YouTube Video URL")
@@ -198,7 +198,8 @@ def _scrape_vmix_video_url(url, callback):
         url = (u"http://sdstage01.vmix.com/videos.php?type=%s&id=%s&l=%s" %
                (type_, id_, l))
         httpclient.grab_url(url, lambda x: _scrape_vmix_callback(x, callback),
-                           lambda x: _scrape_vmix_errback(x, callback))
+                           lambda x: _scrape_vmix_errback(x, callback),
+                           use_cache=True)
 
     except StandardError:
         logging.warning("unable to scrape VMix Video URL: %s", url)
@@ -292,7 +293,7 @@ def _scrape_vimeo_video_url(url, callback):
         httpclient.grab_url(
             url,
             lambda x: _scrape_vimeo_callback(x, callback),
-            lambda x: _scrape_vimeo_errback(x, callback))
+            lambda x: _scrape_vimeo_errback(x, callback), use_cache=True)
     except StandardError:
         logging.exception("Unable to scrape vimeo.com video URL: %s", url)
         callback(None)
@@ -306,7 +307,7 @@ def _scrape_vimeo_moogaloop_url(url, callback):
         httpclient.grab_url(
             url,
             lambda x: _scrape_vimeo_callback(x, callback),
-            lambda x: _scrape_vimeo_errback(x, callback))
+            lambda x: _scrape_vimeo_errback(x, callback), use_cache=True)
     except StandardError:
         logging.exception("Unable to scrape vimeo.com moogaloop URL: %s", url)
         callback(None)
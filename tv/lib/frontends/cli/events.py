@@ -30,6 +30,8 @@
 import threading
 import Queue
 
+from miro import eventloop
+from miro import feedupdate
 from miro import signals
 from miro import messages
 from miro.frontends.cli.util import print_box
@@ -106,3 +108,9 @@ class CliMessageHandler(messages.MessageHandler):
 
     def handle_item_list(self, message):
         print "Item list %s %s %d" % (message.type, message.id, len(message.items))
+
+    def handle_current_event_loop_stats(self, message):
+        print eventloop.format_stats(message.stats)
+
+    def handle_current_feed_update_stats(self, message):
+        print feedupdate.format_stats(message.stats)
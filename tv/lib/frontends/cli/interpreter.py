@@ -37,6 +37,7 @@ from miro import dialogs
 from miro import eventloop
 from miro import item
 from miro import folder
+from miro import messages
 from miro import tabs
 from miro.frontends.cli import clidialog
 from miro.plat import resources
@@ -415,6 +416,21 @@ class MiroInterpreter(cmd.Cmd):
         return self.handle_item_complete(text, self._get_item_view(),
                 lambda i: i.is_downloaded())
 
+    def do_loopstats(self, line):
+        """loopstats [reset] -- Shows what the backend event loop has been
+        doing.  With reset, starts collecting new stats afterwards.
+        """
+        messages.QueryEventLoopStats(reset=(line.strip() == 'reset')
+                ).send_to_backend()
+
+    def do_feedstats(self, line):
+        """feedstats [reset] -- Shows how feed updates are doing: the
+        update queue depth and how long feeds take to refresh.  With reset,
+        starts collecting new stats afterwards.
+        """
+        messages.QueryFeedUpdateStats(reset=(line.strip() == 'reset')
+                ).send_to_backend()
+
     @run_in_event_loop
     def do_testdialog(self, line):
         """testdialog -- Tests the cli dialog system."""
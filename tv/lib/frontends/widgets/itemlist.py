@@ -41,6 +41,7 @@ import itertools
 import sys
 
 from miro import app
+from miro import search
 from miro import util
 from miro.frontends.widgets import itemfilter
 from miro.frontends.widgets.widgetstatestore import WidgetStateStore
@@ -288,6 +289,30 @@ class KindSort(ItemSort):
     def sort_key(self, info):
         return info.kind
 
+class RelevanceSort(ItemSort):
+    """Sort that puts the items that best match a search first.
+
+    Items that match equally well are ordered by another sort, normally the
+    one that the user picked for the list.
+
+    :param search_text: search to rank items for
+    :param tiebreaker: ItemSort for items with the same relevance
+    """
+    KEY = 'relevance'
+
+    def __init__(self, search_text, tiebreaker):
+        # Use the tiebreaker's direction for the whole sort, and flip the
+        # score when sorting in reverse so the best matches still go first.
+        ItemSort.__init__(self, tiebreaker.is_ascending())
+        self.search_text = search_text
+        self.tiebreaker = tiebreaker
+
+    def sort_key(self, info):
+        score = search.relevance_score(info, self.search_text)
+        if not self.reverse:
+            score = -score
+        return (score, self.tiebreaker.sort_key(info))
+
 class PlaylistSort(ItemSort):
     """Sort that orders items by their order in the playlist.
     """
@@ -253,6 +253,11 @@ class ItemListController(object):
         self.id = id_
         self.views = {}
         self._search_text = ''
+        # sorter for the column that the user picked
+        self._column_sorter = None
+        # Should searches order items by relevance?  Picking a column while
+        # searching turns this off until the search is cleared.
+        self._relevance_sort_enabled = True
         self._got_initial_list = False
         self._playing_items = False
         self._selection_to_restore = None
@@ -346,8 +351,25 @@ class ItemListController(object):
     def _init_sort(self):
         sorter = self.get_sorter()
         self.change_sort_indicators(sorter.KEY, sorter.is_ascending())
+        self._set_sort(sorter)
+
+    def _set_sort(self, sorter):
+        """Set the sort for our item list.
+
+        While there's a search, we order items by relevance and use sorter
+        for items that match equally well.
+        """
+        self._column_sorter = sorter
+        if self._should_sort_by_relevance():
+            sorter = itemlist.RelevanceSort(self._search_text, sorter)
         self.item_list.set_sort(sorter)
 
+    def _should_sort_by_relevance(self):
+        # Playlist order can be changed by dragging items, which only makes
+        # sense when we're displaying that order.
+        return (self._search_text != '' and self._relevance_sort_enabled
+                and not isinstance(self._column_sorter, itemlist.PlaylistSort))
+
     def get_saved_search_text(self):
         """Get the text we would use to create a saved search.
 
@@ -721,8 +743,17 @@ class ItemListController(object):
         """Set the search for all ItemViews managed by this controller.
         """
         self._search_text = search_text
+        if search_text == '':
+            self._relevance_sort_enabled = True
         if self.item_tracker:
             self.item_tracker.set_search(search_text)
+        if self._column_sorter is not None and (
+                self._should_sort_by_relevance() or
+                isinstance(self.item_list.get_sort(), itemlist.RelevanceSort)):
+            # re-rank the items for the new search
+            self.item_list_will_change()
+            self._set_sort(self._column_sorter)
+            self.send_model_changed()
         app.inline_search_memory.set_search(self.type, self.id, search_text)
 
     def on_row_activated(self, item_view, iter_):
@@ -742,7 +773,10 @@ class ItemListController(object):
         self.views[view].reset_scroll()
         self.item_list_will_change()
         sorter = self.make_sorter(sort_key, ascending)
-        self.item_list.set_sort(sorter)
+        if self._search_text != '':
+            # the user picked a column, use it instead of relevance
+            self._relevance_sort_enabled = False
+        self._set_sort(sorter)
         self.send_model_changed()
         self.change_sort_indicators(sort_key, ascending)
         sort_key = self.make_sort_key(sorter)
@@ -45,6 +45,7 @@ from miro import app
 from miro import messages
 from miro import signals
 from miro import search
+from miro import searchindex
 from miro.frontends.widgets import itemlist
 from miro.plat.frontends.widgets.threads import call_on_ui_thread
 
@@ -80,6 +81,11 @@ class ItemListTracker(signals.SignalEmitter):
     # maps (type, id) -> ItemListTracker objects
     _live_trackers = weakref.WeakValueDictionary()
 
+    # types whose items all come from the ItemInfoCache.  We can use
+    # app.search_index to search them.
+    SEARCH_INDEX_TYPES = ('feed', 'playlist', 'downloading', 'videos', 'music',
+            'others', 'search', 'folder-contents')
+
     @classmethod
     def create(cls, type_, id_):
         """Get a ItemListTracker 
@@ -115,9 +121,16 @@ class ItemListTracker(signals.SignalEmitter):
         self.item_list = itemlist.ItemList()
         self.id = id_
         self.is_tracking = False
-        self.search_filter = SearchFilter()
+        self.search_filter = SearchFilter(self._make_searcher())
         self.saw_initial_list = False
 
+    def _make_searcher(self):
+        if (self.type in self.SEARCH_INDEX_TYPES and
+                app.search_index is not None):
+            return searchindex.ListSearcher(app.search_index)
+        else:
+            return None
+
     def connect(self, name, func, *extra_args):
         if not self.is_tracking:
             self._start_tracking()
@@ -247,9 +260,14 @@ class ManualItemListTracker(ItemListTracker):
 
 class SearchFilter(object):
     """SearchFilter filter out non-matching items from item lists
+
+    :param searcher: object to index and search our items with.  If None, we
+        create a search.ItemSearcher.
     """
-    def __init__(self):
-        self.searcher = search.ItemSearcher()
+    def __init__(self, searcher=None):
+        if searcher is None:
+            searcher = search.ItemSearcher()
+        self.searcher = searcher
         self.query = ''
         self.all_items = {} # maps id to item info
         self.matching_ids = set()
@@ -334,7 +352,7 @@ class SearchFilter(object):
     def _add_items(self, items):
         for item in items:
             self.all_items[item.id] = item
-            self.searcher.add_item(item)
+        self.searcher.add_items(items)
 
     def _update_items(self, items):
         for item in items:
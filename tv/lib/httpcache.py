@@ -0,0 +1,440 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+
+"""``miro.httpcache`` -- On-disk cache for HTTP responses.
+
+httpclient uses this to store the responses for grab_url() calls that pass
+``use_cache=True``.  We follow the caching headers that the server sends:
+
+- ``Cache-Control`` (``max-age``, ``no-cache`` and ``no-store``) and
+  ``Expires`` decide how long a response is fresh.  Fresh responses are used
+  without touching the network.
+- If there's no explicit expiration time, but there's a ``Last-Modified``
+  header, we guess that the response is fresh for 10% of the time since it
+  was modified, up to 1 day (see RFC 2616 section 13.2.4).
+- Stale responses with an ``ETag`` or ``Last-Modified`` header get
+  revalidated with a conditional GET.  If the server says 304, we use the
+  cached body.
+
+Each response is stored as a pickle file in the cache directory.  The cache
+has a maximum size.  When we go past it, we remove the least recently used
+responses.
+"""
+
+import cPickle as pickle
+import email.utils
+import logging
+import os
+import threading
+import time
+from hashlib import sha1
+
+from miro import fileutil
+
+# default maximum size of the cache, in bytes
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+# limits for our guess at the lifetime of responses without an explicit one
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_LIFETIME = 24 * 60 * 60
+# responses that we don't store the headers for
+UNCACHED_HEADERS = set(['connection', 'keep-alive', 'transfer-encoding',
+                        'set-cookie'])
+
+CACHE_FILE_EXTENSION = '.cache'
+
+class HTTPCacheStats(object):
+    """Holds data about how well the HTTP cache is working.
+
+    Attributes:
+        hits -- requests that used a fresh cached response
+        revalidations -- requests that used a cached response after the
+            server answered our conditional GET with 304
+        misses -- requests that had to download the response
+        stores -- responses that we added to the cache
+        evictions -- responses that we removed to stay under the size limit
+    """
+    def __init__(self):
+        self.hits = self.revalidations = self.misses = 0
+        self.stores = self.evictions = 0
+
+    def hit_rate(self):
+        """Get the fraction of requests that didn't have to download the
+        response body.
+        """
+        total = self.hits + self.revalidations + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits + self.revalidations) / total
+
+    def copy(self):
+        rv = HTTPCacheStats()
+        rv.__dict__.update(self.__dict__)
+        return rv
+
+class CacheEntry(object):
+    """A response stored in the cache.
+
+    Attributes:
+        url -- URL that the response is for
+        info -- info dict from grab_url(), including the body
+        expires -- time when the response becomes stale
+    """
+    def __init__(self, url, info, expires):
+        self.url = url
+        self.info = info
+        self.expires = expires
+
+    def is_fresh(self, now=None):
+        if now is None:
+            now = time.time()
+        return now < self.expires
+
+    def etag(self):
+        return self.info.get('etag')
+
+    def last_modified(self):
+        return self.info.get('last-modified')
+
+    def has_validator(self):
+        return self.etag() is not None or self.last_modified() is not None
+
+    def conditional_headers(self):
+        """Get the headers to send to revalidate this response."""
+        headers = {}
+        if self.etag() is not None:
+            headers['If-None-Match'] = self.etag()
+        if self.last_modified() is not None:
+            headers['If-Modified-Since'] = self.last_modified()
+        return headers
+
+def parse_http_date(value):
+    """Convert a HTTP date string to a timestamp.
+
+    :returns: seconds since the epoch, or None if value isn't a valid date
+    """
+    if not value:
+        return None
+    try:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return email.utils.mktime_tz(parsed)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def parse_cache_control(value):
+    """Parse a Cache-Control header.
+
+    :returns: dict mapping lowercase directives to their values (or None for
+        directives without a value)
+    """
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            name, arg = part.split('=', 1)
+            directives[name.strip().lower()] = arg.strip().strip('"')
+        else:
+            directives[part.lower()] = None
+    return directives
+
+def calc_expiration(headers, now=None):
+    """Calculate when a response becomes stale.
+
+    :param headers: response headers, with lowercase keys
+    :param now: time that we received the response
+    :returns: timestamp when the response goes stale, or None if we
+        shouldn't store the response
+    """
+    if now is None:
+        now = time.time()
+    cache_control = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in cache_control or headers.get('vary') == '*':
+        return None
+    if ('no-cache' in cache_control or
+            'no-cache' in headers.get('pragma', '').lower()):
+        return now
+    age = 0
+    if 'age' in headers:
+        try:
+            age = max(0, int(headers['age']))
+        except ValueError:
+            pass
+    if 'max-age' in cache_control:
+        try:
+            return now + int(cache_control['max-age']) - age
+        except ValueError:
+            # invalid max-age means the response is stale
+            return now
+    # Compare Expires against the server's Date header, so that clock
+    # differences between us and the server don't matter.
+    date = parse_http_date(headers.get('date'))
+    if date is None:
+        date = now
+    if 'expires' in headers:
+        expires = parse_http_date(headers['expires'])
+        if expires is None:
+            return now
+        return now + (expires - date)
+    last_modified = parse_http_date(headers.get('last-modified'))
+    if last_modified is not None and last_modified < date:
+        lifetime = min((date - last_modified) * HEURISTIC_FRACTION,
+                       MAX_HEURISTIC_LIFETIME)
+        return now + lifetime - age
+    return now
+
+class HTTPCache(object):
+    """Stores HTTP responses in a directory.
+
+    This class can be used from any thread.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = HTTPCacheStats()
+        self.lock = threading.Lock()
+        # maps cache filenames to (size, last use time).  We build this the
+        # first time it's needed.
+        self._index = None
+        self._total_size = 0
+
+    def get_stats(self):
+        """Get a copy of our HTTPCacheStats."""
+        self.lock.acquire()
+        try:
+            return self.stats.copy()
+        finally:
+            self.lock.release()
+
+    def _filename(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return sha1(url).hexdigest() + CACHE_FILE_EXTENSION
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _ensure_index(self):
+        if self._index is not None:
+            return
+        self._index = {}
+        self._total_size = 0
+        if not fileutil.exists(self.directory):
+            return
+        for filename in fileutil.listdir(self.directory):
+            if not filename.endswith(CACHE_FILE_EXTENSION):
+                continue
+            try:
+                stat = os.stat(self._path(filename))
+            except OSError:
+                continue
+            self._index[filename] = (stat.st_size, stat.st_mtime)
+            self._total_size += stat.st_size
+
+    def lookup(self, url):
+        """Find the cached response for a URL.
+
+        :returns: CacheEntry or None
+        """
+        self.lock.acquire()
+        try:
+            self._ensure_index()
+            filename = self._filename(url)
+            if filename not in self._index:
+                return None
+            try:
+                f = fileutil.open_file(self._path(filename), 'rb')
+                try:
+                    entry = pickle.load(f)
+                finally:
+                    f.close()
+            except (EnvironmentError, pickle.UnpicklingError, EOFError,
+                    AttributeError, ValueError, TypeError), e:
+                logging.warn("error reading HTTP cache file: %s", e)
+                self._remove(filename)
+                return None
+            if entry.url != url:
+                # hash collision
+                return None
+            self._touch(filename)
+            return entry
+        finally:
+            self.lock.release()
+
+    def store(self, url, info, now=None):
+        """Store a response from grab_url().
+
+        Responses that can't be cached are ignored.
+
+        :returns: the new CacheEntry or None if we didn't store the response
+        """
+        if info.get('status') != 200:
+            return None
+        expires = calc_expiration(info, now)
+        if expires is None:
+            return None
+        entry = CacheEntry(url, self._cacheable_info(info), expires)
+        if not entry.is_fresh(now) and not entry.has_validator():
+            # we could never use this response
+            return None
+        self.lock.acquire()
+        try:
+            self._write_entry(entry)
+            self.stats.stores += 1
+        finally:
+            self.lock.release()
+        return entry
+
+    def revalidated(self, entry, info, now=None):
+        """Update a cached response after the server returned 304.
+
+        :param entry: CacheEntry that we revalidated
+        :param info: info dict for the 304 response
+        :returns: info dict to pass to the grab_url() callback
+        """
+        for key, value in info.items():
+            # 304 responses include updated headers, like Date, Expires and
+            # Cache-Control.  Everything else should come from the cached
+            # response.
+            if (key in UNCACHED_HEADERS or
+                    key in ('status', 'body', 'content-length')):
+                continue
+            if isinstance(value, str):
+                entry.info[key] = value
+        expires = calc_expiration(entry.info, now)
+        self.lock.acquire()
+        try:
+            if expires is None:
+                self._ensure_index()
+                self._remove(self._filename(entry.url))
+            else:
+                entry.expires = expires
+                self._write_entry(entry)
+        finally:
+            self.lock.release()
+        return entry.info.copy()
+
+    def record_hit(self):
+        self._record('hits')
+
+    def record_revalidation(self):
+        self._record('revalidations')
+
+    def record_miss(self):
+        self._record('misses')
+
+    def _record(self, attr):
+        self.lock.acquire()
+        try:
+            setattr(self.stats, attr, getattr(self.stats, attr) + 1)
+        finally:
+            self.lock.release()
+
+    def _cacheable_info(self, info):
+        return dict((key, value) for key, value in info.items()
+                    if key not in UNCACHED_HEADERS)
+
+    def _write_entry(self, entry):
+        self._ensure_index()
+        if not fileutil.exists(self.directory):
+            fileutil.makedirs(self.directory)
+        filename = self._filename(entry.url)
+        path = self._path(filename)
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            self._remove(filename)
+            return
+        temp_path = path + '.tmp'
+        try:
+            f = fileutil.open_file(temp_path, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            if fileutil.exists(path):
+                # windows can't rename over an existing file
+                fileutil.remove(path)
+            fileutil.rename(temp_path, path)
+        except EnvironmentError, e:
+            logging.warn("error writing HTTP cache file: %s", e)
+            self._remove(filename)
+            return
+        self._forget(filename)
+        self._index[filename] = (len(data), time.time())
+        self._total_size += len(data)
+        self._shrink()
+
+    def _touch(self, filename):
+        size, last_used = self._index[filename]
+        last_used = time.time()
+        self._index[filename] = (size, last_used)
+        try:
+            os.utime(self._path(filename), (last_used, last_used))
+        except OSError:
+            pass
+
+    def _forget(self, filename):
+        try:
+            size, last_used = self._index.pop(filename)
+        except KeyError:
+            pass
+        else:
+            self._total_size -= size
+
+    def _remove(self, filename):
+        self._forget(filename)
+        try:
+            fileutil.remove(self._path(filename))
+        except OSError:
+            pass
+
+    def _shrink(self):
+        if self._total_size <= self.max_size:
+            return
+        by_last_use = sorted(self._index.items(), key=lambda i: i[1][1])
+        for filename, (size, last_used) in by_last_use:
+            if self._total_size <= self.max_size:
+                break
+            self._remove(filename)
+            self.stats.evictions += 1
+
+    def clear(self):
+        """Remove all responses from the cache."""
+        self.lock.acquire()
+        try:
+            self._ensure_index()
+            for filename in self._index.keys():
+                self._remove(filename)
+        finally:
+            self.lock.release()
@@ -38,6 +38,7 @@ fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 import logging
 import os
 import stat
+import tempfile
 import threading
 import urllib
 import Queue
@@ -50,10 +51,12 @@ from miro import download_utils
 from miro import eventloop
 from miro import fileutil
 from miro import httpauth
+from miro import httpcache
 from miro import net
 from miro import prefs
 from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.gtcache import gettext as _
 from miro.xhtmltools import url_encode_dict, multipart_encode
 from miro.plat import utils
@@ -67,6 +70,14 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# Most connections that we open to a single host at once.  Transfers past
+# this wait inside libcurl for a connection to free up.
+MAX_HOST_CONNECTIONS = 8
+# Number of connections that libcurl keeps open so that later transfers to
+# the same host can reuse them.
+MAX_CACHED_CONNECTIONS = 32
+# Number of libcurl easy handles that we keep around to reuse.
+MAX_FREE_HANDLES = 16
 
 _logged_noproxy_error = False
 
@@ -84,6 +95,18 @@ def _proxy_auth_url():
     return 'proxy://%s:%s/' % (app.config.get(prefs.HTTP_PROXY_HOST),
             app.config.get(prefs.HTTP_PROXY_PORT))
 
+def _setopt_if_supported(curl_object, option_name, value):
+    """Set a libcurl option, unless our pycurl is too old to have it."""
+    try:
+        option = getattr(pycurl, option_name)
+    except AttributeError:
+        logging.debug("pycurl.%s doesn't exist", option_name)
+        return
+    try:
+        curl_object.setopt(option, value)
+    except pycurl.error, e:
+        logging.debug("error setting %s: %s", option_name, e)
+
 def trap_call(when, function, *args, **kwargs):
     """Version of trap_call for the libcurl thread.
 
@@ -203,7 +226,8 @@ class TransferOptions(object):
     """
 
     def __init__(self, url, etag=None, modified=None, resume=False,
-            post_vars=None, post_files=None, write_file=None):
+            post_vars=None, post_files=None, write_file=None,
+            spool_threshold=None):
         self.url = url
         self.etag = etag
         self.modified = modified
@@ -211,9 +235,12 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        self.spool_threshold = spool_threshold
         self.requires_cookies = False
         self.head_request = False
         self.invalid_url = False
+        # headers for conditional GETs from the HTTP cache
+        self.conditional_headers = {}
         # _cancel_on_body_data is an internal attribute used for grab_headers.
         self._cancel_on_body_data = False
         self.parse_url()
@@ -237,28 +264,38 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
+    def build_handle(self, out_headers, handle=None, share=None):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: recycled handle to set up, or None to create a new one
+        :param share: CurlShare object for new handles to use
         """
         if self.etag is not None:
             out_headers['etag'] = self.etag
         if self.modified is not None:
             out_headers['If-Modified-Since'] = self.modified
+        out_headers.update(self.conditional_headers)
 
-        handle = self._init_handle()
+        handle = self._init_handle(handle, share)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle, share):
+        if handle is None:
+            handle = pycurl.Curl()
+            # recycled handles still have their share object after reset()
+            if share is not None:
+                handle.setopt(pycurl.SHARE, share)
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
         handle.setopt(pycurl.NOPROGRESS, 1)
         handle.setopt(pycurl.NOSIGNAL, 1)
         handle.setopt(pycurl.CONNECTTIMEOUT, net.SOCKET_CONNECT_TIMEOUT)
+        # keep idle connections alive, so that we can reuse them
+        _setopt_if_supported(handle, 'TCP_KEEPALIVE', 1)
         if self.requires_cookies:
             # we don't do this for every request, since on OS X this generates
             # a new cookies.txt file
@@ -357,6 +394,7 @@ class CurlTransfer(object):
         self.saw_temporary_redirect = False
         self.headers_finished = False
         self._filehandle = None
+        self._spool_file = self._spool_path = None
         self.resume_from = 0
         self.out_headers = {}
         self.status_code = None
@@ -364,6 +402,7 @@ class CurlTransfer(object):
         self.saw_head_success = False
 
     def _send_new_request(self):
+        self._remove_spool_file()
         self._reset_transfer_data()
         curl_manager.add_transfer(self)
 
@@ -451,11 +490,15 @@ class CurlTransfer(object):
                 self.proxy_auth = auth
             self._send_new_request()
 
-    def build_handle(self):
+    def build_handle(self, handle=None, share=None):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: recycled handle to set up, or None to create a new one
+        :param share: CurlShare object for new handles to use
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        self.handle = self.options.build_handle(self.out_headers, handle,
+                                                share)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
@@ -476,6 +519,8 @@ class CurlTransfer(object):
                 self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
         elif self.content_check_callback is not None:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._call_content_check)
+        elif self.options.spool_threshold is not None:
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_spooled)
         else:
             self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
@@ -488,6 +533,70 @@ class CurlTransfer(object):
         if self.check_response_code(self.status_code):
             self._filehandle.write(buf)
 
+    def _write_spooled(self, buf):
+        if self._spool_file is not None:
+            self._spool_file.write(buf)
+            return
+        self.buffer.write(buf)
+        if self.buffer.tell() > self.options.spool_threshold:
+            # The body is too big to keep in memory.  Move it to a temporary
+            # file, which is where the rest of the data will go.
+            try:
+                fd, self._spool_path = tempfile.mkstemp(prefix='miro-',
+                                                        suffix='.httpbody')
+                self._spool_file = os.fdopen(fd, 'wb')
+                self._spool_file.write(self.buffer.getvalue())
+            except EnvironmentError, e:
+                logging.warn("error creating spool file: %s", e)
+                self._remove_spool_file()
+                # returning 0 makes libcurl stop the transfer with
+                # E_WRITE_ERROR
+                return 0
+            self.buffer = StringIO()
+
+    def _finish_spool_file(self, info):
+        """Set info['body_path'] to our spool file."""
+        if gzip and info.get('content-encoding', '') == 'gzip':
+            try:
+                self._gunzip_spool_file()
+            except IOError, e:
+                logging.warning("Received header with content-encoding "
+                                "gzip, but content is not gzip encoded")
+        info['body_path'] = self._spool_path
+        # the callback takes ownership of the file
+        self._spool_path = None
+
+    def _gunzip_spool_file(self):
+        fd, path = tempfile.mkstemp(prefix='miro-', suffix='.httpbody')
+        output = os.fdopen(fd, 'wb')
+        try:
+            input_ = gzip.GzipFile(self._spool_path, 'rb')
+            try:
+                while True:
+                    data = input_.read(65536)
+                    if not data:
+                        break
+                    output.write(data)
+            finally:
+                input_.close()
+                output.close()
+        except IOError:
+            os.remove(path)
+            raise
+        os.remove(self._spool_path)
+        self._spool_path = path
+
+    def _remove_spool_file(self):
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+        if self._spool_path is not None:
+            try:
+                os.remove(self._spool_path)
+            except OSError:
+                pass
+            self._spool_path = None
+
     def _lookup_auth(self):
         """Lookup existing HTTP passwords to use.
 
@@ -629,7 +738,8 @@ class CurlTransfer(object):
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
-        if self.options.etag or self.options.modified:
+        if (self.options.etag or self.options.modified or
+                self.options.conditional_headers):
             expected_codes.add(304)
         return code in expected_codes
 
@@ -657,7 +767,10 @@ class CurlTransfer(object):
     def on_finished(self):
         info = self._make_callback_info()
         self.last_url = self.handle.getinfo(pycurl.EFFECTIVE_URL)
-        if self.options.write_file is None:
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+        elif self.options.write_file is None:
             if gzip and info.get('content-encoding', '') == 'gzip':
                 try:
                     self.buffer.seek(0)
@@ -672,6 +785,8 @@ class CurlTransfer(object):
 
         if self.check_response_code(info['status']):
             if not self.trying_head_request:
+                if self._spool_path is not None:
+                    self._finish_spool_file(info)
                 self.call_callback(info)
             else:
                 # we tried a HEAD request and it worked, now we can do the
@@ -705,6 +820,7 @@ class CurlTransfer(object):
 
     def on_cancel(self, remove_file):
         self._cleanup_filehandle()
+        self._remove_spool_file()
         if remove_file and self.options.write_file:
             try:
                 fileutil.remove(self.options.write_file)
@@ -789,6 +905,7 @@ class CurlTransfer(object):
 
     def call_errback(self, error):
         self._cleanup_filehandle()
+        self._remove_spool_file()
         eventloop.add_idle(self.errback, 'curl transfer errback',
                            args=(error,))
 
@@ -849,6 +966,33 @@ class TransferStats(object):
         self.initial_size = 0
         self.status_code = None
 
+class ConnectionPoolStats(object):
+    """Holds data about how well we reuse connections and libcurl handles.
+
+    Attributes:
+        transfers -- transfers that have completed
+        new_connections -- connections that those transfers had to open
+        reused_connections -- transfers that didn't open any new connections
+        handles_created -- libcurl handles that we've created
+        handles_reused -- times that we reused a libcurl handle
+    """
+    def __init__(self):
+        self.transfers = self.new_connections = self.reused_connections = 0
+        self.handles_created = self.handles_reused = 0
+
+    def reuse_rate(self):
+        """Get the fraction of transfers that reused an existing
+        connection.
+        """
+        if self.transfers == 0:
+            return 0.0
+        return float(self.reused_connections) / self.transfers
+
+    def copy(self):
+        rv = ConnectionPoolStats()
+        rv.__dict__.update(self.__dict__)
+        return rv
+
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
 
@@ -857,11 +1001,40 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+
+    libcurl keeps a cache of open connections for the multi object, which
+    lets transfers to the same host reuse a connection rather than making a
+    new one.  On top of that we share the DNS and SSL session caches between
+    all handles, recycle handles once their transfers are done, and limit the
+    number of connections to a single host.
+
+    We use libcurl's socket interface.  libcurl tells us which sockets to
+    watch and when its next timeout is, and we tell it which sockets are
+    ready.  That way libcurl only has to deal with the sockets that had
+    activity, rather than checking every transfer each time we wake up.
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.on_curl_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.on_curl_timer)
+        _setopt_if_supported(self.multi, 'M_MAX_HOST_CONNECTIONS',
+                             MAX_HOST_CONNECTIONS)
+        _setopt_if_supported(self.multi, 'M_MAXCONNECTS',
+                             MAX_CACHED_CONNECTIONS)
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.free_handles = []
+        self.pool_stats = ConnectionPoolStats()
+        self.pool_stats_lock = threading.Lock()
+        # maps sockets that libcurl wants us to watch to poller events
+        self.curl_sockets = {}
+        # time that libcurl wants us to call socket_action() with
+        # SOCKET_TIMEOUT, or None
+        self.timer_deadline = None
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
@@ -883,7 +1056,12 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        for handle in self.free_handles:
+            handle.close()
+        self.free_handles = []
         self.multi.close()
+        self.share.close()
+        self.poller.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -896,28 +1074,56 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
-    def calc_fds(self):
-        return self.multi.fdset()
+    def on_curl_socket(self, what, fd, multi, socketp):
+        """Called by libcurl when it wants us to change the events that we
+        watch for on a socket.
+        """
+        if what == pycurl.POLL_REMOVE:
+            if self.curl_sockets.pop(fd, None) is not None:
+                self.poller.unregister(fd)
+            return
+        events = 0
+        if what & pycurl.POLL_IN:
+            events |= eventloop.POLL_READ
+        if what & pycurl.POLL_OUT:
+            events |= eventloop.POLL_WRITE
+        self.curl_sockets[fd] = events
+        self.poller.register(fd, events)
+
+    def on_curl_timer(self, timeout_ms):
+        """Called by libcurl when it wants to change its timeout."""
+        if timeout_ms < 0:
+            self.timer_deadline = None
+        else:
+            self.timer_deadline = clock() + timeout_ms / 1000.0
 
     def calc_timeout(self):
-        timeout = self.multi.timeout()
-        if timeout < 0:
-            # libcurl documentation says this means to wait "not too long"
-            # Let's try 2 seconds
+        if self.timer_deadline is None:
+            # libcurl doesn't have a timeout for us.  Wake up every once in a
+            # while to keep our transfer stats up to date.
             return 2.0
         else:
-            return timeout / 1000.0
+            return max(0, self.timer_deadline - clock())
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
-        while True:
-            rv, num_handles = self.multi.perform()
-            self.update_stats()
-            for callback in self.after_perform_callbacks:
-                trap_call('after perform callback', callback)
-            self.after_perform_callbacks = []
-            if rv != pycurl.E_CALL_MULTI_PERFORM:
-                break
+        actions = {}
+        for fd in readfds:
+            if fd in self.curl_sockets:
+                actions[fd] = pycurl.CSELECT_IN
+        for fd in writefds:
+            if fd in self.curl_sockets:
+                actions[fd] = actions.get(fd, 0) | pycurl.CSELECT_OUT
+        for fd, action in actions.items():
+            self.multi.socket_action(fd, action)
+        if (self.timer_deadline is not None and
+                clock() >= self.timer_deadline):
+            self.timer_deadline = None
+            self.multi.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        self.update_stats()
+        for callback in self.after_perform_callbacks:
+            trap_call('after perform callback', callback)
+        self.after_perform_callbacks = []
         self.process_queues()
         self.check_finished()
 
@@ -925,15 +1131,66 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             transfer.update_stats()
 
+    def get_pool_stats(self):
+        """Get a ConnectionPoolStats object for our transfers.
+
+        This method can be called from any thread.
+        """
+        self.pool_stats_lock.acquire()
+        try:
+            return self.pool_stats.copy()
+        finally:
+            self.pool_stats_lock.release()
+
+    def _get_handle(self):
+        self.pool_stats_lock.acquire()
+        try:
+            if self.free_handles:
+                self.pool_stats.handles_reused += 1
+                return self.free_handles.pop()
+            else:
+                self.pool_stats.handles_created += 1
+                return None
+        finally:
+            self.pool_stats_lock.release()
+
+    def _recycle_handle(self, transfer, handle):
+        if transfer.handle is handle:
+            transfer.handle = None
+        if len(self.free_handles) < MAX_FREE_HANDLES:
+            # reset() also drops our python callbacks, so the handle doesn't
+            # keep the transfer alive.
+            handle.reset()
+            self.free_handles.append(handle)
+        else:
+            handle.close()
+
+    def _record_connections(self, handle):
+        try:
+            new_connections = handle.getinfo(pycurl.NUM_CONNECTS)
+        except (AttributeError, pycurl.error):
+            return
+        self.pool_stats_lock.acquire()
+        try:
+            self.pool_stats.transfers += 1
+            self.pool_stats.new_connections += new_connections
+            if new_connections == 0:
+                self.pool_stats.reused_connections += 1
+        finally:
+            self.pool_stats_lock.release()
+
     def process_queues(self):
         while True:
             try:
                 transfer = self.transfers_to_add.get_nowait()
             except Queue.Empty:
                 break
+            handle = self._get_handle()
             try:
-                transfer.build_handle()
+                transfer.build_handle(handle, self.share)
             except NetworkError, e:
+                if transfer.handle is not None:
+                    self._recycle_handle(transfer, transfer.handle)
                 transfer.call_errback(e)
                 continue
             self.transfer_map[transfer.handle] = transfer
@@ -945,24 +1202,32 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             transfer.on_cancel(remove_file)
+            handle = transfer.handle
             try:
-                del self.transfer_map[transfer.handle]
+                del self.transfer_map[handle]
             except KeyError:
                 continue
-            self.multi.remove_handle(transfer.handle)
+            self.multi.remove_handle(handle)
+            self._recycle_handle(transfer, handle)
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
+            self._record_connections(handle)
+            transfer = self.pop_transfer(handle)
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer.on_finished()
             except StandardError:
                 logging.stacktrace("Error calling on_finished()")
+            self._recycle_handle(transfer, handle)
         for handle, code, message in errors:
+            self._record_connections(handle)
+            transfer = self.pop_transfer(handle)
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer.on_error(code, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_error()")
+            self._recycle_handle(transfer, handle)
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
@@ -990,6 +1255,33 @@ class HTTPClient(object):
 
         return self.transfer.get_stats()
 
+class CachedHTTPClient(object):
+    """HTTPClient for a grab_url call that used a response from the HTTP
+    cache.
+    """
+    def __init__(self, info, callback, header_callback=None):
+        self.info = info
+        self.canceled = False
+        if header_callback is not None:
+            eventloop.add_idle(self._call, 'http cache header callback',
+                               args=(header_callback,))
+        eventloop.add_idle(self._call, 'http cache callback',
+                           args=(callback,))
+
+    def _call(self, callback):
+        if not self.canceled:
+            callback(self.info)
+
+    def cancel(self, remove_file=False):
+        self.canceled = True
+
+    def get_stats(self):
+        stats = TransferStats()
+        stats.status_code = 200
+        stats.downloaded = stats.download_total = len(
+            self.info.get('body', ''))
+        return stats
+
 
 def sanitize_url(url):
     """Fix poorly constructed URLs.
@@ -1001,7 +1293,7 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None):
+        post_files=None, use_cache=False, spool_threshold=None):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -1022,11 +1314,20 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_vars: dictionary of variables to send as POST data
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
+    :param use_cache: use the HTTP cache for this request.  This only works
+        for plain GET requests that don't use write_file, resume, etag,
+        modified, content_check_callback or spool_threshold.
+    :param spool_threshold: if given, response bodies bigger than this many
+        bytes get written to a temporary file instead of being kept in
+        memory.  In that case, the callback gets 'body_path' instead of
+        'body' and is responsible for deleting the file.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
         'status': HTTP response code
         'body': The request body (if write_file is not given)
+        'body_path': Temporary file holding the request body (if
+            spool_threshold was given and the body was bigger than it)
         'content-length': Length of the downloads as an int
         'total-size': Total size of the download (this is different from
             content-length because it includes the data we are resuming from)
@@ -1045,12 +1346,44 @@ def grab_url(url, callback, errback, header_callback=None,
         return _grab_file_url(url, callback, errback, default_mime_type)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
-                post_files, write_file)
+                post_files, write_file, spool_threshold)
+        if (use_cache and http_cache is not None and
+                _can_use_cache(options) and content_check_callback is None):
+            return _grab_url_with_cache(options, callback, errback,
+                                        header_callback)
         transfer = CurlTransfer(options, callback, errback, header_callback,
                 content_check_callback)
         transfer.start()
         return HTTPClient(transfer)
 
+def _can_use_cache(options):
+    return (options.write_file is None and options.post_vars is None and
+            options.post_files is None and not options.resume and
+            options.etag is None and options.modified is None and
+            options.spool_threshold is None and not options.invalid_url)
+
+def _grab_url_with_cache(options, callback, errback, header_callback):
+    entry = http_cache.lookup(options.url)
+    if entry is not None and entry.is_fresh():
+        http_cache.record_hit()
+        return CachedHTTPClient(entry.info.copy(), callback, header_callback)
+    if entry is not None and entry.has_validator():
+        options.conditional_headers = entry.conditional_headers()
+    else:
+        entry = None
+
+    def cache_callback(info):
+        if info['status'] == 304 and entry is not None:
+            http_cache.record_revalidation()
+            info = http_cache.revalidated(entry, info)
+        else:
+            http_cache.record_miss()
+            http_cache.store(options.url, info)
+        callback(info)
+    transfer = CurlTransfer(options, cache_callback, errback, header_callback)
+    transfer.start()
+    return HTTPClient(transfer)
+
 def _grab_file_url(url, callback, errback, default_mime_type):
     path = download_utils.get_file_url_path(url)
     try:
@@ -1080,21 +1413,40 @@ def _grab_headers_using_get(url, callback, errback):
     transfer.start()
     return HTTPClient(transfer)
 
-def grab_headers(url, callback, errback):
-    """Quickly get the headers for a URL"""
+def grab_headers(url, callback, errback, use_cache=False):
+    """Quickly get the headers for a URL
+
+    :param use_cache: use a fresh response from the HTTP cache if we have
+        one, and store the response there
+    """
+    url = sanitize_url(url)
+    if use_cache and http_cache is not None:
+        cache_key = 'HEAD ' + url
+        entry = http_cache.lookup(cache_key)
+        if entry is not None and entry.is_fresh():
+            http_cache.record_hit()
+            return CachedHTTPClient(entry.info.copy(), callback)
+        callback = _make_headers_cache_callback(cache_key, callback)
+
     def errback_intercept(error):
         if isinstance(error, AuthorizationCanceled):
             # don't bother asking again
             return errback(error)
         _grab_headers_using_get(url, callback, errback)
 
-    url = sanitize_url(url)
     options = TransferOptions(url)
     options.head_request = True
     transfer = CurlTransfer(options, callback, errback_intercept)
     transfer.start()
     return HTTPClient(transfer)
 
+def _make_headers_cache_callback(cache_key, callback):
+    def cache_callback(info):
+        http_cache.record_miss()
+        http_cache.store(cache_key, info)
+        callback(info)
+    return cache_callback
+
 def init_libcurl():
     pycurl.global_init(pycurl.GLOBAL_ALL)
 
@@ -1111,6 +1463,35 @@ def register_on_start(fun):
 # FIXME - this is a singleton global and the name should be all-caps
 curl_manager = None
 
+http_cache = None
+
+def init_http_cache(directory, max_size=httpcache.DEFAULT_MAX_SIZE):
+    """Start using an HTTP cache stored in directory.
+
+    After this, grab_url() and grab_headers() calls with use_cache=True will
+    use the cache.
+    """
+    global http_cache
+    http_cache = httpcache.HTTPCache(directory, max_size)
+
+def get_http_cache_stats():
+    """Get a HTTPCacheStats object for the HTTP cache.
+
+    :returns: HTTPCacheStats, or None if the cache isn't enabled
+    """
+    if http_cache is None:
+        return None
+    return http_cache.get_stats()
+
+def get_connection_pool_stats():
+    """Get a ConnectionPoolStats object for the libcurl thread.
+
+    :returns: ConnectionPoolStats, or None if the thread isn't running
+    """
+    if curl_manager is None:
+        return None
+    return curl_manager.get_pool_stats()
+
 def start_thread():
     global curl_manager
     curl_manager = LibCURLManager()
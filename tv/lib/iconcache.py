@@ -57,7 +57,8 @@ class IconCacheUpdater:
                    and item.url == item.dbItem.get_thumbnail_url()):
                 is_vital = False
         if self.running_count < RUNNING_MAX:
-            eventloop.add_idle(item.request_icon, "Icon Request")
+            eventloop.add_idle(item.request_icon, "Icon Request",
+                               priority=eventloop.PRIORITY_BACKGROUND)
             self.running_count += 1
         else:
             if is_vital:
@@ -78,7 +79,8 @@ class IconCacheUpdater:
             self.running_count -= 1
             return
 
-        eventloop.add_idle(item.request_icon, "Icon Request")
+        eventloop.add_idle(item.request_icon, "Icon Request",
+                           priority=eventloop.PRIORITY_BACKGROUND)
 
     @eventloop.as_idle
     def clear_vital(self):
@@ -296,7 +298,7 @@ class IconCache(DDBObject):
 
         # Last try, get the icon from HTTP.
         httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+                lambda error: self.error_callback(url, error), use_cache=True)
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
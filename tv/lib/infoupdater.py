@@ -34,14 +34,21 @@
 * :class:`InfoUpdaterCallbackList` -- tracks the list of callbacks for
   info updater
 """
+import logging
+
+from miro import messages
 from miro import signals
 
 class InfoUpdaterCallbackList(object):
     """Tracks the list of callbacks for InfoUpdater.
+
+    :param on_empty: function to call with ``type_`` and ``id_`` when the
+                     last callback for them is removed
     """
 
-    def __init__(self):
+    def __init__(self, on_empty=None):
         self._callbacks = {}
+        self._on_empty = on_empty
 
     def add(self, type_, id_, callback):
         """Adds the callback to the list for ``type_`` ``id_``.
@@ -65,6 +72,8 @@ class InfoUpdaterCallbackList(object):
         callback_set.remove(callback)
         if len(callback_set) == 0:
             del self._callbacks[key]
+            if self._on_empty is not None:
+                self._on_empty(type_, id_)
 
     def get(self, type_, id_):
         """Get the list of callbacks for ``type_``, ``id_``.
@@ -109,14 +118,68 @@ class InfoUpdater(signals.SignalEmitter):
             self.create_signal('%s-removed' % prefix)
 
         self.item_list_callbacks = InfoUpdaterCallbackList()
-        self.item_changed_callbacks = InfoUpdaterCallbackList()
+        self.item_changed_callbacks = InfoUpdaterCallbackList(
+                self._forget_item_infos)
+        # maps (type, id) -> dict mapping item ids to the last ItemInfo we got
+        # for them.  We use this to rebuild ItemInfos from ItemInfoDeltas.
+        self._item_infos = {}
 
     def handle_items_changed(self, message):
+        self._update_item_infos(message)
         callback_list = self.item_changed_callbacks
         for callback in callback_list.get(message.type, message.id):
             callback(message)
 
+    def _update_item_infos(self, message):
+        """Update _item_infos and replace ItemInfoDeltas in message.changed
+        with ItemInfo objects.
+        """
+        key = (message.type, message.id)
+        if not self.item_changed_callbacks.get(*key):
+            # nobody is listening, so we don't need to keep track of infos.
+            # Deltas are useless without them, so drop those.
+            self._item_infos.pop(key, None)
+            message.changed = [obj for obj in message.changed
+                               if not isinstance(obj, messages.ItemInfoDelta)]
+            return
+        infos = self._item_infos.setdefault(key, {})
+        for info in message.added:
+            infos[info.id] = info
+        changed = []
+        unknown_ids = []
+        for obj in message.changed:
+            if isinstance(obj, messages.ItemInfoDelta):
+                try:
+                    obj = obj.apply(infos[obj.id])
+                except KeyError:
+                    # We don't have an ItemInfo to apply the delta to.  Ask
+                    # the backend to send us the whole thing.
+                    unknown_ids.append(obj.id)
+                    continue
+            infos[obj.id] = obj
+            changed.append(obj)
+        message.changed = changed
+        for id_ in message.removed:
+            infos.pop(id_, None)
+        if unknown_ids:
+            logging.info("Got ItemInfoDeltas for unknown items (%s %s), "
+                         "asking for full ItemInfos", message.type,
+                         message.id)
+            messages.ResendItemInfos(message.type, message.id,
+                                     unknown_ids).send_to_backend()
+
+    def _forget_item_infos(self, type_, id_):
+        self._item_infos.pop((type_, id_), None)
+
     def handle_item_list(self, message):
+        key = (message.type, message.id)
+        if self.item_changed_callbacks.get(*key):
+            self._item_infos[key] = dict((info.id, info)
+                                         for info in message.items)
+        else:
+            # Without changed callbacks, _forget_item_infos() would never
+            # get called for this list.
+            self._item_infos.pop(key, None)
         callback_list = self.item_list_callbacks
         for callback in callback_list.get(message.type, message.id):
             callback(message)
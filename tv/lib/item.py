@@ -36,14 +36,12 @@ import locale
 import os.path
 import traceback
 import logging
-import re
 import shutil
 import time
 
 from miro.gtcache import gettext as _
 from miro.util import (check_u, returns_unicode, check_f, returns_filename,
-                       quote_unicode_url, stringify, get_first_video_enclosure,
-                       entity_replace)
+                       stringify)
 from miro.plat.utils import (filename_to_unicode, unicode_to_filename,
                              utf8_to_filename)
 
@@ -69,263 +67,23 @@ from miro import signals
 from miro import search
 from miro import models
 from miro import metadata
+from miro.feedparserutil import (FeedParserValues, CONTENT_KEYS,
+                                 ENCLOSURE_KEYS, KNOWN_MIME_TYPES,
+                                 MIME_SUBSITUTIONS)
 
 _charset = locale.getpreferredencoding()
 
-KNOWN_MIME_TYPES = (u'audio', u'video')
-KNOWN_MIME_SUBTYPES = (
-    u'mov', u'wmv', u'mp4', u'mp3',
-    u'mpg', u'mpeg', u'avi', u'x-flv',
-    u'x-msvideo', u'm4v', u'mkv', u'm2v', u'ogg'
-    )
-MIME_SUBSITUTIONS = {
-    u'QUICKTIME': u'MOV',
-}
-
 # We don't mdp_state as of version 5.0, but we need to set this for
 # DeviceItems so that older versions can read the device DB
 MDP_STATE_RAN = 1
 
-def _check_for_image(path, element):
-    """Given an element (which is really a dict), traverses
-    the path in the element and if that turns out to be an image,
-    then it returns True.
-
-    Otherwise it returns False.
-    """
-    for part in path:
-        try:
-            element = element[part]
-        except (KeyError, TypeError):
-            return False
-    if ((isinstance(element, basestring)
-         and element.endswith((".jpg", ".jpeg", ".png", ".gif")))):
-        return True
-    return False
-
-class FeedParserValues(object):
-    """Helper class to get values from feedparser entries
-
-    FeedParserValues objects inspect the FeedParserDict for the entry
-    attribute for various attributes using in Item (entry_title,
-    rss_id, url, etc...).
-    """
-    def __init__(self, entry):
-        self.entry = entry
-        self.first_video_enclosure = get_first_video_enclosure(entry)
-
-        self.data = {
-            'license': entry.get("license"),
-            'rss_id': entry.get('id'),
-            'entry_title': self._calc_title(),
-            'thumbnail_url': self._calc_thumbnail_url(),
-            'entry_description': self._calc_raw_description(),
-            'link': self._calc_link(),
-            'payment_link': self._calc_payment_link(),
-            'comments_link': self._calc_comments_link(),
-            'url': self._calc_url(),
-            'enclosure_size': self._calc_enclosure_size(),
-            'enclosure_type': self._calc_enclosure_type(),
-            'enclosure_format': self._calc_enclosure_format(),
-            'releaseDateObj': self._calc_release_date(),
-        }
-
-    def update_item(self, item):
-        for key, value in self.data.items():
-            setattr(item, key, value)
-
-    def compare_to_item(self, item):
-        for key, value in self.data.items():
-            if getattr(item, key) != value:
-                return False
-        return True
-
-    def compare_to_item_enclosures(self, item):
-        compare_keys = (
-            'url', 'enclosure_size', 'enclosure_type',
-            'enclosure_format'
-            )
-        for key in compare_keys:
-            if getattr(item, key) != self.data[key]:
-                return False
-        return True
-
-    def _calc_title(self):
-        if hasattr(self.entry, "title"):
-            # The title attribute shouldn't use entities, but some in
-            # the wild do (#11413).  In that case, try to fix them.
-            title = entity_replace(self.entry.title)
-            # Strip tags from the title.
-            p = re.compile('<.*?>')
-            return p.sub('', title)
-
-        if ((self.first_video_enclosure
-             and 'url' in self.first_video_enclosure)):
-            return self.first_video_enclosure['url'].decode("ascii",
-                                                                "replace")
-        return None
-
-    def _calc_thumbnail_url(self):
-        """Returns a link to the thumbnail of the video.  """
-        # Try to get the thumbnail specific to the video enclosure
-        if self.first_video_enclosure is not None:
-            url = self._get_element_thumbnail(self.first_video_enclosure)
-            if url is not None:
-                return url
-
-        # Try to get any enclosure thumbnail
-        if "enclosures" in self.entry:
-            for enclosure in self.entry["enclosures"]:
-                url = self._get_element_thumbnail(enclosure)
-                if url is not None:
-                    return url
-
-        # Try to get the thumbnail for our entry
-        return self._get_element_thumbnail(self.entry)
-
-    def _get_element_thumbnail(self, element):
-        # handles <thumbnail><href>http:...
-        if _check_for_image(("thumbnail", "href"), element):
-            return element["thumbnail"]["href"]
-        if _check_for_image(("thumbnail",), element):
-            return element["thumbnail"]
-
-        return None
-
-    def _calc_raw_description(self):
-        """Check the enclosure to see if it has a description first.
-        If not, then grab the description from the entry.
-
-        Both first_video_enclosure and entry are FeedParserDicts,
-        which does some fancy footwork with normalizing feed entry
-        data.
-        """
-        rv = None
-        if self.first_video_enclosure:
-            rv = self.first_video_enclosure.get("text", None)
-        if not rv and self.entry:
-            rv = self.entry.get("description", None)
-        if not rv:
-            return u''
-        return rv
-
-    def _calc_link(self):
-        if hasattr(self.entry, "link"):
-            link = self.entry.link
-            if isinstance(link, dict):
-                try:
-                    link = link['href']
-                except KeyError:
-                    return u""
-            if link is None:
-                return u""
-            if isinstance(link, unicode):
-                return link
-            try:
-                return link.decode('ascii', 'replace')
-            except UnicodeDecodeError:
-                return link.decode('ascii', 'ignore')
-        return u""
-
-    def _calc_payment_link(self):
-        try:
-            return self.first_video_enclosure.payment_url.decode(
-                'ascii', 'replace')
-        except (AttributeError, UnicodeDecodeError):
-            try:
-                return self.entry.payment_url.decode('ascii','replace')
-            except (AttributeError, UnicodeDecodeError):
-                return u""
-
-    def _calc_comments_link(self):
-        return self.entry.get('comments', u"")
-
-    def _calc_url(self):
-        if (self.first_video_enclosure is not None and
-                'url' in self.first_video_enclosure):
-            url = self.first_video_enclosure['url'].replace('+', '%20')
-            return quote_unicode_url(url)
-        else:
-            return u''
-
-    def _calc_enclosure_size(self):
-        enc = self.first_video_enclosure
-        if enc is not None and "torrent" not in enc.get("type", ""):
-            try:
-                return int(enc['length'])
-            except (KeyError, ValueError):
-                return None
-
-    def _calc_enclosure_type(self):
-        if ((self.first_video_enclosure
-             and self.first_video_enclosure.has_key('type'))):
-            return self.first_video_enclosure['type']
-        else:
-            return None
-
-    def _calc_enclosure_format(self):
-        enclosure = self.first_video_enclosure
-        if enclosure:
-            try:
-                extension = enclosure['url'].split('.')[-1]
-                extension = extension.lower().encode('ascii', 'replace')
-            except (SystemExit, KeyboardInterrupt):
-                raise
-            except KeyError:
-                extension = u''
-            # Hack for mp3s, "mpeg audio" isn't clear enough
-            if extension.lower() == u'mp3':
-                return u'.mp3'
-            if enclosure.get('type'):
-                enc = enclosure['type'].decode('ascii', 'replace')
-                if "/" in enc:
-                    mtype, subtype = enc.split('/', 1)
-                    mtype = mtype.lower()
-                    if mtype in KNOWN_MIME_TYPES:
-                        format = subtype.split(';')[0].upper()
-                        if mtype == u'audio':
-                            format += u' AUDIO'
-                        if format.startswith(u'X-'):
-                            format = format[2:]
-                        return (u'.%s' %
-                                MIME_SUBSITUTIONS.get(format, format).lower())
-
-            if extension in KNOWN_MIME_SUBTYPES:
-                return u'.%s' % extension
-        return None
+def item_content_key(item):
+    """Get the FeedParserValues.content_key() that matches an item."""
+    return tuple(getattr(item, key) for key in CONTENT_KEYS)
 
-    def _calc_release_date(self):
-        # FIXME - this is awful.  need to handle site-specific things
-        # a different way.
-        release_date = None
-
-        # if this is not a youtube url, then we try to use
-        # updated_parsed from either the enclosure or the entry
-        if "youtube.com" not in self._calc_url():
-            try:
-                release_date = self.first_video_enclosure.updated_parsed
-            except AttributeError:
-                try:
-                    release_date = self.entry.updated_parsed
-                except AttributeError:
-                    pass
-
-        # if this is a youtube url and/or there was no updated_parsed,
-        # then we try to use the published_parsed from either the
-        # enclosure or the entry
-        if release_date is None:
-            try:
-                release_date = self.first_video_enclosure.published_parsed
-            except AttributeError:
-                try:
-                    release_date = self.entry.published_parsed
-                except AttributeError:
-                    pass
-
-        if release_date is not None:
-            return datetime(*release_date[0:7])
-
-        return datetime.min
+def item_enclosure_key(item):
+    """Get the FeedParserValues.enclosure_key() that matches an item."""
+    return tuple(getattr(item, key) for key in ENCLOSURE_KEYS)
 
 class FileFeedParserValues(FeedParserValues):
     """FeedParserValues for FileItems"""
@@ -637,6 +395,16 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
                              "feed.origURL NOT LIKE 'dtv:search%'",
                              joins={'feed': 'item.feed_id = feed.id'})
 
+    @classmethod
+    def feed_content_keys(cls, feed_id):
+        """Get (id, item_content_key()) tuples for a feed's items.
+
+        This selects just the CONTENT_KEYS columns, so we don't have to load
+        the items or their cold columns.
+        """
+        return [(row[0], tuple(row[1:])) for row in
+                cls.select(('id',) + CONTENT_KEYS, 'feed_id=?', (feed_id,))]
+
     @classmethod
     def feed_view(cls, feed_id):
         return cls.make_view('feed_id=?', (feed_id,))
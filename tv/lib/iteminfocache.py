@@ -46,11 +46,25 @@ The general strategy is to just dumbly pickle the data and if we notice any
 errors, or if the DB version changes, throw away the cache and rebuild.  We
 use a lot of direct SQL queries in this code, borrowing app.db's cursor.  This
 is slightly naughty, but results in fast peformance.
+
+MmapItemInfoCache is an alternative backend that stores the pickles in a file
+outside of the database.  The file is memory-mapped and ItemInfos are only
+unpickled when something asks for them, so loading the cache doesn't depend
+on the number of items and we don't keep an ItemInfo in memory for items that
+are never displayed.
 """
 
+from array import array
+import bisect
 import cPickle
+import heapq
 import itertools
 import logging
+import mmap
+import os
+import struct
+import sys
+import uuid
 
 from miro import app
 from miro import dbupgradeprogress
@@ -88,6 +102,7 @@ class ItemInfoCache(signals.SignalEmitter):
         self.create_signal('removed')
         self.id_to_info = None
         self.loaded = False
+        self.did_failsafe_load = False
 
     def load(self):
         # call _reset_changes() first.  This way if we throw an exception
@@ -102,9 +117,10 @@ class ItemInfoCache(signals.SignalEmitter):
         if self.id_to_info is None:
             self._failsafe_load()
             # the current data is suspect, delete it
-            app.db.cursor.execute("DELETE FROM item_info_cache")
+            self._delete_saved_data()
             did_failsafe_load = True
         app.db.set_variable(self.VERSION_KEY, self.version())
+        self.did_failsafe_load = did_failsafe_load
         self._save_dc = None
         if did_failsafe_load:
             # Need to save the cache data we just created
@@ -146,6 +162,9 @@ class ItemInfoCache(signals.SignalEmitter):
             if len(quick_load_values) == self._db_item_count():
                 self.id_to_info = quick_load_values
 
+    def _delete_saved_data(self):
+        app.db.cursor.execute("DELETE FROM item_info_cache")
+
     def _db_item_count(self):
         app.db.cursor.execute("SELECT COUNT(*) from item")
         return app.db.cursor.fetchone()[0]
@@ -291,6 +310,439 @@ class ItemInfoCache(signals.SignalEmitter):
         self.schedule_save_to_db()
         self.emit("removed", info)
 
+class _InfoFile(object):
+    """Stores pickled ItemInfos for MmapItemInfoCache.
+
+    The data is kept in 2 files:
+
+    - A data file that holds a random token, then pickles stored back to
+      back.  New pickles get appended to the end.  The token is part of the
+      filename, so a new data file never overwrites one that an index refers
+      to.
+    - An index file that holds a header, then 3 columns: item ids (sorted),
+      offsets into the data file, and pickle lengths.  The index file is
+      replaced atomically each time we save.
+
+    The columns are stored using the native byte order, which is fine since
+    the file is just a cache for this machine.  Offsets are 32-bit, so the
+    data file can't be bigger than 4GB.
+    """
+
+    MAGIC = 'MIIC'
+    FORMAT_VERSION = 1
+    # magic, format version, byte order, count, data size, dead bytes, token,
+    # key
+    HEADER = struct.Struct('<4sIIIII16s64s')
+    MAX_DATA_SIZE = 0xffffffff
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.token = None
+        self.key = None
+        self.ids = array('i')
+        self.offsets = array('I')
+        self.lengths = array('I')
+        self.data_size = 0
+        self.dead_size = 0
+        self._mmap = None
+
+    def data_path(self, token):
+        return '%s-%s.dat' % (self.path, token.encode('hex'))
+
+    def open(self):
+        """Open the files
+
+        :raises IOError: files don't exist
+        :raises ValueError: files are corrupt
+        """
+        f = open(self.index_path, 'rb')
+        try:
+            header = f.read(self.HEADER.size)
+            if len(header) != self.HEADER.size:
+                raise ValueError("index header truncated")
+            (magic, format_version, byteorder, count, data_size, dead_size,
+                    token, key) = self.HEADER.unpack(header)
+            if magic != self.MAGIC or format_version != self.FORMAT_VERSION:
+                raise ValueError("bad index header")
+            if byteorder != self._byteorder():
+                raise ValueError("index has the wrong byte order")
+            ids = array('i')
+            offsets = array('I')
+            lengths = array('I')
+            try:
+                for column in (ids, offsets, lengths):
+                    column.fromfile(f, count)
+            except EOFError:
+                raise ValueError("index columns truncated")
+        finally:
+            f.close()
+
+        data_file = open(self.data_path(token), 'rb')
+        try:
+            if os.fstat(data_file.fileno()).st_size < data_size:
+                raise ValueError("data file truncated")
+            if data_file.read(len(token)) != token:
+                raise ValueError("data file token doesn't match")
+            data_mmap = mmap.mmap(data_file.fileno(), data_size,
+                    access=mmap.ACCESS_READ)
+        finally:
+            # the mmap keeps its own handle to the file
+            data_file.close()
+
+        self.close()
+        self.token = token
+        self.key = key.rstrip('\0')
+        self.ids = ids
+        self.offsets = offsets
+        self.lengths = lengths
+        self.data_size = data_size
+        self.dead_size = dead_size
+        self._mmap = data_mmap
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _byteorder(self):
+        if sys.byteorder == 'little':
+            return 1
+        else:
+            return 2
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        pos = bisect.bisect_left(self.ids, id_)
+        return pos < len(self.ids) and self.ids[pos] == id_
+
+    def read(self, id_):
+        """Get the pickle stored for an item id.
+
+        :raises KeyError: id_ not stored in the file
+        """
+        pos = bisect.bisect_left(self.ids, id_)
+        if pos == len(self.ids) or self.ids[pos] != id_:
+            raise KeyError(id_)
+        start = self.offsets[pos]
+        return self._mmap[start:start+self.lengths[pos]]
+
+    def live_size(self):
+        return sum(self.lengths)
+
+    def rewrite(self, key, blobs):
+        """Write a new set of files.
+
+        :param key: string to store in the header (at most 64 bytes).
+        :param blobs: iterable of (id, pickle) tuples, sorted by id.
+        """
+        token = uuid.uuid4().bytes
+        ids = array('i')
+        offsets = array('I')
+        lengths = array('I')
+        data_path = self.data_path(token)
+        f = open(data_path, 'wb')
+        try:
+            f.write(token)
+            pos = len(token)
+            for id_, blob in blobs:
+                ids.append(id_)
+                offsets.append(pos)
+                lengths.append(len(blob))
+                f.write(blob)
+                pos += len(blob)
+            if pos > self.MAX_DATA_SIZE:
+                raise ValueError("item info data too big")
+        finally:
+            f.close()
+        old_token = self.token
+        self.close()
+        try:
+            self._write_index(token, key, ids, offsets, lengths, pos, 0)
+        except:
+            os.remove(data_path)
+            raise
+        if old_token is not None:
+            try:
+                os.remove(self.data_path(old_token))
+            except OSError:
+                logging.warn("Error deleting old item info data file",
+                        exc_info=True)
+        self.open()
+
+    def update(self, new_blobs, deleted_ids):
+        """Append data to the data file and rewrite the index.
+
+        :param new_blobs: dict mapping ids to pickles for added and changed
+            item infos
+        :param deleted_ids: ids to remove from the index
+        """
+        f = open(self.data_path(self.token), 'r+b')
+        try:
+            # There could be junk at the end of the file if we crashed
+            # during an earlier update(), just overwrite it
+            f.seek(self.data_size)
+            pos = self.data_size
+            added = []
+            for id_ in sorted(new_blobs):
+                blob = new_blobs[id_]
+                added.append((id_, pos, len(blob)))
+                f.write(blob)
+                pos += len(blob)
+            if pos > self.MAX_DATA_SIZE:
+                raise ValueError("item info data too big")
+            if os.fstat(f.fileno()).st_size > pos:
+                f.truncate()
+        finally:
+            f.close()
+
+        # merge the rows we're keeping with the new ones.  Both are sorted
+        # by id, so heapq.merge() keeps the result sorted.
+        replaced = deleted_ids.union(new_blobs)
+        kept = []
+        dead_size = self.dead_size
+        for row in itertools.izip(self.ids, self.offsets, self.lengths):
+            if row[0] in replaced:
+                dead_size += row[2]
+            else:
+                kept.append(row)
+        ids = array('i')
+        offsets = array('I')
+        lengths = array('I')
+        for id_, offset, length in heapq.merge(kept, added):
+            ids.append(id_)
+            offsets.append(offset)
+            lengths.append(length)
+        self.close()
+        self._write_index(self.token, self.key, ids, offsets, lengths, pos,
+                dead_size)
+        self.open()
+
+    def _write_index(self, token, key, ids, offsets, lengths, data_size,
+            dead_size):
+        if len(key) > 64:
+            raise ValueError("key too long: %r" % key)
+        header = self.HEADER.pack(self.MAGIC, self.FORMAT_VERSION,
+                self._byteorder(), len(ids), data_size, dead_size, token, key)
+        temp_path = self.index_path + '.tmp'
+        f = open(temp_path, 'wb')
+        try:
+            f.write(header)
+            for column in (ids, offsets, lengths):
+                column.tofile(f)
+        finally:
+            f.close()
+        if sys.platform == 'win32' and os.path.exists(self.index_path):
+            # windows can't rename over an existing file
+            os.remove(self.index_path)
+        os.rename(temp_path, self.index_path)
+
+    def delete(self):
+        """Remove the files from disk.
+
+        This also removes data files that were left behind if we crashed in
+        the middle of rewrite().
+        """
+        self.close()
+        self.token = None
+        directory, basename = os.path.split(self.path)
+        for filename in os.listdir(directory):
+            if (filename == os.path.basename(self.index_path) or
+                    (filename.startswith(basename + '-') and
+                        filename.endswith('.dat'))):
+                os.remove(os.path.join(directory, filename))
+        self.ids = array('i')
+        self.offsets = array('I')
+        self.lengths = array('I')
+        self.data_size = self.dead_size = 0
+
+class _MappedInfoMap(object):
+    """Maps item ids to ItemInfos for MmapItemInfoCache.
+
+    This works like the id_to_info dict that ItemInfoCache uses, but
+    ItemInfos are unpickled from an _InfoFile the first time they're
+    accessed.  Changes are kept in memory until they are saved to the file.
+    """
+    def __init__(self, info_file, blob_to_info):
+        self.info_file = info_file
+        self.blob_to_info = blob_to_info
+        # ItemInfos that we've unpickled or that have been set since the last
+        # save.  Unchanged ones get dropped in saved().
+        self.loaded = {}
+        # ids deleted since the last save
+        self.deleted = set()
+
+    def __getitem__(self, id_):
+        return self._get(id_, True)
+
+    def _get(self, id_, cache):
+        """Get an ItemInfo, unpickling it if needed.
+
+        :param cache: should we keep an unpickled ItemInfo in loaded?
+        """
+        try:
+            return self.loaded[id_]
+        except KeyError:
+            if id_ in self.deleted:
+                raise
+        blob = self.info_file.read(id_)
+        try:
+            info = self.blob_to_info(blob)
+        except (StandardError, cPickle.UnpicklingError), e:
+            # Treat this the same as a missing info.  ItemInfoCache will
+            # recreate it.
+            logging.warn("Error loading item info for %s: %s", id_, e)
+            raise KeyError(id_)
+        if cache:
+            self.loaded[id_] = info
+        return info
+
+    def __setitem__(self, id_, info):
+        self.loaded[id_] = info
+        self.deleted.discard(id_)
+
+    def __delitem__(self, id_):
+        if id_ not in self:
+            raise KeyError(id_)
+        self.loaded.pop(id_, None)
+        self.deleted.add(id_)
+
+    def __contains__(self, id_):
+        return id_ in self.loaded or (id_ not in self.deleted and
+                id_ in self.info_file)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def pop(self, id_):
+        if id_ not in self:
+            raise KeyError(id_)
+        try:
+            return self[id_]
+        finally:
+            del self[id_]
+
+    def keys(self):
+        ids = set(self.info_file.ids)
+        ids.difference_update(self.deleted)
+        ids.update(self.loaded)
+        return list(ids)
+
+    def values(self):
+        # Don't keep the ItemInfos that we unpickle here.  values() gets
+        # called for things like rebuilding the search index, and caching
+        # every ItemInfo would defeat the point of loading them lazily.
+        values = []
+        for id_ in self.keys():
+            try:
+                values.append(self._get(id_, False))
+            except KeyError:
+                pass
+        return values
+
+    def saved(self, changed_ids):
+        """Call this after the changes have been written to our _InfoFile.
+
+        ItemInfos that we unpickled but weren't changed are dropped, so that
+        they don't pile up in memory.  They can be unpickled again if they
+        get used.
+
+        :param changed_ids: ids of the ItemInfos that were just saved
+        """
+        self.loaded = dict((id_, self.loaded[id_]) for id_ in changed_ids
+                           if id_ in self.loaded)
+        self.deleted.clear()
+
+class MmapItemInfoCache(ItemInfoCache):
+    """ItemInfoCache that stores ItemInfos in a memory-mapped file.
+
+    Loading only reads the file's index, ItemInfos get unpickled the first
+    time they're used.  Saving appends the changed ItemInfos to the data file
+    and writes a new index.
+
+    :param path: base path for the cache files
+    """
+
+    FILE_TOKEN_KEY = 'item_info_cache_file_token'
+    # Rewrite the data file when it has more unused bytes than this and more
+    # unused bytes than used ones.
+    COMPACT_THRESHOLD = 1024 * 1024
+
+    def __init__(self, path):
+        ItemInfoCache.__init__(self)
+        self.info_file = _InfoFile(path)
+
+    def version(self):
+        # Use a different version than ItemInfoCache, so that if we switch
+        # back and forth between the two, we don't use stale data.
+        return ItemInfoCache.version(self) + '-mmap'
+
+    def _quick_load(self):
+        """Load ItemInfos using our data files."""
+        saved_db_version = app.db.get_variable(self.VERSION_KEY)
+        if saved_db_version != self.version():
+            return
+        self.info_file.open()
+        # Check that the files are the ones that we last saved for this
+        # database.  They won't be if we're using a backup of the database
+        # for example.
+        if (self.info_file.key != self.version() or
+                self.info_file.token !=
+                app.db.get_variable(self.FILE_TOKEN_KEY)):
+            return
+        if len(self.info_file) == self._db_item_count():
+            self.id_to_info = _MappedInfoMap(self.info_file,
+                    self._blob_to_info)
+
+    def _delete_saved_data(self):
+        try:
+            self.info_file.delete()
+        except EnvironmentError, e:
+            logging.warn("Error deleting item info cache files: %s", e)
+
+    def save(self):
+        if isinstance(self.id_to_info, _MappedInfoMap):
+            self._save_changes()
+        else:
+            # We did a failsafe load, write out all of the data.
+            infos = self.id_to_info
+            self._rewrite((id_, str(self._info_to_blob(infos[id_])))
+                    for id_ in sorted(infos))
+            # Start with nothing loaded, the ItemInfos will get unpickled
+            # as they're needed.
+            self.id_to_info = _MappedInfoMap(self.info_file,
+                    self._blob_to_info)
+        self._reset_changes()
+
+    def _save_changes(self):
+        deleted = self._infos_deleted.union(self.id_to_info.deleted)
+        if not (self._infos_added or self._infos_changed or deleted):
+            self.id_to_info.saved(())
+            return
+        new_blobs = {}
+        for infos in (self._infos_added, self._infos_changed):
+            for id_, info in infos.iteritems():
+                new_blobs[id_] = str(self._info_to_blob(info))
+        self.info_file.update(new_blobs, deleted)
+        self.id_to_info.saved(new_blobs)
+        if self.info_file.dead_size > max(self.COMPACT_THRESHOLD,
+                self.info_file.live_size()):
+            self._compact()
+
+    def _compact(self):
+        info_file = self.info_file
+        self._rewrite((id_, info_file.read(id_))
+                for id_ in list(info_file.ids))
+
+    def _rewrite(self, blobs):
+        self.info_file.rewrite(self.version(), blobs)
+        app.db.set_variable(self.FILE_TOKEN_KEY, self.info_file.token)
+
 def create_sql():
     """Get the SQL needed to create the tables we need for the ItemInfo cache
     """
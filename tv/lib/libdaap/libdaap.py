@@ -34,6 +34,8 @@ import os
 import sys
 import itertools
 import socket
+import select
+import time
 import random
 import traceback
 # XXX merged into urllib.urlparse in Python 3
@@ -42,6 +44,7 @@ import urlparse
 import BaseHTTPServer
 import SocketServer
 import threading
+import Queue
 import httplib
 import gzip
 try:
@@ -65,6 +68,16 @@ DAAP_TIMEOUT = 1800    # timeout (in seconds)
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
 
+# Number of worker threads serving requests.  A session can have requests
+# going on its control connection, a data connection and a heartbeat
+# connection at the same time, so leave room for all of them.
+DAAP_MAXTHREADS = 4 * DAAP_MAXCONN
+# Number of requests that can wait for a worker before we send 503.
+DAAP_MAXQUEUE = DAAP_MAXTHREADS
+# A client that stalls in the middle of a request gets cut off after this
+# many seconds, so that it doesn't hold onto a worker.
+DAAP_REQUEST_TIMEOUT = 60
+
 # !!! No user servicable parts below. !!!
 
 VERSION = '0.1'
@@ -106,24 +119,244 @@ class SessionObject(object):
     # on the requests which come in.
     pass
 
-class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+def make_socket_pair():
+    # socket.socketpair() isn't available on Windows, fake it with a
+    # loopback connection there.
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, address = listener.accept()
+    listener.close()
+    return sender, receiver
+
+class DaapThreadPoolMixIn(object):
+    # Like SocketServer.ThreadingMixIn, but instead of spawning a new thread
+    # for every connection, requests are handed over to a bounded set of
+    # worker threads which get reused.
+    #
+    # Workers don't sit on keep-alive connections between requests.  Idle
+    # connections are parked with a watcher thread, which hands them to a
+    # worker once there is something to read and drops them after
+    # idle_timeout seconds of silence.  Workers are started on demand, up
+    # to max_threads.  If they are all busy, up to max_queue requests wait
+    # for one to free up; beyond that we reply 503 and hang up.
+    max_threads = DAAP_MAXTHREADS
+    max_queue = DAAP_MAXQUEUE
+    idle_timeout = DAAP_TIMEOUT
+
+    UNAVAILABLE_RESPONSE = ('HTTP/1.1 %d Service Unavailable\r\n'
+                            'Content-Length: 0\r\n'
+                            'Connection: close\r\n\r\n' % DAAP_UNAVAILABLE)
+
+    def init_pool(self, max_threads, max_queue):
+        self.max_threads = max_threads
+        self.max_queue = max_queue
+        self.request_queue = Queue.Queue()
+        self.pool_lock = threading.Lock()
+        self.workers = []
+        self.idle_workers = 0
+        self.pool_stopped = False
+        # fileno -> (handler, time it went idle)
+        self.idle_connections = dict()
+        self.wake_sender, self.wake_receiver = make_socket_pair()
+        self.watcher = threading.Thread(target=self.watch_connections,
+                                        name='DAAP Connection Watcher')
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def process_request(self, request, client_address):
+        # Don't give the new connection a worker until it sends something.
+        handler = self.RequestHandlerClass(request, client_address, self)
+        self.park_connection(handler)
+
+    def park_connection(self, handler):
+        with self.pool_lock:
+            if self.pool_stopped:
+                stopped = True
+            else:
+                stopped = False
+                self.idle_connections[handler.connection.fileno()] = (
+                        handler, time.time())
+        if stopped:
+            self.drop_connection(handler)
+        else:
+            self.wake_watcher()
+
+    def wake_watcher(self):
+        try:
+            self.wake_sender.send('x')
+        except socket.error:
+            pass
+
+    def watch_connections(self):
+        wake_fd = self.wake_receiver.fileno()
+        while True:
+            with self.pool_lock:
+                if self.pool_stopped:
+                    break
+                fds = self.idle_connections.keys()
+                if self.idle_connections:
+                    oldest = min(idle_time for handler, idle_time in
+                                 self.idle_connections.values())
+                    timeout = max(0, oldest + self.idle_timeout - time.time())
+                else:
+                    timeout = None
+            try:
+                r, w, x = select.select([wake_fd] + fds, [], [], timeout)
+            except select.error, (err, errstring):
+                if err == errno.EINTR:
+                    continue
+                raise
+            ready = []
+            expired = []
+            with self.pool_lock:
+                for fd in r:
+                    if fd == wake_fd:
+                        self.wake_receiver.recv(1024)
+                    elif fd in self.idle_connections:
+                        handler, idle_time = self.idle_connections.pop(fd)
+                        ready.append(handler)
+                now = time.time()
+                for fd, (handler, idle_time) in self.idle_connections.items():
+                    if now - idle_time >= self.idle_timeout:
+                        del self.idle_connections[fd]
+                        expired.append(handler)
+            for handler in ready:
+                self.dispatch(handler)
+            for handler in expired:
+                self.drop_connection(handler)
+        # We've been stopped, hang up on everybody who is left.
+        with self.pool_lock:
+            leftover = [handler for handler, idle_time in
+                        self.idle_connections.values()]
+            self.idle_connections.clear()
+        for handler in leftover:
+            self.drop_connection(handler)
+        self.wake_sender.close()
+        self.wake_receiver.close()
+
+    def dispatch(self, handler):
+        full = False
+        with self.pool_lock:
+            if self.idle_workers:
+                # This guy's request goes to an idle worker.  Claim it now
+                # so the next request doesn't count on it too.
+                self.idle_workers -= 1
+            elif len(self.workers) < self.max_threads:
+                self.start_worker()
+            elif self.request_queue.qsize() >= self.max_queue:
+                full = True
+            if not full:
+                self.request_queue.put(handler)
+        if full:
+            # Tell the client we are full, rather than make it wait for a
+            # worker indefinitely.
+            try:
+                handler.connection.sendall(self.UNAVAILABLE_RESPONSE)
+            except socket.error:
+                pass
+            self.drop_connection(handler)
+
+    def start_worker(self):
+        # Caller must hold the pool lock.
+        t = threading.Thread(target=self.pool_worker,
+                             name='DAAP Worker Thread %d' % len(self.workers))
+        t.daemon = True
+        self.workers.append(t)
+        t.start()
+
+    def pool_worker(self):
+        current_thread = threading.current_thread()
+        while True:
+            handler = self.request_queue.get()
+            if handler is None:
+                break
+            keep_alive = self.process_request_thread(handler)
+            # Don't let the generation of the last session we served leak
+            # into the next request.
+            current_thread.__dict__.pop('generation', None)
+            # Count ourselves idle before parking the connection, so that
+            # its next request can count on us.
+            with self.pool_lock:
+                self.idle_workers += 1
+            if keep_alive:
+                self.park_connection(handler)
+        with self.pool_lock:
+            self.workers.remove(current_thread)
+
+    def process_request_thread(self, handler):
+        # Returns True if the connection should be kept open.
+        try:
+            while True:
+                if not handler.handle_request():
+                    self.drop_connection(handler)
+                    return False
+                # Pipelined requests may already be sitting in the buffer,
+                # where select() can't see them.
+                if not handler.has_buffered_input():
+                    return True
+        except:
+            self.handle_error(handler.connection, handler.client_address)
+            self.drop_connection(handler)
+            return False
+
+    def drop_connection(self, handler):
+        try:
+            handler.finish()
+        except:
+            self.handle_error(handler.connection, handler.client_address)
+        self.shutdown_request(handler.connection)
+
+    def worker_count(self):
+        with self.pool_lock:
+            return len(self.workers)
+
+    def stop_pool(self):
+        # Drop requests nobody got to, tell idle workers to go away and
+        # have the watcher close idle connections.  Busy workers exit once
+        # they are done with their current request.
+        with self.pool_lock:
+            self.pool_stopped = True
+            queued = []
+            while True:
+                try:
+                    handler = self.request_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if handler is not None:
+                    queued.append(handler)
+            for i in xrange(len(self.workers)):
+                self.request_queue.put(None)
+        for handler in queued:
+            self.drop_connection(handler)
+        self.wake_watcher()
+
+class DaapTCPServer(DaapThreadPoolMixIn, SocketServer.TCPServer):
     # GRRR!  Stupid Windows!  When bind() is called twice on a socket
     # it should return EADDRINUSE on the second one - Windows doesn't!
     # Use robust=True (default) in make_daap_server() and it will pick 
     # a new port.
     # allow_reuse_address = True    # setsockopt(... SO_REUSEADDR, 1)
-    daemon_threads = True
 
     def __init__(self, server_address, RequestHandlerClass,
-                 bind_and_activate=True):
+                 bind_and_activate=True, max_threads=DAAP_MAXTHREADS,
+                 max_queue=DAAP_MAXQUEUE):
         SocketServer.TCPServer.__init__(self, server_address,
                                         RequestHandlerClass,
                                         bind_and_activate)
+        self.init_pool(max_threads, max_queue)
         self.finished_callback = None
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
 
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.stop_pool()
+
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
     def set_backend(self, backend):
@@ -206,11 +439,34 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     server_version = 'daap.py' + ' ' + VERSION
 
-    # Not used at the moment.
-    # def __init__(self, request, client_address, server):
-    #    super(BaseHTTPRequestHandler, self).__init__(self, request,
-    #                                                   client_address,
-    #                                                   server)
+    timeout = DAAP_REQUEST_TIMEOUT
+
+    def __init__(self, request, client_address, server):
+        # Don't call the base class __init__(), it serves the whole
+        # connection on the spot.  Instead, the server calls
+        # handle_request() each time there is a request to read, and
+        # finish() when the connection goes away.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def handle_request(self):
+        """
+           handle_request() -> bool
+
+           Serve one request.  Returns False if the connection should be
+           closed.
+        """
+        self.close_connection = 1
+        self.handle_one_request()
+        return not self.close_connection and not self.wfile.closed
+
+    def has_buffered_input(self):
+        # XXX pokes into socket._fileobject internals.
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf is not None and rbuf.tell() > 0
+
     def log_message(self, format, *args):
         if self.server.log_message_callback:
             self.server.log_message_callback(format, *args)
@@ -247,8 +503,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            blob.send(self.wfile, self.connection)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
         except IOError:
@@ -795,12 +1050,15 @@ def runloop(daapserver):
     daapserver.serve_forever()
 
 def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
-                     max_conn=DAAP_MAXCONN, robust=True):
+                     max_conn=DAAP_MAXCONN, robust=True,
+                     max_threads=DAAP_MAXTHREADS, max_queue=DAAP_MAXQUEUE):
     handler = DaapHttpRequestHandler
     failed = False
     while True:
         try:
-            httpd = DaapTCPServer(('', port), handler)
+            httpd = DaapTCPServer(('', port), handler,
+                                  max_threads=max_threads,
+                                  max_queue=max_queue)
             break
         except socket.error, e:
             if robust and not port == 0:
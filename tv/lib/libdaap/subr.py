@@ -29,6 +29,10 @@
 # subr.py
 
 import os
+import errno
+import mmap
+import select
+import socket
 import stat
 import struct
 import urllib
@@ -56,30 +60,66 @@ fmts = {
     DMAP_TYPE_VERSION: ('I', 4),
 }
 
+# Structs for the tag header (code and size), and for each fixed size type.
+header_struct = struct.Struct('!4sI')
+value_structs = dict((typ, struct.Struct('!' + fmt))
+                     for typ, (fmt, size) in fmts.items()
+                     if typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING))
+item_structs = dict((typ, struct.Struct('!4sI' + fmt))
+                    for typ, (fmt, size) in fmts.items()
+                    if typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING))
+
 class StreamObj(object):
     """
        Data object for encoding HTTP responses.  Use once then dispose.
+
+       data may be a string, or a list of strings which are sent one after
+       the other.  The latter saves us from joining a big response into one
+       string before sending it.
     """
-    def __init__(self, data, content_encoding=None):
+    DEFAULT_CHUNK_SIZE = 128 * 1024
+
+    def __init__(self, data, content_encoding=None,
+                 chunksize=DEFAULT_CHUNK_SIZE):
         self.content_encoding = content_encoding
+        self.chunksize = chunksize
+        if isinstance(data, basestring):
+            parts = [data]
+        else:
+            parts = data
         if content_encoding == 'gzip':
             gzdata = StringIO()
             f = gzip.GzipFile(fileobj=gzdata, mode='wb')
-            f.write(data)
+            for part in parts:
+                f.write(part)
             f.close()
-            self.data = gzdata.getvalue()
-        else:
-            self.data = data
+            parts = [gzdata.getvalue()]
+        self.parts = parts
+        self.size = sum(len(part) for part in parts)
 
     def __str__(self):
-        return self.data
+        return ''.join(self.parts)
 
-    # Treat this as one big block of data.
+    # Hand out the data in blocks of around chunksize bytes.
     def __iter__(self):
-        yield self.data
+        chunk = []
+        chunklen = 0
+        for part in self.parts:
+            chunk.append(part)
+            chunklen += len(part)
+            if chunklen >= self.chunksize:
+                yield ''.join(chunk)
+                chunk = []
+                chunklen = 0
+        if chunk:
+            yield ''.join(chunk)
 
     def __len__(self):
-        return len(self.data)
+        return self.size
+
+    def send(self, wfile, sock):
+        for chunk in self:
+            wfile.write(chunk)
 
     def get_headers(self):
         headers = []
@@ -100,8 +140,13 @@ class ChunkedStreamObj(object):
 
        for chunk in streamobj:
            write(chunk)
+
+       or just call send(), which avoids copying the file data into Python
+       strings when the file object is a real file.
     """
     DEFAULT_CHUNK_SIZE = 128 * 1024
+    # How much of the file we map into memory at a time.
+    MMAP_WINDOW_SIZE = 64 * mmap.ALLOCATIONGRANULARITY
 
     def __init__(self, file_obj, hint, start=0, end=0,
                  chunksize=DEFAULT_CHUNK_SIZE):
@@ -153,6 +198,73 @@ class ChunkedStreamObj(object):
     def __len__(self):
         return self.streamsize
 
+    def send(self, wfile, sock):
+        """
+           send(wfile, sock) -> None
+
+           Write the stream out to the socket.  Plain files are sent
+           straight from the page cache, using sendfile() if the OS module
+           has it, otherwise by mapping the file and writing out the mapped
+           memory.  Anything else is read and written out in chunks.
+
+           In either case, the data starts at the current position of the
+           file object, same as the iterator.
+        """
+        if not isinstance(self.file_obj, file):
+            for chunk in self:
+                wfile.write(chunk)
+            return
+        offset = self.file_obj.tell()
+        # Maybe file got truncated.  Don't map past the end of it.
+        filesize = os.fstat(self.file_obj.fileno())[stat.ST_SIZE]
+        count = max(0, min(self.unread, filesize - offset))
+        if hasattr(os, 'sendfile'):
+            sent = self._sendfile(sock, offset, count)
+        else:
+            sent = self._send_mapped(sock, offset, count)
+        self.unread -= sent
+        self.file_obj.seek(offset + sent, os.SEEK_SET)
+
+    def _sendfile(self, sock, offset, count):
+        infd = self.file_obj.fileno()
+        outfd = sock.fileno()
+        sent = 0
+        while sent < count:
+            try:
+                n = os.sendfile(outfd, infd, offset + sent, count - sent)
+            except OSError, e:
+                # Sockets with a timeout are non-blocking underneath.
+                if e.errno != errno.EAGAIN:
+                    raise
+                r, w, x = select.select([], [outfd], [], sock.gettimeout())
+                if not w:
+                    raise socket.timeout('timed out')
+                continue
+            if n == 0:
+                break
+            sent += n
+        return sent
+
+    def _send_mapped(self, sock, offset, count):
+        infd = self.file_obj.fileno()
+        sent = 0
+        while sent < count:
+            # mmap offset must be a multiple of the allocation granularity.
+            pos = offset + sent
+            start = pos - pos % mmap.ALLOCATIONGRANULARITY
+            length = min(self.MMAP_WINDOW_SIZE, offset + count - start)
+            m = mmap.mmap(infd, length, access=mmap.ACCESS_READ,
+                          offset=start)
+            try:
+                while pos < start + length:
+                    n = min(self.chunksize, start + length - pos)
+                    sock.sendall(buffer(m, pos - start, n))
+                    pos += n
+                    sent += n
+            finally:
+                m.close()
+        return sent
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -242,40 +354,91 @@ def decode_response(reply):
        Things in a DMAP_TYPE_LIST container will contain a list with other
        response codes.
     """
+    return decode_items(reply, 0, len(reply))
+
+def decode_items(reply, pos, end):
+    """
+       decode_items(reply, pos, end) -> reply
+
+       Decode the items between offsets pos and end of reply.  We walk
+       the buffer by offset rather than slicing it so that decoding is
+       linear in the size of the reply.
+    """
     # This must be wrapped around a try ... except block in case the other
     # end lies to us about the size of the individual items.
     decoded = []
+    # Local names for speed, this loop runs for every tag we get.
+    unpack_header = header_struct.unpack_from
+    header_size = header_struct.size
     try:
-        while reply:
-            headerfmt = '!4sI'
-            headersize = struct.calcsize(headerfmt)
-            code, size = struct.unpack(headerfmt, reply[:headersize])
-            reply = reply[headersize:]
+        while pos < end:
+            if pos + header_size > end:
+                raise ValueError('truncated header')
+            code, size = unpack_header(reply, pos)
+            pos += header_size
             realname, realtype = dmap_consts[code]
-            realfmt, realsize = fmts[realtype]
-            # XXX check size == realsize
             if realtype == DMAP_TYPE_LIST:
-                decoded.append((code,
-                                decode_response(reply[:size])))
+                # If the size is a lie, decode what is there.
+                listend = min(pos + size, end)
+                decoded.append((code, decode_items(reply, pos, listend)))
                 # next guy
-                reply = reply[size:]
+                pos = listend
                 continue
+            if pos + size > end:
+                raise ValueError('truncated value')
             if realtype == DMAP_TYPE_STRING:
-                # overwrite the size for string with the size specified
-                # by the server.
-                realfmt = str(size) + realfmt 
+                value = reply[pos:pos + size]
             else:
-                if realsize != size:
-                    raise ValueError
-                realfmt = '!' + realfmt
-            realfmtsize = struct.calcsize(realfmt)
-            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
+                value_struct = value_structs[realtype]
+                if value_struct.size != size:
+                    raise ValueError('bad size for %s' % code)
+                (value, ) = value_struct.unpack_from(reply, pos)
             decoded.append((code, value))
-            reply = reply[realfmtsize:]
+            pos += size
         return decoded
     except (struct.error, KeyError, ValueError), e:
         return [(-1, [])]
 
+def encode_items(reply, parts):
+    """
+       encode_items(reply, parts) -> size
+
+       Encode reply, appending the encoded strings to parts.  Returns the
+       number of bytes added.
+
+       Containers need their size up front, so we save a spot in parts for
+       the header and fill it in once we know how big the contents are.
+       This way each item is only encoded and copied once.
+    """
+    total = 0
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        if typ == DMAP_TYPE_LIST:
+            # code (4 bytes), length (4 bytes), network byte order, then
+            # the contained items.
+            index = len(parts)
+            parts.append(None)
+            size = encode_items(value, parts)
+            parts[index] = header_struct.pack(code, size)
+        elif typ == DMAP_TYPE_STRING:
+            if not isinstance(value, str):
+                # This ensures we always get a string type even if we are
+                # lame and passed a unicode in.
+                value = struct.pack('%ds' % len(value), str(buffer(value)))
+            size = len(value)
+            parts.append(header_struct.pack(code, size))
+            parts.append(value)
+        else:
+            try:
+                parts.append(item_structs[typ].pack(code,
+                                                    fmts[typ][1], value))
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                continue
+            size = fmts[typ][1]
+        total += header_struct.size + size
+    return total
+
 def encode_response(reply, content_encoding=None):
     """
        encode_response(reply) -> StreamObj/ChunkedStreamObj
@@ -290,36 +453,10 @@ def encode_response(reply, content_encoding=None):
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        parts = []
+        encode_items(reply, parts)
+        blob = StreamObj(parts, content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
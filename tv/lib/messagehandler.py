@@ -31,18 +31,21 @@
 """
 
 import copy
+import cPickle
 import logging
 import time
 import os
 
 from miro import app
 from miro import autoupdate
+from miro import clock
 from miro import database
 from miro import devices
 from miro import conversions
 from miro import downloader
 from miro import eventloop
 from miro import feed
+from miro import feedupdate
 from miro import guide
 from miro import fileutil
 from miro import commandline
@@ -55,6 +58,7 @@ from miro import singleclick
 from miro import subscription
 from miro import tabs
 from miro import opml
+from miro import util
 from miro.widgetstate import DisplayState, ViewState, GlobalState
 from miro.feed import Feed, lookup_feed
 from miro.gtcache import gettext as _
@@ -65,6 +69,68 @@ from miro.plat.utils import make_url_safe, filename_to_unicode
 
 import shutil
 
+class ItemsChangedStats(object):
+    """Counts what we save by sending ItemInfoDelta objects.
+
+    objects_saved is the number of ItemInfos that we sent an ItemInfoDelta
+    for instead.  bytes_saved estimates the data saved.  Pickling every
+    ItemInfo would be too slow, so we only measure one delta in
+    SAMPLE_INTERVAL and use the average for the rest.
+
+    We only keep stats when TIMING messages get logged.  Every LOG_INTERVAL
+    seconds, we log the savings per second.
+    """
+
+    LOG_INTERVAL = 60
+    SAMPLE_INTERVAL = 50
+
+    def __init__(self):
+        self.sample_count = 0
+        self.sampled_bytes_saved = 0
+        self.reset()
+
+    def reset(self):
+        self.start_time = clock.clock()
+        self.objects_saved = 0
+        self.bytes_saved = 0
+
+    def enabled(self):
+        return logging.getLogger().isEnabledFor(util.TIMING_LEVEL)
+
+    def record_delta(self, info, delta):
+        if not self.enabled():
+            return
+        if self.objects_saved % self.SAMPLE_INTERVAL == 0:
+            self.sample_count += 1
+            self.sampled_bytes_saved += (self._pickled_size(info) -
+                    self._pickled_size(delta.changes))
+        self.objects_saved += 1
+        self.bytes_saved += self.sampled_bytes_saved / self.sample_count
+
+    def _pickled_size(self, obj):
+        try:
+            return len(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+        except (TypeError, cPickle.PicklingError):
+            return 0
+
+    def rates(self):
+        """Get the savings per second since the last reset.
+
+        :returns: (objects_saved, bytes_saved) tuple
+        """
+        elapsed = max(clock.clock() - self.start_time, 0.001)
+        return (self.objects_saved / elapsed, self.bytes_saved / elapsed)
+
+    def maybe_log(self):
+        if clock.clock() - self.start_time < self.LOG_INTERVAL:
+            return
+        if self.objects_saved:
+            logging.timing("ItemsChanged deltas saved %.1f objects/s, "
+                    "%.1f bytes/s", *self.rates())
+        self.reset()
+
+items_changed_stats = ItemsChangedStats()
+
 class ViewTracker(object):
     """Handles tracking views for TrackGuides, TrackChannels, TrackPlaylist and
     TrackItems.
@@ -342,6 +408,10 @@ class WatchedFolderTracker(ViewTracker):
 class SourceTrackerBase(ViewTracker):
     # we only deal with ItemInfo objects, so we don't need to create anything
     info_factory = lambda self, info: info
+    # Send ItemInfoDelta objects for changed items.  This only works if the
+    # frontend knows what we sent last time, which it does if we sent it an
+    # ItemList message.
+    send_deltas = True
 
     def __init__(self):
         ViewTracker.__init__(self)
@@ -369,8 +439,43 @@ class SourceTrackerBase(ViewTracker):
         return messages.ItemsChanged(self.type, self.id, added, changed,
                                      removed)
 
+    def _make_changed_list(self, changed):
+        if not self.send_deltas:
+            return ViewTracker._make_changed_list(self, changed)
+        retval = []
+        for info in changed:
+            try:
+                last_sent = self._last_sent_info[info.id]
+            except KeyError:
+                retval.append(info)
+                self._last_sent_info[info.id] = info
+                continue
+            try:
+                delta = messages.ItemInfoDelta.make(last_sent, info)
+            except ValueError:
+                retval.append(info)
+            else:
+                if delta is None:
+                    continue
+                items_changed_stats.record_delta(info, delta)
+                retval.append(delta)
+            self._last_sent_info[info.id] = info
+        return retval
+
     def send_messages(self):
         ViewTracker.send_messages(self)
+        items_changed_stats.maybe_log()
+
+    def resend_infos(self, item_ids):
+        """Send full ItemInfos for some items in our next message."""
+        for id_ in item_ids:
+            try:
+                info = self._last_sent_info.pop(id_)
+            except KeyError:
+                continue # item was removed
+            if id_ not in self.added and id_ not in self.changed:
+                self.changed[id_] = info
+        self.schedule_send_messages()
 
 class DatabaseSourceTrackerBase(SourceTrackerBase):
 
@@ -418,6 +523,9 @@ class PlaylistFolderItemTracker(DatabaseSourceTrackerBase):
 
 class ManualItemTracker(DatabaseSourceTrackerBase):
     type = u'manual'
+    # We don't send an ItemList for manual trackers, so the frontend can't
+    # apply deltas.
+    send_deltas = False
 
     def __init__(self, id_, info_list):
         self.id = id_
@@ -1347,6 +1455,15 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             item_tracker = self.item_trackers[key]
         item_tracker.send_initial_list()
 
+    def handle_resend_item_infos(self, message):
+        try:
+            item_tracker = self.item_trackers[self.item_tracker_key(message)]
+        except KeyError:
+            logging.warn("ResendItemInfos: item tracker not found (%s %s)",
+                         message.type, message.id)
+        else:
+            item_tracker.resend_infos(message.item_ids)
+
     def handle_track_items_manually(self, message):
         # handle_track_items can handle this message too
         self.handle_track_items(message)
@@ -1770,6 +1887,18 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         m = messages.CurrentViewStates(states)
         m.send_to_frontend()
 
+    def handle_query_event_loop_stats(self, message):
+        stats = eventloop.stats.snapshot()
+        if message.reset:
+            eventloop.stats.reset()
+        messages.CurrentEventLoopStats(stats).send_to_frontend()
+
+    def handle_query_feed_update_stats(self, message):
+        stats = feedupdate.get_stats()
+        if message.reset:
+            feedupdate.reset_stats()
+        messages.CurrentFeedUpdateStats(stats).send_to_frontend()
+
     def handle_query_global_state(self, message):
         info = messages.GlobalInfo(GlobalState.get_singleton())
         m = messages.CurrentGlobalState(info)
@@ -175,6 +175,18 @@ class StopTrackingItems(BackendMessage):
         self.type = typ
         self.id = id_
 
+class ResendItemInfos(BackendMessage):
+    """Ask the backend to send full ItemInfos for some items.
+
+    The frontend sends this when it gets ItemInfoDeltas for items that it
+    doesn't have an ItemInfo to apply them to.  The backend will send the
+    ItemInfos in its next ItemsChanged message.
+    """
+    def __init__(self, typ, id_, item_ids):
+        self.type = typ
+        self.id = id_
+        self.item_ids = item_ids
+
 class TrackDownloadCount(BackendMessage):
     """Start tracking the number of downloading items.  After this message is
     received the backend will send a corresponding DownloadCountChanged
@@ -919,6 +931,22 @@ class ForceFeedparserProcessing(BackendMessage):
     """
     pass
 
+class QueryEventLoopStats(BackendMessage):
+    """Ask for a CurrentEventLoopStats message to be sent back.
+
+    :param reset: start collecting new stats after sending the current ones
+    """
+    def __init__(self, reset=False):
+        self.reset = reset
+
+class QueryFeedUpdateStats(BackendMessage):
+    """Ask for a CurrentFeedUpdateStats message to be sent back.
+
+    :param reset: start collecting new stats after sending the current ones
+    """
+    def __init__(self, reset=False):
+        self.reset = reset
+
 class ForceDBSaveError(BackendMessage):
     """Simulate an error running an INSERT/UPDATE statement on the main DB.
     """
@@ -1244,6 +1272,54 @@ class ItemInfo(object):
         self.description_oneline = (
                 self.description_stripped[0].replace('\n', '$'))
 
+class ItemInfoDelta(object):
+    """Changes to an ItemInfo since it was last sent to the frontend.
+
+    :param id: object id
+    :param changes: dict mapping ItemInfo attributes to their new values
+    """
+    def __init__(self, id_, changes):
+        self.id = id_
+        self.changes = changes
+
+    def __repr__(self):
+        return "<ItemInfoDelta %r %r>" % (self.id, self.changes.keys())
+
+    @classmethod
+    def make(cls, old_info, new_info):
+        """Calculate the changes between 2 ItemInfo objects.
+
+        :returns: an ItemInfoDelta object, or None if nothing changed.
+        :raises ValueError: the infos don't have the same attributes.
+        """
+        old_dict = old_info.__dict__
+        new_dict = new_info.__dict__
+        if len(old_dict) != len(new_dict):
+            raise ValueError("ItemInfos have different attributes")
+        changes = {}
+        for name, value in new_dict.iteritems():
+            try:
+                old_value = old_dict[name]
+            except KeyError:
+                raise ValueError("ItemInfos have different attributes")
+            if old_value != value:
+                changes[name] = value
+        if changes:
+            return cls(new_info.id, changes)
+        else:
+            return None
+
+    def apply(self, info):
+        """Create a new ItemInfo by applying our changes to info.
+
+        info is left alone, since the backend and other item lists may have a
+        reference to it.
+        """
+        new_info = info.__class__.__new__(info.__class__)
+        new_info.__dict__.update(info.__dict__)
+        new_info.__dict__.update(self.changes)
+        return new_info
+
 class DownloadInfo(object):
     """Tracks the download state of an item.
 
@@ -1274,6 +1350,13 @@ class DownloadInfo(object):
             self.short_reason_failed = u""
         self.eta = downloader.get_eta()
 
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
 class PendingDownloadInfo(DownloadInfo):
     """DownloadInfo object for pending downloads (downloads queued,
     but not started because we've reached some limit)
@@ -1428,7 +1511,11 @@ class ItemsChanged(FrontendMessage):
     :param id: id of the object being tracked (same as in TrackItems)
     :param added: list containing an ItemInfo object for each added item.
                   The order will be the order they were added.
-    :param changed: set containing an ItemInfo for each changed item.
+    :param changed: list containing an ItemInfo or ItemInfoDelta for each
+                    changed item.  ItemInfoDelta objects hold the changes
+                    since the last ItemList/ItemsChanged message for this
+                    type/id.  InfoUpdater replaces them with ItemInfo
+                    objects before passing the message on.
     :param removed: set containing ids for each item that was removed
     """
     def __init__(self, typ, id_, added, changed, removed):
@@ -1747,6 +1834,24 @@ class CurrentGlobalState(FrontendMessage):
     def __init__(self, global_info):
         self.info = global_info
 
+class CurrentEventLoopStats(FrontendMessage):
+    """Sends statistics about the backend event loop.
+
+    :param stats: dict returned by eventloop.EventLoopStats.snapshot().
+        eventloop.format_stats() can format it for display.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+class CurrentFeedUpdateStats(FrontendMessage):
+    """Sends statistics about feed updates.
+
+    :param stats: dict returned by feedupdate.get_stats().
+        feedupdate.format_stats() can format it for display.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
 class CurrentViewStates(FrontendMessage):
     """Returns the states of all Views
     """
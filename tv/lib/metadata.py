@@ -38,6 +38,7 @@ import collections
 import contextlib
 import logging
 import os.path
+import time
 
 import sqlite3
 
@@ -57,6 +58,9 @@ from miro import workerprocess
 from miro.plat.utils import (filename_to_unicode,
                              get_enmfp_executable_info)
 
+# Max number of CachedExtractorResult objects to keep
+MAX_CACHED_RESULTS = 100000
+
 attribute_names = set([
     'file_type', 'duration', 'album', 'album_artist', 'album_tracks',
     'artist', 'cover_art', 'screenshot', 'has_drm', 'genre',
@@ -414,6 +418,168 @@ class MetadataEntry(database.DDBObject):
             entry.signal_change()
             return True
 
+class CachedExtractorResult(database.DDBObject):
+    """Stores the result of running mutagen or the movie data program on a
+    file.
+
+    We look results up using the size and modification time of the file,
+    then check a fingerprint of its contents (see
+    fileutil.calc_fingerprint()).
+    This lets us skip processing files that get renamed, remounted, or added
+    again after their MetadataStatus was removed.
+
+    dest_dir is the cover art/screenshot directory that we ran the extractor
+    with.  Results for one directory don't get used for another one.
+
+    The paths to the cover art and screenshot are stored in their own
+    columns.  result stores the rest of the metadata columns.
+    """
+
+    def setup_new(self, source, dest_dir, file_size, file_mtime,
+                  fingerprint, result):
+        self.source = source
+        self.dest_dir = dest_dir
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.fingerprint = fingerprint
+        self.cover_art = result.get('cover_art')
+        self.screenshot = result.get('screenshot')
+        self.result = dict((key, value) for key, value in result.items()
+                           if key in MetadataEntry.metadata_columns and
+                           key != 'screenshot')
+        self.last_used = time.time()
+
+    @classmethod
+    def lookup_view(cls, source, dest_dir, file_size, file_mtime,
+                    db_info=None):
+        return cls.make_view('file_size=? AND file_mtime=? AND source=? '
+                             'AND dest_dir=?',
+                             (file_size, file_mtime, source,
+                              filename_to_unicode(dest_dir)),
+                             db_info=db_info)
+
+    @classmethod
+    def prune(cls, max_count, db_info=None):
+        """Remove the least recently used results over max_count.
+
+        This deletes rows directly, so it should be called before any
+        CachedExtractorResult objects are loaded.
+        """
+        cls.delete('id IN (SELECT id FROM metadata_result_cache '
+                   'ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                   (max_count,), db_info=db_info)
+
+    def images_exist(self):
+        """Check that the cover art/screenshot for the result still exist."""
+        for path in (self.cover_art, self.screenshot):
+            if path is not None and not fileutil.exists(path):
+                return False
+        return True
+
+    def get_result(self, source_path):
+        """Get a result dict like the extractor would return for a file."""
+        result = dict(self.result)
+        result['source_path'] = source_path
+        if self.cover_art is not None:
+            result['cover_art'] = self.cover_art
+        if self.screenshot is not None:
+            result['screenshot'] = self.screenshot
+        return result
+
+    @classmethod
+    def mark_used(cls, results, db_info=None):
+        """Update last_used for a list of results.
+
+        This uses a single UPDATE, rather than calling signal_change() for
+        each result.
+        """
+        if db_info is None:
+            db = app.db
+        else:
+            db = db_info.db
+        now = time.time()
+        for result in results:
+            result.last_used = now
+        db.update(cls, 'last_used', now, 'id IN (%s)' %
+                  ', '.join(str(result.id) for result in results), ())
+
+class ExtractorResultCache(object):
+    """Remembers the mutagen and movie data results for files.
+
+    Results are stored using CachedExtractorResult objects in the main
+    database, so they can be shared by the library and device
+    MetadataManagers.
+
+    Attributes:
+
+    hits -- number of lookups that found a result
+    misses -- number of lookups that didn't
+    stale -- number of results that we found, but whose cover art or
+             screenshot was deleted.  These also count as misses.
+    """
+    def __init__(self, db_info=None):
+        self.db_info = db_info
+        self.hits = self.misses = self.stale = 0
+        # results that get() returned since the last save_used() call
+        self.used = []
+
+    def get(self, source, dest_dir, path, file_identity):
+        """Get the result of running an extractor on a file.
+
+        :param file_identity: (size, mtime, fingerprint) tuple for the file.
+            The worker process calculates this (see FileIdentityTask), so
+            that we don't have to read the file here.  None means the file
+            couldn't be read.
+        :returns: result dict or None if we don't have one
+        """
+        if file_identity is not None:
+            file_size, file_mtime, fingerprint = file_identity
+            for cached in CachedExtractorResult.lookup_view(source, dest_dir,
+                    file_size, file_mtime, db_info=self.db_info):
+                if cached.fingerprint != fingerprint:
+                    continue
+                if not cached.images_exist():
+                    self.stale += 1
+                    cached.remove()
+                    break
+                self.hits += 1
+                self.used.append(cached)
+                return cached.get_result(path)
+        self.misses += 1
+        return None
+
+    def save_used(self):
+        """Update last_used for the results that get() returned."""
+        if self.used:
+            CachedExtractorResult.mark_used(self.used, self.db_info)
+            self.used = []
+
+    def store(self, source, dest_dir, file_identity, result):
+        """Remember the result of running an extractor on a file.
+
+        :param file_identity: (size, mtime, fingerprint) tuple for the file.
+            The worker process calculates this along with the result, so
+            that we don't have to read the file here.
+        """
+        file_size, file_mtime, fingerprint = file_identity
+        for cached in CachedExtractorResult.lookup_view(source, dest_dir,
+                file_size, file_mtime, db_info=self.db_info):
+            if cached.fingerprint == fingerprint:
+                cached.remove()
+        CachedExtractorResult(source, dest_dir, file_size, file_mtime,
+                              fingerprint, result, db_info=self.db_info)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def log_stats(self):
+        logging.info("extractor result cache: %d hits, %d misses "
+                     "(%d stale), %0.1f%% hit rate", self.hits, self.misses,
+                     self.stale, self.hit_rate() * 100)
+
 class _MetadataProcessor(signals.SignalEmitter):
     """Base class for processors that handle getting metadata somehow.
 
@@ -429,7 +595,9 @@ class _MetadataProcessor(signals.SignalEmitter):
 
     Signals:
 
-    - task-complete(path, result) -- we successfully extracted metadata
+    - task-complete(path, result[, file_identity]) -- we successfully
+      extracted metadata.  file_identity is the (size, mtime, fingerprint)
+      of the file, if the worker process sent it.
     - task-error(path, error) -- we failed to extract metadata
     """
     def __init__(self, source_name):
@@ -491,8 +659,9 @@ class _TaskProcessor(_MetadataProcessor):
                           task.source_path)
             return
         logging.debug("%s done: %r", self.source_name, task.source_path)
+        file_identity = result.pop('file_identity', None)
         self._check_for_none_values(result)
-        self.emit('task-complete', task.source_path, result)
+        self.emit('task-complete', task.source_path, result, file_identity)
         self.remove_task_for_path(task.source_path)
 
     def _check_for_none_values(self, result):
@@ -1071,9 +1240,23 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.echonest_cover_art_dir = os.path.join(cover_art_dir, 'echonest')
         self.mutagen_processor = _TaskProcessor(u'mutagen', 100)
         self.moviedata_processor = _TaskProcessor(u'movie-data', 100)
+        # results are stored in the main database, even for devices, so that
+        # they can be shared between databases.
+        self.result_cache = ExtractorResultCache(app.db_info)
+        # maps processors that we cache results for to the image directory
+        # we pass them.
+        self.result_cache_dirs = {
+            self.mutagen_processor: cover_art_dir,
+            self.moviedata_processor: screenshot_dir,
+        }
         self.echonest_processor = _EchonestProcessor(
             5, self.echonest_cover_art_dir)
-        self.pending_mutagen_tasks = []
+        # (processor, task) tuples to look up in result_cache once we're
+        # out of bulk_add()
+        self.pending_cache_checks = []
+        # maps (processor, path) to tasks waiting for their result_cache
+        # lookup
+        self.cache_checks = {}
         self.bulk_add_count = 0
         self.metadata_processors = [
             self.mutagen_processor,
@@ -1161,7 +1344,8 @@ class MetadataManagerBase(signals.SignalEmitter):
     def bulk_add(self):
         """Context manager to use when adding lots of files
 
-        While this context manager is active, we will delay calling mutagen.
+        While this context manager is active, we will delay calling mutagen
+        and looking up cached results.
         bulk_add() contexts can be nested, we will delay processing metadata
         until the last one finishes.
 
@@ -1178,16 +1362,11 @@ class MetadataManagerBase(signals.SignalEmitter):
         # cleanup context
         self.bulk_add_count -= 1
         if not self.in_bulk_add():
-            self._send_pending_mutagen_tasks()
+            self._send_pending_cache_checks()
 
     def in_bulk_add(self):
         return self.bulk_add_count != 0
 
-    def _send_pending_mutagen_tasks(self):
-        for task in self.pending_mutagen_tasks:
-            self.mutagen_processor.add_task(task)
-        self.pending_mutagen_tasks = []
-
     def _translate_path(self, path):
         """Translate a path value from the db to a filesystem path.
         """
@@ -1244,6 +1423,13 @@ class MetadataManagerBase(signals.SignalEmitter):
 
     def _cancel_processing_paths(self, paths):
         paths = [self._translate_path(p) for p in paths]
+        path_set = set(paths)
+        self.pending_cache_checks = [
+            (processor, task) for (processor, task) in
+            self.pending_cache_checks if task.source_path not in path_set]
+        for key in self.cache_checks.keys():
+            if key[1] in path_set:
+                del self.cache_checks[key]
         workerprocess.cancel_tasks_for_files(paths)
         for processor in self.metadata_processors:
             processor.remove_tasks_for_paths(paths)
@@ -1282,6 +1468,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         paths = [r[0] for r in
                  MetadataStatus.select(['path'], db_info=self.db_info)]
         self._cancel_processing_paths(paths)
+        self.result_cache.log_stats()
 
     def _remove_files(self, paths):
         """Does the work for remove_file and remove_files"""
@@ -1537,17 +1724,14 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.check_image_directories()
         path = self._translate_path(path)
         task = workerprocess.MutagenTask(path, self.cover_art_dir)
-        if not self.in_bulk_add():
-            self.mutagen_processor.add_task(task)
-        else:
-            self.pending_mutagen_tasks.append(task)
+        self._check_result_cache(self.mutagen_processor, task)
 
     def _run_movie_data(self, path):
         """Run the movie data program on a path."""
         self.check_image_directories()
         path = self._translate_path(path)
         task = workerprocess.MovieDataProgramTask(path, self.screenshot_dir)
-        self.moviedata_processor.add_task(task)
+        self._check_result_cache(self.moviedata_processor, task)
 
     def _run_echonest(self, path):
         """Run echonest and other internet queries on a path."""
@@ -1571,7 +1755,60 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.echonest_processor.add_path(self._translate_path(path),
                                          metadata_fetcher)
 
-    def _on_task_complete(self, processor, path, result):
+    def _check_result_cache(self, processor, task):
+        """Send a task to processor unless result_cache has its result.
+
+        The cache lookup needs the size, mtime and fingerprint of the file.
+        We get those from the worker process, so that we don't read files in
+        the event loop.  While we're in bulk_add(), the lookups are saved up
+        and sent in one FileIdentityTask.
+        """
+        self.cache_checks[processor, task.source_path] = task
+        self.pending_cache_checks.append((processor, task))
+        if not self.in_bulk_add():
+            self._send_pending_cache_checks()
+
+    def _send_pending_cache_checks(self):
+        if not self.pending_cache_checks:
+            return
+        checks = self.pending_cache_checks
+        self.pending_cache_checks = []
+        def callback(msg, file_identities):
+            self._on_file_identities(checks, file_identities)
+        def errback(msg, error):
+            logging.warn("Error getting file identities: %s", error)
+            self._on_file_identities(checks, [None] * len(checks))
+        paths = [task.source_path for (processor, task) in checks]
+        workerprocess.send(workerprocess.FileIdentityTask(paths), callback,
+                           errback)
+
+    def _on_file_identities(self, checks, file_identities):
+        for (processor, task), file_identity in zip(checks, file_identities):
+            key = (processor, task.source_path)
+            if self.cache_checks.get(key) is not task:
+                # The file was removed, or its check was restarted while we
+                # were waiting for the worker process
+                continue
+            del self.cache_checks[key]
+            result = self.result_cache.get(processor.source_name,
+                                           self.result_cache_dirs[processor],
+                                           task.source_path, file_identity)
+            if result is not None:
+                self._add_finished_metadata(processor, task.source_path,
+                                            result)
+            else:
+                processor.add_task(task)
+        self.result_cache.save_used()
+
+    def _on_task_complete(self, processor, path, result,
+                          file_identity=None):
+        if processor in self.result_cache_dirs and file_identity is not None:
+            self.result_cache.store(processor.source_name,
+                                    self.result_cache_dirs[processor],
+                                    file_identity, result)
+        self._add_finished_metadata(processor, path, result)
+
+    def _add_finished_metadata(self, processor, path, result):
         path = self._untranslate_path(path)
         self.metadata_finished.append((processor, path, result))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
@@ -1707,6 +1944,11 @@ class MetadataManagerBase(signals.SignalEmitter):
 class LibraryMetadataManager(MetadataManagerBase):
     """MetadataManager for the user's audio/video library."""
 
+    def __init__(self, cover_art_dir, screenshot_dir, db_info=None):
+        CachedExtractorResult.prune(MAX_CACHED_RESULTS, db_info=app.db_info)
+        MetadataManagerBase.__init__(self, cover_art_dir, screenshot_dir,
+                                     db_info)
+
     def make_count_tracker(self):
         return LibraryProgressCountTracker()
 
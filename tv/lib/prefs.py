@@ -74,6 +74,7 @@ MAIN_WINDOW_FRAME           = Pref(key='mainWindowFrame',       default=None,  p
 LEFT_VIEW_SIZE              = Pref(key='leftViewSize',          default=None,  platformSpecific=False)
 RIGHT_VIEW_SIZE             = Pref(key='rightViewSize',         default=None,  platformSpecific=False)
 CHECK_CHANNELS_EVERY_X_MN   = Pref(key='checkChannelsEveryXMn', default=60,    platformSpecific=False)
+MAX_FEED_UPDATE_INTERVAL_MN = Pref(key='maxFeedUpdateIntervalMn', default=1440, platformSpecific=False)
 LIMIT_UPSTREAM              = Pref(key='limitUpstream',         default=False, platformSpecific=False)
 UPSTREAM_LIMIT_IN_KBS       = Pref(key='upstreamLimitInKBS',    default=12,    platformSpecific=False)
 UPSTREAM_TORRENT_LIMIT      = Pref(key='upstreamTorrentLimit',  default=10,    platformSpecific=False)
@@ -208,6 +209,9 @@ PLANET_URL        = Pref(key='PlanetURL', default=u"http://planet.getmiro.com/",
 # TODO: should be set to False by default
 NET_LOOKUP_BY_DEFAULT  = Pref(key='UseInternetLookupForNew', default=False,
                               platformSpecific=False)
+# Store the item info cache in a memory-mapped file instead of the database
+MMAP_ITEM_INFO_CACHE = Pref(key='MmapItemInfoCache', default=False,
+                            platformSpecific=False)
 
 # These can be safely ignored on platforms without minimize to tray
 MINIMIZE_TO_TRAY = \
@@ -354,6 +354,9 @@ class ObjectSchema(object):
     * ``table_name`` -- SQL table name to store the class in
     * ``fields`` -- list of (name, SchemaItem) pairs.  One item for
       each attribute that should be stored to disk.
+    * ``hot_columns`` -- columns to load when restoring an object.  The
+      rest get loaded the first time one of them is accessed.  None means
+      load all columns right away.
     """
 
     @classmethod
@@ -366,6 +369,7 @@ class ObjectSchema(object):
 
     indexes = ()
     unique_indexes = ()
+    hot_columns = None
 
 class MultiClassObjectSchema(ObjectSchema):
     """ObjectSchema where rows will be restored to different python
@@ -386,12 +390,14 @@ from miro.feed import (Feed, FeedImpl, RSSFeedImpl, SavedSearchFeedImpl,
 from miro.feed import (SearchFeedImpl, DirectoryWatchFeedImpl,
                        DirectoryFeedImpl, SearchDownloadsFeedImpl)
 from miro.feed import ManualFeedImpl
+from miro.feedupdate import FeedUpdateHistory
 from miro.folder import (HideableTab, ChannelFolder, PlaylistFolder,
                          PlaylistFolderItemMap)
 from miro.guide import ChannelGuide
 from miro.item import Item, FileItem
 from miro.iconcache import IconCache
-from miro.metadata import MetadataStatus, MetadataEntry
+from miro.metadata import (MetadataStatus, MetadataEntry,
+                           CachedExtractorResult)
 from miro.playlist import SavedPlaylist, PlaylistItemMap
 from miro.tabs import TabOrder
 from miro.theme import ThemeHistory
@@ -428,6 +434,17 @@ class ItemSchema(MultiClassObjectSchema):
         else:
             return Item
 
+    # Columns that setup_restored(), get_ddb_class() and our view WHERE
+    # clauses use.  Things like the description, links and metadata only
+    # get loaded when we need to build an ItemInfo.
+    hot_columns = frozenset([
+        'id', 'is_file_item', 'feed_id', 'downloader_id', 'parent_id',
+        'seen', 'autoDownloaded', 'pendingManualDL', 'expired', 'keep',
+        'creationTime', 'downloadedTime', 'watchedTime', 'lastWatched',
+        'isContainerItem', 'eligibleForAutoDownload', 'was_downloaded',
+        'filename', 'deleted', 'shortFilename', 'file_type',
+    ])
+
     fields = DDBObjectSchema.fields + [
         ('is_file_item', SchemaBool()),
         ('feed_id', SchemaInt(noneOk=True)),
@@ -617,6 +634,33 @@ class ManualFeedImplSchema(FeedImplSchema):
     table_name = 'manual_feed_impl'
     # no addition fields over FeedImplSchema
 
+class FeedUpdateHistorySchema(DDBObjectSchema):
+    klass = FeedUpdateHistory
+    table_name = 'feed_update_history'
+    fields = DDBObjectSchema.fields + [
+        ('feed_id', SchemaInt()),
+        ('change_likelihood', SchemaFloat()),
+        ('changed_count', SchemaInt()),
+        ('unchanged_count', SchemaInt()),
+        ('not_modified_count', SchemaInt()),
+        ('same_body_count', SchemaInt()),
+        ('unchanged_streak', SchemaInt()),
+        ('new_entry_times', SchemaList(SchemaFloat())),
+        ('body_hashes', SchemaDict(SchemaURL(), SchemaString())),
+    ]
+
+    indexes = (
+        ('feed_update_history_feed', ('feed_id',)),
+    )
+
+    @staticmethod
+    def handle_malformed_new_entry_times(row):
+        return []
+
+    @staticmethod
+    def handle_malformed_body_hashes(row):
+        return {}
+
 class RemoteDownloaderSchema(DDBObjectSchema):
     klass = RemoteDownloader
     table_name = 'remote_downloader'
@@ -879,7 +923,30 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 178
+class CachedExtractorResultSchema(DDBObjectSchema):
+    klass = CachedExtractorResult
+    table_name = 'metadata_result_cache'
+    fields = DDBObjectSchema.fields + [
+        ('source', SchemaString()),
+        ('dest_dir', SchemaFilename()),
+        ('file_size', SchemaInt()),
+        ('file_mtime', SchemaInt()),
+        ('fingerprint', SchemaString()),
+        ('cover_art', SchemaFilename(noneOk=True)),
+        ('screenshot', SchemaFilename(noneOk=True)),
+        ('result', SchemaReprContainer()),
+        ('last_used', SchemaFloat()),
+    ]
+
+    indexes = (
+        ('metadata_result_cache_file', ('file_size', 'file_mtime')),
+    )
+
+    @staticmethod
+    def handle_malformed_result(row):
+        return {}
+
+VERSION = 181
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
@@ -892,5 +959,6 @@ object_schemas = [
     PlaylistItemMapSchema, PlaylistFolderItemMapSchema,
     TabOrderSchema, ThemeHistorySchema, DisplayStateSchema, GlobalStateSchema,
     DBLogEntrySchema, ViewStateSchema, MetadataStatusSchema,
-    MetadataEntrySchema
+    MetadataEntrySchema, FeedUpdateHistorySchema,
+    CachedExtractorResultSchema,
 ]
@@ -29,13 +29,18 @@
 
 """search.py -- Indexed searching of items.
 
-To make incremental search fast, we index the N-grams for each item.
+To make incremental search fast, we index the N-grams for each item.  For
+each N-gram we store a posting list: a sorted array of the ids of the items
+that contain it.  Searches intersect the posting lists for each term.
 """
-import collections
+from array import array
+from bisect import bisect_left
 import os
 import re
+import threading
 
 from miro import ngrams
+from miro import util
 from miro.plat.utils import filename_to_unicode
 
 # XXX not correct as we don't take into account of foreign quotation marks
@@ -45,12 +50,62 @@ SLASHKILLER = re.compile(r'\\.')
 WORDMATCHER = re.compile("\w+", re.UNICODE)
 NGRAM_MIN = 3
 NGRAM_MAX = 5
-SEARCHOBJECTS = {}
+# How many parsed searches to keep around.  Typing in the search box parses
+# a new search for every keystroke, so we can't keep them all.
+SEARCH_OBJECT_CACHE_SIZE = 100
+# How many search results each ItemSearcher keeps around.
+SEARCH_RESULT_CACHE_SIZE = 20
+
+class BooleanSearchCache(util.Cache):
+    """LRU cache of BooleanSearch objects, keyed by search string.
+
+    SEARCHOBJECTS gets used by the backend and frontend threads, so we
+    hold a lock while accessing the cache.  Otherwise a get() running
+    while another thread shrinks the cache can raise a KeyError.
+    """
+    def __init__(self, size):
+        util.Cache.__init__(self, size)
+        # reentrant, since util.Cache.get() calls set()
+        self.lock = threading.RLock()
+
+    def get(self, key, invalidator=None):
+        self.lock.acquire()
+        try:
+            return util.Cache.get(self, key, invalidator)
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, invalidator=None):
+        self.lock.acquire()
+        try:
+            util.Cache.set(self, key, value, invalidator)
+        finally:
+            self.lock.release()
+
+    def create_new_value(self, search_string, invalidator=None):
+        return BooleanSearch(search_string)
+
+SEARCHOBJECTS = BooleanSearchCache(SEARCH_OBJECT_CACHE_SIZE)
 
 def _get_boolean_search(search_string):
-    if not SEARCHOBJECTS.has_key(search_string):
-        SEARCHOBJECTS[search_string] = BooleanSearch(search_string)
-    return SEARCHOBJECTS[search_string]
+    return SEARCHOBJECTS.get(search_string)
+
+class SearchResultCache(util.Cache):
+    """LRU cache of search results.
+
+    Keys are (search_text, generation) tuples.  generation should change
+    whenever the items being searched change, so that we never return stale
+    results.  Old entries just drop out of the cache.
+
+    :param search_func: function that takes search_text and returns the
+        results
+    """
+    def __init__(self, search_func, size=SEARCH_RESULT_CACHE_SIZE):
+        util.Cache.__init__(self, size)
+        self.search_func = search_func
+
+    def create_new_value(self, key, invalidator=None):
+        return self.search_func(key[0])
 
 class BooleanSearch:
     def __init__ (self, search_string):
@@ -96,22 +151,39 @@ class BooleanSearch:
     def as_string(self):
         return self.string
 
-def _calc_search_text(item_info):
-    match_against = [item_info.name, item_info.description]
+# How much a term matching each field counts for when ranking search results.
+# Fields without an entry here count for DEFAULT_FIELD_WEIGHT.
+FIELD_WEIGHTS = {
+    'name': 4,
+    'feed_name': 2,
+}
+DEFAULT_FIELD_WEIGHT = 1
+
+def _calc_search_fields(item_info):
+    """Get the text that we search for an ItemInfo.
+
+    :returns: list of (field_name, text) tuples
+    """
+    fields = [('name', item_info.name),
+              ('description', item_info.description)]
     if item_info.artist is not None:
-        match_against.append(item_info.artist)
+        fields.append(('artist', item_info.artist))
     if item_info.album is not None:
-        match_against.append(item_info.album)
+        fields.append(('album', item_info.album))
     if item_info.genre is not None:
-        match_against.append(item_info.genre)
+        fields.append(('genre', item_info.genre))
     if item_info.feed_name is not None:
-        match_against.append(item_info.feed_name)
+        fields.append(('feed_name', item_info.feed_name))
     if item_info.download_info and item_info.download_info.torrent:
-        match_against.append(u'torrent')
+        fields.append(('torrent', u'torrent'))
     if item_info.video_path:
         filename = os.path.basename(item_info.video_path)
-        match_against.append(filename_to_unicode(filename))
-    return (' '.join(match_against)).lower()
+        fields.append(('filename', filename_to_unicode(filename)))
+    return fields
+
+def _calc_search_text(item_info):
+    return (' '.join(text for (field, text)
+                     in _calc_search_fields(item_info))).lower()
 
 def calc_search_terms(item_info):
     """Return a list of terms that we want to index for an ItemInfo. """
@@ -141,6 +213,152 @@ def _ngrams_for_item(item_info):
 
     return ngrams.breakup_list(item_info.search_terms, NGRAM_MIN, NGRAM_MAX)
 
+def _search_terms(search_text):
+    """Get the terms to search for.
+
+    :returns: (positive_terms, negative_terms) tuple.  Terms smaller than the
+        smallest N-gram we index are filtered out.
+    """
+    parsed_search = _get_boolean_search(search_text)
+    positive_terms = [t for t in parsed_search.positive_terms
+            if len(t) >= NGRAM_MIN]
+    negative_terms = [t for t in parsed_search.negative_terms
+            if len(t) >= NGRAM_MIN]
+    return positive_terms, negative_terms
+
+def relevance_score(item_info, search_text):
+    """Calculate how relevant an ItemInfo is for a search.
+
+    Each time a positive search term appears in one of the item's fields, we
+    add that field's weight from FIELD_WEIGHTS to the score.  Items that
+    don't match the search get a score of 0.
+
+    :returns: relevance score, higher is more relevant
+    """
+    positive_terms, negative_terms = _search_terms(search_text)
+    if not positive_terms:
+        return 0
+    score = 0
+    for field, text in _calc_search_fields(item_info):
+        text = text.lower()
+        weight = FIELD_WEIGHTS.get(field, DEFAULT_FIELD_WEIGHT)
+        for term in positive_terms:
+            score += text.count(term) * weight
+    return score
+
+# When intersecting posting lists, we only gallop through the posting list if
+# it's at least this many times longer than the set of ids we're matching.
+GALLOP_RATIO = 32
+
+def _gallop(postings, value, low):
+    """Find the position of value in a sorted array.
+
+    We start looking at low, and skip ahead in increasing steps before doing
+    a binary search.  This is fast when value is close to low, which is the
+    usual case when walking through two sorted lists together.
+
+    :returns: the index of the first element >= value
+    """
+    length = len(postings)
+    step = 1
+    while low + step < length and postings[low + step] < value:
+        step *= 2
+    return bisect_left(postings, value, low + step // 2,
+                       min(low + step + 1, length))
+
+def _should_gallop(ids, postings):
+    return len(postings) >= len(ids) * GALLOP_RATIO
+
+def intersect_postings(ids, postings):
+    """Intersect a set of item ids with a sorted array of item ids.
+
+    If the array is much longer than the set, we walk through the sorted ids
+    and gallop through the array, so the time this takes mostly depends on
+    the size of the set.  Otherwise, we let set.intersection() walk through
+    the array, since that's much faster than galloping in python code.  In
+    that case the array doesn't need to be sorted.
+
+    :returns: set of ids that are in both
+    """
+    if not _should_gallop(ids, postings):
+        return ids.intersection(postings)
+    rv = set()
+    pos = 0
+    length = len(postings)
+    for id_ in sorted(ids):
+        pos = _gallop(postings, id_, pos)
+        if pos >= length:
+            break
+        if postings[pos] == id_:
+            rv.add(id_)
+            pos += 1
+    return rv
+
+def _intersect_ngrams(ngram_postings, ngrams, ids=None):
+    """Find the items that contain every N-gram in a list.
+
+    We go through the posting lists shortest first, to keep the sets we
+    build small.  Posting lists only need to be sorted if we gallop through
+    them, so we ask for unsorted ones otherwise.
+
+    :param ngram_postings: function that takes an N-gram and a sort flag and
+        returns the array of ids for items that contain that N-gram.  The
+        array must be sorted if the flag is True.
+    :param ids: set of ids to start with.  If None, we start with the
+        items that contain the first N-gram.
+    :returns: set of matching ids
+    """
+    ngrams = sorted(ngrams, key=lambda gram: len(ngram_postings(gram, False)))
+    if ids is None:
+        ids = set(ngram_postings(ngrams[0], False))
+        ngrams = ngrams[1:]
+    for gram in ngrams:
+        if not ids:
+            break
+        postings = ngram_postings(gram, False)
+        if _should_gallop(ids, postings):
+            postings = ngram_postings(gram, True)
+        ids = intersect_postings(ids, postings)
+    return ids
+
+def term_search(ngram_postings, term):
+    """Find the items that contain a search term.
+
+    :param ngram_postings: see _intersect_ngrams()
+    :returns: set of matching ids
+    """
+    return _intersect_ngrams(ngram_postings, _ngrams_for_term(term))
+
+def search_postings(ngram_postings, search_text):
+    """Search using posting lists.
+
+    Posting lists are only turned into sets once they've been narrowed down,
+    so for typical searches we build a set from the shortest list and let
+    set.intersection() do the rest.
+
+    :param ngram_postings: see _intersect_ngrams()
+    :param search_text: search_text to search with
+    :returns: set of matching ids, or None if the search doesn't have any
+        positive terms.  In that case, the search matches every item that
+        doesn't contain the negative terms (see term_search()), and callers
+        need to handle it themselves.
+    """
+    positive_terms, negative_terms = _search_terms(search_text)
+    if not positive_terms:
+        return None
+    # Items match if they contain every N-gram of every positive term.
+    ngrams = set()
+    for term in positive_terms:
+        ngrams.update(_ngrams_for_term(term))
+    matching_ids = _intersect_ngrams(ngram_postings, ngrams)
+    for term in negative_terms:
+        if not matching_ids:
+            break
+        # only look for the term in the items that we've matched so far
+        matching_ids.difference_update(_intersect_ngrams(ngram_postings,
+            _ngrams_for_term(term), matching_ids))
+    return matching_ids
+
 def item_matches(item_info, search_text):
     """Test if a single ItemInfo matches a search
 
@@ -190,15 +408,30 @@ class ItemSearcher(object):
     """Index Item objects so that they can be searched quickly """
 
     def __init__(self):
-        # map N-grams -> set of item ids
-        self._ngram_map = collections.defaultdict(set)
+        # map N-grams -> sorted array of item ids
+        self._postings = {}
+        # N-grams whose arrays had ids appended out of order.  We sort them
+        # the next time they're searched.
+        self._unsorted = set()
         # map item id -> list of N-grams
         self._item_ngrams = {}
+        # incremented every time the index changes
+        self.generation = 0
+        self._result_cache = SearchResultCache(self._search)
 
     def add_item(self, item_info):
         """Add an item info to the index."""
         self._add_item(item_info)
 
+    def add_items(self, item_infos):
+        """Add several item infos to the index.
+
+        We add them in id order, so that the posting lists stay sorted and
+        we don't have to sort them when searching.
+        """
+        for item_info in sorted(item_infos, key=lambda info: info.id):
+            self._add_item(item_info)
+
     def update_item(self, item_info):
         """Update the index based on an item info changing.
 
@@ -215,46 +448,77 @@ class ItemSearcher(object):
         self._remove_item(item_id)
 
     def _add_item(self, item_info):
+        self.generation += 1
+        item_id = item_info.id
         item_ngrams = _ngrams_for_item(item_info)
         for ngram in item_ngrams:
-            self._ngram_map[ngram].add(item_info.id)
-        self._item_ngrams[item_info.id] = item_ngrams
+            try:
+                postings = self._postings[ngram]
+            except KeyError:
+                self._postings[ngram] = array('i', (item_id,))
+                continue
+            if postings[-1] > item_id:
+                self._unsorted.add(ngram)
+            postings.append(item_id)
+        self._item_ngrams[item_id] = item_ngrams
 
     def _remove_item(self, item_id):
+        self.generation += 1
         for ngram in self._item_ngrams.pop(item_id):
-            self._ngram_map[ngram].discard(item_id)
+            postings = self._postings[ngram]
+            if len(postings) == 1:
+                del self._postings[ngram]
+                self._unsorted.discard(ngram)
+            elif ngram in self._unsorted:
+                postings.remove(item_id)
+            else:
+                del postings[bisect_left(postings, item_id)]
 
-    def _term_search(self, term):
-        grams = _ngrams_for_term(term)
-        # note that we need to copy the value from _ngram_map.  We don't want
-        # our calls to intersection_update to change it.
-        rv = set(self._ngram_map[grams[0]])
-        for gram in grams[1:]:
-            rv.intersection_update(self._ngram_map[gram])
-        return rv
+    def ngram_postings(self, ngram, sort=True):
+        """Get the array of ids for items that contain an N-gram.
+
+        The array must not be modified.
+
+        :param sort: if False, the array might not be sorted.  That saves
+            sorting arrays that we only make sets from.
+        """
+        try:
+            postings = self._postings[ngram]
+        except KeyError:
+            return array('i')
+        if sort and ngram in self._unsorted:
+            postings = array('i', sorted(postings))
+            self._postings[ngram] = postings
+            self._unsorted.discard(ngram)
+        return postings
+
+    def iter_ngram_postings(self):
+        """Iterate through (N-gram, postings) for all indexed N-grams."""
+        for ngram in self._postings.keys():
+            yield ngram, self.ngram_postings(ngram)
+
+    def all_ids(self):
+        """Get the ids of all items in the index."""
+        return self._item_ngrams.keys()
 
     def search(self, search_text):
         """Search through the index items.
 
+        Results for recent searches are cached until the index changes, so
+        the set returned must not be modified.
+
         :param search_text: search_text to search with
 
         :returns: set of ids that match the search
         """
-        parsed_search = _get_boolean_search(search_text)
-        # filter out terms smaller than the smallest N-gram we index.
-        positive_terms = [t for t in parsed_search.positive_terms
-                if len(t) >= NGRAM_MIN]
-        negative_terms = [t for t in parsed_search.negative_terms
-                if len(t) >= NGRAM_MIN]
-
-        if positive_terms:
-            first_term = positive_terms[0]
-            matching_ids = self._term_search(first_term)
-            for term in positive_terms[1:]:
-                matching_ids.intersection_update(self._term_search(term))
-        else:
-            matching_ids = set(self._item_ngrams.keys())
-
-        for term in negative_terms:
-            matching_ids.difference_update(self._term_search(term))
+        return self._result_cache.get((search_text, self.generation))
+
+    def _search(self, search_text):
+        matching_ids = search_postings(self.ngram_postings, search_text)
+        if matching_ids is not None:
+            return matching_ids
+        matching_ids = set(self._item_ngrams)
+        for term in _search_terms(search_text)[1]:
+            matching_ids.difference_update(term_search(self.ngram_postings,
+                                                       term))
         return matching_ids
@@ -0,0 +1,533 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.searchindex`` -- Shared N-gram index for all items.
+
+search.ItemSearcher indexes the items for a single item list, which means
+that every list that we search has to index all of its items first.
+SearchIndex indexes every item in the ItemInfoCache once, and keeps the index
+up to date using the cache's signals.  Item lists use ListSearcher to search
+the items that they contain.
+
+The index is stored in a file that maps each N-gram to a sorted array of item
+ids.  The file is memory-mapped, so we only read the N-grams that we actually
+search for.  Changes since the file was written are kept in memory using an
+ItemSearcher and written out when we shut down.
+
+The backend thread updates the index and the frontend thread searches it, so
+access is protected by a lock.
+"""
+
+from array import array
+import bisect
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import uuid
+
+from miro import app
+from miro import eventloop
+from miro import search
+
+class _IndexFile(object):
+    """Memory-mapped N-gram index file.
+
+    The file contains:
+
+    - a header
+    - the ids of all items in the index, sorted
+    - a dictionary with an entry for each N-gram: the N-gram encoded as UTF-8
+      and padded with NULs, the position of its postings and the number of
+      ids in them.  Entries are sorted by the encoded N-gram, so we can
+      binary search them without reading the whole dictionary.
+    - the postings: sorted arrays of item ids
+
+    Arrays are stored in the native byte order, since the file is just a
+    cache for this machine.
+    """
+
+    MAGIC = 'MSIX'
+    FORMAT_VERSION = 1
+    # magic, format version, byte order, N-gram count, item count, token, key
+    HEADER = struct.Struct('<4sIIII16s64s')
+    # N-gram, position, id count
+    ENTRY = struct.Struct('<20sII')
+    KEY_SIZE = 20
+
+    def __init__(self):
+        self.token = None
+        self.key = None
+        self.ngram_count = 0
+        self.item_ids = array('i')
+        self._dict_start = 0
+        self._mmap = None
+        self._file = None
+
+    def open(self, path):
+        """Open an index file
+
+        :raises IOError: the file doesn't exist
+        :raises ValueError: the file is corrupt
+        """
+        f = open(path, 'rb')
+        try:
+            header = f.read(self.HEADER.size)
+            if len(header) != self.HEADER.size:
+                raise ValueError("header truncated")
+            (magic, format_version, byteorder, ngram_count, item_count,
+                    token, key) = self.HEADER.unpack(header)
+            if magic != self.MAGIC or format_version != self.FORMAT_VERSION:
+                raise ValueError("bad header")
+            if byteorder != _byteorder():
+                raise ValueError("wrong byte order")
+            item_ids = array('i')
+            try:
+                item_ids.fromfile(f, item_count)
+            except EOFError:
+                raise ValueError("item ids truncated")
+            dict_start = f.tell()
+            file_size = os.fstat(f.fileno()).st_size
+            if dict_start + ngram_count * self.ENTRY.size > file_size:
+                raise ValueError("dictionary truncated")
+            index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            f.close()
+            raise
+        self.close()
+        self._file = f
+        self._mmap = index_mmap
+        self.token = token
+        self.key = key.rstrip('\0')
+        self.ngram_count = ngram_count
+        self.item_ids = item_ids
+        self._dict_start = dict_start
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.ngram_count = 0
+        self.item_ids = array('i')
+
+    def _entry(self, index):
+        return self.ENTRY.unpack_from(self._mmap,
+                self._dict_start + index * self.ENTRY.size)
+
+    def postings(self, ngram):
+        """Get the ids for items that contain an N-gram.
+
+        :returns: array of item ids.
+        """
+        key = encode_ngram(ngram)
+        low = 0
+        high = self.ngram_count
+        while low < high:
+            middle = (low + high) // 2
+            pos = self._dict_start + middle * self.ENTRY.size
+            middle_key = self._mmap[pos:pos+self.KEY_SIZE]
+            if middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.ngram_count:
+            entry_key, start, count = self._entry(low)
+            if entry_key == key:
+                ids = array('i')
+                ids.fromstring(self._mmap[start:start+count*ids.itemsize])
+                return ids
+        return array('i')
+
+    def iter_entries(self):
+        """Iterate through (encoded N-gram, postings) tuples."""
+        for i in xrange(self.ngram_count):
+            key, start, count = self._entry(i)
+            ids = array('i')
+            ids.fromstring(self._mmap[start:start+count*ids.itemsize])
+            yield key, ids
+
+def _byteorder():
+    if sys.byteorder == 'little':
+        return 1
+    else:
+        return 2
+
+def encode_ngram(ngram):
+    return ngram.encode('utf-8').ljust(_IndexFile.KEY_SIZE, '\0')
+
+def write_index_file(path, token, key, item_ids, entries):
+    """Write an index file.
+
+    :param path: path to write to
+    :param token: 16 byte string to identify the file
+    :param key: string to store in the header (at most 64 bytes)
+    :param item_ids: sorted array of item ids
+    :param entries: list of (encoded N-gram, postings) tuples, sorted by
+        N-gram
+    """
+    header_size = _IndexFile.HEADER.size
+    pos = (header_size + len(item_ids) * item_ids.itemsize +
+            len(entries) * _IndexFile.ENTRY.size)
+    f = open(path, 'wb')
+    try:
+        f.write(_IndexFile.HEADER.pack(_IndexFile.MAGIC,
+            _IndexFile.FORMAT_VERSION, _byteorder(), len(entries),
+            len(item_ids), token, key))
+        item_ids.tofile(f)
+        for ngram_key, postings in entries:
+            f.write(_IndexFile.ENTRY.pack(ngram_key, pos, len(postings)))
+            pos += len(postings) * postings.itemsize
+        for ngram_key, postings in entries:
+            postings.tofile(f)
+    finally:
+        f.close()
+
+class SearchIndex(object):
+    """N-gram index of all the items in the ItemInfoCache.
+
+    :param path: path to the index file
+    """
+
+    TOKEN_KEY = 'search_index_token'
+    # If we have more than this many changed items in memory, write a new
+    # index file.
+    MAX_PENDING_ITEMS = 5000
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._file = _IndexFile()
+        # items added/changed since the index file was written
+        self._pending = search.ItemSearcher()
+        # ids whose entries in the index file are out of date
+        self._stale_ids = set()
+        # sorted list of _stale_ids, None until _ngram_search() needs it
+        self._sorted_stale_ids = None
+        self._save_scheduled = False
+        self._cache_callback_handles = []
+        self.loaded = False
+        # incremented every time the index changes
+        self.generation = 0
+        self._result_cache = search.SearchResultCache(self._search)
+
+    def version(self):
+        return "%s-%s-%s" % (search.NGRAM_MIN, search.NGRAM_MAX,
+                app.item_info_cache.version())
+
+    def load(self):
+        """Load the index file, or rebuild it if it's not usable.
+
+        Call this after the ItemInfoCache is loaded.
+        """
+        if not self._try_open():
+            self._rebuild()
+        # Unset our token until we save again.  If we crash before then, the
+        # file won't match the database and we'll rebuild it.
+        app.db.unset_variable(self.TOKEN_KEY)
+        cache = app.item_info_cache
+        self._cache_callback_handles = [
+            cache.connect('added', self.on_item_added),
+            cache.connect('changed', self.on_item_changed),
+            cache.connect('removed', self.on_item_removed),
+        ]
+        self.loaded = True
+
+    def close(self):
+        """Stop tracking changes and close the index file.
+
+        Pending changes are not saved, call save() first to keep them.
+        """
+        for handle in self._cache_callback_handles:
+            app.item_info_cache.disconnect(handle)
+        self._cache_callback_handles = []
+        with self._lock:
+            self._file.close()
+        self.loaded = False
+
+    def _try_open(self):
+        if app.item_info_cache.did_failsafe_load:
+            # the item infos were rebuilt, rebuild our index as well
+            return False
+        try:
+            self._file.open(self.path)
+            saved_token = app.db.get_variable(self.TOKEN_KEY)
+        except (StandardError, EnvironmentError), e:
+            logging.warn("Error loading search index: %s", e)
+            self._file.close()
+            return False
+        if (self._file.key != self.version() or
+                self._file.token != saved_token or
+                len(self._file.item_ids) != len(app.item_info_cache.id_to_info)):
+            self._file.close()
+            return False
+        return True
+
+    def _rebuild(self):
+        logging.info("Rebuilding search index")
+        pending = search.ItemSearcher()
+        pending.add_items(app.item_info_cache.all_infos())
+        with self._lock:
+            self._file.close()
+            self._set_stale_ids(set())
+            self._pending = pending
+        self._write()
+
+    def _set_stale_ids(self, stale_ids):
+        self._stale_ids = stale_ids
+        self._sorted_stale_ids = None
+
+    def on_item_added(self, cache, info):
+        with self._lock:
+            self.generation += 1
+            self._stale_ids.add(info.id)
+            self._sorted_stale_ids = None
+            try:
+                self._pending.update_item(info)
+            except KeyError:
+                self._pending.add_item(info)
+        self._check_pending_count()
+
+    on_item_changed = on_item_added
+
+    def on_item_removed(self, cache, info):
+        with self._lock:
+            self.generation += 1
+            self._stale_ids.add(info.id)
+            self._sorted_stale_ids = None
+            try:
+                self._pending.remove_item(info.id)
+            except KeyError:
+                pass
+        self._check_pending_count()
+
+    def _check_pending_count(self):
+        if (len(self._stale_ids) > self.MAX_PENDING_ITEMS and
+                not self._save_scheduled):
+            eventloop.add_idle(self._write_pending, 'write search index')
+            self._save_scheduled = True
+
+    def _write_pending(self):
+        self._save_scheduled = False
+        self._write()
+
+    def save(self):
+        """Write out pending changes.  Call this when shutting down."""
+        if self._stale_ids or self._file.token is None:
+            self._write()
+        app.db.set_variable(self.TOKEN_KEY, self._file.token)
+
+    def _write(self):
+        """Write a new index file that merges the old file and the pending
+        changes.
+
+        Only the backend thread changes the index, so we can build the new
+        file without holding the lock.  Searches keep using the old file and
+        the pending changes until we swap in the new file.
+        """
+        with self._lock:
+            pending_map = dict(self._pending.iter_ngram_postings())
+            pending_ids = self._pending.all_ids()
+            stale_ids = set(self._stale_ids)
+        entries = []
+        pending_keys = sorted((encode_ngram(ngram), ngram)
+                for ngram in pending_map)
+        pending_iter = iter(pending_keys)
+        next_pending = _next_or_none(pending_iter)
+        for file_key, postings in self._file.iter_entries():
+            while next_pending is not None and next_pending[0] < file_key:
+                entries.append((next_pending[0], pending_map[next_pending[1]]))
+                next_pending = _next_or_none(pending_iter)
+            if stale_ids and not stale_ids.isdisjoint(postings):
+                postings = array('i', [id_ for id_ in postings
+                    if id_ not in stale_ids])
+            if next_pending is not None and next_pending[0] == file_key:
+                postings.extend(pending_map[next_pending[1]])
+                postings = _sorted_array(postings)
+                next_pending = _next_or_none(pending_iter)
+            if postings:
+                entries.append((file_key, postings))
+        while next_pending is not None:
+            entries.append((next_pending[0], pending_map[next_pending[1]]))
+            next_pending = _next_or_none(pending_iter)
+
+        item_ids = [id_ for id_ in self._file.item_ids
+                if id_ not in stale_ids]
+        item_ids.extend(pending_ids)
+        item_ids = _sorted_array(item_ids)
+
+        token = uuid.uuid4().bytes
+        temp_path = self.path + '.tmp'
+        write_index_file(temp_path, token, self.version(), item_ids, entries)
+        with self._lock:
+            self._file.close()
+            if sys.platform == 'win32' and os.path.exists(self.path):
+                # windows can't rename over an existing file
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+            self._file.open(self.path)
+            self._pending = search.ItemSearcher()
+            self._set_stale_ids(set())
+            self.generation += 1
+
+    def _all_ids(self):
+        ids = set(self._file.item_ids)
+        ids.difference_update(self._stale_ids)
+        ids.update(self._pending.all_ids())
+        return ids
+
+    def _ngram_search(self, ngram, sort=True):
+        # arrays from the file are always sorted, we only need to sort when
+        # we merge in the pending postings
+        postings = self._file.postings(ngram)
+        if self._stale_ids:
+            if self._sorted_stale_ids is None:
+                self._sorted_stale_ids = sorted(self._stale_ids)
+            postings = _subtract_sorted(postings, self._sorted_stale_ids,
+                                        self._stale_ids)
+            # Ids in pending are always in stale_ids, so after filtering the
+            # file postings, the two arrays don't overlap.
+            pending_postings = self._pending.ngram_postings(ngram, sort)
+            if pending_postings:
+                postings = postings + pending_postings
+                if sort:
+                    postings = _sorted_array(postings)
+        return postings
+
+    def search(self, search_text):
+        """Search the index.
+
+        Results for recent searches are cached until the index changes, so
+        the set returned must not be modified.
+
+        :param search_text: search_text to search with
+
+        :returns: set of ids that match the search
+        """
+        with self._lock:
+            return self._result_cache.get((search_text, self.generation))
+
+    def _search(self, search_text):
+        with self._lock:
+            matching_ids = search.search_postings(self._ngram_search,
+                    search_text)
+            if matching_ids is not None:
+                return matching_ids
+            matching_ids = self._all_ids()
+            for term in search._search_terms(search_text)[1]:
+                matching_ids.difference_update(search.term_search(
+                    self._ngram_search, term))
+        return matching_ids
+
+def _next_or_none(iterator):
+    try:
+        return iterator.next()
+    except StopIteration:
+        return None
+
+def _sorted_array(ids):
+    return array('i', sorted(ids))
+
+def _subtract_sorted(postings, sorted_ids, id_set):
+    """Remove ids from a sorted array of item ids.
+
+    If there are fewer ids to remove than postings, we binary search for each
+    one and copy the slices between them.  That way the time this takes
+    depends on the number of ids to remove, rather than the length of
+    postings.
+
+    :param sorted_ids: sorted list of the ids to remove
+    :param id_set: set of the same ids
+    :returns: sorted array of ids
+    """
+    if len(sorted_ids) >= len(postings):
+        return array('i', [id_ for id_ in postings if id_ not in id_set])
+    rv = None
+    start = 0
+    length = len(postings)
+    for id_ in sorted_ids:
+        pos = bisect.bisect_left(postings, id_, start)
+        if pos >= length:
+            break
+        if postings[pos] == id_:
+            if rv is None:
+                rv = array('i')
+            rv.extend(postings[start:pos])
+            start = pos + 1
+        else:
+            start = pos
+    if rv is None:
+        return postings
+    rv.extend(postings[start:])
+    return rv
+
+class ListSearcher(object):
+    """Search the items in an item list using a SearchIndex.
+
+    This has the same interface as search.ItemSearcher, but it only keeps
+    track of which ids are in the list.  The searching is done by the
+    SearchIndex.
+    """
+    def __init__(self, index):
+        self.index = index
+        self._ids = set()
+        # incremented every time our ids change
+        self.generation = 0
+        self._result_cache = search.SearchResultCache(self._search)
+
+    def add_item(self, item_info):
+        self._ids.add(item_info.id)
+        self.generation += 1
+
+    def add_items(self, item_infos):
+        self._ids.update(info.id for info in item_infos)
+        self.generation += 1
+
+    def update_item(self, item_info):
+        if item_info.id not in self._ids:
+            raise KeyError(item_info.id)
+
+    def remove_item(self, item_id):
+        self._ids.remove(item_id)
+        self.generation += 1
+
+    def search(self, search_text):
+        """Search the items in our list.
+
+        The set returned must not be modified.
+        """
+        return self._result_cache.get((search_text, self.generation,
+                                       self.index.generation))
+
+    def _search(self, search_text):
+        return self._ids.intersection(self.index.search(search_text))
@@ -2035,6 +2035,7 @@ class SharingManager(object):
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
                             del self.thread
+                            self.server.server_close()
                             del self.server
                             self.reload_done_event.set()
                             return
@@ -81,6 +81,7 @@ from miro import tabs
 from miro import theme
 from miro import util
 from miro import searchengines
+from miro import searchindex
 from miro import storedatabase
 from miro import conversions
 from miro import devices
@@ -256,6 +257,8 @@ def startup():
     logging.info("Starting libCURL thread")
     httpclient.init_libcurl()
     httpclient.start_thread()
+    httpclient.init_http_cache(os.path.join(
+        app.config.get(prefs.SUPPORT_DIRECTORY), 'http-cache'))
     logging.info("Starting event loop thread")
     eventloop.startup()
     if DEBUG_DB_MEM_USAGE:
@@ -307,8 +310,19 @@ def finish_startup(obj, thread):
         mem_usage_test_event.set()
 
     item.setup_metadata_manager()
-    app.item_info_cache = iteminfocache.ItemInfoCache()
+    if (app.config.get(prefs.MMAP_ITEM_INFO_CACHE) and
+            app.db.path != ':memory:'):
+        path = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                            'iteminfocache')
+        app.item_info_cache = iteminfocache.MmapItemInfoCache(path)
+    else:
+        app.item_info_cache = iteminfocache.ItemInfoCache()
     app.item_info_cache.load()
+    if app.db.path != ':memory:':
+        path = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                            'searchindex')
+        app.search_index = searchindex.SearchIndex(path)
+        app.search_index.load()
     dbupgradeprogress.upgrade_end()
 
     logging.info("Loading video converters...")
@@ -456,8 +470,9 @@ def on_frontend_started():
             "start checking deleted items")
     eventloop.add_timeout(30, feed.start_updates, "start feed updates")
     eventloop.add_timeout(60, item.update_incomplete_metadata,
-            "update metadata data")
-    eventloop.add_timeout(90, clear_icon_cache_orphans, "clear orphans")
+            "update metadata data", priority=eventloop.PRIORITY_BACKGROUND)
+    eventloop.add_timeout(90, clear_icon_cache_orphans, "clear orphans",
+            priority=eventloop.PRIORITY_BACKGROUND)
 
 def setup_global_feeds():
     setup_global_feed(u'dtv:manualFeed', initiallyAutoDownloadable=False)
@@ -40,10 +40,10 @@ separate column.
 Most columns are stored using SQLite datatypes (``INTEGER``, ``REAL``,
 ``TEXT``, ``DATETIME``, etc.).  However some of our python values,
 don't have an equivalent (lists, dicts and timedelta objects).  For
-those, we store the python representation of the object.  This makes
-the column look similar to a JSON value, although not quite the same.
-The hope is that it will be human readable.  We use the type
-``pythonrepr`` to label these columns.
+those, we store a BLOB created by the columncodec module.  Older versions
+stored the python representation of the object, which is why we use the
+type ``pythonrepr`` to label these columns.  These columns aren't decoded
+until the attribute is accessed (see ``database.LazyAttributeValue``).
 """
 
 import glob
@@ -51,7 +51,6 @@ import shutil
 import cPickle
 import itertools
 import logging
-import datetime
 import traceback
 import time
 import os
@@ -64,8 +63,10 @@ except ImportError:
     from pysqlite2 import dbapi2 as sqlite3
 
 from miro import app
+from miro import columncodec
 from miro import crashreport
 from miro import convert20database
+from miro import database
 from miro import databaseupgrade
 from miro import dbupgradeprogress
 from miro import dialogs
@@ -351,7 +352,7 @@ class LiveStorage:
     """
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
-                 start_in_temp_mode=False):
+                 start_in_temp_mode=False, lazy_restore=True):
         """Create a LiveStorage for a database
 
         :param path: path to the database (or ":memory:")
@@ -365,6 +366,9 @@ class LiveStorage:
         :param start_in_temp_mode: True if this database should start in
                                    temporary mode (running in memory, but
                                    checking if it can write to the disk)
+        :param lazy_restore: only load the hot_columns for schemas that
+                             define them when restoring objects, wait until
+                             the other columns are accessed to load them.
         """
         if path is None:
             path = app.config.get(prefs.SQLITE_PATHNAME)
@@ -408,6 +412,7 @@ class LiveStorage:
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
+        self.lazy_restore = lazy_restore
         self._statements_in_transaction = []
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
@@ -853,9 +858,14 @@ class LiveStorage:
         setters = []
         values = []
         for name, schema_item in obj_schema.fields:
-            if (isinstance(schema_item, schema.SchemaSimpleItem) and
-                    name not in obj.changed_attributes):
-                continue
+            if name not in obj.changed_attributes:
+                if isinstance(schema_item, schema.SchemaSimpleItem):
+                    continue
+                # Containers can change without us knowing about it, but
+                # not if they haven't been loaded yet.
+                if isinstance(obj.__dict__.get(name),
+                              database.LazyAttributeValue):
+                    continue
             setters.append('%s=?' % name)
             value = getattr(obj, name)
             try:
@@ -885,6 +895,8 @@ class LiveStorage:
         """Remove a DDBObject from disk."""
 
         schema = self._schema_map[obj.__class__]
+        # load cold columns while we still can
+        self._ensure_cold_columns_loaded([obj])
         sql = "DELETE FROM %s WHERE id=?" % (schema.table_name)
         self._execute(sql, (obj.id,), is_update=True)
         self.forget_object(obj)
@@ -902,6 +914,7 @@ class LiveStorage:
         for obj in objects:
             if obj_schema != self._schema_map[obj.__class__]:
                 raise ValueError("Incompatible types for bulk remove")
+        self._ensure_cold_columns_loaded(objects)
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         for objects_chunk in util.split_values_for_sqlite(objects):
@@ -935,6 +948,14 @@ class LiveStorage:
         """
         return self._object_map[(id_, app.db.table_name(klass))]
 
+    def get_obj_by_table_name(self, id_, table_name):
+        """Get a particular DDBObject using its table name.
+
+        This will throw a KeyError if id is not in the database, or if the
+        object for id has not been loaded yet.
+        """
+        return self._object_map[(id_, table_name)]
+
     def id_alive(self, id_, klass):
         """Check if an id exists and is loaded in the database."""
         return (id_, app.db.table_name(klass)) in self._object_map
@@ -945,6 +966,16 @@ class LiveStorage:
     def schema_fields(self, klass):
         return self._schema_map[klass].fields
 
+    def schema_fields_for_table_name(self, table_name):
+        """Get the schema fields for a table.
+
+        This will throw a KeyError if we don't have a schema for table_name.
+        """
+        for oschema in self._all_schemas:
+            if oschema.table_name == table_name:
+                return oschema.fields
+        raise KeyError(table_name)
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
@@ -989,8 +1020,15 @@ class LiveStorage:
         return (row[0] for row in self.cursor.fetchall())
 
     def _restore_objects(self, schema, id_set, db_info):
+        if self.lazy_restore and schema.hot_columns is not None:
+            fields = [f for f in schema.fields if f[0] in schema.hot_columns]
+            cold_fields = [f for f in schema.fields
+                           if f[0] not in schema.hot_columns]
+        else:
+            fields = schema.fields
+            cold_fields = []
         column_names = ['%s.%s' % (schema.table_name, f[0])
-                for f in schema.fields]
+                for f in fields]
 
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
@@ -1002,32 +1040,44 @@ class LiveStorage:
                 ', '.join('?' for i in xrange(len(id_list_chunk)))))
 
             self.cursor.execute(sql.getvalue(), id_list_chunk)
+            if cold_fields:
+                cold_batch = _ColdColumnBatch(schema, cold_fields,
+                                              id_list_chunk,
+                                              self._load_cold_column)
+            else:
+                cold_batch = None
             for row in self.cursor.fetchall():
-                self._restore_object_from_row(schema, row, db_info)
+                self._restore_object_from_row(schema, row, db_info, fields,
+                                              cold_batch)
+
+    def _restore_object_from_row(self, schema, db_row, db_info, fields=None,
+                                 cold_batch=None):
+        """Create a DDBObject from a row of data.
 
-    def _restore_object_from_row(self, schema, db_row, db_info):
+        :param fields: schema fields for the columns in db_row.  Defaults to
+            schema.fields.
+        :param cold_batch: _ColdColumnBatch to load the fields that aren't in
+            db_row
+        """
+        if fields is None:
+            fields = schema.fields
         restored_data = {}
+        if cold_batch is not None:
+            restored_data.update(cold_batch.placeholders)
         columns_to_update = []
         values_to_update = []
         for (name, schema_item), value in \
-                itertools.izip(schema.fields, db_row):
+                itertools.izip(fields, db_row):
+            if value is not None and self._converter.is_lazy(schema_item):
+                restored_data[name] = database.LazyAttributeValue(
+                    self._load_lazy_value, (schema, schema_item, value))
+                continue
             try:
                 value = self._converter.from_sql(schema, name, schema_item,
                         value)
             except StandardError:
-                logging.exception('self._converter.from_sql failed.')
-                handler = self._converter.get_malformed_data_handler(schema,
-                        name, schema_item, value)
-                if handler is None:
-                    if util.chatter:
-                        logging.warn("error converting %s (%r)", name, value)
-                    raise
-                try:
-                    value = handler(value)
-                except StandardError:
-                    if util.chatter:
-                        logging.warn("error converting %s (%r)", name, value)
-                    raise
+                value = self._handle_malformed_value(schema, name,
+                                                     schema_item, value)
                 columns_to_update.append(name)
                 values_to_update.append(self._converter.to_sql(schema, name,
                     schema_item, value))
@@ -1042,6 +1092,125 @@ class LiveStorage:
         klass = schema.get_ddb_class(restored_data)
         return klass(restored_data=restored_data, db_info=db_info)
 
+    def _handle_malformed_value(self, schema, name, schema_item, value):
+        """Get a value to use when from_sql() fails for a column.
+
+        This must be called from inside an except block.  If the schema
+        doesn't have a handler for the column, we re-raise the exception.
+        """
+        logging.exception('self._converter.from_sql failed.')
+        handler = self._converter.get_malformed_data_handler(schema,
+                name, schema_item, value)
+        if handler is None:
+            if util.chatter:
+                logging.warn("error converting %s (%r)", name, value)
+            raise
+        try:
+            return handler(value)
+        except StandardError:
+            if util.chatter:
+                logging.warn("error converting %s (%r)", name, value)
+            raise
+
+    def _load_cold_column(self, obj, name, cold_batch):
+        """Load a column that _restore_objects() didn't select.
+
+        We load all the cold columns for all the objects in cold_batch at
+        once, since whatever is accessing the column for one of them will
+        probably want it for the others too (for example when building
+        ItemInfos for a view).
+        """
+        if obj.id in cold_batch.pending_ids:
+            self._load_cold_batch(cold_batch)
+        value = obj.__dict__[name]
+        if value is cold_batch.placeholder:
+            raise database.ObjectNotFoundError(
+                "Can't load %s for %s (id: %s)" % (name,
+                                                  cold_batch.schema.table_name,
+                                                  obj.id))
+        if isinstance(value, database.LazyAttributeValue):
+            value = value.load(obj, name)
+        return value
+
+    def _load_cold_batch(self, cold_batch):
+        schema = cold_batch.schema
+        table_name = schema.table_name
+        # Only load objects that are in memory.  If we're called while the
+        # batch is still being restored, the rest will get loaded later.
+        ids = [id_ for id_ in cold_batch.pending_ids
+               if (id_, table_name) in self._object_map]
+        cold_batch.pending_ids.difference_update(ids)
+        if not ids:
+            return
+        column_names = ['id'] + [f[0] for f in cold_batch.fields]
+        sql = "SELECT %s FROM %s WHERE id IN (%s)" % (
+            ', '.join(column_names), table_name,
+            ', '.join('?' for i in xrange(len(ids))))
+        placeholder = cold_batch.placeholder
+        columns = [(name, schema_item, self._converter.is_lazy(schema_item))
+                   for name, schema_item in cold_batch.fields]
+        for row in self._execute(sql, ids):
+            obj = self._object_map.get((row[0], table_name))
+            if obj is None:
+                continue
+            obj_dict = obj.__dict__
+            columns_to_update = []
+            values_to_update = []
+            for (name, schema_item, is_lazy), value in \
+                    itertools.izip(columns, row[1:]):
+                if obj_dict.get(name) is not placeholder:
+                    # set since we restored the object
+                    continue
+                if value is None:
+                    obj_dict[name] = None
+                    continue
+                if is_lazy:
+                    obj_dict[name] = database.LazyAttributeValue(
+                        self._load_lazy_value, (schema, schema_item, value))
+                    continue
+                try:
+                    value = self._converter.from_sql(schema, name,
+                                                     schema_item, value)
+                except StandardError:
+                    value = self._handle_malformed_value(schema, name,
+                                                         schema_item, value)
+                    columns_to_update.append(name)
+                    values_to_update.append(self._converter.to_sql(schema,
+                        name, schema_item, value))
+                obj_dict[name] = value
+            if columns_to_update:
+                setters = ['%s=?' % c for c in columns_to_update]
+                sql = "UPDATE %s SET %s WHERE id=%s" % (table_name,
+                        ', '.join(setters), obj.id)
+                self._execute(sql, values_to_update)
+
+    def _ensure_cold_columns_loaded(self, objects):
+        """Load the cold columns for objects that are about to be removed."""
+        if not self.lazy_restore:
+            return
+        for obj in objects:
+            for value in obj.__dict__.itervalues():
+                if (isinstance(value, database.LazyAttributeValue) and
+                        isinstance(value.data, _ColdColumnBatch)):
+                    if obj.id in value.data.pending_ids:
+                        self._load_cold_batch(value.data)
+                    break
+
+    def _load_lazy_value(self, obj, name, data):
+        """Decode a column that _restore_object_from_row() skipped."""
+        schema, schema_item, value = data
+        try:
+            return self._converter.from_sql(schema, name, schema_item, value)
+        except StandardError:
+            value = self._handle_malformed_value(schema, name, schema_item,
+                                                 value)
+            # Update the database to match the value we're using.
+            sql = "UPDATE %s SET %s=? WHERE id=?" % (schema.table_name, name)
+            self._execute(sql, (self._converter.to_sql(schema, name,
+                                                       schema_item, value),
+                                obj.id))
+            return value
+
     def persistent_object_count(self):
         return len(self._object_map)
 
@@ -1061,6 +1230,20 @@ class LiveStorage:
             sql.write('\nWHERE %s' % where)
         self._execute(sql.getvalue(), values, is_update=True)
 
+    def update(self, klass, name, value, where, values):
+        """Set a column for all the rows that match where.
+
+        This runs a single UPDATE statement, it doesn't change any objects
+        that are loaded in memory.
+        """
+        schema = self._schema_map[klass]
+        schema_item = self._schema_column_map[schema, name]
+        sql = 'UPDATE %s SET %s=?' % (schema.table_name, name)
+        if where is not None:
+            sql += '\nWHERE %s' % where
+        sql_value = self._converter.to_sql(schema, name, schema_item, value)
+        self._execute(sql, (sql_value,) + tuple(values), is_update=True)
+
     def select(self, klass, columns, where, values, joins=None, limit=None,
             convert=True):
         schema = self._schema_map[klass]
@@ -1362,6 +1545,20 @@ class LiveStorage:
             save_name = "%s.%d" % (org_save_name, i)
         return save_name
 
+class _ColdColumnBatch(object):
+    """Objects restored together whose cold columns haven't been loaded.
+
+    Every cold column for those objects is set to the same
+    LazyAttributeValue, which keeps a reference to us.
+    """
+    def __init__(self, schema, fields, ids, loader):
+        self.schema = schema
+        self.fields = fields
+        self.pending_ids = set(ids)
+        self.placeholder = database.LazyAttributeValue(loader, self)
+        self.placeholders = dict((name, self.placeholder)
+                                 for name, schema_item in fields)
+
 class SQLiteConverter(object):
     def __init__(self):
         self._to_sql_converters = {
@@ -1379,15 +1576,17 @@ class SQLiteConverter(object):
                 schema.SchemaStringSet: self._string_set_from_sql,
         }
 
-        repr_types = (schema.SchemaTimeDelta,
+        codec_types = (schema.SchemaTimeDelta,
                 schema.SchemaReprContainer,
                 schema.SchemaTuple,
                 schema.SchemaDict,
                 schema.SchemaList,
                 )
-        for schema_class in repr_types:
-            self._to_sql_converters[schema_class] = self._repr_to_sql
-            self._from_sql_converters[schema_class] = self._repr_from_sql
+        for schema_class in codec_types:
+            self._to_sql_converters[schema_class] = self._codec_to_sql
+            self._from_sql_converters[schema_class] = self._codec_from_sql
+        self._lazy_types = set(codec_types)
+        self._lazy_types.add(schema.SchemaStatusContainer)
 
     def to_sql(self, schema, name, schema_item, value):
         if value is None:
@@ -1403,6 +1602,10 @@ class SQLiteConverter(object):
                 self._null_convert)
         return converter(value, schema_item)
 
+    def is_lazy(self, schema_item):
+        """Should we wait until a column is accessed to call from_sql()?"""
+        return schema_item.__class__ in self._lazy_types
+
     def get_malformed_data_handler(self, schema, name, schema_item, value):
         handler_name = 'handle_malformed_%s' % name
         if hasattr(schema, handler_name):
@@ -1443,14 +1646,14 @@ class SQLiteConverter(object):
     def _filename_to_sql(self, value, schema_item):
         return filename_to_unicode(value)
 
-    def _repr_to_sql(self, value, schema_item):
-        return repr(value)
+    def _codec_to_sql(self, value, schema_item):
+        return columncodec.encode(value)
 
-    def _repr_from_sql(self, value, schema_item):
-        return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
+    def _codec_from_sql(self, value, schema_item):
+        return columncodec.decode(value)
 
-    def _status_from_sql(self, repr_value, schema_item):
-        status_dict = self._repr_from_sql(repr_value, schema_item)
+    def _status_from_sql(self, sql_value, schema_item):
+        status_dict = self._codec_from_sql(sql_value, schema_item)
         filename_fields = schema.SchemaStatusContainer.filename_fields
         for key in filename_fields:
             value = status_dict.get(key)
@@ -1465,20 +1668,10 @@ class SQLiteConverter(object):
             value = to_save.get(key)
             if value is not None:
                 to_save[key] = filename_to_unicode(value)
-        return repr(to_save)
+        return self._codec_to_sql(to_save, schema_item)
 
     def _string_set_to_sql(self, value, schema_item):
         return schema_item.delimiter.join(value)
 
     def _string_set_from_sql(self, value, schema_item):
         return set(value.split(schema_item.delimiter))
-
-class TimeModuleShadow:
-    """In Python 2.6, time.struct_time is a named tuple and evals poorly,
-    so we have struct_time_shadow which takes the arguments that struct_time
-    should have and returns a 9-tuple
-    """
-    def struct_time(self, tm_year=0, tm_mon=0, tm_mday=0, tm_hour=0, tm_min=0, tm_sec=0, tm_wday=0, tm_yday=0, tm_isdst=0):
-        return (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec, tm_wday, tm_yday, tm_isdst)
-
-_TIME_MODULE_SHADOW = TimeModuleShadow()
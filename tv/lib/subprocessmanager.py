@@ -38,14 +38,18 @@ Platforms need to ensure that this script is available and that it can be run
 with the command line and env from plat.utils.miro_helper_program_info().
 """
 
+from cStringIO import StringIO
 import ctypes
 import cPickle as pickle
 import logging
+import mmap
 import os
 import struct
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 import trapcall
 import warnings
 import Queue
@@ -72,8 +76,11 @@ def _on_windows():
 # ** Protocol between miro and subprocesses **
 #
 # We spawn a child process and communicate to it by sending messages through
-# it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# it's stdin and stdout.  Messages are pickled and sent in frames.  Each
+# frame has a header with the frame type, the data length and the time it was
+# sent, followed by the pickles for 1 or more messages.  Large frames are
+# written to a temporary file and the frame just contains the file's path (see
+# MessageWriter).
 #
 # The communication goes like this:
 #
@@ -115,9 +122,10 @@ class SubprocessMessage(messagetools.Message):
 
 class StartupInfo(SubprocessMessage):
     """Data needed to bootstrap the subprocess."""
-    def __init__(self, config_dict, in_unit_tests):
+    def __init__(self, config_dict, in_unit_tests, large_message_size=None):
         self.config_dict = config_dict
         self.in_unit_tests = in_unit_tests
+        self.large_message_size = large_message_size
 
 class HandlerInfo(SubprocessMessage):
     """Describes how to build a SubprocessHandler object."""
@@ -261,7 +269,17 @@ class SubprocessResponder(messagetools.MessageHandler):
 class LoadError(StandardError):
     """Exception for corrupt data when reading from a pipe."""
 
-SIZEOF_LONG = struct.calcsize("L")
+# Frame types
+FRAME_DATA = 0 # the frame data contains the pickles
+FRAME_FILE = 1 # the frame data is the path to a file containing the pickles
+
+# frame type, data length, time the frame was sent
+FRAME_HEADER = struct.Struct("!BId")
+
+# MessageWriter sends frames once its pending data reaches this size
+BATCH_SIZE = 64 * 1024
+# Default size for writing frames to a temporary file instead of the pipe
+LARGE_MESSAGE_SIZE = 1024 * 1024
 
 def _read_bytes_from_pipe(pipe, length):
     """Read size bytes from a pipe.
@@ -282,54 +300,288 @@ def _read_bytes_from_pipe(pipe, length):
         data.append(d)
     return ''.join(data)
 
-def _load_obj(pipe):
-    """Load an object from one side of a pipe.
+class IPCStats(object):
+    """Track the messages that go through our pipes.
 
-    _load_obj blocks until the all the data has been sent.
+    For each message class, we track how many messages we sent and received,
+    the size of their pickles, and how long they took.  For sent messages,
+    the time is spent pickling them.  For received messages, the time is from
+    when the other side wrote the frame until we unpickled the message.
 
-    :raises IOError: low-level error while reading from the pipe
-    :raises LoadError: data read was corrupted
+    IPCStats is thread-safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # map message class names to [count, bytes, total time, max time]
+            self.sent = {}
+            self.received = {}
+
+    def _record(self, counters, name, size, seconds):
+        with self.lock:
+            try:
+                entry = counters[name]
+            except KeyError:
+                entry = counters[name] = [0, 0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += size
+            entry[2] += seconds
+            entry[3] = max(entry[3], seconds)
+
+    def record_sent(self, name, size, seconds):
+        self._record(self.sent, name, size, seconds)
+
+    def record_received(self, name, size, seconds):
+        self._record(self.received, name, size, seconds)
+
+    def get_summary(self):
+        """Get our counters.
+
+        :returns: list of (direction, class name, count, bytes, total time,
+            max time) tuples.  direction is "sent" or "received".
+        """
+        summary = []
+        with self.lock:
+            for direction, counters in (("sent", self.sent),
+                                        ("received", self.received)):
+                for name, entry in sorted(counters.items()):
+                    summary.append((direction, name) + tuple(entry))
+        return summary
+
+    def log_summary(self):
+        for (direction, name, count, size, total_time,
+                max_time) in self.get_summary():
+            logging.debug("IPC %s %s: %d messages, %d bytes, "
+                          "%0.4fs average, %0.4fs max", direction, name,
+                          count, size, total_time / count, max_time)
+
+# IPCStats for all of the pipes in this process
+ipc_stats = IPCStats()
+
+def _message_name(msg):
+    if msg is None:
+        return 'None'
+    return msg.__class__.__name__
+
+class MessageWriter(object):
+    """Write messages to one side of a pipe.
+
+    Messages are pickled as soon as add() is called, then flush() writes all
+    of them as a single frame.  If the frame is bigger than
+    large_message_size, we write it to a temporary file and only send the
+    path through the pipe.  The MessageReader on the other side deletes the
+    file once it's read it.  If the other side goes away before that,
+    remove_temp_files() cleans up.
+
+    MessageWriter isn't thread-safe.
+    """
+    def __init__(self, pipe, stats=None, large_message_size=None):
+        self.pipe = pipe
+        self.stats = stats
+        self.large_message_size = large_message_size
+        self.pending = []
+        self.pending_size = 0
+        # temporary files we've written that may not have been read yet
+        self.temp_paths = set()
+
+    def add(self, msg):
+        """Add a message to the next frame.
+
+        :raises pickle.PickleError: msg could not be pickled
+        """
+        start = time.time()
+        pickle_data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        if self.stats is not None:
+            self.stats.record_sent(_message_name(msg), len(pickle_data),
+                                   time.time() - start)
+        self.pending.append(pickle_data)
+        self.pending_size += len(pickle_data)
+
+    def flush(self):
+        """Write our pending messages.
+
+        :raises IOError: low-level error while writing to the pipe
+        """
+        if not self.pending:
+            return
+        data = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        if (self.large_message_size is not None and
+                len(data) >= self.large_message_size):
+            frame_type = FRAME_FILE
+            data = self._write_temp_file(data)
+        else:
+            frame_type = FRAME_DATA
+        # NOTE: We do a blocking write here.  This should be fine, since on
+        # both sides we have a thread dedicated to just reading from the pipe
+        # and pushing the data into a Queue.  However, there's some chance
+        # that the process on the other side has gone really haywire and the
+        # reader thread is hung.  I (BDK) can't really see a way for this to
+        # realistically happen, so we stick with blocking writes.
+        try:
+            self.pipe.write(FRAME_HEADER.pack(frame_type, len(data),
+                                              time.time()))
+            self.pipe.write(data)
+            self.pipe.flush()
+        except IOError:
+            if frame_type == FRAME_FILE:
+                self._remove_temp_file(data)
+            raise
 
-    :returns: Python object send from the other side
+    def remove_temp_files(self):
+        """Delete the temporary files that the other side hasn't read.
+
+        Call this once the other side of the pipe is gone.
+        """
+        for path in list(self.temp_paths):
+            self._remove_temp_file(path)
+
+    def _remove_temp_file(self, path):
+        self.temp_paths.discard(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _write_temp_file(self, data):
+        # forget about files the reader has already deleted
+        self.temp_paths = set(path for path in self.temp_paths
+                              if os.path.exists(path))
+        fd, path = tempfile.mkstemp(prefix='miro-ipc-')
+        self.temp_paths.add(path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            self._remove_temp_file(path)
+            raise IOError("Error writing IPC file: %s" % e)
+        return path
+
+class MessageReader(object):
+    """Read messages that a MessageWriter wrote to the other side of a pipe.
+
+    Messages are unpickled one at a time as read() is called.  This matters
+    for the subprocess, which needs to setup some modules after reading
+    StartupInfo and before unpickling the messages that follow it.
+
+    MessageReader isn't thread-safe.
     """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
-        raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("L", size_data)[0]
-    pickle_data = _read_bytes_from_pipe(pipe, size)
-    if len(pickle_data) < size:
-        raise LoadError("EOF reached while reading pickle data "
-                "(read %s bytes)" % len(pickle_data))
-    try:
-        return pickle.loads(pickle_data)
-    except pickle.PickleError:
-        raise LoadError("Pickle data corrupt")
-    except ImportError:
-        raise LoadError("Pickle data references unimportable module")
-    except StandardError, e:
-        # log this exception for easier debugging.
-        send_subprocess_error_for_exception()
-        raise LoadError("Unknown error in pickle.loads: %s" % e)
+    def __init__(self, pipe, stats=None):
+        self.pipe = pipe
+        self.stats = stats
+        # state for the frame that we're reading messages from
+        self.stream = None
+        self.unpickler = None
+        self.frame_end = 0
+        self.sent_time = 0
+        self.mapped_file = None
+        self.path = None
+
+    def read(self):
+        """Read the next message.
+
+        read() blocks until the all the data has been sent.
+
+        :raises IOError: low-level error while reading from the pipe
+        :raises LoadError: data read was corrupted
+
+        :returns: Python object send from the other side
+        """
+        if self.stream is None:
+            self._read_frame()
+        try:
+            obj = self._load_object()
+        except LoadError:
+            self._finish_frame()
+            raise
+        if self.stream.tell() >= self.frame_end:
+            self._finish_frame()
+        return obj
+
+    def _read_frame(self):
+        header = _read_bytes_from_pipe(self.pipe, FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            raise LoadError("EOF reached while reading frame header "
+                    "(read %s bytes)" % len(header))
+        frame_type, size, self.sent_time = FRAME_HEADER.unpack(header)
+        data = _read_bytes_from_pipe(self.pipe, size)
+        if len(data) < size:
+            raise LoadError("EOF reached while reading frame data "
+                    "(read %s bytes)" % len(data))
+        if frame_type == FRAME_FILE:
+            data = self._map_file(data)
+        elif frame_type != FRAME_DATA:
+            raise LoadError("Unknown frame type: %s" % frame_type)
+        if len(data) == 0:
+            self._finish_frame()
+            raise LoadError("Empty frame")
+        self.stream = StringIO(data)
+        self.unpickler = pickle.Unpickler(self.stream)
+        self.frame_end = len(data)
+
+    def _map_file(self, path):
+        # map the file rather than reading it into a string.  The pickles get
+        # loaded straight from the page cache.
+        self.path = path
+        try:
+            f = open(path, 'rb')
+            try:
+                self.mapped_file = mmap.mmap(f.fileno(), 0,
+                                             access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        except EnvironmentError, e:
+            self._finish_frame()
+            raise LoadError("Error reading IPC file: %s" % e)
+        return self.mapped_file
+
+    def _finish_frame(self):
+        self.stream = self.unpickler = None
+        if self.mapped_file is not None:
+            self.mapped_file.close()
+            self.mapped_file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def _load_object(self):
+        start = self.stream.tell()
+        try:
+            obj = self.unpickler.load()
+        except pickle.PickleError:
+            raise LoadError("Pickle data corrupt")
+        except EOFError:
+            raise LoadError("Pickle data truncated")
+        except ImportError:
+            raise LoadError("Pickle data references unimportable module")
+        except StandardError, e:
+            # log this exception for easier debugging.
+            send_subprocess_error_for_exception()
+            raise LoadError("Unknown error in pickle.loads: %s" % e)
+        if self.stats is not None:
+            self.stats.record_received(_message_name(obj),
+                    self.stream.tell() - start, time.time() - self.sent_time)
+        return obj
 
 def _dump_obj(obj, pipe):
-    """Dump an object to the other side of the pipe.
+    """Dump a single object to the other side of the pipe.
 
     :raises IOError: low-level error while writing to the pipe
     :raises pickle.PickleError: obj could not be pickled
     """
-
-    pickle_data = pickle.dumps(obj)
-    size_data = struct.pack("L", len(pickle_data))
-    # NOTE: We do a blocking write here.  This should be fine, since on both
-    # sides we have a thread dedicated to just reading from the pipe and
-    # pushing the data into a Queue.  However, there's some chance that the
-    # process on the other side has gone really haywire and the reader thread
-    # is hung.  I (BDK) can't really see a way for this to realistically
-    # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
-    pipe.flush()
+    writer = MessageWriter(pipe)
+    writer.add(obj)
+    writer.flush()
 
 class SubprocessManager(object):
     """Manages a running subprocess
@@ -339,14 +591,17 @@ class SubprocessManager(object):
     """
 
     def __init__(self, message_base_class, responder, handler_class,
-            handler_args=None, restart_delay=60):
+            handler_args=None, restart_delay=60, large_message_size=None):
         """Create a new SubprocessManager.
 
         This method prepares the subprocess to run.  Use start() to start it
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, we don't
+        install anything and messages must be passed to send_message()
+        directly.  This is useful when several SubprocessManagers handle the
+        same type of messages.
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -355,10 +610,14 @@ class SubprocessManager(object):
 
         restart_delay controls how quickly we restart crashed subprocesses.
         We will not start more than 1 process per <restart_delay> seconds.
+
+        large_message_size enables sending large frames through temporary
+        files (see MessageWriter).  It's used by both sides of the pipe.
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
@@ -368,6 +627,9 @@ class SubprocessManager(object):
         self.thread = None
         self.start_time = 0
         self.restart_delay = restart_delay
+        self.large_message_size = large_message_size
+        self.writer = None
+        self.flush_scheduled = False
 
     # Process management
 
@@ -382,6 +644,8 @@ class SubprocessManager(object):
         """Does the work to startup a new process/thread."""
         # create our child process.
         self.process = self._start_subprocess()
+        self.writer = MessageWriter(self.process.stdin, ipc_stats,
+                                    self.large_message_size)
         # create thread to handle the subprocess's output.  It would be nice
         # to eliminate this thread, but I don't see an easy way to integrate
         # it into the eventloop, since windows doesn't have support for
@@ -506,35 +770,58 @@ class SubprocessManager(object):
     def _cleanup_process(self):
         """Cleanup after our process quits."""
 
+        if self.writer is not None:
+            self.writer.remove_temp_files()
         self.thread = None
         self.process = None
+        self.writer = None
         self.is_running = False
 
     # Handle communication to our child process
 
     def send_message(self, msg):
-        """Send a message to our subprocess """
+        """Send a message to our subprocess
+
+        Messages get sent together in the next idle callback, or once we have
+        BATCH_SIZE bytes of them.
+        """
 
         if not self.is_running:
             raise ValueError("subprocess not running")
         try:
-            _dump_obj(msg, self.process.stdin)
+            self.writer.add(msg)
+        except pickle.PickleError:
+            logging.warn("Error pickling message in send_message() (%s)", msg)
+            return
+        if self.writer.pending_size >= BATCH_SIZE:
+            self.flush_messages()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            eventloop.add_idle(self.flush_messages, 'flush subprocess messages')
+
+    def flush_messages(self):
+        """Write the messages that we've queued up to our subprocess."""
+        self.flush_scheduled = False
+        if not self.is_running:
+            return
+        try:
+            self.writer.flush()
         except IOError:
-            logging.warn("Broken pipe in send_message()")
+            logging.warn("Broken pipe in flush_messages()")
             # we could try to restart our subprocess here, but if the pipe is
             # really broken, then our thread will quit soon and this will
             # cause a restart.
-        except pickle.PickleError:
-            logging.warn("Error pickling message in send_message() (%s)", msg)
 
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
+        self.flush_messages()
         self.sent_quit = True
 
     def _send_startup_info(self):
         self.send_message(StartupInfo(self._get_config_dict(),
-                                      hasattr(app, 'in_unit_tests')))
+                                      hasattr(app, 'in_unit_tests'),
+                                      self.large_message_size))
         self.send_message(HandlerInfo(self.handler_class, self.handler_args))
 
     def _get_config_dict(self):
@@ -556,19 +843,19 @@ class SubprocessManager(object):
         # just forward the message to our process
         self.send_message(msg)
 
-def _read_from_pipe(pipe):
+def _read_from_pipe(reader):
     """Read objects from a pipe.
 
-    This method is a generator that reads pickled objects from pipe.  It
-    terminates when None is sent over the pipe.
+    This method is a generator that reads pickled objects from a
+    MessageReader.  It terminates when None is sent over the pipe.
 
-    raises the same exceptions that _load_obj does, namely:
+    raises the same exceptions that MessageReader.read() does, namely:
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
     """
     while True:
-        msg = _load_obj(pipe)
+        msg = reader.read()
         if msg is None:
             return # other side wants to quit
         yield msg
@@ -601,7 +888,8 @@ class SubprocessResponderThread(threading.Thread):
 
     def run(self):
         try:
-            for msg in _read_from_pipe(self.subprocess_stdout):
+            reader = MessageReader(self.subprocess_stdout, ipc_stats)
+            for msg in _read_from_pipe(reader):
                 self.responder.handle(msg)
         except LoadError, e:
             logging.warn("Quiting from bad data from our subprocess in "
@@ -631,24 +919,26 @@ def subprocess_main():
         import msvcrt
         msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
         msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+    reader = MessageReader(sys.stdin, ipc_stats)
+    # setup MessageHandler for messages going to the main process
+    msg_handler = PipeMessageProxy(sys.stdout)
+    SubprocessResponse.install_handler(msg_handler)
     # unset stdin and stdout so that we don't accidentally print to them
-    stdin = sys.stdin
-    stdout = sys.stdout
     sys.stdout = sys.stdin = None
     # initialize things
     try:
-        handler = _subprocess_setup(stdin, stdout)
+        handler = _subprocess_setup(reader, msg_handler)
     except Exception, e:
         # error reading our initial messages.  Try to log a warning, then
         # quit.
 
         send_subprocess_error_for_exception()
-        _finish_subprocess_message_stream(stdout)
+        msg_handler.close()
         raise # reraise so that miro_helper.py returns a non-zero exit code
     logging.info("_subprocess_setup() finished")
     # startup thread to process stdin
     queue = Queue.Queue()
-    thread = threading.Thread(target=_subprocess_pipe_thread, args=(stdin,
+    thread = threading.Thread(target=_subprocess_pipe_thread, args=(reader,
         queue))
     thread.daemon = False
     thread.start()
@@ -666,26 +956,16 @@ def subprocess_main():
     finally:
         handler.on_shutdown()
         # send None to signal that we are about to quit
-        _finish_subprocess_message_stream(stdout)
+        msg_handler.close()
         # exceptions will continue on here, which causes miro_helper.py
         # to return a non-zero exit code
 
-def _finish_subprocess_message_stream(stdout):
-    """Signal that we are done sending messages in the subprocess."""
-    try:
-        _dump_obj(None, stdout)
-    except IOError:
-        # just ignore since we're done writing out anyways
-        pass
-    # Note we don't catch PickleError, but there should never be an issue
-    # pickling None
-
-def _subprocess_setup(stdin, stdout):
+def _subprocess_setup(reader, msg_handler):
     """Does initial setup for a subprocess.
 
     Returns a SubprocessHandler to use for the subprocess
 
-    raises the same exceptions that _load_obj does, namely:
+    raises the same exceptions that MessageReader.read() does, namely:
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
@@ -693,13 +973,11 @@ def _subprocess_setup(stdin, stdout):
     global logging_setup
     # disable warnings so we don't get too much junk on stderr
     warnings.filterwarnings("ignore")
-    # setup MessageHandler for messages going to the main process
-    msg_handler = PipeMessageProxy(stdout)
-    SubprocessResponse.install_handler(msg_handler)
     # load startup info
-    msg = _load_obj(stdin)
+    msg = reader.read()
     if not isinstance(msg, StartupInfo):
         raise LoadError("first message must a StartupInfo obj")
+    msg_handler.set_large_message_size(msg.large_message_size)
     # setup some basic modules like config and gtcache
     utils.initialize_locale()
     config.load(config.ManualConfig())
@@ -711,7 +989,7 @@ def _subprocess_setup(stdin, stdout):
     logging_setup = True
     logging.info("Logging Started")
     # setup our handler
-    msg = _load_obj(stdin)
+    msg = reader.read()
     if not isinstance(msg, HandlerInfo):
         raise LoadError("second message must a HandlerInfo obj")
     try:
@@ -721,14 +999,14 @@ def _subprocess_setup(stdin, stdout):
         send_subprocess_error_for_exception()
         raise LoadError("Exception while constructing handler: %s" % e)
 
-def _subprocess_pipe_thread(stdin, queue):
+def _subprocess_pipe_thread(reader, queue):
     """Thread inside the subprocess that reads messages from stdin.
 
     We use a separate thread so that our pipe doesn't get backed up while we
     are process messages
     """
     try:
-        for msg in _read_from_pipe(stdin):
+        for msg in _read_from_pipe(reader):
             queue.put(msg)
     except StandardError, e:
         # we could try to send a SubprocessError message, but it's highly
@@ -744,18 +1022,54 @@ class PipeMessageProxy(object):
     This is used in the subprocess to send messages back to the main process
     over it's stdout pipe
 
-    It's safe for multiple threads in the subprocess to use this at once
+    It's safe for multiple threads in the subprocess to use this at once.
+    Messages get put into a queue and a writer thread sends them.  If several
+    messages are waiting when the writer thread wakes up, they all get sent
+    in one frame.
     """
     def __init__(self, fileobj):
-        self.fileobj = fileobj
-        self.lock = threading.Lock()
+        self.writer = MessageWriter(fileobj, ipc_stats)
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._writer_thread,
+                                       name="PipeMessageProxy writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def set_large_message_size(self, large_message_size):
+        self.writer.large_message_size = large_message_size
 
     def handle(self, msg):
+        self.queue.put(msg)
+
+    def close(self):
+        """Send None to the main process, then stop our writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _writer_thread(self):
+        while True:
+            msg = self.queue.get()
+            while True:
+                self._add_message(msg)
+                if msg is None or self.writer.pending_size >= BATCH_SIZE:
+                    break
+                try:
+                    msg = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            try:
+                self.writer.flush()
+            except IOError:
+                # what can we do about that?  Just stop writing.  Our main
+                # process is probably gone, so we will shutdown once our
+                # stdin pipe closes.
+                self.writer.remove_temp_files()
+                return
+            if msg is None:
+                return
+
+    def _add_message(self, msg):
         try:
-            with self.lock:
-                _dump_obj(msg, self.fileobj)
+            self.writer.add(msg)
         except pickle.PickleError:
             send_subprocess_error_for_exception()
-        # NOTE: we don't handle IOError here because what can we do about
-        # that?  Just let it propagate up to the top and which should cause us
-        # to shutdown.
@@ -57,9 +57,12 @@ from miro.test.opmltest import *
 from miro.test.schedulertest import *
 from miro.test.networktest import *
 from miro.test.httpclienttest import *
+from miro.test.httpcachetest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
+from miro.test.feedupdatetest import *
+from miro.test.feeddifftest import *
 from miro.test.feedparsertest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
@@ -74,6 +77,7 @@ from miro.test.itemtest import *
 from miro.test.filetypestest import *
 from miro.test.cellpacktest import *
 from miro.test.searchtest import *
+from miro.test.searchindextest import *
 from miro.test.infolisttest import *
 from miro.test.fileobjecttest import *
 from miro.test.fastresumetest import *
@@ -83,9 +87,11 @@ from miro.test.tableselectiontest import *
 from miro.test.filetagstest import *
 from miro.test.watchedfoldertest import *
 from miro.test.subprocesstest import *
+from miro.test.libdaaptest import *
 from miro.test.itemfiltertest import *
 from miro.test.extensiontest import *
 from miro.test.idleiteratetest import *
+from miro.test.viewpredicatetest import *
 
 # platform specific tests
 
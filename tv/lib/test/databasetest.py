@@ -146,6 +146,45 @@ class ViewTrackerTest(DatabaseTestCase):
         self.assertEquals(self.remove_callbacks, [self.i2])
         self.assertEquals(self.change_callbacks, [self.i1])
 
+    def test_with_bulk_many_objects(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        app.bulk_sql_manager.start()
+        new_items = [item.Item(item.FeedParserValues({'title': u'new'}),
+                               feed_id=self.feed.id)
+                     for i in xrange(1500)]
+        other_items = [item.Item(item.FeedParserValues({'title': u'other'}),
+                                 feed_id=self.feed2.id)
+                       for i in xrange(50)]
+        self.i1.remove()
+        app.bulk_sql_manager.finish()
+        self.assertSameSet(self.add_callbacks, new_items)
+        self.assertEquals(self.remove_callbacks, [self.i1])
+        self.assertEquals(self.change_callbacks, [])
+        self.assertEquals(len(self.tracker), 1501)
+        tracked_ids = set(obj.id for obj in self.view)
+        for obj in other_items:
+            self.assert_(obj.id not in tracked_ids)
+        key = ('item', "feed.userTitle='booya'")
+        self.assertEquals(app.bulk_sql_manager.tracker_times[key][:2],
+                          [1, 1551])
+
+    def test_report_tracker_times(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        app.bulk_sql_manager.start()
+        item.Item(item.FeedParserValues({'title': u'new'}),
+                  feed_id=self.feed.id)
+        app.bulk_sql_manager.finish()
+        self.assertEquals(len(app.bulk_sql_manager.tracker_times), 1)
+        # after enough time has passed, the times get reported and reset
+        app.bulk_sql_manager.tracker_times_start -= 3600
+        app.bulk_sql_manager.start()
+        item.Item(item.FeedParserValues({'title': u'new'}),
+                  feed_id=self.feed.id)
+        app.bulk_sql_manager.finish()
+        self.assertEquals(app.bulk_sql_manager.tracker_times, {})
+
     def test_unlink(self):
         self.tracker.unlink()
         self.feed2.set_title(u"booya")
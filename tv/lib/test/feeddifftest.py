@@ -0,0 +1,108 @@
+from miro import feeddiff
+from miro import feedparserutil
+from miro.feed import Feed
+from miro.item import Item
+from miro.test.framework import MiroTestCase
+
+class FeedDiffTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'http://example.com/feed.rss')
+
+    def make_entry(self, number, title=None, guid=True,
+                   description='description'):
+        if title is None:
+            title = 'Entry %d' % number
+        if guid:
+            guid = '<guid>http://example.com/guid/%d</guid>' % number
+        else:
+            guid = ''
+        return """\
+<item>
+ <title>%s</title>
+ %s
+ <description>%s</description>
+ <enclosure url="http://example.com/video%d.mpg" length="%d"
+  type="video/mpeg" />
+</item>
+""" % (title, guid, description, number, 1000 + number)
+
+    def parse(self, *entries):
+        return feedparserutil.parse("""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Test Feed</title>
+      <link>http://example.com/</link>
+      <description>Feed for FeedDiffTest</description>
+%s
+   </channel>
+</rss>""" % ''.join(entries))
+
+    def make_items(self, diff):
+        for status, item_id, fp_values in diff.entries:
+            self.assertEquals(status, feeddiff.ENTRY_NEW)
+            Item(fp_values, feed_id=self.feed.id)
+
+    def item_keys(self):
+        return feeddiff.item_keys(Item.feed_content_keys(self.feed.id))
+
+    def statuses(self, diff):
+        return [status for status, item_id, fp_values in diff.entries]
+
+    def test_new_entries(self):
+        diff = feeddiff.diff_feed(self.parse(self.make_entry(1),
+                                             self.make_entry(2)), [])
+        self.assertEquals(diff.entry_count, 2)
+        self.assertEquals(diff.parsed.entries, [])
+        self.assertEquals(diff.parsed.feed.title, u'Test Feed')
+        self.assertEquals(diff.last_item_id, 0)
+        self.assertEquals(self.statuses(diff), [feeddiff.ENTRY_NEW] * 2)
+        self.assertEquals([e[2].data['entry_title'] for e in diff.entries],
+                          [u'Entry 1', u'Entry 2'])
+
+    def test_changes(self):
+        self.make_items(feeddiff.diff_feed(self.parse(
+            self.make_entry(1), self.make_entry(2)), []))
+        items = dict((i.entry_title, i) for i in Item.make_view())
+        item_keys = self.item_keys()
+        diff = feeddiff.diff_feed(self.parse(
+            self.make_entry(1),
+            self.make_entry(2, title='Changed'),
+            self.make_entry(3)), item_keys)
+        self.assertEquals(diff.last_item_id,
+                          max(item_id for item_id, key in item_keys))
+        self.assertEquals(diff.entries[0],
+                (feeddiff.ENTRY_UNCHANGED, items[u'Entry 1'].id, None))
+        self.assertEquals(diff.entries[1][:2],
+                (feeddiff.ENTRY_UPDATED, items[u'Entry 2'].id))
+        self.assertEquals(diff.entries[1][2].data['entry_title'],
+                          u'Changed')
+        self.assertEquals(diff.entries[2][:2], (feeddiff.ENTRY_NEW, None))
+
+    def test_keyless_entries(self):
+        self.make_items(feeddiff.diff_feed(self.parse(
+            self.make_entry(1, guid=False)), []))
+        item = Item.make_view().get_singleton()
+        diff = feeddiff.diff_feed(self.parse(
+            self.make_entry(1, guid=False)), self.item_keys())
+        self.assertEquals(diff.entries,
+                          [(feeddiff.ENTRY_UNCHANGED, item.id, None)])
+        # a different title but the same enclosure is still the same item
+        diff = feeddiff.diff_feed(self.parse(
+            self.make_entry(1, title='Renamed', guid=False)),
+            self.item_keys())
+        self.assertEquals(self.statuses(diff), [feeddiff.ENTRY_UPDATED])
+        self.assertEquals(diff.entries[0][1], item.id)
+
+    def test_compact_description(self):
+        description = 'x' * 10000
+        self.make_items(feeddiff.diff_feed(self.parse(
+            self.make_entry(1, description=description)), []))
+        item_keys = self.item_keys()
+        self.assert_(len(repr(item_keys)) < len(description))
+        diff = feeddiff.diff_feed(self.parse(
+            self.make_entry(1, description=description)), item_keys)
+        self.assertEquals(self.statuses(diff), [feeddiff.ENTRY_UNCHANGED])
+        diff = feeddiff.diff_feed(self.parse(
+            self.make_entry(1, description=description + 'y')), item_keys)
+        self.assertEquals(self.statuses(diff), [feeddiff.ENTRY_UPDATED])
@@ -5,7 +5,9 @@ from time import sleep
 from miro import app
 from miro import prefs
 from miro import dialogs
+from miro import feed
 from miro import feedparserutil
+from miro import feedupdate
 from miro.item import Item
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
 
@@ -203,6 +205,109 @@ Instead, astronauts have other options.</description>
         self.assertEqual(len(items), 1)
         my_feed.remove()
 
+    def test_skip_unchanged_body(self):
+        my_feed = self.make_feed()
+        # the first update comes from the HTML that we downloaded when
+        # creating the feed, the next one downloads the feed again.
+        self.update_feed(my_feed)
+        self.assertEqual(feedupdate.get_stats()['parses_skipped'], 0)
+        # the file didn't change, so we shouldn't parse it again
+        self.update_feed(my_feed)
+        self.assertEqual(feedupdate.get_stats()['parses_skipped'], 1)
+        self.assert_(not my_feed.actualFeed.updating)
+        history = feedupdate.global_update_queue.get_history(my_feed)
+        self.assertEqual(history.same_body_count, 1)
+        # after clean_old_items(), we should parse it no matter what
+        my_feed.clean_old_items()
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        self.assertEqual(feedupdate.get_stats()['parses_skipped'], 1)
+
+    def test_run_feed_diff_from_file(self):
+        # feeds that grab_url() spooled to disk get parsed from the file,
+        # which gets cleaned up afterwards.
+        results = []
+        feed.run_feed_diff(None, [], results.append, self.fail,
+                           body_path=self.filename, charset='utf-8')
+        self.assertEquals(len(results), 1)
+        self.assertEquals(results[0].parsed.feed.title, u'Liftoff News')
+        self.assert_(not os.path.exists(self.filename))
+
+class KeylessEntryTest(FeedTestCase):
+    """Test matching items for entries without a guid."""
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.old_merge_chunk_time = feed.MERGE_CHUNK_TIME
+
+    def tearDown(self):
+        feed.MERGE_CHUNK_TIME = self.old_merge_chunk_time
+        FeedTestCase.tearDown(self)
+
+    def make_feed_content(self, entry_count, title_prefix='Entry'):
+        items = []
+        for x in range(entry_count):
+            items.append("""\
+<item>
+ <title>%s %d</title>
+ <enclosure url="http://example.com/video%d.mpg" length="%d"
+  type="video/mpeg" />
+</item>
+""" % (title_prefix, x, x, 1000 + x))
+        return """<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Keyless</title>
+      <link>http://example.com/</link>
+      <description>Entries without guids</description>
+%s
+   </channel>
+</rss>""" % ''.join(items)
+
+    def titles(self):
+        return sorted(i.entry_title for i in Item.make_view())
+
+    def test_match_enclosures(self):
+        self.write_file(self.make_feed_content(5))
+        my_feed = self.make_feed()
+        self.assertEquals(Item.make_view().count(), 5)
+        # updating with the same entries shouldn't create new items
+        self.write_file(self.make_feed_content(5) + ' ')
+        self.update_feed(my_feed)
+        self.assertEquals(Item.make_view().count(), 5)
+        # changing the titles should update the items with the same
+        # enclosures
+        self.write_file(self.make_feed_content(5, 'Renamed'))
+        self.update_feed(my_feed)
+        self.assertEquals(self.titles(),
+                [u'Renamed %d' % i for i in range(5)])
+
+    def test_chunked_merge(self):
+        # with a chunk time of 0, we create one item per idle call
+        feed.MERGE_CHUNK_TIME = 0
+        self.write_file(self.make_feed_content(10))
+        my_feed = Feed(self.url)
+        self.update_feed(my_feed)
+        self.assert_(Item.make_view().count() < 10)
+        self.run_idles_for_this_loop()
+        while self.hasIdles():
+            self.run_idles_for_this_loop()
+        self.assertEquals(Item.make_view().count(), 10)
+        self.assert_(not my_feed.is_updating())
+
+    def test_remove_during_merge(self):
+        feed.MERGE_CHUNK_TIME = 0
+        self.write_file(self.make_feed_content(10))
+        my_feed = Feed(self.url)
+        self.update_feed(my_feed)
+        # we should have done 1 chunk
+        self.assertEquals(Item.make_view().count(), 1)
+        my_feed.remove()
+        self.run_idles_for_this_loop()
+        while self.hasIdles():
+            self.run_idles_for_this_loop()
+        self.assertEquals(Item.make_view().count(), 0)
+
 class MultiFeedExpireTest(FeedTestCase):
     def write_files(self, subfeed_count, feed_item_count):
         all_urls = []
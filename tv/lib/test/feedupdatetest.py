@@ -0,0 +1,200 @@
+from miro import feedupdate
+from miro import signals
+from miro.test.framework import EventLoopTest
+
+class FakeFeed(signals.SignalEmitter):
+    def __init__(self, id_, url):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id_
+        self.url = url
+        self.exists = True
+
+    def get_url(self):
+        return self.url
+
+    def get_title(self):
+        return self.url
+
+    def id_exists(self):
+        return self.exists
+
+class FeedUpdateQueueTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.updated = []
+        self.next_id = 0
+
+    def make_feed(self, url):
+        self.next_id += 1
+        return FakeFeed(self.next_id, url)
+
+    def add_to_queue(self, feed):
+        # skip the timeout that schedule_update() would add
+        self.queue.timeouts[feed.id] = None
+        self.queue.do_update(feed, lambda: self.updated.append(feed))
+
+    def finish_update(self, feed):
+        feed.emit('update-finished')
+        self.runPendingIdles()
+
+    def test_max_updates(self):
+        feeds = [self.make_feed(u'http://host%d.com/feed' % i)
+                 for i in range(feedupdate.MIN_UPDATES + 2)]
+        for feed in feeds:
+            self.add_to_queue(feed)
+        self.assertEquals(self.updated, feeds[:feedupdate.MIN_UPDATES])
+        self.assertEquals(len(self.queue.update_queue), 2)
+
+    def test_per_host_limit(self):
+        same_host = [self.make_feed(u'http://example.com/feed%d' % i)
+                     for i in range(3)]
+        other_host = self.make_feed(u'http://other.com/feed')
+        for feed in same_host + [other_host]:
+            self.add_to_queue(feed)
+        self.assertEquals(self.updated, same_host[:2] + [other_host])
+        # when an update for the host finishes, the next one can start
+        self.finish_update(same_host[0])
+        self.assertEquals(self.updated[-1], same_host[2])
+
+    def test_non_network_feeds(self):
+        # feeds without a host don't count against the per-host limit
+        feeds = [self.make_feed(u'dtv:multi:%d' % i) for i in range(3)]
+        for feed in feeds:
+            self.add_to_queue(feed)
+        self.assertEquals(self.updated, feeds)
+
+    def test_change_likelihood_order(self):
+        busy = [self.make_feed(u'http://host%d.com/feed' % i)
+                for i in range(feedupdate.MIN_UPDATES)]
+        quiet = self.make_feed(u'http://quiet.com/feed')
+        active = self.make_feed(u'http://active.com/feed')
+        for i in range(3):
+            self.queue.record_result(quiet, 0)
+            self.queue.record_result(active, 1)
+        # fill up the update slots, then queue the quiet feed before the
+        # active one.
+        for feed in busy + [quiet, active]:
+            self.add_to_queue(feed)
+        self.assertEquals(self.updated, busy)
+        self.finish_update(busy[0])
+        self.assertEquals(self.updated[len(busy)], active)
+
+    def test_change_likelihood(self):
+        feed = self.make_feed(u'http://example.com/feed')
+        history = self.queue.get_history(feed)
+        self.assertEquals(history.change_likelihood,
+                feedupdate.INITIAL_CHANGE_LIKELIHOOD)
+        self.queue.record_result(feed, 0, not_modified=True)
+        unchanged_likelihood = history.change_likelihood
+        self.assert_(unchanged_likelihood <
+                feedupdate.INITIAL_CHANGE_LIKELIHOOD)
+        self.queue.record_result(feed, 2)
+        self.assert_(history.change_likelihood > unchanged_likelihood)
+        self.assertEquals(history.changed_count, 1)
+        self.assertEquals(history.unchanged_count, 1)
+        self.assertEquals(history.not_modified_count, 1)
+        self.assertEquals(len(history.new_entry_times), 1)
+
+    def test_history_saved(self):
+        feed = self.make_feed(u'http://example.com/feed')
+        self.queue.record_result(feed, 1)
+        self.queue.record_result(feed, 0)
+        self.assert_(not self.queue.check_body_hash(feed, feed.url, u'abc'))
+        self.queue.record_body_hash(feed, feed.url, u'abc')
+        self.assert_(self.queue.check_body_hash(feed, feed.url, u'abc'))
+        self.assertEquals(self.queue.get_stats()['parses_skipped'], 1)
+        # a new queue should load the history from the database
+        queue = feedupdate.FeedUpdateQueue()
+        history = queue.get_history(feed)
+        self.assertEquals(history.changed_count, 1)
+        self.assertEquals(history.unchanged_count, 1)
+        self.assertEquals(history.unchanged_streak, 1)
+        self.assertEquals(history.same_body_count, 1)
+        self.assertEquals(history.body_hashes, {feed.url: u'abc'})
+        queue.forget_feed(feed)
+        self.assertEquals(
+                feedupdate.FeedUpdateHistory.feed_view(feed.id).count(), 0)
+
+    def test_removed_feed(self):
+        feed = self.make_feed(u'http://example.com/feed')
+        feed.exists = False
+        self.add_to_queue(feed)
+        self.assertEquals(self.updated, [])
+        self.assertEquals(len(self.queue.currently_updating), 0)
+
+    def test_adjust_max_updates(self):
+        self.add_to_queue(self.make_feed(u'http://example.com/feed'))
+        # fast updates with feeds still waiting let us run more at once
+        self.queue.update_queue.append(None)
+        self.queue.adjust_max_updates(1.0)
+        self.assertEquals(self.queue.max_updates, feedupdate.MIN_UPDATES + 1)
+        for i in range(feedupdate.MAX_UPDATES):
+            self.queue.adjust_max_updates(1.0)
+        self.assertEquals(self.queue.max_updates, feedupdate.MAX_UPDATES)
+        # slow updates cut it in half
+        self.queue.adjust_max_updates(feedupdate.SLOW_UPDATE_TIME + 1)
+        self.assertEquals(self.queue.max_updates,
+                feedupdate.MAX_UPDATES // 2)
+        # but never below MIN_UPDATES
+        for i in range(5):
+            self.queue.adjust_max_updates(feedupdate.SLOW_UPDATE_TIME + 1)
+        self.assertEquals(self.queue.max_updates, feedupdate.MIN_UPDATES)
+        # with nothing waiting, there's no reason to go higher
+        self.queue.update_queue = []
+        self.queue.adjust_max_updates(1.0)
+        self.assertEquals(self.queue.max_updates, feedupdate.MIN_UPDATES)
+
+    def test_stats(self):
+        feeds = [self.make_feed(u'http://host%d.com/feed' % i)
+                 for i in range(feedupdate.MIN_UPDATES + 1)]
+        for feed in feeds:
+            self.add_to_queue(feed)
+        self.queue.record_result(feeds[0], 1)
+        self.finish_update(feeds[0])
+        stats = self.queue.get_stats()
+        self.assertEquals(stats['queue_depth'], 0)
+        self.assertEquals(stats['max_queue_depth'], 1)
+        self.assertEquals(stats['updating'], feedupdate.MIN_UPDATES)
+        self.assertEquals(stats['max_concurrency'], feedupdate.MIN_UPDATES)
+        self.assertEquals(stats['changed'], 1)
+        self.assertEquals(stats['wait']['count'], len(feeds))
+        self.assertEquals(stats['refresh']['count'], 1)
+        # make sure format_stats() can handle the result
+        feedupdate.format_stats(stats)
+
+class PredictUpdateIntervalTest(EventLoopTest):
+    HOUR = 60 * 60
+    DAY = 24 * HOUR
+
+    def predict(self, new_entry_times, unchanged_streak):
+        return feedupdate.predict_update_interval(new_entry_times,
+                unchanged_streak, self.HOUR, 7 * self.DAY)
+
+    def test_no_history(self):
+        self.assertEquals(self.predict([], 0), self.HOUR)
+
+    def test_backoff(self):
+        # updates without new items push the next one back
+        self.assertEquals(self.predict([], 1),
+                self.HOUR * feedupdate.UNCHANGED_BACKOFF)
+        # but never past max_interval
+        self.assertEquals(self.predict([], 100), 7 * self.DAY)
+
+    def test_prediction(self):
+        # a feed that changes every day gets checked a few times a day
+        times = [i * self.DAY for i in range(5)]
+        self.assertEquals(self.predict(times, 0),
+                self.DAY / feedupdate.CHECKS_PER_NEW_ENTRY)
+        # one that changes every minute still gets checked at most hourly
+        times = [i * 60 for i in range(5)]
+        self.assertEquals(self.predict(times, 0), self.HOUR)
+        # a monthly feed gets checked at the max interval
+        times = [i * 30 * self.DAY for i in range(5)]
+        self.assertEquals(self.predict(times, 0), 7 * self.DAY)
+
+    def test_max_below_min(self):
+        # if the max is lower than the feed's update frequency, the update
+        # frequency wins
+        self.assertEquals(feedupdate.predict_update_interval([], 10,
+            self.HOUR, 60), self.HOUR)
@@ -13,6 +13,7 @@ from miro import database
 from miro import eventloop
 from miro import extensionmanager
 from miro import feed
+from miro import feedupdate
 from miro import downloader
 from miro import httpauth
 from miro import httpclient
@@ -329,8 +330,7 @@ class MiroTestCase(unittest.TestCase):
             patcher.stop()
         # shutdown workerprocess if we started it for some reason.
         workerprocess.shutdown()
-        workerprocess._subprocess_manager = \
-                workerprocess.WorkerSubprocessManager()
+        workerprocess._worker_pool = workerprocess.WorkerProcessPool()
         workerprocess._miro_task_queue.reset()
         self.reset_log_filter()
         signals.system.disconnect_all()
@@ -346,6 +346,9 @@ class MiroTestCase(unittest.TestCase):
 
         # Remove anything that may have been accidentally queued up
         eventloop._eventloop = eventloop.EventLoop()
+        # Forget about feed updates, the FeedUpdateHistory objects it caches
+        # are from the database we just closed.
+        feedupdate.global_update_queue = feedupdate.FeedUpdateQueue()
 
         # Remove tempdir
         shutil.rmtree(self.tempdir, onerror=self._on_rmtree_error)
@@ -615,8 +618,8 @@ class EventLoopTest(MiroTestCase):
         eventloop.add_idle(function, name, args=None, kwargs=None)
 
     def hasIdles(self):
-        return not (eventloop._eventloop.idle_queue.queue.empty() and
-                    eventloop._eventloop.urgent_queue.queue.empty())
+        return (eventloop._eventloop.idle_queue.has_pending_idle() or
+                eventloop._eventloop.urgent_queue.has_pending_idle())
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
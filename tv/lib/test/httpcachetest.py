@@ -0,0 +1,174 @@
+import os
+import time
+
+from miro import httpcache
+from miro.test.framework import MiroTestCase
+
+# Fri, 13 Feb 2009 23:31:30 GMT
+NOW = 1234567890
+
+def http_date(timestamp):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(timestamp))
+
+class CacheHeadersTest(MiroTestCase):
+    def test_parse_cache_control(self):
+        self.assertEquals(httpcache.parse_cache_control(
+            'public, max-age=60, no-cache="set-cookie"'),
+            {'public': None, 'max-age': '60', 'no-cache': 'set-cookie'})
+        self.assertEquals(httpcache.parse_cache_control(None), {})
+
+    def test_parse_http_date(self):
+        self.assertEquals(httpcache.parse_http_date(http_date(NOW)), NOW)
+        self.assertEquals(httpcache.parse_http_date('garbage'), None)
+        self.assertEquals(httpcache.parse_http_date(None), None)
+
+    def check_expiration(self, headers, correct_expiration):
+        self.assertEquals(httpcache.calc_expiration(headers, NOW),
+                          correct_expiration)
+
+    def test_max_age(self):
+        self.check_expiration({'cache-control': 'max-age=60'}, NOW + 60)
+        # Age gets subtracted from max-age
+        self.check_expiration({'cache-control': 'max-age=60', 'age': '10'},
+                              NOW + 50)
+        # max-age wins over expires
+        self.check_expiration({'cache-control': 'max-age=60',
+                               'expires': http_date(NOW + 1000)}, NOW + 60)
+
+    def test_expires(self):
+        # Expires is relative to the server's date header
+        self.check_expiration({'expires': http_date(NOW + 100),
+                               'date': http_date(NOW - 50)}, NOW + 150)
+        self.check_expiration({'expires': http_date(NOW + 100)}, NOW + 100)
+        # invalid expires means the response is already stale
+        self.check_expiration({'expires': '0'}, NOW)
+
+    def test_no_store(self):
+        self.check_expiration({'cache-control': 'no-store, max-age=60'},
+                              None)
+        self.check_expiration({'vary': '*'}, None)
+
+    def test_no_cache(self):
+        self.check_expiration({'cache-control': 'no-cache, max-age=60'}, NOW)
+        self.check_expiration({'pragma': 'no-cache'}, NOW)
+
+    def test_heuristic(self):
+        self.check_expiration({'last-modified': http_date(NOW - 1000)},
+                              NOW + 100)
+        # the heuristic lifetime is capped at a day
+        self.check_expiration({'last-modified': http_date(NOW - 10000000)},
+                              NOW + httpcache.MAX_HEURISTIC_LIFETIME)
+        self.check_expiration({}, NOW)
+
+class HTTPCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.tempdir, 'http-cache')
+        self.cache = httpcache.HTTPCache(self.cache_dir)
+
+    def make_info(self, body='data', **headers):
+        info = {'status': 200, 'body': body}
+        info.update(headers)
+        return info
+
+    def test_store_and_lookup(self):
+        url = 'http://example.com/'
+        info = self.make_info(**{'cache-control': 'max-age=60',
+                                 'set-cookie': 'abc'})
+        self.cache.store(url, info)
+        entry = self.cache.lookup(url)
+        self.assertEquals(entry.info['body'], 'data')
+        self.assert_(entry.is_fresh())
+        # we shouldn't store set-cookie
+        self.assert_('set-cookie' not in entry.info)
+        self.assertEquals(self.cache.lookup('http://example.com/other'),
+                          None)
+        # a new cache object should find the response on disk
+        cache2 = httpcache.HTTPCache(self.cache_dir)
+        self.assertEquals(cache2.lookup(url).info['body'], 'data')
+
+    def test_uncacheable(self):
+        self.cache.store('http://example.com/1',
+                         self.make_info(**{'cache-control': 'no-store'}))
+        # without freshness info or a validator, we can't use the response
+        self.cache.store('http://example.com/2', self.make_info())
+        info = self.make_info(**{'cache-control': 'max-age=60'})
+        info['status'] = 404
+        self.cache.store('http://example.com/3', info)
+        for i in (1, 2, 3):
+            self.assertEquals(self.cache.lookup('http://example.com/%s' % i),
+                              None)
+        self.assertEquals(self.cache.get_stats().stores, 0)
+
+    def test_validators(self):
+        url = 'http://example.com/'
+        self.cache.store(url, self.make_info(**{
+            'etag': '"abc"',
+            'last-modified': http_date(NOW),
+            'cache-control': 'no-cache',
+        }))
+        entry = self.cache.lookup(url)
+        self.assert_(not entry.is_fresh())
+        self.assertEquals(entry.conditional_headers(), {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': http_date(NOW),
+        })
+
+    def test_revalidated(self):
+        url = 'http://example.com/'
+        self.cache.store(url, self.make_info(**{
+            'etag': '"abc"',
+            'cache-control': 'no-cache',
+        }))
+        entry = self.cache.lookup(url)
+        info = self.cache.revalidated(entry, {
+            'status': 304,
+            'body': '',
+            'cache-control': 'max-age=60',
+        })
+        self.assertEquals(info['status'], 200)
+        self.assertEquals(info['body'], 'data')
+        # the new cache-control header should make the response fresh
+        self.assert_(self.cache.lookup(url).is_fresh())
+
+    def test_lru_eviction(self):
+        body = 'x' * 1000
+        self.cache = httpcache.HTTPCache(self.cache_dir, max_size=3500)
+        headers = {'cache-control': 'max-age=60'}
+        for i in xrange(3):
+            self.cache.store('http://example.com/%s' % i,
+                             self.make_info(body, **headers))
+            # make sure each entry has a different last use time
+            time.sleep(0.01)
+        # use the first entry, so that the second one is the least recently
+        # used
+        self.cache.lookup('http://example.com/0')
+        self.cache.store('http://example.com/3',
+                         self.make_info(body, **headers))
+        self.assertEquals(self.cache.lookup('http://example.com/1'), None)
+        for i in (0, 2, 3):
+            self.assertNotEquals(
+                self.cache.lookup('http://example.com/%s' % i), None)
+        self.assertEquals(self.cache.get_stats().evictions, 1)
+        self.assert_(self.cache._total_size <= 3500)
+
+    def test_corrupt_file(self):
+        url = 'http://example.com/'
+        self.cache.store(url, self.make_info(**{'cache-control':
+                                                'max-age=60'}))
+        path = os.path.join(self.cache_dir, self.cache._filename(url))
+        f = open(path, 'wb')
+        f.write('garbage')
+        f.close()
+        self.assertEquals(self.cache.lookup(url), None)
+        self.assert_(not os.path.exists(path))
+
+    def test_stats(self):
+        self.cache.record_hit()
+        self.cache.record_revalidation()
+        self.cache.record_miss()
+        self.cache.record_miss()
+        stats = self.cache.get_stats()
+        self.assertEquals((stats.hits, stats.revalidations, stats.misses),
+                          (1, 1, 2))
+        self.assertEquals(stats.hit_rate(), 0.5)
@@ -3,6 +3,7 @@ import os
 import logging
 import pycurl
 import pickle
+import tempfile
 from cStringIO import StringIO
 
 from miro import app
@@ -23,9 +24,6 @@ TEST_PATH = 'test.txt'
 def uses_mock_httpclient(fun):
     def _uses_mock_httpclient(self):
         self.mocked_multi = httpclient.curl_manager.multi = mock.Mock()
-        self.mocked_multi.timeout.return_value = -1
-        self.mocked_multi.fdset.return_value = ([], [], [])
-        self.mocked_multi.perform.return_value = (None, None)
         return fun(self)
     wrapped = functools.update_wrapper(_uses_mock_httpclient, fun)
     return uses_httpclient(wrapped)
@@ -85,6 +83,67 @@ class HTTPClientTest(HTTPClientTestBase):
         self.grab_url(self.httpserver.build_url('test.txt'))
         self.assertEquals(self.grab_url_info['body'], self.test_response_data)
 
+    @uses_httpclient
+    def test_connection_reuse(self):
+        url = self.httpserver.build_url('test.txt')
+        for i in xrange(3):
+            self.grab_url(url)
+            self.assertEquals(self.grab_url_info['body'],
+                              self.test_response_data)
+        stats = httpclient.get_connection_pool_stats()
+        self.assertEquals(stats.transfers, 3)
+        # the first transfer opens a connection, the others reuse it
+        self.assertEquals(stats.new_connections, 1)
+        self.assertEquals(stats.reused_connections, 2)
+        self.assertAlmostEquals(stats.reuse_rate(), 2.0 / 3)
+        # we should also recycle the libcurl handles
+        self.assertEquals(stats.handles_created, 1)
+        self.assertEquals(stats.handles_reused, 2)
+
+    @uses_httpclient
+    def test_spool_body(self):
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                      spool_threshold=10)
+        self.assert_('body' not in self.grab_url_info)
+        path = self.grab_url_info['body_path']
+        try:
+            self.assertEquals(open(path, 'rb').read(), self.test_response_data)
+        finally:
+            os.remove(path)
+
+    @uses_httpclient
+    def test_spool_small_body(self):
+        # bodies under the threshold should stay in memory
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                      spool_threshold=len(self.test_response_data))
+        self.assert_('body_path' not in self.grab_url_info)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+
+    @uses_httpclient
+    def test_spool_gzip(self):
+        self.httpserver.add_header("content-encoding", "gzip")
+        self.grab_url(self.httpserver.build_url('test.txt.gz'),
+                      spool_threshold=10)
+        path = self.grab_url_info['body_path']
+        try:
+            self.assertEquals(open(path, 'rb').read(), self.test_response_data)
+        finally:
+            os.remove(path)
+
+    @uses_httpclient
+    def test_spool_error(self):
+        # when the transfer fails, we should remove the spool file
+        def spool_files():
+            return set(f for f in os.listdir(tempfile.gettempdir())
+                       if f.endswith('.httpbody'))
+        files_before = spool_files()
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'),
+                      spool_threshold=10)
+        self.assert_(isinstance(self.grab_url_error,
+            httpclient.UnexpectedStatusCode))
+        self.assertEquals(spool_files(), files_before)
+
     @uses_httpclient
     def test_file_get(self):
         path = resources.path("testdata/httpserver/test.txt")
@@ -944,6 +1003,85 @@ class HTTPAuthBackendTestDLDaemonVersion(HTTPAuthBackendTest):
         self.assertEquals(httpauth.find_http_auth(url, header), None)
         self.assertEquals(miro.httpauth.find_http_auth(url, header), None)
 
+class HTTPClientCacheTest(HTTPClientTestBase):
+    def setUp(self):
+        HTTPClientTestBase.setUp(self)
+        httpclient.init_http_cache(os.path.join(self.tempdir, 'http-cache'))
+        self.url = self.httpserver.build_url('test.txt')
+
+    def tearDown(self):
+        httpclient.http_cache = None
+        HTTPClientTestBase.tearDown(self)
+
+    def check_stats(self, hits=0, revalidations=0, misses=0):
+        stats = httpclient.get_http_cache_stats()
+        self.assertEquals((stats.hits, stats.revalidations, stats.misses),
+                          (hits, revalidations, misses))
+
+    @uses_httpclient
+    def test_fresh_response(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        self.grab_url(self.url, use_cache=True)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.check_stats(misses=1)
+        # the second request should come from the cache
+        self.httpserver.httpserver.last_info = None
+        self.grab_url(self.url, use_cache=True)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assertEquals(self.grab_url_info['status'], 200)
+        self.assertEquals(self.httpserver.last_info(), None)
+        self.check_stats(hits=1, misses=1)
+
+    @uses_httpclient
+    def test_revalidation(self):
+        self.httpserver.add_header('Cache-Control', 'no-cache')
+        self.httpserver.add_header('ETag', '"abc"')
+        self.grab_url(self.url, use_cache=True)
+        self.grab_url(self.url, use_cache=True)
+        # we should send a conditional GET, then use the cached body when the
+        # server returns 304
+        headers = self.httpserver.last_info()['headers']
+        self.assertEquals(headers['if-none-match'], '"abc"')
+        self.assertEquals(self.grab_url_info['status'], 200)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.check_stats(revalidations=1, misses=1)
+
+    @uses_httpclient
+    def test_cache_not_used(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        self.grab_url(self.url)
+        self.grab_url(self.url, use_cache=True)
+        # requests that don't use the cache shouldn't see the response
+        self.grab_url(self.url)
+        self.check_stats(misses=1)
+        self.httpserver.add_header('Cache-Control', 'no-store')
+        url = self.httpserver.build_url('test%20with%20spaces.txt')
+        self.grab_url(url, use_cache=True)
+        self.grab_url(url, use_cache=True)
+        self.check_stats(misses=3)
+
+    @uses_httpclient
+    def test_cancel_cached_response(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        self.grab_url(self.url, use_cache=True)
+        self.grab_url_info = None
+        client = httpclient.grab_url(self.url, self.grab_url_callback,
+                                     self.grab_url_errback, use_cache=True)
+        client.cancel()
+        self.runPendingIdles()
+        self.check_nothing_called()
+
+    @uses_httpclient
+    def test_headers(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        self.grab_headers(self.url, use_cache=True)
+        self.assertEquals(self.httpserver.last_info()['method'], 'HEAD')
+        self.httpserver.httpserver.last_info = None
+        self.grab_headers(self.url, use_cache=True)
+        self.assertEquals(self.grab_url_info['status'], 200)
+        self.assertEquals(self.httpserver.last_info(), None)
+        self.check_stats(hits=1, misses=1)
+
 class BadURLTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -6,7 +6,8 @@ import tempfile
 from miro import app
 from miro import prefs
 from miro.feed import Feed
-from miro.item import Item, FileItem, FeedParserValues, on_new_metadata
+from miro.item import (Item, FileItem, FeedParserValues, on_new_metadata,
+                       CONTENT_KEYS, item_content_key, item_enclosure_key)
 from miro.fileobject import FilenameType
 from miro.downloader import RemoteDownloader
 from miro.test import mock
@@ -418,3 +419,33 @@ class ItemMetadataTest(MiroTestCase):
                 self.assertEquals(item.album, None)
                 self.assertEquals(item.title, None)
                 self.assertEquals(item.duration, None)
+
+class ItemKeyTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'http://example.com/1')
+
+    def test_content_keys(self):
+        fp_values = fp_values_for_url(u'http://example.com/1.avi')
+        self.assertEquals(list(CONTENT_KEYS), sorted(fp_values.data.keys()))
+
+    def test_item_keys(self):
+        fp_values = fp_values_for_url(u'http://example.com/1.avi',
+                {'title': u'one'})
+        item = Item(fp_values, feed_id=self.feed.id)
+        self.assertEquals(item_content_key(item), fp_values.content_key())
+        self.assertEquals(item_enclosure_key(item), fp_values.enclosure_key())
+        other = fp_values_for_url(u'http://example.com/1.avi',
+                {'title': u'two'})
+        self.assertNotEquals(item_content_key(item), other.content_key())
+        self.assertEquals(item_enclosure_key(item), other.enclosure_key())
+
+    def test_feed_content_keys(self):
+        fp_values = fp_values_for_url(u'http://example.com/1.avi',
+                {'title': u'one', 'description': u'desc'})
+        item = Item(fp_values, feed_id=self.feed.id)
+        other_feed = Feed(u'http://example.com/2')
+        Item(fp_values_for_url(u'http://example.com/2.avi'),
+             feed_id=other_feed.id)
+        self.assertEquals(Item.feed_content_keys(self.feed.id),
+                          [(item.id, fp_values.content_key())])
@@ -0,0 +1,366 @@
+import httplib
+import mmap
+import os
+import socket
+import threading
+import time
+import gzip
+from cStringIO import StringIO
+
+from miro import libdaap
+from miro.libdaap.subr import (ChunkedStreamObj, StreamObj, encode_response,
+                               decode_response)
+from miro.test.framework import MiroTestCase
+
+class FakeDaapBackend(object):
+    """Backend that shares a single file as item 1."""
+    def __init__(self, path):
+        self.path = path
+        # Clear this to make get_file() block until it gets set.
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def get_revision(self, session, old_revision, request):
+        return old_revision
+
+    def get_items(self, playlist_id=None):
+        return {}
+
+    def get_playlists(self):
+        return {}
+
+    def get_file(self, itemid, generation, ext, session, request_path_func,
+                 offset=0, chunk=None):
+        self.gate.wait()
+        if itemid != 1:
+            return None, None
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(offset, os.SEEK_SET)
+        return file_obj, os.path.basename(self.path)
+
+def make_test_file(path, size):
+    # Use a pattern that makes it obvious when we send the wrong range.
+    data = ''.join(chr(i % 251) for i in xrange(size))
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+    return data
+
+class DaapServerTestMixin(object):
+    def start_server(self, path, max_threads=libdaap.DAAP_MAXTHREADS,
+                     max_queue=libdaap.DAAP_MAXQUEUE):
+        self.backend = FakeDaapBackend(path)
+        self.server = libdaap.make_daap_server(self.backend, port=0,
+                                               max_threads=max_threads,
+                                               max_queue=max_queue)
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever,
+                                              name='DAAP Test Server')
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def stop_server(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def connect_client(self):
+        client = libdaap.make_daap_client('127.0.0.1', self.port, gzip=False)
+        self.assert_(client.connect())
+        self.assertEquals(client.databases(), 1)
+        return client
+
+    def get_stream(self, client, headers=None):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        conn.request('GET', client.daap_get_file_request(1),
+                      headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response, data
+
+class DaapServerTest(MiroTestCase, DaapServerTestMixin):
+    FILE_SIZE = 300 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'song.mp3')
+        self.data = make_test_file(self.path, self.FILE_SIZE)
+        self.start_server(self.path)
+        self.client = self.connect_client()
+
+    def tearDown(self):
+        self.client.disconnect()
+        self.stop_server()
+        MiroTestCase.tearDown(self)
+
+    def test_stream(self):
+        response, data = self.get_stream(self.client)
+        self.assertEquals(response.status, libdaap.DAAP_OK)
+        self.assertEquals(response.getheader('Content-length'),
+                          str(self.FILE_SIZE))
+        self.assert_(data == self.data)
+
+    def test_stream_range(self):
+        response, data = self.get_stream(self.client,
+                                         {'Range': 'bytes=1000-1999'})
+        self.assertEquals(response.status, libdaap.DAAP_PARTIAL_CONTENT)
+        self.assertEquals(response.getheader('Content-Range'),
+                          'bytes 1000-1999/%d' % self.FILE_SIZE)
+        self.assert_(data == self.data[1000:2000])
+
+    def test_stream_open_range(self):
+        start = 200 * 1024 + 17
+        response, data = self.get_stream(self.client,
+                                         {'Range': 'bytes=%d-' % start})
+        self.assertEquals(response.status, libdaap.DAAP_PARTIAL_CONTENT)
+        self.assertEquals(response.getheader('Content-Range'),
+                          'bytes %d-%d/%d' % (start, self.FILE_SIZE - 1,
+                                              self.FILE_SIZE))
+        self.assert_(data == self.data[start:])
+
+    def test_missing_file(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        conn.request('GET', self.client.daap_get_file_request(2))
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        self.assertEquals(response.status, libdaap.DAAP_FILENOTFOUND)
+
+class DaapThreadPoolTest(MiroTestCase, DaapServerTestMixin):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'song.mp3')
+        make_test_file(self.path, 1024)
+        self.start_server(self.path, max_threads=2)
+
+    def tearDown(self):
+        self.stop_server()
+        MiroTestCase.tearDown(self)
+
+    def server_info(self, conn):
+        conn.request('GET', '/server-info')
+        response = conn.getresponse()
+        response.read()
+        return response.status
+
+    def test_reuse(self):
+        for i in xrange(5):
+            conn = httplib.HTTPConnection('127.0.0.1', self.port)
+            self.assertEquals(self.server_info(conn), libdaap.DAAP_OK)
+            conn.close()
+        self.assert_(self.server.worker_count() <= 2)
+
+    def test_keep_alive(self):
+        # Idle HTTP/1.1 connections don't hold onto workers, so 2 workers
+        # can serve more connections than that.
+        conns = [httplib.HTTPConnection('127.0.0.1', self.port)
+                 for i in xrange(5)]
+        for i in xrange(2):
+            for conn in conns:
+                self.assertEquals(self.server_info(conn), libdaap.DAAP_OK)
+        self.assert_(self.server.worker_count() <= 2)
+        for conn in conns:
+            conn.close()
+
+    def wait_for_idle_workers(self, count):
+        for i in xrange(100):
+            if self.server.idle_workers == count:
+                return
+            time.sleep(0.01)
+        self.fail('workers never went idle')
+
+    def test_full(self):
+        self.stop_server()
+        self.start_server(self.path, max_threads=1, max_queue=0)
+        client = self.connect_client()
+        self.wait_for_idle_workers(1)
+        # Tie up the only worker with a stream.
+        self.backend.gate.clear()
+        results = []
+        t = threading.Thread(target=lambda: results.append(
+            self.get_stream(client)[0].status))
+        t.daemon = True
+        t.start()
+        self.wait_for_idle_workers(0)
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.assertEquals(self.server_info(conn), libdaap.DAAP_UNAVAILABLE)
+        conn.close()
+        self.backend.gate.set()
+        t.join(5)
+        self.assertEquals(results, [libdaap.DAAP_OK])
+        client.disconnect()
+
+    def test_idle_timeout(self):
+        self.server.idle_timeout = 0.2
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.assertEquals(self.server_info(conn), libdaap.DAAP_OK)
+        conn.sock.settimeout(5)
+        # The server should hang up on us.
+        self.assertEquals(conn.sock.recv(1), '')
+        conn.close()
+
+class NonFile(object):
+    """Wraps a file object so that it's not a real file anymore."""
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+class ChunkedStreamObjTest(MiroTestCase):
+    FILE_SIZE = 5 * mmap.ALLOCATIONGRANULARITY + 123
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'song.mp3')
+        self.data = make_test_file(self.path, self.FILE_SIZE)
+
+    def send(self, stream):
+        sender, receiver = socket.socketpair()
+        received = []
+        def read_all():
+            while True:
+                data = receiver.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+        t = threading.Thread(target=read_all)
+        t.start()
+        wfile = sender.makefile('wb', 0)
+        stream.send(wfile, sender)
+        wfile.close()
+        sender.close()
+        t.join()
+        receiver.close()
+        return ''.join(received)
+
+    def make_stream(self, start=0, end=0, wrap=False):
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(start, os.SEEK_SET)
+        if wrap:
+            file_obj = NonFile(file_obj)
+        return ChunkedStreamObj(file_obj, self.path, start, end)
+
+    def check_send(self, start=0, end=0, wrap=False):
+        stream = self.make_stream(start, end, wrap)
+        # Use small windows to test sending over several of them.
+        stream.MMAP_WINDOW_SIZE = mmap.ALLOCATIONGRANULARITY
+        if end:
+            expected = self.data[start:end+1]
+        else:
+            expected = self.data[start:]
+        self.assertEquals(len(stream), len(expected))
+        self.assert_(self.send(stream) == expected)
+        self.assertEquals(stream.unread, 0)
+        self.assertEquals(stream.file_obj.tell(), start + len(expected))
+
+    def test_send(self):
+        self.check_send()
+
+    def test_send_range(self):
+        self.check_send(start=mmap.ALLOCATIONGRANULARITY - 10,
+                        end=3 * mmap.ALLOCATIONGRANULARITY + 10)
+
+    def test_send_open_range(self):
+        self.check_send(start=2 * mmap.ALLOCATIONGRANULARITY + 1)
+
+    def test_send_not_a_file(self):
+        self.check_send(start=100, end=200, wrap=True)
+
+    def test_send_truncated(self):
+        stream = self.make_stream(start=100)
+        f = open(self.path, 'r+b')
+        f.truncate(1000)
+        f.close()
+        self.assert_(self.send(stream) == self.data[100:1000])
+
+def make_item_listing(count):
+    items = []
+    for i in xrange(count):
+        items.append(('mlit', [('mikd', 2),
+                               ('miid', i),
+                               ('minm', 'Item %d' % i),
+                               ('asal', 'Album %d' % (i % 10)),
+                               ('astm', 1000 * i),
+                               ('assz', 1234567 * (i % 1000))]))
+    return [('adbs', [('mstt', libdaap.DAAP_OK),
+                      ('muty', 0),
+                      ('mtco', count),
+                      ('mrco', count),
+                      ('mlcl', items)])]
+
+class DMAPCodecTest(MiroTestCase):
+    def test_encode(self):
+        blob = encode_response([('mstt', 200), ('minm', 'abc')])
+        self.assertEquals(str(blob),
+                          'mstt\x00\x00\x00\x04\x00\x00\x00\xc8'
+                          'minm\x00\x00\x00\x03abc')
+        self.assertEquals(len(blob), 23)
+
+    def test_encode_nested(self):
+        blob = encode_response([('mlog', [('mstt', 200), ('mlid', 7)]),
+                                ('mstt', 200)])
+        self.assertEquals(str(blob),
+                          'mlog\x00\x00\x00\x18'
+                          'mstt\x00\x00\x00\x04\x00\x00\x00\xc8'
+                          'mlid\x00\x00\x00\x04\x00\x00\x00\x07'
+                          'mstt\x00\x00\x00\x04\x00\x00\x00\xc8')
+
+    def test_encode_bad_value(self):
+        # values that don't fit get left out.
+        blob = encode_response([('mikd', 1000), ('mstt', 200)])
+        self.assertEquals(decode_response(str(blob)), [('mstt', 200)])
+
+    def test_encode_file(self):
+        path = os.path.join(self.tempdir, 'song.mp3')
+        make_test_file(path, 100)
+        file_obj = open(path, 'rb')
+        blob = encode_response([(file_obj, path, 0, 0)])
+        self.assert_(isinstance(blob, ChunkedStreamObj))
+        self.assertEquals(len(blob), 100)
+        file_obj.close()
+
+    def test_round_trip(self):
+        reply = make_item_listing(100)
+        self.assertEquals(decode_response(str(encode_response(reply))),
+                          reply)
+
+    def test_gzip(self):
+        reply = make_item_listing(100)
+        blob = encode_response(reply, content_encoding='gzip')
+        self.assertEquals(blob.get_headers(),
+                          [('Content-encoding', 'gzip')])
+        data = gzip.GzipFile(fileobj=StringIO(str(blob))).read()
+        self.assertEquals(decode_response(data), reply)
+
+    def test_chunks(self):
+        blob = encode_response(make_item_listing(1000))
+        blob.chunksize = 1024
+        chunks = list(blob)
+        self.assert_(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assert_(1024 <= len(chunk) < 2048)
+        self.assertEquals(''.join(chunks), str(blob))
+        self.assertEquals(sum(len(c) for c in chunks), len(blob))
+
+    def test_stream_obj_string(self):
+        blob = StreamObj('abc')
+        self.assertEquals(list(blob), ['abc'])
+        self.assertEquals(len(blob), 3)
+
+    def test_decode_truncated(self):
+        data = str(encode_response([('mstt', 200), ('minm', 'abc')]))
+        self.assertEquals(decode_response(data[:-1]), [(-1, [])])
+        self.assertEquals(decode_response(data[:10]), [(-1, [])])
+
+    def test_decode_bad_size(self):
+        self.assertEquals(decode_response('mstt\x00\x00\x00\x02\x00\xc8'),
+                          [(-1, [])])
+
+    def test_decode_bad_list(self):
+        # An error inside a container only spoils that container.
+        data = ('mlog\x00\x00\x00\x06mstt\x00\x00' +
+                str(encode_response([('mstt', 200)])))
+        self.assertEquals(decode_response(data),
+                          [('mlog', [(-1, [])]), ('mstt', 200)])
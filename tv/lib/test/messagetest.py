@@ -1,6 +1,7 @@
 import logging
 import cPickle
 import functools
+import os
 
 from miro import app
 from miro import prefs
@@ -12,6 +13,8 @@ from miro.playlist import SavedPlaylist
 from miro.folder import PlaylistFolder, ChannelFolder
 from miro.singleclick import _build_entry
 from miro.tabs import TabOrder
+from miro.infoupdater import InfoUpdater
+from miro import iteminfocache
 from miro import itemsource
 from miro import messages
 from miro import messagehandler
@@ -59,10 +62,28 @@ class MessageHandlerTest(MiroTestCase):
 class TestFrontendMessageHandler(object):
     def __init__(self):
         self.messages = []
+        # ItemInfoDeltas that we've seen
+        self.deltas = []
+        # rebuild ItemInfos from ItemInfoDeltas like the frontend does
+        self.info_updater = InfoUpdater()
 
     def handle(self, message):
+        if isinstance(message, messages.ItemList):
+            # InfoUpdater only keeps track of infos for lists that have
+            # changed callbacks
+            callbacks = self.info_updater.item_changed_callbacks
+            if not callbacks.get(message.type, message.id):
+                callbacks.add(message.type, message.id, self.on_items_changed)
+            self.info_updater.handle_item_list(message)
+        elif isinstance(message, messages.ItemsChanged):
+            self.deltas.extend(obj for obj in message.changed
+                               if isinstance(obj, messages.ItemInfoDelta))
+            self.info_updater.handle_items_changed(message)
         self.messages.append(message)
 
+    def on_items_changed(self, message):
+        pass
+
 class TrackerTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
@@ -487,6 +508,46 @@ class FeedItemTrackTest(TrackerTest):
         self.assertEquals(len(self.test_handler.messages), 2)
         self.check_changed_message(1, removed=[self.items[1]])
 
+    def test_update_sends_delta(self):
+        messagehandler.items_changed_stats.reset()
+        self.items[0].entry_title = u'new name'
+        self.items[0].signal_change()
+        self.runUrgentCalls()
+        self.assertEquals(len(self.test_handler.deltas), 1)
+        delta = self.test_handler.deltas[0]
+        self.assertEquals(delta.id, self.items[0].id)
+        self.assertEquals(delta.changes['name'], u'new name')
+        self.assert_('description' not in delta.changes)
+        self.assert_('feed_id' not in delta.changes)
+        self.assertEquals(messagehandler.items_changed_stats.objects_saved, 1)
+        self.assert_(messagehandler.items_changed_stats.bytes_saved > 0)
+        # the info we send to callbacks should have the new value, but the
+        # info from the initial list should be left alone
+        self.check_changed_message(1, changed=[self.items[0]])
+        old_info = [i for i in self.test_handler.messages[0].items
+                    if i.id == self.items[0].id][0]
+        self.assertEquals(old_info.name, u'my first item')
+
+    def test_resend_item_infos(self):
+        messages.ResendItemInfos('feed', self.feed.id,
+                                 [self.items[0].id]).send_to_backend()
+        self.runUrgentCalls()
+        # we should send the full ItemInfo, even though it didn't change
+        self.check_changed_message(1, changed=[self.items[0]])
+        self.assert_(isinstance(self.test_handler.messages[1].changed[0],
+                                messages.ItemInfo))
+        self.assertEquals(self.test_handler.deltas, [])
+        # after that, we can go back to sending deltas
+        self.items[0].entry_title = u'new name'
+        self.items[0].signal_change()
+        self.runUrgentCalls()
+        self.assertEquals(len(self.test_handler.deltas), 1)
+
+    def test_unchanged_not_sent(self):
+        self.items[0].signal_change()
+        self.runUrgentCalls()
+        self.assertEquals(len(self.test_handler.messages), 1)
+
     def test_stop(self):
         messages.StopTrackingItems('feed', self.feed.id).send_to_backend()
         self.runUrgentCalls()
@@ -704,3 +765,301 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         self.setup_new_item_info_cache()
         app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
         self.assertEquals(app.db.cursor.fetchone()[0], 0)
+
+class MmapItemInfoCacheTest(ItemInfoCacheTest):
+    # Run the ItemInfoCacheTest tests using MmapItemInfoCache
+    def setup_new_item_info_cache(self):
+        path = os.path.join(self.tempdir, 'iteminfocache')
+        app.item_info_cache = iteminfocache.MmapItemInfoCache(path)
+        app.item_info_cache.load()
+
+class MmapItemInfoCacheErrorTest(ItemInfoCacheErrorTest):
+    def setup_new_item_info_cache(self):
+        self.cache_path = os.path.join(self.tempdir, 'iteminfocache')
+        app.item_info_cache = iteminfocache.MmapItemInfoCache(self.cache_path)
+        app.item_info_cache.load()
+
+    def save_and_reload(self):
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+
+    def check_infos(self):
+        for item in self.items:
+            cache_info = app.item_info_cache.get_info(item.id)
+            real_info = itemsource.DatabaseItemSource._item_info_for(item)
+            self.assertEquals(cache_info.__dict__, real_info.__dict__)
+
+    def test_lazy_load(self):
+        self.save_and_reload()
+        id_to_info = app.item_info_cache.id_to_info
+        self.assertEquals(id_to_info.loaded, {})
+        self.assertEquals(len(id_to_info), len(self.items))
+        self.assert_(self.items[0].id in id_to_info)
+        self.check_infos()
+        self.assertEquals(set(id_to_info.loaded),
+                          set(item.id for item in self.items))
+
+    def test_save_drops_unchanged_infos(self):
+        self.save_and_reload()
+        id_to_info = app.item_info_cache.id_to_info
+        self.check_infos()
+        self.assertEquals(len(id_to_info.loaded), len(self.items))
+        changed_item = self.items[0]
+        changed_item.title = u'new title'
+        changed_item.signal_change()
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        # only the changed info should still be loaded
+        self.assertEquals(set(id_to_info.loaded), set([changed_item.id]))
+        self.check_infos()
+
+    def test_failsafe_save_doesnt_keep_infos(self):
+        self.save_and_reload()
+        app.item_info_cache.info_file.delete()
+        self.setup_new_item_info_cache()
+        self.assertEquals(type(app.item_info_cache.id_to_info), dict)
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.assertEquals(app.item_info_cache.id_to_info.loaded, {})
+        self.check_infos()
+
+    def test_values_doesnt_cache(self):
+        self.save_and_reload()
+        id_to_info = app.item_info_cache.id_to_info
+        first_id = self.items[0].id
+        id_to_info[first_id]
+        values = id_to_info.values()
+        self.assertEquals(set(info.id for info in values),
+                          set(item.id for item in self.items))
+        self.assertEquals(set(id_to_info.loaded), set([first_id]))
+        # ItemInfos that were already loaded should be shared
+        self.assert_(id_to_info[first_id] in values)
+
+    def test_failsafe_load(self):
+        self.save_and_reload()
+        # overwrite the pickles with junk
+        info_file = app.item_info_cache.info_file
+        data_path = info_file.data_path(info_file.token)
+        info_file.close()
+        f = open(data_path, 'r+b')
+        f.seek(len(info_file.token))
+        f.write('BOGUS' * 100)
+        f.close()
+        self.setup_new_item_info_cache()
+        # the bad pickles should be recreated from the items
+        self.check_infos()
+        # missing files should result in a failsafe load
+        app.item_info_cache.info_file.delete()
+        self.setup_new_item_info_cache()
+        self.assertEquals(type(app.item_info_cache.id_to_info), dict)
+        self.check_infos()
+        self.save_and_reload()
+        self.assertNotEquals(type(app.item_info_cache.id_to_info), dict)
+        self.check_infos()
+
+    def test_incremental_save(self):
+        self.save_and_reload()
+        info_file = app.item_info_cache.info_file
+        token = info_file.token
+        data_size = info_file.data_size
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        self.items[1].remove()
+        del self.items[1]
+        self.make_item(u'http://example.com/3')
+        self.save_and_reload()
+        info_file = app.item_info_cache.info_file
+        # the data file should be appended to, not rewritten
+        self.assertEquals(info_file.token, token)
+        self.assert_(info_file.data_size > data_size)
+        self.assert_(info_file.dead_size > 0)
+        self.assertEquals(list(info_file.ids),
+                          sorted(item.id for item in self.items))
+        self.check_infos()
+        self.assertEquals(app.item_info_cache.get_info(self.items[0].id).name,
+                          u'new title')
+
+    def test_compact(self):
+        self.save_and_reload()
+        old_cache = app.item_info_cache
+        old_cache.COMPACT_THRESHOLD = 0
+        token = old_cache.info_file.token
+        # make the unused data bigger than the used data
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        self.items[1].remove()
+        del self.items[1]
+        self.save_and_reload()
+        info_file = app.item_info_cache.info_file
+        self.assertNotEquals(info_file.token, token)
+        self.assertEquals(info_file.dead_size, 0)
+        self.assertEquals(os.path.exists(info_file.data_path(token)), False)
+        self.check_infos()
+
+    def test_database_changed(self):
+        self.save_and_reload()
+        # Simulate using a database that doesn't match our files.
+        app.db.set_variable(iteminfocache.MmapItemInfoCache.FILE_TOKEN_KEY,
+                            'abc')
+        self.setup_new_item_info_cache()
+        self.assertEquals(type(app.item_info_cache.id_to_info), dict)
+        self.check_infos()
+
+    def test_failsafe_load_item_change(self):
+        # the base class version corrupts the item_info_cache table, corrupt
+        # our files instead
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        app.item_info_cache.info_file.delete()
+        self.clear_ddb_object_cache()
+        app.item_info_cache = None
+        old_setup_restored = Item.setup_restored
+        def new_setup_restored(self):
+            self.title = u'new title2'
+            self.signal_change()
+            old_setup_restored(self)
+        Item.setup_restored = new_setup_restored
+        try:
+            self.setup_new_item_info_cache()
+        finally:
+            Item.setup_restored = old_setup_restored
+        cached_info = self.get_info_from_item_info_cache(self.items[0].id)
+        self.assertEquals(cached_info.name, 'new title2')
+
+    def test_item_info_version(self):
+        self.save_and_reload()
+        itemsource.DatabaseItemSource.VERSION += 1
+        try:
+            self.setup_new_item_info_cache()
+        finally:
+            itemsource.DatabaseItemSource.VERSION -= 1
+        self.assertEquals(type(app.item_info_cache.id_to_info), dict)
+        self.assertEquals(os.path.exists(self.cache_path + '.idx'), False)
+
+class InfoUpdaterDeltaTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        self.info_updater = InfoUpdater()
+        self.infos = []
+        for i in xrange(3):
+            entry = _build_entry(u'http://example.com/%s' % i,
+                                 'video/x-unknown', {'title': u'title-%s' % i})
+            item_ = Item(FeedParserValues(entry), feed_id=self.feed.id)
+            self.infos.append(
+                itemsource.DatabaseItemSource._item_info_for(item_))
+        self.info_updater.item_changed_callbacks.add(
+            'feed', self.feed.id, self.on_items_changed)
+        self.info_updater.handle_item_list(messages.ItemList('feed',
+            self.feed.id, self.infos[:2]))
+        self.backend_messages = []
+        messages.BackendMessage.install_handler(self)
+
+    def tearDown(self):
+        messages.BackendMessage.reset_handler()
+        MiroTestCase.tearDown(self)
+
+    def handle(self, message):
+        self.backend_messages.append(message)
+
+    def on_items_changed(self, message):
+        pass
+
+    def make_delta(self, info, **changes):
+        return messages.ItemInfoDelta(info.id, changes)
+
+    def send_changes(self, added, changed, removed):
+        message = messages.ItemsChanged('feed', self.feed.id, added, changed,
+                                        removed)
+        self.info_updater.handle_items_changed(message)
+        return message
+
+    def test_apply(self):
+        message = self.send_changes([], [self.make_delta(self.infos[0],
+                                                         name=u'new')], [])
+        self.assertEquals(message.changed[0].name, u'new')
+        self.assertEquals(message.changed[0].id, self.infos[0].id)
+        self.assertEquals(self.infos[0].name, u'title-0')
+        # later deltas should apply to the new info
+        message = self.send_changes([], [self.make_delta(self.infos[0],
+                                                         size=123)], [])
+        self.assertEquals(message.changed[0].name, u'new')
+        self.assertEquals(message.changed[0].size, 123)
+
+    def test_added_and_removed(self):
+        self.send_changes([self.infos[2]], [], [self.infos[0].id])
+        message = self.send_changes([], [
+            self.make_delta(self.infos[0], name=u'new'),
+            self.make_delta(self.infos[2], name=u'new2'),
+        ], [])
+        # We don't know about infos[0] anymore, so we have to drop the delta
+        # and ask the backend for the whole ItemInfo
+        self.assertEquals([info.name for info in message.changed], [u'new2'])
+        self.assertEquals(len(self.backend_messages), 1)
+        resend = self.backend_messages[0]
+        self.assert_(isinstance(resend, messages.ResendItemInfos))
+        self.assertEquals((resend.type, resend.id, resend.item_ids),
+                          ('feed', self.feed.id, [self.infos[0].id]))
+
+    def test_item_list_without_callbacks(self):
+        # if nobody is tracking changes for a list, we shouldn't keep its
+        # infos around
+        self.info_updater.handle_item_list(messages.ItemList('feed', 12345,
+            self.infos))
+        self.assert_(('feed', 12345) not in self.info_updater._item_infos)
+
+    def test_forget_infos(self):
+        self.info_updater.item_changed_callbacks.remove(
+            'feed', self.feed.id, self.on_items_changed)
+        message = self.send_changes([], [self.make_delta(self.infos[0],
+                                                         name=u'new')], [])
+        self.assertEquals(message.changed, [])
+
+    def test_make_delta(self):
+        info = self.infos[0]
+        self.assertEquals(messages.ItemInfoDelta.make(info, info), None)
+        other_info = messages.ItemInfoDelta(info.id, {'name': u'new'}).apply(
+            info)
+        delta = messages.ItemInfoDelta.make(info, other_info)
+        self.assertEquals(delta.changes, {'name': u'new'})
+
+class ItemsChangedStatsTest(InfoUpdaterDeltaTest):
+    def setUp(self):
+        InfoUpdaterDeltaTest.setUp(self)
+        self.stats = messagehandler.ItemsChangedStats()
+        self.pickled = []
+        self.stats._pickled_size = self.pickled_size
+
+    def pickled_size(self, obj):
+        self.pickled.append(obj)
+        return len(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+    def record_deltas(self, count):
+        info = self.infos[0]
+        delta = self.make_delta(info, name=u'new')
+        for i in xrange(count):
+            self.stats.record_delta(info, delta)
+
+    def test_sampling(self):
+        count = self.stats.SAMPLE_INTERVAL * 2
+        self.record_deltas(count)
+        self.assertEquals(self.stats.objects_saved, count)
+        # only 1 in SAMPLE_INTERVAL deltas gets pickled (the info and the
+        # changes)
+        self.assertEquals(len(self.pickled), 4)
+        saved = (len(cPickle.dumps(self.infos[0], cPickle.HIGHEST_PROTOCOL)) -
+                 len(cPickle.dumps({'name': u'new'},
+                                   cPickle.HIGHEST_PROTOCOL)))
+        self.assertEquals(self.stats.bytes_saved, saved * count)
+
+    def test_only_with_timing_logs(self):
+        logger = logging.getLogger()
+        old_level = logger.level
+        logger.setLevel(logging.ERROR)
+        try:
+            self.record_deltas(10)
+        finally:
+            logger.setLevel(old_level)
+        self.assertEquals(self.stats.objects_saved, 0)
+        self.assertEquals(self.pickled, [])
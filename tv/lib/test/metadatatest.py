@@ -20,6 +20,7 @@ from miro import models
 from miro import prefs
 from miro import schema
 from miro import filetypes
+from miro import fileutil
 from miro import metadata
 from miro import workerprocess
 from miro.plat import resources
@@ -43,6 +44,12 @@ class MockMetadataProcessor(object):
             'echonest': {},
         }
         self.canceled_files = set()
+        # paths for each FileIdentityTask we've seen
+        self.file_identity_calls = []
+        # if True, keep FileIdentityTasks until run_file_identities() is
+        # called, rather than running them right away
+        self.delay_file_identities = False
+        self.pending_file_identities = []
         # store the codes we see in query_echonest calls
         self.query_echonest_codes = {}
         self.query_echonest_metadata = {}
@@ -87,9 +94,22 @@ class MockMetadataProcessor(object):
             self.add_task_data(task.source_path, 'movie-data', task_data)
         elif isinstance(task, workerprocess.CancelFileOperations):
             self.canceled_files.update(task.paths)
+        elif isinstance(task, workerprocess.FileIdentityTask):
+            self.file_identity_calls.append(task.paths)
+            self.pending_file_identities.append(task_data)
+            if not self.delay_file_identities:
+                self.run_file_identities()
         else:
             raise TypeError(task)
 
+    def run_file_identities(self):
+        """Send results for the FileIdentityTasks that we've seen."""
+        pending = self.pending_file_identities
+        self.pending_file_identities = []
+        for task, callback, errback in pending:
+            callback(task, [fileutil.get_file_identity(path)
+                            for path in task.paths])
+
     def exec_codegen(self, codegen_info, path, callback, errback):
         task_data = (callback, errback)
         self.add_task_data(path, 'echonest-codegen', task_data)
@@ -102,10 +122,18 @@ class MockMetadataProcessor(object):
         self.query_echonest_metadata[path] = metadata
         self.add_task_data(path, 'echonest', (callback, errback))
 
+    def add_file_identity(self, source_path, callback_data):
+        # emulate the worker process sending the file identity along with
+        # mutagen/movie data results
+        file_identity = fileutil.get_file_identity(source_path)
+        if file_identity is not None:
+            callback_data['file_identity'] = file_identity
+
     def run_mutagen_callback(self, source_path, metadata):
         task, callback, errback = self.pop_task_data(source_path, 'mutagen')
         callback_data = {'source_path': source_path}
         callback_data.update(metadata)
+        self.add_file_identity(source_path, callback_data)
         callback(task, callback_data)
 
     def run_mutagen_errback(self, source_path, error):
@@ -116,6 +144,7 @@ class MockMetadataProcessor(object):
         task, callback, errback = self.pop_task_data(source_path, 'movie-data')
         callback_data = {'source_path': source_path}
         callback_data.update(metadata)
+        self.add_file_identity(source_path, callback_data)
         callback(task, callback_data)
 
     def run_movie_data_errback(self, source_path, error):
@@ -1093,6 +1122,173 @@ class MetadataManagerTest(MiroTestCase):
         correct_paths = paths[100:150] + new_paths
         self.assertSameSet(self.processor.mutagen_paths(), correct_paths)
 
+class ExtractorResultCacheTest(MiroTestCase):
+    """Test reusing mutagen/movie data results for files we've seen."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        self.processor = MockMetadataProcessor()
+        self.patch_function('miro.workerprocess.send', self.processor.send)
+        self.screenshot_dir = os.path.join(self.tempdir, 'screenshots')
+        os.makedirs(self.screenshot_dir)
+        self.metadata_manager = metadata.LibraryMetadataManager(
+            self.tempdir, self.screenshot_dir)
+        self.cache = self.metadata_manager.result_cache
+
+    def make_file(self, filename, data='FAKE VIDEO DATA'):
+        path = os.path.join(self.tempdir, filename)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def process_file(self, path):
+        """Add a file and run mutagen and movie data for it."""
+        self.metadata_manager.add_file(path)
+        self.processor.run_mutagen_callback(path, {
+            'file_type': u'video',
+            'title': u'My Video',
+            'drm': False,
+        })
+        self.metadata_manager.run_updates()
+        screenshot = os.path.join(self.screenshot_dir,
+                                  os.path.basename(path) + '.png')
+        open(screenshot, 'wb').write('FAKE SCREENSHOT')
+        self.processor.run_movie_data_callback(path, {
+            'file_type': u'video',
+            'duration': 100,
+            'screenshot': screenshot,
+        })
+        self.metadata_manager.run_updates()
+        return screenshot
+
+    def check_cached_metadata(self, path):
+        """Add a file and check that we use cached results for it."""
+        self.metadata_manager.add_file(path)
+        self.metadata_manager.run_updates()
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.processor.movie_data_paths(), [])
+        metadata = self.metadata_manager.get_metadata(path)
+        self.assertEquals(metadata['title'], u'My Video')
+        self.assertEquals(metadata['duration'], 100)
+
+    def test_readd_file(self):
+        path = self.make_file('foo.avi')
+        self.process_file(path)
+        self.assertEquals(self.cache.misses, 2)
+        self.assertEquals(metadata.CachedExtractorResult.make_view().count(),
+                          2)
+        self.metadata_manager.remove_file(path)
+        self.check_cached_metadata(path)
+        self.assertEquals(self.cache.hits, 2)
+        self.assertEquals(self.cache.hit_rate(), 0.5)
+
+    def test_renamed_file(self):
+        path = self.make_file('foo.avi')
+        self.process_file(path)
+        self.metadata_manager.remove_file(path)
+        new_path = os.path.join(self.tempdir, 'bar.avi')
+        os.rename(path, new_path)
+        self.check_cached_metadata(new_path)
+
+    def test_changed_file(self):
+        path = self.make_file('foo.avi')
+        self.process_file(path)
+        self.metadata_manager.remove_file(path)
+        # change the contents, but keep the same size and mtime.  The
+        # fingerprint should catch this.
+        mtime = os.stat(path).st_mtime
+        self.make_file('foo.avi', 'FAKE VIDEO DAT2')
+        os.utime(path, (mtime, mtime))
+        self.metadata_manager.add_file(path)
+        self.assertEquals(self.processor.mutagen_paths(), [path])
+        self.assertEquals(self.cache.hits, 0)
+
+    def test_missing_screenshot(self):
+        path = self.make_file('foo.avi')
+        screenshot = self.process_file(path)
+        self.metadata_manager.remove_file(path)
+        os.remove(screenshot)
+        self.metadata_manager.add_file(path)
+        self.metadata_manager.run_updates()
+        # we should use the mutagen result, but not the movie data one
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.processor.movie_data_paths(), [path])
+        self.assertEquals(self.cache.stale, 1)
+
+    def test_missing_file(self):
+        # files that we can't read shouldn't be cached
+        path = os.path.join(self.tempdir, 'missing.avi')
+        self.metadata_manager.add_file(path)
+        self.processor.run_mutagen_callback(path, {'file_type': u'video'})
+        self.metadata_manager.run_updates()
+        self.assertEquals(metadata.CachedExtractorResult.make_view().count(),
+                          0)
+
+    def test_bulk_add(self):
+        paths = [self.make_file('foo-%d.avi' % i, 'FAKE VIDEO DATA %d' % i)
+                 for i in xrange(3)]
+        for path in paths:
+            self.process_file(path)
+            self.metadata_manager.remove_file(path)
+        self.processor.file_identity_calls = []
+        with self.metadata_manager.bulk_add():
+            for path in paths:
+                self.metadata_manager.add_file(path)
+            self.assertEquals(self.processor.file_identity_calls, [])
+        # we should look up all the files with one FileIdentityTask
+        self.assertEquals(self.processor.file_identity_calls, [paths])
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.cache.hits, 3)
+
+    def test_mark_used(self):
+        path = self.make_file('foo.avi')
+        self.process_file(path)
+        self.metadata_manager.remove_file(path)
+        app.db.cursor.execute("UPDATE metadata_result_cache SET last_used=0")
+        self.check_cached_metadata(path)
+        app.db.cursor.execute("SELECT last_used FROM metadata_result_cache")
+        for row in app.db.cursor.fetchall():
+            self.assertNotEquals(row[0], 0)
+
+    def test_remove_while_waiting(self):
+        # if a file gets removed while we're waiting for the worker process,
+        # we shouldn't process it
+        path = self.make_file('foo.avi')
+        self.processor.delay_file_identities = True
+        self.metadata_manager.add_file(path)
+        self.metadata_manager.remove_file(path)
+        self.processor.run_file_identities()
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.cache.misses, 0)
+
+    def test_prune(self):
+        for i in xrange(5):
+            metadata.CachedExtractorResult(u'mutagen', self.tempdir, i, 0,
+                                           u'fingerprint', {})
+        metadata.CachedExtractorResult.prune(3)
+        sizes = [r[0] for r in
+                 metadata.CachedExtractorResult.select(['file_size'])]
+        self.assertSameSet(sizes, [2, 3, 4])
+
+    def test_fingerprint(self):
+        path = self.make_file('foo.avi', 'a' * 100000)
+        size = os.stat(path).st_size
+        fingerprint = fileutil.calc_fingerprint(path, size)
+        # changing the middle of large files doesn't change the fingerprint
+        self.make_file('foo.avi', 'a' * 50000 + 'b' + 'a' * 49999)
+        self.assertEquals(fileutil.calc_fingerprint(path, size),
+                          fingerprint)
+        # changing the start or end does
+        self.make_file('foo.avi', 'b' + 'a' * 99999)
+        self.assertNotEquals(fileutil.calc_fingerprint(path, size),
+                             fingerprint)
+        self.make_file('foo.avi', 'a' * 99999 + 'b')
+        self.assertNotEquals(fileutil.calc_fingerprint(path, size),
+                             fingerprint)
+        self.assertEquals(fileutil.calc_fingerprint(
+            os.path.join(self.tempdir, 'missing'), 0), None)
+
 class EchonestNetErrorTest(EventLoopTest):
     # Test our pause/retry logic when we get HTTP errors from echonest
 
@@ -1293,10 +1489,12 @@ class DeviceMetadataTest(EventLoopTest):
         with patcher:
             self.device.metadata_manager = devices.make_metadata_manager(
                 self.tempdir, self.device.sqlite_database, self.device.id)
+        # we should look up the file in the result cache before running
+        # mutagen on it
         self.assertEquals(mock_send.call_count, 1)
         task = mock_send.call_args[0][0]
-        self.assertEquals(task.source_path,
-                          os.path.join(self.tempdir, 'test-song.ogg'))
+        self.assertEquals(task.paths,
+                          [os.path.join(self.tempdir, 'test-song.ogg')])
 
     @mock.patch('miro.fileutil.migrate_file')
     def test_copy(self, mock_migrate_file):
@@ -1531,11 +1729,12 @@ class TestEchonestQueries(MiroTestCase):
                                 self.callback, self.errback)
 
     def check_grab_url(self, url, query_dict=None, post_vars=None,
-                       write_file=None):
+                       write_file=None, use_cache=False):
         """Check that grab_url was called with a given URL.
         """
         self.assertEquals(mock_grab_url.call_count, 1)
         args, kwargs = mock_grab_url.call_args
+        self.assertEquals(kwargs.pop('use_cache', False), use_cache)
         if post_vars is not None:
             grab_url_post_vars = kwargs.pop('post_vars')
             # handle query specially, since it's a json encoded dict so it can
@@ -1608,7 +1807,7 @@ class TestEchonestQueries(MiroTestCase):
             'artist': [self.query_metadata['artist'].encode('utf-8')],
             'title': [self.query_metadata['title'].encode('utf-8')],
         }
-        self.check_grab_url(search_url, query_dict)
+        self.check_grab_url(search_url, query_dict, use_cache=True)
 
     def check_echonest_grab_url_call_with_code(self):
         """Check the url sent to grab_url to perform our echonest query."""
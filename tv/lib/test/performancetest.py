@@ -1,15 +1,43 @@
+import gc
+import random
 import shutil
+import struct
 import os
 import pstats
 import cProfile
+import threading
+import time
 
 from miro import app
+from miro import columncodec
+from miro import feedupdate
+from miro import iteminfocache
 from miro import messagehandler
 from miro import messages
+from miro import search
+from miro import searchindex
+from miro import workerprocess
 from miro import models
+from miro import libdaap
+from miro.libdaap import subr
 from miro.fileobject import FilenameType
-from miro.test.framework import EventLoopTest
+from miro.item import FeedParserValues
+from miro.plat import resources
+from miro.plat.utils import PlatformFilenameType, get_logical_cpu_count
+from miro.test.framework import EventLoopTest, MiroTestCase
 from miro.test import messagetest
+from miro.test import libdaaptest
+
+def _rss():
+    """Get the resident set size of our process, or 0 if we can't."""
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return 0
+    try:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        f.close()
 
 class PerformanceTest(EventLoopTest):
     def setUp(self):
@@ -66,3 +94,645 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class ViewTrackerPerformanceTest(EventLoopTest):
+    """Compare checking ViewTrackers in python vs. with SQL queries."""
+
+    ITEM_COUNT = 50000
+    CHANGE_COUNT = 2000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed = models.Feed(u'http://example.com/feed')
+        app.bulk_sql_manager.start()
+        for x in xrange(self.ITEM_COUNT):
+            models.Item(FeedParserValues({'title': u'item-%s' % x}),
+                        feed_id=self.feed.id)
+        app.bulk_sql_manager.finish()
+        self.changed_items = list(models.Item.feed_view(
+            self.feed.id))[:self.CHANGE_COUNT]
+        views = [
+            models.Item.feed_view(self.feed.id),
+            models.Item.visible_feed_view(self.feed.id),
+            models.Item.feed_unwatched_view(self.feed.id),
+            models.Item.feed_downloaded_view(self.feed.id),
+            models.Item.feed_available_view(self.feed.id),
+            models.Item.unwatched_downloaded_items(),
+            models.Item.newly_downloaded_view(),
+            models.Item.downloaded_view(),
+            models.Item.downloading_view(),
+            models.Item.paused_view(),
+            models.Item.unique_new_video_view(),
+            models.Item.watchable_video_view(),
+            models.Item.watchable_audio_view(),
+            models.Item.recently_watched_view(),
+            models.Item.file_items_view(),
+            models.Item.containers_view(),
+        ]
+        self.trackers = [view.make_tracker() for view in views]
+
+    def _time_changes(self):
+        start = time.time()
+        for item in self.changed_items:
+            item.seen = not item.seen
+            item.signal_change()
+        return time.time() - start
+
+    def test_python_vs_sql(self):
+        python_time = self._time_changes()
+        for tracker in self.trackers:
+            tracker.predicate = None
+        sql_time = self._time_changes()
+        print
+        print '%d items, %d trackers, %d changes' % (self.ITEM_COUNT,
+                len(self.trackers), self.CHANGE_COUNT)
+        print 'python predicates: %0.3fs' % python_time
+        print 'SQL queries:       %0.3fs' % sql_time
+
+class DBStartupPerformanceTest(EventLoopTest):
+    """Time restoring RemoteDownloaders stored with repr() vs. columncodec."""
+
+    DOWNLOADER_COUNT = 10000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.save_path = FilenameType(self.make_temp_path(extension=".db"))
+        if os.path.exists(self.save_path):
+            os.unlink(self.save_path)
+        self.reload_database(self.save_path)
+        feed = models.Feed(u'dtv:manualFeed')
+        app.bulk_sql_manager.start()
+        for x in xrange(self.DOWNLOADER_COUNT):
+            url = u'http://example.com/%s/movie.avi' % x
+            item = models.Item(FeedParserValues({'title': u'item-%s' % x}),
+                               feed_id=feed.id)
+            downloader = models.RemoteDownloader(url, item)
+            downloader.status = {
+                'state': u'finished',
+                'dlerType': u'HTTP',
+                'url': url,
+                'currentSize': 123456789,
+                'totalSize': 123456789,
+                'startTime': 1300000000.0 + x,
+                'endTime': 1300001000.0 + x,
+                'shortFilename': PlatformFilenameType('movie-%s.avi' % x),
+                'filename': PlatformFilenameType(
+                    '/home/user/Movies/Miro/movie-%s.avi' % x),
+                'reasonFailed': None,
+                'retryTime': None,
+                'retryCount': -1,
+                'channelName': None,
+                'rate': 0,
+                'upRate': 0,
+                'eta': 0,
+                'uploaded': 0,
+            }
+            downloader.state = u'finished'
+            item.set_downloader(downloader)
+        app.bulk_sql_manager.finish()
+
+    def _time_restore(self):
+        self.reload_database(self.save_path)
+        start = time.time()
+        downloaders = list(models.RemoteDownloader.make_view())
+        restore_time = time.time() - start
+        start = time.time()
+        for downloader in downloaders:
+            downloader.status
+        return restore_time, time.time() - start
+
+    def _convert_to_repr(self):
+        app.db.cursor.execute("SELECT id, status FROM remote_downloader")
+        updates = [(repr(columncodec.decode(status)), id_)
+                   for id_, status in app.db.cursor.fetchall()]
+        app.db.cursor.executemany("UPDATE remote_downloader SET status=? "
+                                  "WHERE id=?", updates)
+        app.db.connection.commit()
+
+    def test_restore(self):
+        codec_times = self._time_restore()
+        self._convert_to_repr()
+        repr_times = self._time_restore()
+        print
+        print '%d downloaders' % self.DOWNLOADER_COUNT
+        print 'columncodec: restore %0.3fs, decode status %0.3fs' % codec_times
+        print 'repr/eval:   restore %0.3fs, decode status %0.3fs' % repr_times
+
+class LazyRestorePerformanceTest(EventLoopTest):
+    """Time restoring items with and without LiveStorage.lazy_restore."""
+
+    ITEM_COUNT = 20000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.save_path = FilenameType(self.make_temp_path(extension=".db"))
+        if os.path.exists(self.save_path):
+            os.unlink(self.save_path)
+        self.reload_database(self.save_path)
+        feed = models.Feed(u'http://example.com/feed')
+        app.bulk_sql_manager.start()
+        for x in xrange(self.ITEM_COUNT):
+            models.Item(FeedParserValues({
+                'description': u'description for item %s ' % x * 10,
+                'link': u'http://example.com/item/%s' % x,
+            }), feed_id=feed.id)
+        app.bulk_sql_manager.finish()
+
+    def _time_restore(self, lazy_restore):
+        self.reload_database(self.save_path, lazy_restore=lazy_restore)
+        start = time.time()
+        items = list(models.Item.make_view())
+        restore_time = time.time() - start
+        start = time.time()
+        for item in items:
+            item.entry_description
+        return restore_time, time.time() - start
+
+    def test_restore(self):
+        full_times = self._time_restore(False)
+        lazy_times = self._time_restore(True)
+        print
+        print '%d items' % self.ITEM_COUNT
+        print 'full restore: restore %0.3fs, load all columns %0.3fs' % (
+            full_times)
+        print 'lazy restore: restore %0.3fs, load all columns %0.3fs' % (
+            lazy_times)
+
+class ItemInfoCachePerformanceTest(EventLoopTest):
+    """Compare loading the item info cache table with MmapItemInfoCache."""
+
+    ITEM_COUNT = 20000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        feed = models.Feed(u'http://example.com/feed')
+        app.bulk_sql_manager.start()
+        for x in xrange(self.ITEM_COUNT):
+            models.Item(FeedParserValues({
+                'description': u'description for item %s ' % x * 10,
+                'link': u'http://example.com/item/%s' % x,
+            }), feed_id=feed.id)
+        app.bulk_sql_manager.finish()
+        self.cache_path = os.path.join(self.tempdir, 'iteminfocache')
+        # save data for both caches
+        for cache in (iteminfocache.ItemInfoCache(),
+                      iteminfocache.MmapItemInfoCache(self.cache_path)):
+            cache.load()
+            app.db.finish_transaction()
+            cache.save()
+        self.ids = [row[0] for row in
+                    app.db.cursor.execute("SELECT id FROM item")]
+
+    def _time_load(self, cache):
+        app.db.set_variable(cache.VERSION_KEY, cache.version())
+        gc.collect()
+        start_rss = _rss()
+        start = time.time()
+        cache.load()
+        load_time = time.time() - start
+        rss = _rss() - start_rss
+        start = time.time()
+        for id_ in self.ids[:100]:
+            cache.get_info(id_)
+        return load_time, rss / 1024.0 / 1024.0, time.time() - start
+
+    def test_load(self):
+        mmap_results = self._time_load(
+            iteminfocache.MmapItemInfoCache(self.cache_path))
+        table_results = self._time_load(iteminfocache.ItemInfoCache())
+        print
+        print '%d items' % self.ITEM_COUNT
+        print 'table: load %0.3fs, RSS +%0.1fMB, 100 infos %0.3fs' % (
+            table_results)
+        print 'mmap: load %0.3fs, RSS +%0.1fMB, 100 infos %0.3fs' % (
+            mmap_results)
+
+class SearchIndexPerformanceTest(EventLoopTest):
+    """Compare searching with ItemSearcher and SearchIndex."""
+
+    ITEM_COUNT = 20000
+    SEARCH_TEXT = u'item 1234'
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        feed = models.Feed(u'http://example.com/feed')
+        app.bulk_sql_manager.start()
+        for x in xrange(self.ITEM_COUNT):
+            models.Item(FeedParserValues({
+                'title': u'item %s' % x,
+                'description': u'description for item %s ' % x * 10,
+                'link': u'http://example.com/item/%s' % x,
+            }), feed_id=feed.id)
+        app.bulk_sql_manager.finish()
+        self.infos = list(app.item_info_cache.all_infos())
+        self.index_path = os.path.join(self.tempdir, 'searchindex')
+        index = searchindex.SearchIndex(self.index_path)
+        index.load()
+        index.save()
+        index.close()
+        # the cache was built from scratch when the test database was
+        # created, pretend that it was loaded normally so that the index
+        # file gets used.
+        app.item_info_cache.did_failsafe_load = False
+
+    def _time_item_searcher(self):
+        start = time.time()
+        searcher = search.ItemSearcher()
+        for info in self.infos:
+            searcher.add_item(info)
+        results = searcher.search(self.SEARCH_TEXT)
+        return time.time() - start, len(results)
+
+    def _time_search_index(self):
+        start = time.time()
+        index = searchindex.SearchIndex(self.index_path)
+        index.load()
+        searcher = searchindex.ListSearcher(index)
+        for info in self.infos:
+            searcher.add_item(info)
+        results = searcher.search(self.SEARCH_TEXT)
+        cold_time = time.time() - start
+        start = time.time()
+        searcher.search(self.SEARCH_TEXT)
+        warm_time = time.time() - start
+        index.close()
+        return cold_time, warm_time, len(results)
+
+    def test_search(self):
+        item_searcher_results = self._time_item_searcher()
+        search_index_results = self._time_search_index()
+        print
+        print '%d items' % self.ITEM_COUNT
+        print 'ItemSearcher: first search %0.3fs (%d results)' % (
+            item_searcher_results)
+        print ('SearchIndex: first search %0.3fs, repeated search %0.4fs '
+               '(%d results)' % search_index_results)
+
+    def test_search_with_changed_item(self):
+        index = searchindex.SearchIndex(self.index_path)
+        index.load()
+        # once an item changes, the postings from the file need to have its
+        # id filtered out
+        index.on_item_changed(app.item_info_cache, self.infos[0])
+        start = time.time()
+        results = index._search(u'item')
+        end = time.time()
+        index.close()
+        print
+        print ('SearchIndex: search with 1 changed item %0.4fs '
+               '(%d results)' % (end - start, len(results)))
+
+class SearchPerformanceTest(EventLoopTest):
+    """Time search-as-you-type with a large ItemSearcher."""
+
+    ITEM_COUNT = 200000
+    SEARCH_TEXT = u'episode 1234'
+
+    class FakeInfo(object):
+        def __init__(self, id_, search_terms):
+            self.id = id_
+            self.search_terms = search_terms
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        words = [u'show', u'episode', u'video', u'music', u'podcast',
+                 u'interview', u'live', u'remix', u'news', u'daily']
+        rand = random.Random(0)
+        self.infos = []
+        for x in xrange(self.ITEM_COUNT):
+            terms = rand.sample(words, 4) + [unicode(x)]
+            self.infos.append(self.FakeInfo(x, terms))
+        # items come in a random order, like an item list sorted by name
+        rand.shuffle(self.infos)
+
+    def test_search_as_you_type(self):
+        gc.collect()
+        start_rss = _rss()
+        start = time.time()
+        searcher = search.ItemSearcher()
+        # SearchFilter adds the whole list at once
+        searcher.add_items(self.infos)
+        index_time = time.time() - start
+        rss = (_rss() - start_rss) / 1024.0 / 1024.0
+        print
+        print '%d items, indexed in %0.3fs, RSS +%0.1fMB' % (
+            self.ITEM_COUNT, index_time, rss)
+        for i in xrange(1, len(self.SEARCH_TEXT) + 1):
+            search_text = self.SEARCH_TEXT[:i]
+            start = time.time()
+            results = searcher.search(search_text)
+            first_time = time.time() - start
+            start = time.time()
+            searcher.search(search_text)
+            print '%-14r first %0.4fs, repeated %0.4fs (%d results)' % (
+                search_text, first_time, time.time() - start, len(results))
+        # backspacing should be answered from the result cache
+        start = time.time()
+        for i in xrange(len(self.SEARCH_TEXT), 0, -1):
+            searcher.search(self.SEARCH_TEXT[:i])
+        print 'backspace through all searches: %0.4fs' % (time.time() - start)
+
+class FeedPollingSimulationTest(EventLoopTest):
+    """Compare fixed and adaptive feed update intervals over a month.
+
+    We make up a month of publishing times for a mix of feeds, then count
+    the requests that each polling strategy makes and how long it takes to
+    see new items.
+    """
+
+    HOUR = 60 * 60
+    DAY = 24 * HOUR
+    DURATION = 30 * DAY
+    MIN_INTERVAL = HOUR
+    MAX_INTERVAL = DAY
+
+    # (name, feed count, mean seconds between new items or None for feeds
+    # that don't publish during the month)
+    FEED_TYPES = [
+        ('hourly', 5, HOUR),
+        ('daily', 30, DAY),
+        ('weekly', 40, 7 * DAY),
+        ('monthly', 20, 30 * DAY),
+        ('dormant', 25, None),
+    ]
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        rand = random.Random(0)
+        self.feeds = []
+        for name, count, mean_gap in self.FEED_TYPES:
+            for i in xrange(count):
+                publish_times = []
+                if mean_gap is not None:
+                    t = rand.uniform(0, mean_gap)
+                    while t < self.DURATION:
+                        publish_times.append(t)
+                        t += rand.uniform(0.5, 1.5) * mean_gap
+                self.feeds.append((name, publish_times))
+
+    def _simulate(self, publish_times, adaptive):
+        """Poll a feed for DURATION seconds.
+
+        :returns: (request count, list of delays until we saw new items)
+        """
+        new_entry_times = []
+        unchanged_streak = 0
+        requests = 0
+        delays = []
+        next_item = 0
+        now = 0
+        while now < self.DURATION:
+            requests += 1
+            new_items = 0
+            while (next_item < len(publish_times) and
+                   publish_times[next_item] <= now):
+                delays.append(now - publish_times[next_item])
+                next_item += 1
+                new_items += 1
+            if new_items:
+                new_entry_times = (new_entry_times +
+                        [now])[-feedupdate.MAX_NEW_ENTRY_TIMES:]
+                unchanged_streak = 0
+            else:
+                unchanged_streak += 1
+            if adaptive:
+                now += feedupdate.predict_update_interval(new_entry_times,
+                        unchanged_streak, self.MIN_INTERVAL,
+                        self.MAX_INTERVAL)
+            else:
+                now += self.MIN_INTERVAL
+        return requests, delays
+
+    def _run(self, adaptive):
+        results = {}
+        for name, publish_times in self.feeds:
+            requests, delays = self._simulate(publish_times, adaptive)
+            total_requests, all_delays = results.setdefault(name, [0, []])
+            results[name][0] += requests
+            all_delays.extend(delays)
+        return results
+
+    def test_simulation(self):
+        fixed = self._run(False)
+        adaptive = self._run(True)
+        print
+        print '%d feeds, %d days' % (len(self.feeds), self.DURATION / self.DAY)
+        print '%-8s %16s %16s %20s' % ('feeds', 'fixed requests',
+                'adaptive requests', 'mean delay (hours)')
+        fixed_total = adaptive_total = 0
+        for name, count, mean_gap in self.FEED_TYPES:
+            fixed_requests, fixed_delays = fixed[name]
+            adaptive_requests, adaptive_delays = adaptive[name]
+            fixed_total += fixed_requests
+            adaptive_total += adaptive_requests
+            def mean_hours(delays):
+                return sum(delays) / max(len(delays), 1) / self.HOUR
+            print '%-8s %16d %16d %9.1f -> %6.1f' % (name, fixed_requests,
+                    adaptive_requests, mean_hours(fixed_delays),
+                    mean_hours(adaptive_delays))
+        print 'total: %d -> %d requests (%.0f%% fewer)' % (fixed_total,
+                adaptive_total, 100.0 * (fixed_total - adaptive_total) /
+                fixed_total)
+        self.assert_(adaptive_total < fixed_total)
+
+
+class WorkerPoolScalingTest(EventLoopTest):
+    """Time parsing a batch of feeds with 1 worker process vs. several.
+
+    On a machine with more than 1 CPU, the throughput should go up with the
+    process count.
+    """
+
+    FEED_COUNT = 60
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed_path = os.path.join(
+            resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+
+    def tearDown(self):
+        workerprocess.shutdown()
+        EventLoopTest.tearDown(self)
+
+    def _time_parse(self, process_count):
+        self.finished = 0
+        self.errors = []
+        def callback(msg, result):
+            self.finished += 1
+            if self.finished == self.FEED_COUNT:
+                self.stopEventLoop(abnormal=False)
+        def errback(msg, error):
+            self.errors.append(error)
+            callback(msg, None)
+        # the time includes starting the processes, like it would when we
+        # update all feeds at startup.
+        start = time.time()
+        workerprocess.startup(thread_count=1, process_count=process_count)
+        for i in xrange(self.FEED_COUNT):
+            msg = workerprocess.FeedDiffTask([], path=self.feed_path)
+            workerprocess.send(msg, callback, errback)
+        self.runEventLoop(120)
+        elapsed = time.time() - start
+        workerprocess.shutdown()
+        self.assertEquals(self.finished, self.FEED_COUNT)
+        self.assertEquals(self.errors, [])
+        return elapsed
+
+    def test_scaling(self):
+        cpu_count = get_logical_cpu_count()
+        print
+        print '%d feeds, %d CPUs' % (self.FEED_COUNT, cpu_count)
+        base_time = self._time_parse(1)
+        print '1 process: %0.2fs (%0.1f feeds/s)' % (base_time,
+                self.FEED_COUNT / base_time)
+        for process_count in xrange(2, workerprocess.MAX_WORKER_PROCESSES + 1):
+            elapsed = self._time_parse(process_count)
+            print '%d processes: %0.2fs (%0.1f feeds/s, %0.1fx)' % (
+                    process_count, elapsed, self.FEED_COUNT / elapsed,
+                    base_time / elapsed)
+
+class DaapStreamLoadTest(MiroTestCase, libdaaptest.DaapServerTestMixin):
+    """Measure DAAP streaming throughput with several concurrent clients.
+
+    Each client logs in with a DaapClient, then streams the shared file a
+    few times over its own data connection.
+    """
+
+    FILE_SIZE = 16 * 1024 * 1024
+    STREAMS_PER_CLIENT = 4
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'song.mp3')
+        libdaaptest.make_test_file(self.path, self.FILE_SIZE)
+        self.start_server(self.path)
+
+    def tearDown(self):
+        self.stop_server()
+        MiroTestCase.tearDown(self)
+
+    def _run_client(self, client, errors):
+        try:
+            for i in xrange(self.STREAMS_PER_CLIENT):
+                response, data = self.get_stream(client)
+                if len(data) != self.FILE_SIZE:
+                    errors.append('short read: %d' % len(data))
+        except Exception, e:
+            errors.append(e)
+
+    def _time_streams(self, client_count):
+        clients = [self.connect_client() for i in xrange(client_count)]
+        errors = []
+        threads = [threading.Thread(target=self._run_client,
+                                    args=(client, errors))
+                   for client in clients]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        for client in clients:
+            client.disconnect()
+        self.assertEquals(errors, [])
+        return elapsed
+
+    def test_load(self):
+        print
+        for client_count in (1, 2, 4, libdaap.DAAP_MAXCONN):
+            elapsed = self._time_streams(client_count)
+            total = (client_count * self.STREAMS_PER_CLIENT *
+                     self.FILE_SIZE / (1024.0 * 1024.0))
+            print '%d clients: %0.1fMB in %0.2fs (%0.1f MB/s)' % (
+                    client_count, total, elapsed, total / elapsed)
+
+def old_encode_response(reply):
+    """The DMAP encoder before it was rewritten, for comparison."""
+    blob = ''
+    subblob = ''
+    for code, value in reply:
+        nam, typ = subr.dmap_consts[code]
+        fmt, size = subr.fmts[typ]
+        if typ == libdaap.DMAP_TYPE_LIST:
+            subblob = old_encode_response(value)
+            size = len(subblob)
+            value = ''
+        if typ == libdaap.DMAP_TYPE_STRING:
+            fmt = str(len(value)) + fmt
+            size = len(value)
+            value = str(buffer(value))
+        fmt = '!4sI' + fmt
+        try:
+            blob += struct.pack(fmt, code, size, value)
+        except struct.error:
+            pass
+        blob += subblob
+    return blob
+
+def old_decode_response(reply):
+    """The DMAP decoder before it was rewritten, for comparison."""
+    decoded = []
+    try:
+        while reply:
+            headerfmt = '!4sI'
+            headersize = struct.calcsize(headerfmt)
+            code, size = struct.unpack(headerfmt, reply[:headersize])
+            reply = reply[headersize:]
+            realname, realtype = subr.dmap_consts[code]
+            realfmt, realsize = subr.fmts[realtype]
+            if realtype == libdaap.DMAP_TYPE_LIST:
+                decoded.append((code, old_decode_response(reply[:size])))
+                reply = reply[size:]
+                continue
+            if realtype == libdaap.DMAP_TYPE_STRING:
+                realfmt = str(size) + realfmt
+            else:
+                if realsize != size:
+                    raise ValueError
+                realfmt = '!' + realfmt
+            realfmtsize = struct.calcsize(realfmt)
+            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
+            decoded.append((code, value))
+            reply = reply[realfmtsize:]
+        return decoded
+    except (struct.error, KeyError, ValueError):
+        return [(-1, [])]
+
+class DMAPCodecPerformanceTest(MiroTestCase):
+    """Time encoding and decoding item listings, old codec vs. new.
+
+    The new codec should scale linearly with the number of items.
+    """
+
+    REPEAT = 3
+
+    def time_call(self, func, *args):
+        # Take the best of a few runs to keep GC and friends out of it.
+        best = None
+        for i in xrange(self.REPEAT):
+            start = time.time()
+            result = func(*args)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best, result
+
+    def test_codec(self):
+        print
+        for count in (1000, 10000, 30000):
+            reply = libdaaptest.make_item_listing(count)
+            old_encode_time, old_data = self.time_call(old_encode_response,
+                                                       reply)
+            encode_time, blob = self.time_call(subr.encode_response, reply)
+            data = str(blob)
+            self.assert_(data == old_data)
+            old_decode_time, old_decoded = self.time_call(
+                    old_decode_response, data)
+            decode_time, decoded = self.time_call(subr.decode_response, data)
+            self.assertEquals(decoded, old_decoded)
+            self.assertEquals(decoded, reply)
+            print ('%d items (%dKB): encode %0.3fs (old %0.3fs), '
+                   'decode %0.3fs (old %0.3fs)' % (count, len(data) / 1024,
+                       encode_time, old_encode_time, decode_time,
+                       old_decode_time))
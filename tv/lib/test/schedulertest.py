@@ -1,8 +1,14 @@
 from time import time, sleep
+import select
 import threading
 
 from miro import eventloop
+from miro import messagehandler
+from miro import messages
+from miro import util
+from miro.feed import Feed
 from miro.test.framework import EventLoopTest
+from miro.test.messagetest import TestFrontendMessageHandler
 
 class SchedulerTest(EventLoopTest):
     def setUp(self):
@@ -57,3 +63,226 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class EventLoopStatsTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        eventloop.stats.reset()
+
+    def callback(self):
+        pass
+
+    def test_idle_stats(self):
+        eventloop.add_idle(self.callback, "stats test")
+        eventloop.add_idle(self.callback, "stats test")
+        self.runPendingIdles()
+        stats = eventloop.stats.snapshot()
+        call_stats = stats['calls']['idle (stats test)']
+        self.assertEquals(call_stats['run']['count'], 2)
+        self.assertEquals(sum(call_stats['run']['counts']), 2)
+        self.assertEquals(call_stats['wait']['count'], 2)
+        self.assert_(call_stats['wait']['max'] >= 0)
+
+    def test_loop_stats(self):
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stop")
+        self.runEventLoop()
+        stats = eventloop.stats.snapshot()
+        self.assert_(stats['wakeups'] > 0)
+        self.assertEquals(stats['calls']['timeout (stop)']['run']['count'],
+                          1)
+        self.assert_(stats['calls']['timeout (stop)']['wait']['max'] < 1)
+        report = eventloop.format_stats(stats)
+        self.assert_('timeout (stop)' in report)
+
+    def test_reset(self):
+        eventloop.add_idle(self.callback, "stats test")
+        self.runPendingIdles()
+        eventloop.stats.reset()
+        self.assertEquals(eventloop.stats.snapshot()['calls'], {})
+
+    def test_histogram(self):
+        histogram = eventloop.Histogram()
+        for value in (0.0005, 0.05, 0.05, 10):
+            histogram.add(value)
+        self.assertEquals(histogram.counts, [1, 0, 2, 0, 0, 0, 1])
+        self.assertEquals(histogram.count, 4)
+        self.assertEquals(histogram.max, 10)
+
+    def test_message(self):
+        # BackendMessageHandler needs the search feed
+        Feed(u'dtv:search')
+        test_handler = TestFrontendMessageHandler()
+        messages.FrontendMessage.install_handler(test_handler)
+        messages.BackendMessage.install_handler(
+            messagehandler.BackendMessageHandler(None))
+        try:
+            eventloop.add_idle(self.callback, "stats test")
+            self.runPendingIdles()
+            messages.QueryEventLoopStats(reset=True).send_to_backend()
+            self.runUrgentCalls()
+        finally:
+            messages.BackendMessage.reset_handler()
+            messages.FrontendMessage.reset_handler()
+        self.assertEquals(len(test_handler.messages), 1)
+        stats = test_handler.messages[0].stats
+        self.assertEquals(stats['calls']['idle (stats test)']['run']['count'],
+                          1)
+        # the stats should have been reset after the message was sent
+        self.assert_('idle (stats test)' not in
+                     eventloop.stats.snapshot()['calls'])
+
+    def test_object_addresses(self):
+        eventloop.stats.record_call('idle (<Foo object at 0x1234>)', 0, 0)
+        eventloop.stats.record_call('idle (<Foo object at 0xabcd>)', 0, 0)
+        calls = eventloop.stats.snapshot()['calls']
+        self.assertEquals(calls.keys(), ['idle (<Foo object>)'])
+        self.assertEquals(calls['idle (<Foo object>)']['run']['count'], 2)
+
+class PrioritySchedulingTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.calls = []
+
+    def callback(self, name):
+        self.calls.append(name)
+
+    def add_idle(self, name, priority=eventloop.PRIORITY_NORMAL):
+        eventloop.add_idle(self.callback, name, args=(name,),
+                           priority=priority)
+
+    def test_round_robin(self):
+        for i in xrange(3):
+            self.add_idle('a')
+        self.add_idle('b')
+        self.add_idle('c')
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['a', 'b', 'c', 'a', 'a'])
+
+    def test_priorities(self):
+        self.add_idle('background', eventloop.PRIORITY_BACKGROUND)
+        self.add_idle('normal')
+        self.add_idle('ui', eventloop.PRIORITY_UI)
+        self.assertEquals(eventloop._eventloop.urgent_queue.qsize(), 1)
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['ui', 'normal', 'background'])
+
+    def test_timeout_priority(self):
+        eventloop.add_timeout(0, self.callback, 'timeout',
+                              args=('timeout',),
+                              priority=eventloop.PRIORITY_BACKGROUND)
+        self.add_idle('normal')
+        eventloop.add_timeout(0.05, eventloop.shutdown, 'stop')
+        self.runEventLoop()
+        self.assertEquals(self.calls, ['normal', 'timeout'])
+
+    def test_ui_timeout(self):
+        # A UI timeout that expires with no idles pending should still run
+        # right away.
+        def ui_callback():
+            self.calls.append('ui')
+            eventloop.shutdown()
+        start = time()
+        eventloop.add_timeout(0.1, ui_callback, 'ui',
+                              priority=eventloop.PRIORITY_UI)
+        eventloop.add_timeout(2.0, eventloop.shutdown, 'stop')
+        self.runEventLoop()
+        self.assertEquals(self.calls, ['ui'])
+        self.assert_(time() - start < 1.0)
+
+    def test_budget(self):
+        # A long queue of background idles shouldn't stop timeouts from
+        # running.
+        def slow_callback():
+            self.calls.append('slow')
+            sleep(0.01)
+        for i in xrange(50):
+            eventloop.add_idle(slow_callback, 'slow',
+                               priority=eventloop.PRIORITY_BACKGROUND)
+        eventloop.add_timeout(0.1, self.callback, 'timeout',
+                              args=('timeout',))
+        eventloop.add_timeout(1.0, eventloop.shutdown, 'stop')
+        self.runEventLoop()
+        self.assertEquals(self.calls.count('slow'), 50)
+        # without the time budget, the timeout would run after all the
+        # slow idles
+        self.assert_(self.calls.index('timeout') < 25)
+
+class PollerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        EventLoopTest.tearDown(self)
+
+    def check_poller(self, poller):
+        fd = self.receiver.fileno()
+        poller.register(fd, eventloop.POLL_READ)
+        self.assertEquals(poller.poll(0), [])
+        self.sender.send("a")
+        self.assertEquals(poller.poll(0.1), [(fd, eventloop.POLL_READ)])
+        # switch to watching for writes
+        poller.register(fd, eventloop.POLL_WRITE)
+        self.assertEquals(poller.poll(0.1), [(fd, eventloop.POLL_WRITE)])
+        poller.register(fd, eventloop.POLL_READ | eventloop.POLL_WRITE)
+        self.assertEquals(poller.poll(0.1),
+                          [(fd, eventloop.POLL_READ | eventloop.POLL_WRITE)])
+        poller.unregister(fd)
+        self.assertEquals(poller.poll(0), [])
+        # unregistering twice should be a no-op
+        poller.unregister(fd)
+        poller.close()
+
+    def test_select_poller(self):
+        self.check_poller(eventloop.SelectPoller())
+
+    def test_poll_poller(self):
+        if hasattr(select, 'poll'):
+            self.check_poller(eventloop.PollPoller())
+
+    def test_epoll_poller(self):
+        if hasattr(select, 'epoll'):
+            self.check_poller(eventloop.EpollPoller())
+
+    def test_epoll_closed_fd(self):
+        # closing a socket removes it from the epoll set.  We should be able
+        # to handle a new socket that gets the same fd.
+        if not hasattr(select, 'epoll'):
+            return
+        poller = eventloop.EpollPoller()
+        fd = self.receiver.fileno()
+        poller.register(fd, eventloop.POLL_READ)
+        self.receiver.close()
+        poller.unregister(fd)
+        self.receiver = util.make_dummy_socket_pair()[1]
+        poller.register(self.receiver.fileno(), eventloop.POLL_WRITE)
+        self.assertEquals(poller.poll(0.1),
+                          [(self.receiver.fileno(), eventloop.POLL_WRITE)])
+        poller.close()
+
+    def test_callbacks_registered(self):
+        loop = eventloop._eventloop
+        fd = self.receiver.fileno()
+        eventloop.add_read_callback(self.receiver, lambda: None)
+        self.assertEquals(loop.poller.fds[fd], eventloop.POLL_READ)
+        eventloop.add_write_callback(self.receiver, lambda: None)
+        self.assertEquals(loop.poller.fds[fd],
+                          eventloop.POLL_READ | eventloop.POLL_WRITE)
+        eventloop.remove_read_callback(self.receiver)
+        self.assertEquals(loop.poller.fds[fd], eventloop.POLL_WRITE)
+        eventloop.remove_write_callback(self.receiver)
+        self.assert_(fd not in loop.poller.fds)
+
+    def test_read_callback(self):
+        def on_read():
+            self.got_data = self.receiver.recv(1024)
+            eventloop.remove_read_callback(self.receiver)
+            eventloop.shutdown()
+        self.got_data = None
+        eventloop.add_read_callback(self.receiver, on_read)
+        eventloop.add_timeout(0.05, self.sender.send, 'send data',
+                              args=('hello',))
+        self.runEventLoop()
+        self.assertEquals(self.got_data, 'hello')
@@ -0,0 +1,149 @@
+from array import array
+import os
+import threading
+
+from miro import app
+from miro import models
+from miro import searchindex
+from miro.item import FeedParserValues
+from miro.singleclick import _build_entry
+from miro.test.framework import EventLoopTest
+
+class SearchIndexTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed = models.Feed(u'http://example.com/')
+        self.item1 = self.make_item(u'http://example.com/', u'my first item')
+        self.item2 = self.make_item(u'http://example.com/', u'my second item')
+        self.path = os.path.join(self.tempdir, 'searchindex')
+        self.load_index()
+
+    def tearDown(self):
+        self.index.close()
+        app.search_index = None
+        EventLoopTest.tearDown(self)
+
+    def make_item(self, url, title=u'default item title'):
+        additional = {'title': title}
+        entry = _build_entry(url, 'video/x-unknown', additional)
+        return models.Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def load_index(self):
+        app.search_index = searchindex.SearchIndex(self.path)
+        app.search_index.load()
+        self.index = app.search_index
+
+    def save_and_reload(self):
+        self.index.save()
+        self.index.close()
+        self.load_index()
+
+    def check_search_results(self, search_text, *correct_items):
+        correct_ids = [i.id for i in correct_items]
+        self.assertSameSet(self.index.search(search_text), correct_ids)
+
+    def check_searches(self):
+        self.check_search_results('item', self.item1, self.item2)
+        self.check_search_results('first', self.item1)
+        self.check_search_results('item -first', self.item2)
+        self.check_search_results('', self.item1, self.item2)
+        self.check_search_results('miro')
+
+    def test_search(self):
+        self.check_searches()
+
+    def test_search_after_reload(self):
+        self.save_and_reload()
+        # everything should come from the index file now
+        self.assertEquals(self.index._pending._item_ngrams, {})
+        self.check_searches()
+
+    def test_update(self):
+        self.save_and_reload()
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        item3 = self.make_item(u'http://example.com/3', u'third item')
+        self.item2.remove()
+        self.check_search_results('new', self.item1)
+        self.check_search_results('item', item3)
+        self.check_search_results('title', self.item1)
+        self.check_search_results('first')
+        self.check_search_results('second')
+        # check that the changes are merged into the new file
+        self.save_and_reload()
+        self.check_search_results('new', self.item1)
+        self.check_search_results('item', item3)
+        self.check_search_results('title', self.item1)
+        self.check_search_results('first')
+        self.check_search_results('', self.item1, item3)
+
+    def test_result_cache(self):
+        results = self.index.search('first')
+        self.assert_(self.index.search('first') is results)
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.check_search_results('first')
+        searcher = searchindex.ListSearcher(self.index)
+        searcher.add_item(app.item_info_cache.get_info(self.item1.id))
+        self.assertSameSet(searcher.search('title'), [self.item1.id])
+        self.item1.entry_title = u'my first item'
+        self.item1.signal_change()
+        self.assertSameSet(searcher.search('title'), [])
+        searcher.add_item(app.item_info_cache.get_info(self.item2.id))
+        self.assertSameSet(searcher.search('item'),
+                           [self.item1.id, self.item2.id])
+
+    def test_write_pending(self):
+        self.index.MAX_PENDING_ITEMS = 1
+        self.make_item(u'http://example.com/3', u'third item')
+        self.make_item(u'http://example.com/4', u'fourth item')
+        self.runPendingIdles()
+        self.assertEquals(self.index._pending._item_ngrams, {})
+        self.assertEquals(self.index._stale_ids, set())
+        self.assertEquals(len(self.index.search('item')), 4)
+
+    def test_search_while_writing(self):
+        # writing the index file shouldn't block searches from other threads
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        results = []
+        def search():
+            results.append(self.index.search('title'))
+        real_write_index_file = searchindex.write_index_file
+        def write_index_file(*args):
+            thread = threading.Thread(target=search)
+            thread.start()
+            thread.join(5.0)
+            real_write_index_file(*args)
+        self.patch_function('miro.searchindex.write_index_file',
+                            write_index_file)
+        self.index.save()
+        self.assertEquals(results, [set([self.item1.id])])
+        self.check_search_results('title', self.item1)
+
+    def test_subtract_sorted(self):
+        postings = array('i', range(0, 100, 2))
+        for ids in ([4, 5, 50, 98, 200], [0], [], range(100)):
+            correct = array('i', [i for i in postings if i not in ids])
+            self.assertEquals(searchindex._subtract_sorted(postings,
+                sorted(ids), set(ids)), correct)
+
+    def test_rebuild_after_crash(self):
+        self.save_and_reload()
+        # we didn't call save(), so the index file shouldn't be used
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.index.close()
+        self.load_index()
+        self.check_search_results('title', self.item1)
+        self.check_search_results('first')
+
+    def test_list_searcher(self):
+        searcher = searchindex.ListSearcher(self.index)
+        searcher.add_item(app.item_info_cache.get_info(self.item1.id))
+        self.assertSameSet(searcher.search('first'), [self.item1.id])
+        self.assertSameSet(searcher.search(''), [self.item1.id])
+        searcher.remove_item(self.item1.id)
+        self.assertSameSet(searcher.search('first'), [])
+        self.assertRaises(KeyError, searcher.update_item,
+                          app.item_info_cache.get_info(self.item1.id))
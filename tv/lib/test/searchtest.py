@@ -1,4 +1,6 @@
 import gc
+import threading
+from array import array
 
 from miro import messages
 from miro import models
@@ -90,6 +92,37 @@ class SearchTest(MiroTestCase):
         self.assertEquals(list(search.list_matches(items, 'foo')),
                           [])
 
+    def test_boolean_search_cache(self):
+        search_text = u''
+        for c in u'abcdefghijklmnopqrstuvwxyz' * 10:
+            search_text += c
+            search._get_boolean_search(search_text)
+        self.assert_(len(search.SEARCHOBJECTS.dict) <=
+                     search.SEARCH_OBJECT_CACHE_SIZE)
+        # the most recent search should still be cached
+        self.assert_(search._get_boolean_search(search_text) is
+                     search._get_boolean_search(search_text))
+
+    def test_boolean_search_cache_threads(self):
+        # SEARCHOBJECTS is shared between threads, make sure gets running
+        # while another thread shrinks the cache don't fail.
+        errors = []
+        def search_thread(prefix):
+            try:
+                for i in xrange(2000):
+                    search._get_boolean_search(u'%s%d' % (prefix, i % 300))
+            except StandardError, e:
+                errors.append(e)
+        threads = [threading.Thread(target=search_thread, args=(prefix,))
+                   for prefix in (u'a', u'b', u'c', u'd')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors, [])
+        self.assert_(len(search.SEARCHOBJECTS.dict) <=
+                     search.SEARCH_OBJECT_CACHE_SIZE)
+
     def test_ngrams_for_term(self):
         self.assertEquals(search._ngrams_for_term('abc'),
                 ['abc'])
@@ -98,6 +131,76 @@ class SearchTest(MiroTestCase):
         self.assertEquals(search._ngrams_for_term('verybig'),
                 ['veryb', 'erybi', 'rybig'])
 
+    def test_relevance_score(self):
+        item3 = self.make_item(u'http://example.com/3', u'item item item')
+        self.assertEquals(search.relevance_score(self.item1, 'first'),
+                          search.FIELD_WEIGHTS['name'])
+        self.assertEquals(search.relevance_score(self.item1, 'second'), 0)
+        self.assertEquals(search.relevance_score(self.item1, ''), 0)
+        self.assertEquals(search.relevance_score(item3, 'item'),
+                          search.FIELD_WEIGHTS['name'] * 3)
+        # the feed name is the feed's URL, matches there count less than
+        # matches in the title
+        self.assertEquals(search.relevance_score(self.item1, 'example'),
+                          search.FIELD_WEIGHTS['feed_name'])
+
+class PostingsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.postings = {
+            'abc': array('i', range(0, 2000, 5)),
+            'bcd': array('i', [1, 5, 7, 100, 101, 500]),
+            'cde': array('i', [5, 7, 500, 1000]),
+            'uvwxy': array('i', [5, 7, 9]),
+            'vwxyz': array('i', [7, 9, 11]),
+        }
+        self.sort_flags = []
+
+    def ngram_postings(self, ngram, sort=True):
+        self.sort_flags.append((ngram, sort))
+        return self.postings.get(ngram, array('i'))
+
+    def test_intersect(self):
+        ids = set([1, 5, 7, 100, 101, 500])
+        # galloping through a long array
+        self.assertEquals(search.intersect_postings(ids,
+                                                    self.postings['abc']),
+                          set([5, 100, 500]))
+        # set intersection with a short one, which doesn't need to be sorted
+        self.assertEquals(search.intersect_postings(ids,
+                                                    array('i', [7, 5, 3])),
+                          set([5, 7]))
+        self.assertEquals(search.intersect_postings(ids, array('i')), set())
+        self.assertEquals(search.intersect_postings(set(), array('i')),
+                          set())
+
+    def test_term_search(self):
+        # we search for long terms using their N-grams
+        self.assertEquals(search.term_search(self.ngram_postings, 'uvwxyz'),
+                          set([7, 9]))
+        self.assertEquals(search.term_search(self.ngram_postings, 'bcd'),
+                          set([1, 5, 7, 100, 101, 500]))
+        self.assertEquals(search.term_search(self.ngram_postings, 'xyz'),
+                          set())
+
+    def test_search_postings(self):
+        self.assertEquals(search.search_postings(self.ngram_postings,
+                                                 'abc bcd'),
+                          set([5, 100, 500]))
+        self.assertEquals(search.search_postings(self.ngram_postings,
+                                                 'bcd -cde'),
+                          set([1, 100, 101]))
+        self.assertEquals(search.search_postings(self.ngram_postings,
+                                                 '-cde'), None)
+
+    def test_only_sort_for_galloping(self):
+        search.search_postings(self.ngram_postings, 'bcd cde')
+        self.assert_(('bcd', True) not in self.sort_flags)
+        self.assert_(('cde', True) not in self.sort_flags)
+        self.sort_flags = []
+        search.search_postings(self.ngram_postings, 'abc bcd')
+        self.assert_(('abc', True) in self.sort_flags)
+
 class ItemSearcherTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -142,6 +245,37 @@ class ItemSearcherTest(MiroTestCase):
         self.check_search_results('my', self.item1)
         self.check_empty_result('second')
 
+    def test_result_cache(self):
+        results = self.searcher.search('first')
+        self.assert_(self.searcher.search('first') is results)
+        # changing the index should invalidate the cached results
+        item3 = self.make_item(u'http://example.com/3', u'first again')
+        self.check_search_results('first', self.item1, item3)
+        self.searcher.remove_item(item3.id)
+        self.check_search_results('first', self.item1)
+
+    def test_postings_sorted(self):
+        # remove and add item1 so its id gets added after item2's
+        self.searcher.remove_item(self.item1.id)
+        self.searcher.add_item(self.make_info(self.item1))
+        self.assertEquals(self.searcher.ngram_postings('item'),
+                          array('i', sorted([self.item1.id, self.item2.id])))
+        self.searcher.remove_item(self.item2.id)
+        self.assertEquals(self.searcher.ngram_postings('item'),
+                          array('i', [self.item1.id]))
+        self.searcher.remove_item(self.item1.id)
+        self.assertEquals(self.searcher.ngram_postings('item'), array('i'))
+
+    def test_add_items(self):
+        searcher = search.ItemSearcher()
+        searcher.add_items([self.make_info(self.item2),
+                            self.make_info(self.item1)])
+        # adding in id order means we don't need to sort postings later
+        self.assertEquals(searcher.ngram_postings('item', sort=False),
+                          array('i', sorted([self.item1.id, self.item2.id])))
+        self.assertSameSet(searcher.search('item'),
+                           [self.item1.id, self.item2.id])
+
 class SearchFilterTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
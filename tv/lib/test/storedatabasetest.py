@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import unittest
 import string
@@ -8,6 +8,7 @@ import time
 import sqlite3
 
 from miro import app
+from miro import columncodec
 from miro import database
 from miro import databaseupgrade
 from miro import dialogs
@@ -226,6 +227,27 @@ class DBUpgradeTest(StoreDatabaseTest):
                 raise AssertionError("different column types for %s (%s)" %
                                      (table_name, diff))
 
+    @skip_for_platforms('win32')
+    def test_pythonrepr_columns_converted(self):
+        shutil.copy(resources.path("testdata/olddatabase.v79"),
+                    self.save_path2)
+        self.reload_database(self.save_path2)
+        checked = 0
+        for table_name in databaseupgrade.get_object_tables(app.db.cursor):
+            app.db.cursor.execute('pragma table_info(%s)' % table_name)
+            for column_info in app.db.cursor.fetchall():
+                name, type_ = column_info[1:3]
+                if type_ != 'pythonrepr':
+                    continue
+                app.db.cursor.execute("SELECT %s FROM %s" %
+                                      (name, table_name))
+                for (value,) in app.db.cursor.fetchall():
+                    if value is not None:
+                        self.assert_(isinstance(value, buffer))
+                        columncodec.decode(value)
+                        checked += 1
+        self.assert_(checked > 0)
+
     def _get_column_types(self):
         app.db.cursor.execute("SELECT name FROM sqlite_master "
                               "WHERE type='table'")
@@ -565,32 +587,147 @@ class CorruptReprTest(FakeSchemaTest):
         self.assertEqual(restored_lee.stuff, 'testing123')
         app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
         row = app.db.cursor.fetchone()
-        self.assertEqual(row[0], "'testing123'")
+        self.assertEqual(row[0], columncodec.encode('testing123'))
 
     def test_repr_failure_no_handler(self):
         app.db.cursor.execute("UPDATE pcf_programmer SET stuff='{baddata' "
                               "WHERE name='ben'")
-        self.assertRaises(SyntaxError, self.reload_object, self.ben)
+        # stuff gets decoded lazily, so the error happens when we access it
+        restored_ben = self.reload_object(self.ben)
+        self.assertRaises(SyntaxError, getattr, restored_ben, 'stuff')
+
+class LazyDecodeTest(FakeSchemaTest):
+    def test_lazy_decode(self):
+        restored_joe = self.reload_object(self.joe)
+        self.assert_(isinstance(restored_joe.__dict__['friend_names'],
+                                database.LazyAttributeValue))
+        self.assertEquals(restored_joe.friend_names, [u'lee'])
+        self.assertEquals(restored_joe.__dict__['friend_names'], [u'lee'])
+        self.assertEquals(restored_joe.changed_attributes, set())
+
+    def test_update_skips_lazy_columns(self):
+        restored_joe = self.reload_object(self.joe)
+        restored_joe.name = u'joe2'
+        restored_joe.signal_change()
+        # friend_names was never accessed, so it shouldn't be decoded or
+        # saved.
+        self.assert_(isinstance(restored_joe.__dict__['friend_names'],
+                                database.LazyAttributeValue))
+        restored_joe = self.reload_object(restored_joe)
+        self.assertEquals(restored_joe.name, u'joe2')
+        self.assertEquals(restored_joe.friend_names, [u'lee'])
+
+    def test_update_after_decode(self):
+        # once we decode a container, we need to save it since it could have
+        # been changed in-place
+        restored_joe = self.reload_object(self.joe)
+        restored_joe.friend_names.append(u'ben')
+        restored_joe.signal_change()
+        restored_joe = self.reload_object(restored_joe)
+        self.assertEquals(restored_joe.friend_names, [u'lee', u'ben'])
 
 class ConverterTest(StoreDatabaseTest):
     def test_convert_repr(self):
         converter = storedatabase.SQLiteConverter()
-        # _repr_to_sql ignores the schema_item parameter, so we can just pass
-        # in None
+        # _codec_from_sql ignores the schema_item parameter, so we can just
+        # pass in None
         schema_item = None
 
         test1 = """{'updated_parsed': (2009, 6, 5, 1, 30, 0, 4, 156, 0)}"""
-        val = converter._repr_from_sql(test1, schema_item)
+        val = converter._codec_from_sql(test1, schema_item)
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
         test2 = """{'updated_parsed': time.struct_time(tm_year=2009, \
 tm_mon=6, tm_mday=5, tm_hour=1, tm_min=30, tm_sec=0, tm_wday=4, tm_yday=156, \
 tm_isdst=0)}"""
-        val = converter._repr_from_sql(test2, schema_item)
+        val = converter._codec_from_sql(test2, schema_item)
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
+    def test_codec(self):
+        for value in ([], {}, [1, 2L, 3.5, None, True],
+                      {u'a': u'\u1234', 'b': ('abc', None)},
+                      {'x': datetime(2011, 6, 5, 1, 30, 0, 5000),
+                       'y': [timedelta(days=2, seconds=5)],
+                       'z': time.localtime()},
+                      timedelta(hours=3)):
+            data = columncodec.encode(value)
+            self.assert_(isinstance(data, buffer))
+            decoded = columncodec.decode(data)
+            self.assertEquals(decoded, value)
+            self.assertEquals(type(decoded), type(value))
+            self.assertEquals(columncodec.decode(repr(value)), value)
+
+    def test_codec_subclasses(self):
+        value = {u'filename': PlatformFilenameType('/tmp/abc')}
+        self.assertEquals(columncodec.decode(columncodec.encode(value)),
+                          value)
+
+    def test_codec_bad_format(self):
+        self.assertRaises(ValueError, columncodec.decode, buffer('\xffabc'))
+
+class ColdColumnTest(StoreDatabaseTest):
+    # test restoring only the hot_columns of the item table
+    def setUp(self):
+        StoreDatabaseTest.setUp(self)
+        self.feed = feed.Feed(u"http://example.com/feed")
+        self.items = []
+        for i in xrange(3):
+            self.items.append(item.Item(
+                item.FeedParserValues({'description': u'item-%s' % i}),
+                feed_id=self.feed.id))
+
+    def restore_items(self):
+        self.clear_ddb_object_cache()
+        return list(item.Item.make_view(order_by='id'))
+
+    def check_cold(self, obj, name):
+        self.assert_(isinstance(obj.__dict__[name],
+                                database.LazyAttributeValue))
+
+    def test_restore(self):
+        restored = self.restore_items()
+        self.assertEquals(restored[0].__dict__['feed_id'], self.feed.id)
+        for obj in restored:
+            self.check_cold(obj, 'entry_description')
+        # accessing a cold column loads it for the entire batch
+        self.assertEquals(restored[0].entry_description, u'item-0')
+        for i, obj in enumerate(restored):
+            self.assertEquals(obj.__dict__['entry_description'],
+                              u'item-%s' % i)
+        self.assertEquals(restored[0].changed_attributes, set())
+
+    def test_update(self):
+        restored = self.restore_items()
+        restored[1].seen = True
+        restored[1].signal_change()
+        restored = self.restore_items()
+        self.assertEquals(restored[1].seen, True)
+        self.assertEquals(restored[1].entry_description, u'item-1')
+
+    def test_set_cold_column(self):
+        restored = self.restore_items()
+        restored[1].entry_description = u'new-description'
+        restored[1].signal_change()
+        # loading the batch shouldn't overwrite our change
+        self.assertEquals(restored[0].entry_description, u'item-0')
+        self.assertEquals(restored[1].entry_description, u'new-description')
+        restored = self.restore_items()
+        self.assertEquals(restored[1].entry_description, u'new-description')
+
+    def test_remove(self):
+        restored = self.restore_items()
+        restored[2].remove()
+        # we should still be able to access the cold columns of removed
+        # objects
+        self.assertEquals(restored[2].entry_description, u'item-2')
+
+    def test_lazy_restore_disabled(self):
+        app.db.lazy_restore = False
+        restored = self.restore_items()
+        self.assertEquals(restored[0].__dict__['entry_description'], u'item-0')
+
 class CorruptDDBObjectReprTest(StoreDatabaseTest):
     # test corrupt SchemaReprContainer columns in real DDBObjects
     def setUp(self):
@@ -1,14 +1,16 @@
+from cStringIO import StringIO
 import os
+import tempfile
 import time
-import Queue
 
 from miro import app
-from miro import moviedata
+from miro import feeddiff
+from miro import fileutil
 from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
-from miro.test import mock
-from miro.test.framework import EventLoopTest, only_on_platforms
+from miro.test.framework import (MiroTestCase, EventLoopTest,
+                                 only_on_platforms)
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -186,6 +188,17 @@ class SubprocessManagerTest(EventLoopTest):
         # test that the original thread is gone
         self.assert_(not old_thread.is_alive())
 
+    def test_restart_removes_temp_files(self):
+        # files for frames that the old process never read should be
+        # cleaned up when we restart it
+        fd, path = tempfile.mkstemp(prefix='miro-ipc-')
+        os.close(fd)
+        self.subprocess.writer.temp_paths.add(path)
+        self.subprocess.process.terminate()
+        self.responder.subprocess_ready = False
+        self._wait_for_subprocess_ready()
+        self.assert_(not os.path.exists(path))
+
     def test_restart2(self):
         # test that we restart subprocesses if the quit normally, but we
         # haven't sent the quit message to them
@@ -206,6 +219,16 @@ class SubprocessManagerTest(EventLoopTest):
         # test that the original thread is gone
         self.assert_(not old_thread.is_alive())
 
+    def test_batch_messages(self):
+        # test that messages sent together get written in one frame
+        Ping().send_to_process()
+        Ping().send_to_process()
+        Ping().send_to_process()
+        self.assertEquals(len(self.subprocess.writer.pending), 3)
+        self.runEventLoop(0.1, timeoutNormal=True)
+        self.assertEquals(self.subprocess.writer.pending, [])
+        self.assertEquals(self.responder.pong_count, 3)
+
     def test_subprocess_exception(self):
         # check that subprocess handler exceptions don't break things
         original_pid = self.subprocess.process.pid
@@ -223,12 +246,143 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+class MessagePipeTest(MiroTestCase):
+    """Test MessageWriter and MessageReader."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.stats = subprocessmanager.IPCStats()
+        self.pipe = StringIO()
+        self.writer = subprocessmanager.MessageWriter(self.pipe, self.stats)
+
+    def make_reader(self):
+        return subprocessmanager.MessageReader(
+            StringIO(self.pipe.getvalue()), self.stats)
+
+    def read_headers(self):
+        """Get the (frame type, size) pairs for the frames we wrote."""
+        headers = []
+        data = self.pipe.getvalue()
+        pos = 0
+        header = subprocessmanager.FRAME_HEADER
+        while pos < len(data):
+            frame_type, size, sent_time = header.unpack_from(data, pos)
+            headers.append((frame_type, size))
+            pos += header.size + size
+        return headers
+
+    def test_batch(self):
+        messages = [Ping(), SawEvent('foo'), {'data': range(10)}, None]
+        for msg in messages:
+            self.writer.add(msg)
+        self.assertEquals(self.pipe.getvalue(), '')
+        self.writer.flush()
+        # everything should be sent in 1 frame
+        headers = self.read_headers()
+        self.assertEquals(len(headers), 1)
+        self.assertEquals(headers[0][0], subprocessmanager.FRAME_DATA)
+        reader = self.make_reader()
+        self.assert_(isinstance(reader.read(), Ping))
+        self.assertEquals(reader.read().event, 'foo')
+        self.assertEquals(reader.read(), {'data': range(10)})
+        self.assertEquals(reader.read(), None)
+        self.assertRaises(subprocessmanager.LoadError, reader.read)
+
+    def test_multiple_frames(self):
+        self.writer.add(Ping())
+        self.writer.flush()
+        # flushing with nothing pending shouldn't write an empty frame
+        self.writer.flush()
+        self.writer.add(SawEvent('foo'))
+        self.writer.flush()
+        self.assertEquals(len(self.read_headers()), 2)
+        reader = self.make_reader()
+        self.assert_(isinstance(reader.read(), Ping))
+        self.assertEquals(reader.read().event, 'foo')
+
+    def test_large_message(self):
+        self.writer.large_message_size = 1000
+        self.writer.add('small')
+        self.writer.flush()
+        self.writer.add('x' * 2000)
+        self.writer.add('y')
+        self.writer.flush()
+        headers = self.read_headers()
+        self.assertEquals([frame_type for frame_type, size in headers],
+                [subprocessmanager.FRAME_DATA, subprocessmanager.FRAME_FILE])
+        # the large frame should only contain the path to its file
+        self.assert_(headers[1][1] < 1000)
+        path = self.pipe.getvalue()[-headers[1][1]:]
+        self.assert_(os.path.exists(path))
+        reader = self.make_reader()
+        self.assertEquals(reader.read(), 'small')
+        self.assertEquals(reader.read(), 'x' * 2000)
+        self.assertEquals(reader.read(), 'y')
+        # the reader should delete the file once it's done
+        self.assert_(not os.path.exists(path))
+        self.writer.add('z' * 2000)
+        self.writer.flush()
+        self.assertEquals(len(self.writer.temp_paths), 1)
+
+    def test_remove_temp_files(self):
+        # if nobody reads the large frames, the writer should be able to
+        # clean up their files
+        self.writer.large_message_size = 1000
+        paths = []
+        for i in xrange(2):
+            self.writer.add('x' * 2000)
+            self.writer.flush()
+            path = self.pipe.getvalue()[-self.read_headers()[-1][1]:]
+            self.assert_(os.path.exists(path))
+            paths.append(path)
+        self.assertEquals(self.writer.temp_paths, set(paths))
+        self.writer.remove_temp_files()
+        self.assertEquals(self.writer.temp_paths, set())
+        for path in paths:
+            self.assert_(not os.path.exists(path))
+
+    def test_remove_temp_file_on_write_error(self):
+        class BrokenPipe(object):
+            def write(self, data):
+                raise IOError("Broken pipe")
+        self.writer.pipe = BrokenPipe()
+        self.writer.large_message_size = 1000
+        self.writer.add('x' * 2000)
+        self.assertRaises(IOError, self.writer.flush)
+        self.assertEquals(self.writer.temp_paths, set())
+
+    def test_truncated(self):
+        self.writer.add(Ping())
+        self.writer.flush()
+        data = self.pipe.getvalue()
+        reader = subprocessmanager.MessageReader(StringIO(data[:-2]))
+        self.assertRaises(subprocessmanager.LoadError, reader.read)
+
+    def test_stats(self):
+        self.writer.add(Ping())
+        self.writer.add(Ping())
+        self.writer.add(SawEvent('foo'))
+        self.writer.flush()
+        reader = self.make_reader()
+        for i in xrange(3):
+            reader.read()
+        summary = dict(((direction, name), (count, size))
+                for (direction, name, count, size, total_time, max_time)
+                in self.stats.get_summary())
+        self.assertEquals(summary[('sent', 'Ping')][0], 2)
+        self.assertEquals(summary[('sent', 'SawEvent')][0], 1)
+        self.assertEquals(summary[('received', 'Ping')],
+                          summary[('sent', 'Ping')])
+        self.assertEquals(summary[('received', 'SawEvent')],
+                          summary[('sent', 'SawEvent')])
+        self.stats.reset()
+        self.assertEquals(self.stats.get_summary(), [])
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
-    def handle_feedparser_task(self, msg):
+    def handle_feed_diff_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
             raise ValueError("Simulated Exception")
         else:
-            return workerprocess.WorkerProcessHandler.handle_feedparser_task(
+            return workerprocess.WorkerProcessHandler.handle_feed_diff_task(
                     self, msg)
 
     def handle_slow_running_task(self, msg):
@@ -240,9 +394,9 @@ class WorkerProcessTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         # override the normal handler class with our own
-        workerprocess._subprocess_manager.handler_class = (
+        workerprocess._worker_pool.handler_class = (
                 UnittestWorkerProcessHandler)
-        workerprocess._subprocess_manager.restart_delay = 0
+        workerprocess._worker_pool.restart_delay = 0
         self.reset_results()
 
     def tearDown(self):
@@ -266,7 +420,7 @@ class FeedParserTest(WorkerProcessTest):
         path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
             "http___feeds_miroguide_com_miroguide_featured.xml")
         html = open(path).read()
-        msg = workerprocess.FeedparserTask(html)
+        msg = workerprocess.FeedDiffTask([], html)
         workerprocess.send(msg, self.callback, self.errback)
 
     def check_successful_result(self):
@@ -274,9 +428,9 @@ class FeedParserTest(WorkerProcessTest):
             raise self.error
         self.assertNotEquals(self.result, None)
         # just do some very basic test to see if the result is correct
-        if self.result['bozo']:
-            raise AssertionError("Feedparser parse error: %s",
-                    self.result['bozo_exception'])
+        if self.result.parsed['bozo']:
+            raise AssertionError("Feedparser parse error")
+        self.assert_(self.result.entry_count > 0)
 
     def test_feedparser_success(self):
         # test feedparser successfully parsing a feed
@@ -285,10 +439,36 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+    def test_feedparser_from_path(self):
+        # test feedparser reading the feed data from a file
+        workerprocess.startup()
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        msg = workerprocess.FeedDiffTask([], path=path)
+        workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(4.0)
+        self.check_successful_result()
+
+    def test_feed_diff(self):
+        # test parsing a feed and matching it against our items
+        workerprocess.startup()
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        msg = workerprocess.FeedDiffTask([], path=path)
+        workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(4.0)
+        if self.error is not None:
+            raise self.error
+        self.assert_(isinstance(self.result, feeddiff.FeedDiff))
+        self.assertEquals(self.result.parsed.entries, [])
+        self.assert_(self.result.entry_count > 0)
+        self.assertEquals(self.result.count(feeddiff.ENTRY_NEW),
+                len(self.result.entries))
+
     def test_feedparser_error(self):
         # test feedparser failing to parse a feed
         workerprocess.startup()
-        msg = workerprocess.FeedparserTask('FORCE EXCEPTION')
+        msg = workerprocess.FeedDiffTask([], 'FORCE EXCEPTION')
         workerprocess.send(msg, self.callback, self.errback)
         self.runEventLoop(4.0)
         self.assertEquals(self.result, None)
@@ -296,14 +476,14 @@ class FeedParserTest(WorkerProcessTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(process_count=1)
+        manager = workerprocess._worker_pool.managers[0]
+        original_pid = manager.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        manager.process.terminate()
         self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, manager.process.pid)
         self.check_successful_result()
 
     def test_queue_before_start(self):
@@ -316,6 +496,29 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+    def test_multiple_processes(self):
+        # test spreading tasks over several processes
+        workerprocess.startup(thread_count=1, process_count=2)
+        results = []
+        def callback(msg, result):
+            results.append(result)
+            if len(results) == 4:
+                self.stopEventLoop(abnormal=False)
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        for i in xrange(4):
+            msg = workerprocess.FeedDiffTask([], path=path)
+            workerprocess.send(msg, callback, self.errback)
+        managers = workerprocess._worker_pool.managers
+        self.assertEquals(len(managers), 2)
+        self.runEventLoop(8.0)
+        if self.error is not None:
+            raise self.error
+        self.assertEquals(len(results), 4)
+        for manager in managers:
+            self.assertEquals(manager.task_ids, set())
+        self.assertEquals(workerprocess.pending_task_count(), 0)
+
 class MovieDataTest(WorkerProcessTest):
     def check_successful_result(self):
         # just do some very basic test to see if the result is correct
@@ -393,6 +596,8 @@ class MutagenTest(WorkerProcessTest):
         self.assertEquals(self.result['file_type'], file_type)
         self.assertClose(self.result['duration'], duration)
         self.assertEquals(self.result['title'], title)
+        self.assertEquals(self.result['file_identity'],
+                          fileutil.get_file_identity(source_path))
         if has_cover_art:
             self.assertNotEquals(self.result['cover_art'], None)
         else:
@@ -410,7 +615,130 @@ class MutagenTest(WorkerProcessTest):
         self.check_mutagen_call('drm.m4v', 'video', 2668832, 'Thinkers',
                                 True)
 
+    def test_file_identity(self):
+        workerprocess.startup()
+        paths = [resources.path("testdata/metadata/mp3-0.mp3"),
+                 os.path.join(self.tempdir, 'missing.mp3')]
+        msg = workerprocess.FileIdentityTask(paths)
+        workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(4.0)
+        if self.error is not None:
+            raise self.error
+        self.assertEquals(self.result,
+                          [fileutil.get_file_identity(paths[0]), None])
 
-# TODO:
-#   Test task priority system in worker process
-#   Test that the CancelFileOperations message is handled properly
+class FakeWorkerManager(object):
+    """Stands in for WorkerSubprocessManager in WorkerProcessPoolTest."""
+    def __init__(self):
+        self.is_running = True
+        self.task_ids = set()
+        self.sent = []
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+    def shutdown(self):
+        self.is_running = False
+
+class WorkerProcessPoolTest(EventLoopTest):
+    """Test how WorkerProcessPool sends tasks to its processes."""
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.pool = workerprocess.WorkerProcessPool()
+        workerprocess._worker_pool = self.pool
+        self.managers = [FakeWorkerManager(), FakeWorkerManager()]
+        self.pool.managers = self.managers
+        self.pool.task_limit = 2
+        self.pool.is_running = True
+        self.results = []
+        self.errors = []
+
+    def callback(self, msg, result):
+        self.results.append((msg, result))
+
+    def errback(self, msg, error):
+        self.errors.append((msg, error))
+
+    def send_task(self, msg):
+        workerprocess.send(msg, self.callback, self.errback)
+        return msg
+
+    def finish_task(self, msg, result=None):
+        self.pool.task_finished(workerprocess.TaskResult(msg.task_id, result))
+
+    def test_balance(self):
+        tasks = [self.send_task(workerprocess.FeedDiffTask([], 'feed%d' % i))
+                 for i in xrange(5)]
+        # tasks should alternate between our processes until they're full
+        self.assertEquals(self.managers[0].sent, tasks[0:4:2])
+        self.assertEquals(self.managers[1].sent, tasks[1:4:2])
+        self.assertEquals(self.pool.waiting_tasks.get_next_task()[1],
+                          tasks[4])
+
+    def test_finish_sends_waiting(self):
+        tasks = [self.send_task(workerprocess.FeedDiffTask([], 'feed%d' % i))
+                 for i in xrange(5)]
+        self.finish_task(tasks[1], 'result')
+        self.assertEquals(self.results, [(tasks[1], 'result')])
+        # the waiting task should go to the process that has room for it
+        self.assertEquals(self.managers[1].sent[-1], tasks[4])
+        self.assertEquals(self.managers[1].task_ids,
+                          set([tasks[3].task_id, tasks[4].task_id]))
+        self.assertEquals(workerprocess.pending_task_count(), 4)
+
+    def test_priority(self):
+        self.pool.task_limit = 0
+        mutagen = self.send_task(workerprocess.MutagenTask('/foo.mp3', '/tmp'))
+        feed = self.send_task(workerprocess.FeedDiffTask([], 'feed'))
+        self.pool.task_limit = 1
+        self.pool.dispatch_tasks()
+        # the feedparser task should go first, since it has a higher priority
+        self.assertEquals(self.managers[0].sent, [feed])
+        self.assertEquals(self.managers[1].sent, [mutagen])
+
+    def test_skip_stopped_process(self):
+        self.managers[0].is_running = False
+        task = self.send_task(workerprocess.FeedDiffTask([], 'feed'))
+        self.assertEquals(self.managers[0].sent, [])
+        self.assertEquals(self.managers[1].sent, [task])
+
+    def test_process_restart(self):
+        task = self.send_task(workerprocess.FeedDiffTask([], 'feed'))
+        self.assertEquals(self.managers[0].sent, [task])
+        # if the process restarts, we should send the task again
+        self.pool.process_started(self.managers[0])
+        self.assertEquals(self.managers[0].sent, [task, task])
+
+    def test_cancel_file_operations(self):
+        self.pool.task_limit = 0
+        mutagen = self.send_task(workerprocess.MutagenTask('/foo.mp3', '/tmp'))
+        mutagen2 = self.send_task(workerprocess.MutagenTask('/bar.mp3',
+                                                            '/tmp'))
+        workerprocess.cancel_tasks_for_files(['/foo.mp3'])
+        # the cancel should go to every process
+        for manager in self.managers:
+            self.assertEquals(len(manager.sent), 1)
+            self.assert_(isinstance(manager.sent[0],
+                                    workerprocess.CancelFileOperations))
+        # the mutagen task for /foo.mp3 never got sent, so we can just drop
+        # it.
+        self.assertEquals(workerprocess.pending_task_count(
+            workerprocess.MutagenTask), 1)
+        self.assertEquals(self.pool.waiting_tasks.get_next_task()[1],
+                          mutagen2)
+        self.assertEquals(self.results, [])
+        self.assertEquals(self.errors, [])
+        # each process replies to the cancel, we should only run the
+        # callback once
+        cancel = self.managers[0].sent[0]
+        self.finish_task(cancel)
+        self.finish_task(cancel)
+        self.assertEquals(workerprocess.pending_task_count(), 1)
+
+    def test_tasks_canceled(self):
+        task = self.send_task(workerprocess.MutagenTask('/foo.mp3', '/tmp'))
+        self.pool.tasks_canceled([task.task_id])
+        self.assertEquals(self.managers[0].task_ids, set())
+        self.assertEquals(workerprocess.pending_task_count(), 0)
+        self.assertEquals(self.results, [])
+        self.assertEquals(self.errors, [])
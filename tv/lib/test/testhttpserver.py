@@ -228,6 +228,20 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         except IOError:
             self.send_error(404, "File not found")
             return None
+        # send 304 responses for conditional GETs that match the ETag from
+        # add_header()
+        etag = None
+        for key, value in self.server.headers_to_send:
+            if key.lower() == 'etag':
+                etag = value
+        if (code == 200 and etag is not None and
+                self.headers.get('if-none-match') == etag):
+            f.close()
+            self.send_response(304)
+            for key, value in self.server.headers_to_send:
+                self.send_header(key, value)
+            self.end_headers()
+            return None
         self.send_response(code)
         if location_header is not None:
             self.send_header("Location", location_header)
@@ -3,6 +3,7 @@ import types
 
 from miro import feed
 from miro import item
+from miro import feeddiff
 from miro import feedparserutil
 from miro import dialogs
 import framework
@@ -31,8 +32,10 @@ class UnicodeFeedTestCase(framework.EventLoopTest):
     def force_feed_parser_callback(self, my_feed):
         # a hack to get the feed to update without eventloop
         feedimpl = my_feed.actualFeed
-        feedimpl.feedparser_callback(
-            feedparserutil.parse(feedimpl.initialHTML))
+        parsed = feedparserutil.parse(feedimpl.initialHTML)
+        feedimpl.feedparser_callback(feeddiff.diff_feed(parsed, []))
+        # items get created in idle callbacks
+        self.runPendingIdles()
 
     def is_proper_feed_parser_dict(self, parsed, name="top"):
         if isinstance(parsed, types.DictionaryType):
@@ -137,6 +140,7 @@ class UnicodeFeedTestCase(framework.EventLoopTest):
         my_feed = self.make_feed(u"file://" + self.filename)
 
         my_feed.update()
+        self.runPendingIdles()
         self.assertEqual(my_feed.items.count(), 1)
         my_item = list(my_feed.items)[0]
         self.assertEqual(len(my_item.get_title()), 14)
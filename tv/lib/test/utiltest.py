@@ -1072,6 +1072,12 @@ class CacheTestCase(MiroTestCase):
         # 1 has expired out
         self.assertEquals(set(self.cache.keys()), set((2, 3)))
 
+    def test_lru_forgets_invalidators(self):
+        for i in xrange(10):
+            self.cache.get(i)
+        self.assertEquals(set(self.cache.invalidators.keys()),
+                          set(self.cache.keys()))
+
     def test_invalidator_set(self):
         def invalidator(key):
             return True
@@ -0,0 +1,112 @@
+from miro import app
+from miro import viewpredicate
+from miro.downloader import RemoteDownloader
+from miro.feed import Feed
+from miro.item import Item, FeedParserValues
+from miro.test.framework import MiroTestCase
+
+class ViewPredicateTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'http://example.com/feed')
+        self.feed2 = Feed(u'dtv:manualFeed')
+        self.items = []
+        for i in xrange(6):
+            feed_id = (self.feed.id, self.feed2.id)[i % 2]
+            item = Item(FeedParserValues({'title': u'item-%s' % i}),
+                        feed_id=feed_id)
+            self.items.append(item)
+        self.items[0].seen = True
+        self.items[0].file_type = u'video'
+        self.items[1].file_type = u'audio'
+        self.items[2].deleted = True
+        self.items[3].feed_id = None
+        self.items[3].parent_id = self.items[2].id
+        for item in self.items:
+            item.signal_change()
+        url = u'http://example.com/feed/movie.mpeg'
+        self.items[4].set_downloader(RemoteDownloader(url, self.items[4]))
+        self.items[4].downloader.state = u'downloading'
+        self.items[4].downloader.signal_change()
+
+    def compile(self, where, values=(), joins=None):
+        return viewpredicate.compile_where('item', where, values, joins,
+                                           app.db_info)
+
+    def check_matches_sql(self, where, values=(), joins=None):
+        predicate = self.compile(where, values, joins)
+        self.assertNotEquals(predicate, None)
+        view = Item.make_view(where, values, joins=joins)
+        sql_ids = set(view.id_list())
+        for item in self.items:
+            result = predicate.evaluate(item)
+            self.assertNotEquals(result, viewpredicate.UNKNOWN)
+            self.assertEquals(result, item.id in sql_ids,
+                              "%s: %s" % (where, item.title))
+
+    def test_simple(self):
+        self.check_matches_sql('feed_id=?', (self.feed.id,))
+        self.check_matches_sql('parent_id=?', (self.items[2].id,))
+        self.check_matches_sql('NOT item.seen')
+        self.check_matches_sql("file_type='video'")
+        self.check_matches_sql("item.file_type IN ('audio', 'video')")
+        self.check_matches_sql("file_type NOT IN ('audio', 'video')")
+
+    def test_nulls(self):
+        self.check_matches_sql('feed_id=? AND (deleted IS NULL or not deleted)',
+                               (self.feed.id,))
+        self.check_matches_sql('parent_id IS NOT NULL')
+        self.check_matches_sql('deleted OR parent_id IS NULL')
+        self.check_matches_sql('feed_id=?', (None,))
+
+    def test_joins(self):
+        self.check_matches_sql("feed.origURL == 'dtv:manualFeed'",
+                               joins={'feed': 'item.feed_id=feed.id'})
+        self.check_matches_sql("feed.origURL == 'dtv:manualFeed'",
+                               joins={'feed': 'feed.id=item.feed_id'})
+        rd_join = {'remote_downloader AS rd': 'item.downloader_id=rd.id'}
+        self.check_matches_sql("rd.state in ('downloading', 'paused') AND "
+                               "rd.main_item_id=item.id", joins=rd_join)
+        self.check_matches_sql("rd.state IS NULL", joins=rd_join)
+
+    def test_partial(self):
+        # lower() can't be evaluated in python, but feed_id can rule items
+        # out.
+        predicate = self.compile('feed_id=? AND lower(title)=?',
+                                 (self.feed.id, u'item-0'))
+        self.assertEquals(predicate.evaluate(self.items[1]), False)
+        self.assertEquals(predicate.evaluate(self.items[0]),
+                          viewpredicate.UNKNOWN)
+
+    def test_unknown(self):
+        for where in ("title LIKE 'item%'",
+                      "creationTime < ?",
+                      "feed_id NOT IN (SELECT id from feed)",
+                      "title",
+                      "feed_id = 'abc'",
+                      "bogus_column = 1"):
+            if '?' in where:
+                values = (1,)
+            else:
+                values = ()
+            predicate = self.compile(where, values)
+            self.assertEquals(predicate.evaluate(self.items[0]),
+                              viewpredicate.UNKNOWN)
+
+    def test_unparsable(self):
+        self.assertEquals(self.compile('feed_id + 1 = 2'), None)
+        self.assertEquals(self.compile('feed_id = ?', ()), None)
+
+    def test_unsaved_changes(self):
+        predicate = self.compile('NOT seen')
+        self.items[1].seen = True
+        self.assertEquals(predicate.evaluate(self.items[1]),
+                          viewpredicate.UNKNOWN)
+        self.items[1].signal_change()
+        self.assertEquals(predicate.evaluate(self.items[1]), False)
+
+    def test_removed(self):
+        predicate = self.compile('feed_id=?', (self.feed.id,))
+        self.items[0].remove()
+        self.assertEquals(predicate.evaluate(self.items[0]),
+                          viewpredicate.UNKNOWN)
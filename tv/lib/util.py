@@ -472,6 +472,9 @@ def db_mem_usage_test():
 def get_mem_usage():
     return int(call_command('ps', '-o', 'rss', 'hp', str(os.getpid())))
 
+# Level for logging.timing() messages
+TIMING_LEVEL = 25
+
 def setup_logging():
     """Adds TIMING and JSALERT logging levels.
     """
@@ -480,9 +483,10 @@ def setup_logging():
         15, "%s\n%s" % ("".join(traceback.format_stack()), msg),
         *args, **kargs)
 
-    logging.addLevelName(25, "TIMING")
-    logging.timing = lambda msg, *args, **kargs: logging.log(25, msg,
-                                                             *args, **kargs)
+    logging.addLevelName(TIMING_LEVEL, "TIMING")
+    logging.timing = lambda msg, *args, **kargs: logging.log(TIMING_LEVEL,
+                                                             msg, *args,
+                                                             **kargs)
     logging.addLevelName(26, "JSALERT")
     logging.jsalert = lambda msg, *args, **kargs: logging.log(26, msg,
                                                               *args, **kargs)
@@ -1157,6 +1161,7 @@ class Cache(object):
             new_access_times[key] = time
         self.dict = new_dict
         self.access_times = new_access_times
+        self.invalidators = new_invalidators
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
@@ -1196,16 +1201,22 @@ def make_file_url(path):
     # there are no unicode to infect us for a unicode type upgrade.
     return 'file:///' + path_part
 
-def split_values_for_sqlite(value_list):
+# The cursor.execute() method can only handle 999 values at once.  Use 990
+# just to be on the safe side.
+SQLITE_CHUNK_SIZE = 990
+
+def split_values_for_sqlite(value_list, chunk_size=SQLITE_CHUNK_SIZE):
     """Split a list of values into chunks that SQL can handle.
 
     The cursor.execute() method can only handle 999 values at once, this
     method splits long lists into chunks where each chunk has is safe to feed
     to sqlite.
+
+    :param chunk_size: max values per chunk.  Lower this if the query will
+        have other values besides the ones in value_list.
     """
-    CHUNK_SIZE = 990 # use 990 just to be on the safe side.
-    for start in xrange(0, len(value_list), CHUNK_SIZE):
-        yield value_list[start:start+CHUNK_SIZE]
+    for start in xrange(0, len(value_list), chunk_size):
+        yield value_list[start:start+chunk_size]
 
 
 class SupportDirBackup(object):
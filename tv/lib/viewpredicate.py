@@ -0,0 +1,622 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""viewpredicate.py -- Evaluate View WHERE clauses in python.
+
+ViewTracker needs to know if an object that just changed is part of its
+view.  Running a "SELECT COUNT(*)" for every tracker and every changed object
+gets expensive, so this module compiles the WHERE clauses that our views use
+into a tree of nodes that can be checked against the attributes of objects
+that are already in memory.
+
+Only a subset of SQL is handled: AND, OR, NOT, comparisons, IS [NOT] NULL
+and [NOT] IN with a list of values.  Columns can come from the view's table
+or from a table LEFT JOINed on its id (for example "rd.state" with
+"item.downloader_id=rd.id").  Anything else (function calls, LIKE,
+sub-selects, comparisons between mismatched types, etc.) compiles to a node
+that evaluates to UNKNOWN.  We follow SQL's three-valued logic, so something
+like "feed_id=? AND lower(filename)=?" can still be decided in python if
+feed_id doesn't match.  When the result is UNKNOWN, callers should fall back
+to SQL.
+"""
+
+import re
+
+class CompileError(StandardError):
+    """Raised when we can't parse a WHERE clause."""
+    pass
+
+class _Unknown(object):
+    def __repr__(self):
+        return 'UNKNOWN'
+
+# Returned when we can't figure out a value in python
+UNKNOWN = _Unknown()
+
+# Kinds of values.  We only compare values of the same kind, since sqlite's
+# type affinity rules for mixed comparisons are hard to replicate.
+NUMERIC = 'numeric'
+TEXT = 'text'
+NULL = 'null'
+OTHER = 'other'
+
+_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*') |
+    (?P<number>\d+(?:\.\d+)?) |
+    (?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?) |
+    (?P<op>==|!=|<>|<=|>=|[=<>(),?])
+    )""", re.VERBOSE)
+
+_KEYWORDS = set(['and', 'or', 'not', 'in', 'is', 'null', 'like', 'glob',
+                 'select'])
+
+def _kind_for_schema_item(schema_item):
+    # schema imports database, which imports us, so we can't import schema
+    # at the module level.
+    from miro import schema
+    if isinstance(schema_item, (schema.SchemaBool, schema.SchemaInt,
+                                schema.SchemaFloat)):
+        return NUMERIC
+    elif isinstance(schema_item, (schema.SchemaString, schema.SchemaURL)):
+        return TEXT
+    else:
+        return OTHER
+
+def _kind_for_value(value):
+    if value is None:
+        return NULL
+    elif isinstance(value, (bool, int, long, float)):
+        return NUMERIC
+    elif isinstance(value, basestring):
+        return TEXT
+    else:
+        return OTHER
+
+def _truth(value):
+    """Convert a value to a SQL boolean (True, False, None or UNKNOWN)."""
+    if value is None or value is UNKNOWN:
+        return value
+    return bool(value)
+
+def tokenize(where):
+    tokens = []
+    pos = 0
+    where = where.rstrip()
+    while pos < len(where):
+        m = _TOKEN_RE.match(where, pos)
+        if m is None or m.end() == pos:
+            raise CompileError("Can't tokenize %r at %d" % (where, pos))
+        pos = m.end()
+        for type_ in ('string', 'number', 'name', 'op'):
+            text = m.group(type_)
+            if text is not None:
+                if type_ == 'name' and text.lower() in _KEYWORDS:
+                    tokens.append(('keyword', text.lower()))
+                else:
+                    tokens.append((type_, text))
+                break
+    return tokens
+
+class _Node(object):
+    kind = NUMERIC
+
+    def evaluate(self, context):
+        raise NotImplementedError()
+
+class _UnknownNode(_Node):
+    kind = OTHER
+
+    def evaluate(self, context):
+        return UNKNOWN
+
+class _Constant(_Node):
+    def __init__(self, value):
+        self.value = value
+        self.kind = _kind_for_value(value)
+
+    def evaluate(self, context):
+        return self.value
+
+class _Column(_Node):
+    def __init__(self, alias, name, kind):
+        self.alias = alias
+        self.name = name
+        self.kind = kind
+
+    def evaluate(self, context):
+        return context.get_value(self.alias, self.name)
+
+class _Boolean(_Node):
+    """Evaluate a numeric value in a boolean context."""
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, context):
+        return _truth(self.operand.evaluate(context))
+
+class _Compare(_Node):
+    OPERATORS = {
+        '=': lambda a, b: a == b,
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<>': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+    }
+
+    def __init__(self, op, left, right):
+        self.func = self.OPERATORS[op]
+        self.left = left
+        self.right = right
+
+    def evaluate(self, context):
+        left = self.left.evaluate(context)
+        if left is UNKNOWN:
+            return UNKNOWN
+        right = self.right.evaluate(context)
+        if right is UNKNOWN:
+            return UNKNOWN
+        if left is None or right is None:
+            return None
+        return self.func(left, right)
+
+class _IsNull(_Node):
+    def __init__(self, operand, negate):
+        self.operand = operand
+        self.negate = negate
+
+    def evaluate(self, context):
+        value = self.operand.evaluate(context)
+        if value is UNKNOWN:
+            return UNKNOWN
+        return (value is None) != self.negate
+
+class _In(_Node):
+    def __init__(self, operand, values, negate):
+        self.operand = operand
+        self.values = frozenset(v for v in values if v is not None)
+        self.has_null = None in values
+        self.negate = negate
+
+    def evaluate(self, context):
+        value = self.operand.evaluate(context)
+        if value is UNKNOWN or value is None:
+            return value
+        if value in self.values:
+            result = True
+        elif self.has_null:
+            return None
+        else:
+            result = False
+        return result != self.negate
+
+class _Not(_Node):
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, context):
+        value = self.operand.evaluate(context)
+        if value is UNKNOWN or value is None:
+            return value
+        return not value
+
+class _And(_Node):
+    def __init__(self, operands):
+        self.operands = operands
+
+    def evaluate(self, context):
+        result = True
+        for operand in self.operands:
+            value = operand.evaluate(context)
+            if value is False:
+                return False
+            elif value is UNKNOWN:
+                result = UNKNOWN
+            elif value is None and result is not UNKNOWN:
+                result = None
+        return result
+
+class _Or(_Node):
+    def __init__(self, operands):
+        self.operands = operands
+
+    def evaluate(self, context):
+        result = False
+        for operand in self.operands:
+            value = operand.evaluate(context)
+            if value is True:
+                return True
+            elif value is UNKNOWN:
+                result = UNKNOWN
+            elif value is None and result is not UNKNOWN:
+                result = None
+        return result
+
+class _Join(object):
+    """A table LEFT JOINed to the view's table on its id column."""
+    def __init__(self, alias, table_name, foreign_key):
+        self.alias = alias
+        self.table_name = table_name
+        self.foreign_key = foreign_key
+
+def _parse_join(join_table, join_where, table_name, main_columns):
+    """Parse a join from a View's joins dict.
+
+    :returns: _Join object or None if we can't handle the join
+    """
+    parts = join_table.split()
+    if len(parts) == 1:
+        joined_table = alias = parts[0]
+    elif len(parts) == 2:
+        joined_table, alias = parts
+    elif len(parts) == 3 and parts[1].lower() == 'as':
+        joined_table, alias = parts[0], parts[2]
+    else:
+        return None
+    m = re.match(r'^\s*([\w.]+)\s*==?\s*([\w.]+)\s*$', join_where)
+    if m is None:
+        return None
+    for id_side, key_side in (m.groups(), reversed(m.groups())):
+        if id_side != '%s.id' % alias:
+            continue
+        if key_side.startswith(table_name + '.'):
+            key_side = key_side[len(table_name)+1:]
+        if key_side in main_columns:
+            return _Join(alias, joined_table, key_side)
+    return None
+
+class _Parser(object):
+    """Recursive descent parser for WHERE clauses.
+
+    Operator precedence follows sqlite: OR < AND < NOT < comparisons.
+    """
+    def __init__(self, tokens, values, table_name, columns,
+                 unknown_aliases):
+        self.tokens = tokens
+        self.pos = 0
+        self.values = values
+        self.param_index = 0
+        self.table_name = table_name
+        # maps alias -> {column name -> kind}.  The view's table uses None
+        # as its alias.
+        self.columns = columns
+        # aliases for joins that we couldn't parse
+        self.unknown_aliases = unknown_aliases
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise CompileError("Extra tokens at %s" % self.pos)
+        if self.param_index != len(self.values):
+            raise CompileError("Wrong number of values")
+        return self.boolean_context(node)
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next_token(self):
+        token = self.peek()
+        if token[0] is None:
+            raise CompileError("Unexpected end of input")
+        self.pos += 1
+        return token
+
+    def accept(self, type_, text=None):
+        token = self.peek()
+        if token[0] == type_ and (text is None or token[1] == text):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, type_, text=None):
+        if not self.accept(type_, text):
+            raise CompileError("Expected %s at %s" % (text or type_,
+                self.pos))
+
+    def skip_parens(self):
+        """Skip over a parenthesized block that we can't handle.
+
+        This should be called just after the opening paren is consumed.  We
+        still need to count placeholders so that values line up.
+        """
+        depth = 1
+        while depth > 0:
+            type_, text = self.next_token()
+            if type_ == 'op':
+                if text == '(':
+                    depth += 1
+                elif text == ')':
+                    depth -= 1
+                elif text == '?':
+                    self.param_index += 1
+
+    def boolean_context(self, node):
+        if isinstance(node, _Column) or isinstance(node, _Constant):
+            if node.kind == NULL:
+                return _Constant(None)
+            elif node.kind != NUMERIC:
+                return _UnknownNode()
+            return _Boolean(node)
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.accept('keyword', 'or'):
+            operands.append(self.parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        return _Or([self.boolean_context(o) for o in operands])
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.accept('keyword', 'and'):
+            operands.append(self.parse_not())
+        if len(operands) == 1:
+            return operands[0]
+        return _And([self.boolean_context(o) for o in operands])
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return _Not(self.boolean_context(self.parse_not()))
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        type_, text = self.peek()
+        if type_ == 'op' and text in _Compare.OPERATORS:
+            self.pos += 1
+            right = self.parse_operand()
+            return self.make_compare(text, left, right)
+        elif type_ == 'keyword' and text == 'is':
+            self.pos += 1
+            negate = self.accept('keyword', 'not')
+            if self.accept('keyword', 'null'):
+                return _IsNull(left, negate)
+            self.parse_operand()
+            return _UnknownNode()
+        elif type_ == 'keyword' and text in ('not', 'in', 'like', 'glob'):
+            self.pos += 1
+            negate = (text == 'not')
+            if negate:
+                type_, text = self.next_token()
+            if text == 'in':
+                return self.parse_in(left, negate)
+            elif text in ('like', 'glob'):
+                self.parse_operand()
+                return _UnknownNode()
+            raise CompileError("Unexpected %s" % text)
+        return left
+
+    def parse_in(self, left, negate):
+        self.expect('op', '(')
+        if self.peek() == ('keyword', 'select'):
+            self.skip_parens()
+            return _UnknownNode()
+        items = [self.parse_operand()]
+        while self.accept('op', ','):
+            items.append(self.parse_operand())
+        self.expect('op', ')')
+        if left.kind not in (NUMERIC, TEXT):
+            return _UnknownNode()
+        for item in items:
+            if (not isinstance(item, _Constant) or
+                    item.kind not in (left.kind, NULL)):
+                return _UnknownNode()
+        return _In(left, [item.value for item in items], negate)
+
+    def make_compare(self, op, left, right):
+        if left.kind == NULL or right.kind == NULL:
+            return _Constant(None)
+        if left.kind != right.kind or left.kind not in (NUMERIC, TEXT):
+            return _UnknownNode()
+        if left.kind == TEXT and op not in ('=', '==', '!=', '<>'):
+            # sqlite compares text by its UTF-8 bytes, which doesn't always
+            # match how python orders unicode strings.
+            return _UnknownNode()
+        return _Compare(op, left, right)
+
+    def parse_operand(self):
+        type_, text = self.next_token()
+        if type_ == 'op' and text == '(':
+            if self.peek() == ('keyword', 'select'):
+                self.skip_parens()
+                return _UnknownNode()
+            node = self.parse_or()
+            self.expect('op', ')')
+            return node
+        elif type_ == 'op' and text == '?':
+            if self.param_index >= len(self.values):
+                raise CompileError("Not enough values")
+            value = self.values[self.param_index]
+            self.param_index += 1
+            return _Constant(value)
+        elif type_ == 'string':
+            return _Constant(unicode(text[1:-1].replace("''", "'")))
+        elif type_ == 'number':
+            if '.' in text:
+                return _Constant(float(text))
+            return _Constant(int(text))
+        elif type_ == 'keyword' and text == 'null':
+            return _Constant(None)
+        elif type_ == 'name':
+            if self.accept('op', '('):
+                # function call
+                self.skip_parens()
+                return _UnknownNode()
+            return self.make_column(text)
+        raise CompileError("Unexpected token: %s" % text)
+
+    def make_column(self, text):
+        if '.' in text:
+            alias, name = text.split('.')
+            if alias == self.table_name:
+                alias = None
+        else:
+            name = text
+            if name in self.columns[None]:
+                alias = None
+            else:
+                # look for the column in joined tables
+                matches = [a for a in self.columns
+                           if a is not None and name in self.columns[a]]
+                if len(matches) != 1 or self.unknown_aliases:
+                    return _UnknownNode()
+                alias = matches[0]
+        if alias not in self.columns or name not in self.columns[alias]:
+            return _UnknownNode()
+        return _Column(alias, name, self.columns[alias][name])
+
+class _EvalContext(object):
+    """Fetches column values while evaluating a ViewPredicate."""
+    def __init__(self, predicate, obj):
+        self.predicate = predicate
+        self.objects = {None: obj}
+
+    def get_value(self, alias, name):
+        try:
+            obj = self.objects[alias]
+        except KeyError:
+            obj = self.objects[alias] = self.predicate.fetch_joined(
+                self.predicate.joins[alias], self.objects[None])
+        if obj is None or obj is UNKNOWN:
+            return obj
+        if name in obj.changed_attributes:
+            # In-memory value hasn't been saved to the DB yet
+            return UNKNOWN
+        try:
+            value = obj.__dict__[name]
+        except KeyError:
+            return UNKNOWN
+        # database imports us, so we can't import it at the module level.
+        from miro.database import LazyAttributeValue
+        if isinstance(value, LazyAttributeValue):
+            # Column hasn't been loaded from the DB yet.  Let SQL decide
+            # rather than loading it here.
+            return UNKNOWN
+        return value
+
+class ViewPredicate(object):
+    """Compiled WHERE clause for a View.
+
+    Use evaluate() to check if an object is in the view.
+    """
+    def __init__(self, root, table_name, joins, db_info):
+        self.root = root
+        self.table_name = table_name
+        self.joins = joins
+        self.db_info = db_info
+
+    def _is_current(self, obj, table_name):
+        """Check that obj matches what's stored in the database."""
+        try:
+            db_obj = self.db_info.db.get_obj_by_table_name(obj.id,
+                                                           table_name)
+        except KeyError:
+            return False
+        return (db_obj is obj and
+                not self.db_info.bulk_sql_manager.will_insert(obj.id))
+
+    def fetch_joined(self, join, obj):
+        """Get the object that a LEFT JOIN would match for obj."""
+        if join.foreign_key in obj.changed_attributes:
+            return UNKNOWN
+        foreign_id = obj.__dict__.get(join.foreign_key)
+        if foreign_id is None:
+            return None
+        from miro.database import LazyAttributeValue
+        if isinstance(foreign_id, LazyAttributeValue):
+            return UNKNOWN
+        try:
+            joined = self.db_info.db.get_obj_by_table_name(foreign_id,
+                                                           join.table_name)
+        except KeyError:
+            # not loaded or doesn't exist, we can't tell which
+            return UNKNOWN
+        if not self._is_current(joined, join.table_name):
+            return UNKNOWN
+        return joined
+
+    def evaluate(self, obj):
+        """Check if obj is in our view.
+
+        :returns: True, False, or UNKNOWN if we need to ask the database
+        """
+        if not self._is_current(obj, self.table_name):
+            return UNKNOWN
+        result = self.root.evaluate(_EvalContext(self, obj))
+        if result is None:
+            return False
+        return result
+
+def compile_where(table_name, where, values, joins, db_info):
+    """Compile a View's WHERE clause into a ViewPredicate
+
+    :returns: ViewPredicate or None if where can't be compiled
+    """
+    db = db_info.db
+    try:
+        main_fields = db.schema_fields_for_table_name(table_name)
+    except KeyError:
+        return None
+    columns = {
+        None: dict((name, _kind_for_schema_item(schema_item))
+                   for name, schema_item in main_fields)
+    }
+    parsed_joins = {}
+    unknown_aliases = set()
+    if joins:
+        for join_table, join_where in joins.items():
+            join = _parse_join(join_table, join_where, table_name,
+                               columns[None])
+            if join is None:
+                unknown_aliases.add(join_table.split()[-1])
+                continue
+            try:
+                fields = db.schema_fields_for_table_name(join.table_name)
+            except KeyError:
+                unknown_aliases.add(join.alias)
+                continue
+            parsed_joins[join.alias] = join
+            columns[join.alias] = dict(
+                (name, _kind_for_schema_item(schema_item))
+                for name, schema_item in fields)
+    if not where:
+        return ViewPredicate(_Constant(True), table_name, parsed_joins,
+                             db_info)
+    try:
+        parser = _Parser(tokenize(where), values, table_name, columns,
+                         unknown_aliases)
+        root = parser.parse()
+    except CompileError:
+        return None
+    return ViewPredicate(root, table_name, parsed_joins, db_info)
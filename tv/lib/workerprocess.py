@@ -41,7 +41,9 @@ import threading
 
 from miro import clock
 from miro import eventloop
+from miro import feeddiff
 from miro import feedparserutil
+from miro import fileutil
 from miro import filetags
 from miro import messagetools
 from miro import moviedata
@@ -50,6 +52,12 @@ from miro import util
 
 from miro.plat import utils
 
+# Most worker processes that we will run
+MAX_WORKER_PROCESSES = 4
+# Number of tasks past its thread count that we send to each worker process.
+# This lets a process start on its next task without waiting for us.
+TASK_PREFETCH = 1
+
 class SubprocessTimeoutError(StandardError):
     """A task failed because the subprocess didn't respond in enough time."""
 
@@ -70,11 +78,34 @@ class TaskMessage(WorkerMessage):
         subprocessmanager.SubprocessMessage.__init__(self)
         self.task_id = TaskMessage._id_counter.next()
 
-class FeedparserTask(TaskMessage):
+class FeedDiffTask(TaskMessage):
+    """Parse a feed and compare its entries to the items we have.
+
+    The feed data comes from either html, or the file at path.  Large feeds
+    get sent as a path, so that we don't have to copy them over the pipe.
+    The result is a feeddiff.FeedDiff.
+
+    :param item_keys: snapshot of the feed's items from
+        feeddiff.item_keys()
+    :param html: feed data
+    :param path: file to read the feed data from
+    :param charset: charset to use for data from path if the XML header
+        doesn't specify one
+    """
     priority = 20
-    def __init__(self, html):
+    def __init__(self, item_keys, html=None, path=None, charset=None):
         TaskMessage.__init__(self)
+        self.item_keys = item_keys
         self.html = html
+        self.path = path
+        self.charset = charset
+
+    def __str__(self):
+        if self.path is not None:
+            return 'FeedDiffTask (path: %s, %d items)' % (self.path,
+                    len(self.item_keys))
+        return 'FeedDiffTask (%d bytes, %d items)' % (len(self.html),
+                len(self.item_keys))
 
 class MovieDataProgramTask(TaskMessage):
     priority = 10
@@ -96,6 +127,21 @@ class MutagenTask(TaskMessage):
     def __str__(self):
         return 'MutagenTask (path: %s)' % self.source_path
 
+class FileIdentityTask(TaskMessage):
+    """Get the size, mtime and fingerprint for a list of files.
+
+    The result is a list with a fileutil.get_file_identity() value for each
+    path.  The MetadataManagers use these to look up cached mutagen/movie
+    data results without reading the files in the main process.
+    """
+    priority = 15
+    def __init__(self, paths):
+        TaskMessage.__init__(self)
+        self.paths = paths
+
+    def __str__(self):
+        return 'FileIdentityTask (%d paths)' % len(self.paths)
+
 class CancelFileOperations(TaskMessage):
     """Cancel mutagen/movie data tasks for a set of path."""
     priority = 0
@@ -111,6 +157,14 @@ class TaskResult(subprocessmanager.SubprocessResponse):
         self.task_id = task_id
         self.result = result
 
+class TasksCanceled(subprocessmanager.SubprocessResponse):
+    """Tasks that a CancelFileOperations message removed from the queue.
+
+    We never send a TaskResult for these.
+    """
+    def __init__(self, task_ids):
+        self.task_ids = task_ids
+
 class MovieDataTaskStatus(subprocessmanager.SubprocessResponse):
     """Report when we are handling movie data tasks.
 
@@ -196,34 +250,62 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
 
     def handle_cancel_file_operations(self, msg):
         path_set = set(msg.paths)
-        self.task_queue.cancel_file_operations(path_set)
+        canceled = self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque()
+        for method, task in self.main_thread_tasks:
+            if task.source_path in path_set:
+                canceled.append(task)
+            else:
+                filtered_tasks.append((method, task))
         self.main_thread_tasks = filtered_tasks
+        if canceled:
+            TasksCanceled([task.task_id for task in canceled]
+                    ).send_to_main_process()
         return None
 
     # handle_movie_data_program_task gets called in the main thread, unlike
     # all other task handler methods
 
     def handle_movie_data_program_task(self, msg):
-        return moviedata.process_file(msg.source_path,
-                                      msg.screenshot_directory)
+        result = moviedata.process_file(msg.source_path,
+                                        msg.screenshot_directory)
+        return self._add_file_identity(msg.source_path, result)
+
+    def _add_file_identity(self, source_path, result):
+        """Add the file's size, mtime and fingerprint to a result dict.
+
+        The main process uses them to store the result in its
+        ExtractorResultCache without reading the file itself.
+        """
+        file_identity = fileutil.get_file_identity(source_path)
+        if file_identity is not None:
+            result['file_identity'] = file_identity
+        return result
 
 
     # NOTE: all of the handle_*_task() methods below get called in one of our
     # worker threads, so they should only call thread-safe functions
 
-    def handle_feedparser_task(self, msg):
-        parsed_feed = feedparserutil.parse(msg.html)
+    def handle_feed_diff_task(self, msg):
+        if msg.path is not None:
+            html = feedparserutil.read_feed_file(msg.path, msg.charset)
+        else:
+            html = msg.html
+        parsed_feed = feedparserutil.parse(html)
         # bozo_exception is sometimes C object that is not picklable.  We
         # don't use it anyways, so just unset the value
         parsed_feed['bozo_exception'] = None
-        return parsed_feed
+        return feeddiff.diff_feed(parsed_feed, msg.item_keys)
+
+    def handle_file_identity_task(self, msg):
+        return [fileutil.get_file_identity(path) for path in msg.paths]
 
     def handle_mutagen_task(self, msg):
-        return filetags.process_file(msg.source_path, msg.cover_art_directory)
+        result = filetags.process_file(msg.source_path,
+                                       msg.cover_art_directory)
+        return self._add_file_identity(msg.source_path, result)
 
     def handle_mutagen_task_with_alarm(self, msg):
         with util.alarm(2):
@@ -265,25 +347,28 @@ class _SinglePriorityQueue(object):
 
         :param filterfunc: function to determine if messages should stay
         :param message_class: type of messages to filter
+        :returns: list of messages that we removed
         """
         fifo = self.fifo_map[message_class]
-        new_items = tuple((method, msg) for (method, msg) in fifo
-                         if filterfunc(msg))
+        new_items = []
+        removed = []
+        for method, msg in fifo:
+            if filterfunc(msg):
+                new_items.append((method, msg))
+            else:
+                removed.append(msg)
         fifo.clear()
         fifo.extend(new_items)
+        return removed
 
-class WorkerTaskQueue(object):
-    """Store the pending tasks for the worker process.
+class TaskPriorityQueue(object):
+    """Store pending tasks and get the next one in order of priority.
 
-    WorkerTaskQueue is responsible for storing task info for each pending
-    task, and getting the next one in order of priority.
-
-    It's shared between the main subprocess thread, and all worker threads, so
-    all methods need to be thread-safe.
+    TaskPriorityQueue isn't thread-safe.  WorkerTaskQueue wraps it in the
+    worker process.  The main process uses one to hold tasks until a worker
+    process has room for them.
     """
     def __init__(self):
-        self.should_quit = False
-        self.condition = threading.Condition()
         # queues_by_priority contains a _SinglePriorityQueue for each priority
         # level, ordered from highest to lowest priority
         self.queues_by_priority = []
@@ -299,10 +384,54 @@ class WorkerTaskQueue(object):
             self.queues_by_priority.append(queue)
             self.queue_map[queue.priority] = queue
 
+    def add_task(self, handler_method, msg):
+        """Add a new task to the queue.  """
+        self.queue_map[msg.priority].add_task(handler_method, msg)
+
+    def get_next_task(self):
+        """Get the next task to be processed from the queue.
+
+        :returns: (handler_method, message) tuple, or None if there are no
+            tasks
+        """
+        for queue in self.queues_by_priority:
+            next_for_queue = queue.get_next_task()
+            if next_for_queue is not None:
+                return next_for_queue
+        # no tasks in any of our queues
+        return None
+
+    def cancel_file_operations(self, path_set):
+        """Cancels all mutagen/movie data tasks for a list of paths.
+
+        :returns: list of the messages that we removed
+        """
+        def filter_func(msg):
+            return msg.source_path not in path_set
+        canceled = []
+        for cls in (MutagenTask, MovieDataProgramTask):
+            queue = self.queue_map[cls.priority]
+            canceled.extend(queue.filter_messages(filter_func, cls))
+        return canceled
+
+class WorkerTaskQueue(object):
+    """Store the pending tasks for the worker process.
+
+    WorkerTaskQueue is responsible for storing task info for each pending
+    task, and getting the next one in order of priority.
+
+    It's shared between the main subprocess thread, and all worker threads, so
+    all methods need to be thread-safe.
+    """
+    def __init__(self):
+        self.should_quit = False
+        self.condition = threading.Condition()
+        self.tasks = TaskPriorityQueue()
+
     def add_task(self, handler_method, msg):
         """Add a new task to the queue.  """
         with self.condition:
-            self.queue_map[msg.priority].add_task(handler_method, msg)
+            self.tasks.add_task(handler_method, msg)
             self.condition.notify()
 
     def get_next_task(self):
@@ -320,33 +449,24 @@ class WorkerTaskQueue(object):
         with self.condition:
             if self.should_quit:
                 return None
-            next_task_info = self._get_next_task()
+            next_task_info = self.tasks.get_next_task()
             if next_task_info is not None:
                 return next_task_info
             # no tasks yet, need to wait for more
             self.condition.wait()
             if self.should_quit:
                 return None
-            return self._get_next_task()
-
-    def _get_next_task(self):
-        for queue in self.queues_by_priority:
-            next_for_queue = queue.get_next_task()
-            if next_for_queue is not None:
-                return next_for_queue
-        # no tasks in any of our queues
-        return None
+            return self.tasks.get_next_task()
 
     def cancel_file_operations(self, path_set):
-        """Cancels all mutagen/movie data tasks for a list of paths."""
+        """Cancels all mutagen/movie data tasks for a list of paths.
+
+        :returns: list of the messages that we removed
+        """
         # Acquire our lock as soon as possible.  We want to prevent other
         # tasks from getting tasks, since they may be about to deleted.
         with self.condition:
-            def filter_func(msg):
-                return msg.source_path not in path_set
-            for cls in (MutagenTask, MovieDataProgramTask):
-                queue = self.queue_map[cls.priority]
-                queue.filter_messages(filter_func, cls)
+            return self.tasks.cancel_file_operations(path_set)
 
     def shutdown(self):
         # should be save to set this without the lock, since it's a boolean
@@ -381,15 +501,15 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, manager):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.manager = manager
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.manager.send_message(self.manager.pool.startup_message)
+        self.manager.pool.process_started(self.manager)
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
@@ -401,7 +521,10 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
 
 
     def handle_task_result(self, msg):
-        _miro_task_queue.process_result(msg)
+        self.manager.pool.task_finished(msg)
+
+    def handle_tasks_canceled(self, msg):
+        self.manager.pool.tasks_canceled(msg.task_ids)
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -430,29 +553,64 @@ class MiroTaskQueue(object):
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        msg.send_to_process()
+
+    def get_task(self, task_id):
+        """Get the message for a task that hasn't finished yet.
+
+        :returns: TaskMessage, or None if task_id isn't in progress
+        """
+        try:
+            return self.tasks_in_progress[task_id][0]
+        except KeyError:
+            return None
+
+    def count_tasks(self, task_class=None):
+        """Count the tasks that haven't finished yet.
+
+        :param task_class: only count tasks of this class
+        """
+        if task_class is None:
+            return len(self.tasks_in_progress)
+        count = 0
+        for msg, callback, errback in self.tasks_in_progress.itervalues():
+            if isinstance(msg, task_class):
+                count += 1
+        return count
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        except KeyError:
+            # CancelFileOperations goes to every worker process, so we get a
+            # result from each one.  Only the first one counts.
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
+    def forget_task(self, task_id):
+        """Remove a task without calling its callback or errback."""
+        self.tasks_in_progress.pop(task_id, None)
 
 _miro_task_queue = MiroTaskQueue()
 
 # Manage subprocess
 class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+    """Manages one of the processes in a WorkerProcessPool.
+
+    :attribute task_ids: ids of the tasks that we've sent to this process
+        that haven't finished yet
+    """
+    def __init__(self, pool):
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(self), pool.handler_class,
+                restart_delay=pool.restart_delay,
+                large_message_size=subprocessmanager.LARGE_MESSAGE_SIZE)
+        self.pool = pool
+        self.task_ids = set()
         self.check_hung_timeout = None
 
     def _start(self):
@@ -490,18 +648,163 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         else:
             self.schedule_check_subprocess_hung()
 
-_subprocess_manager = WorkerSubprocessManager()
+def default_process_count():
+    """Get the number of worker processes to run.
+
+    We use one process per CPU, leaving one for the main process, up to
+    MAX_WORKER_PROCESSES.
+    """
+    cpu_count = utils.get_logical_cpu_count()
+    return max(1, min(cpu_count - 1, MAX_WORKER_PROCESSES))
+
+class WorkerProcessPool(object):
+    """Runs our worker processes and decides which one handles each task.
+
+    feedparser and mutagen are pure python, so the threads inside a single
+    worker process all fight over its GIL.  Using several processes lets us
+    use more than one CPU.
+
+    Tasks wait in a TaskPriorityQueue until a process has room for them.
+    Each process gets at most its thread count plus TASK_PREFETCH tasks at
+    once, so a high priority task never waits behind a long queue that we
+    already sent to a process.  We send each task to the process with the
+    fewest tasks in progress.
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+    WorkerProcessPool handles WorkerMessages.  CancelFileOperations and other
+    non-task messages go to every process.
+    """
+    def __init__(self):
+        WorkerMessage.install_handler(self)
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.managers = []
+        self.waiting_tasks = TaskPriorityQueue()
+        # maps task_ids to the WorkerSubprocessManager handling them
+        self.task_managers = {}
+        self.startup_message = None
+        self.task_limit = 0
+        self.is_running = False
+
+    def start(self, process_count, thread_count):
+        if self.is_running:
+            return
+        self.startup_message = WorkerStartupInfo(thread_count)
+        self.task_limit = thread_count + TASK_PREFETCH
+        self.is_running = True
+        for i in xrange(process_count):
+            manager = WorkerSubprocessManager(self)
+            self.managers.append(manager)
+            manager.start()
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    def shutdown(self):
+        for manager in self.managers:
+            manager.shutdown()
+            # if we start up again, send the unfinished tasks to the new
+            # processes
+            for task_id in manager.task_ids:
+                del self.task_managers[task_id]
+                msg = _miro_task_queue.get_task(task_id)
+                if msg is not None:
+                    self.waiting_tasks.add_task(None, msg)
+        self.managers = []
+        self.is_running = False
+        subprocessmanager.ipc_stats.log_summary()
+
+    def restart(self, clean=False):
+        for manager in self.managers:
+            if manager.is_running:
+                manager.restart(clean)
+
+    # implement the MessageHandler interface
+    def handle(self, msg):
+        if isinstance(msg, CancelFileOperations):
+            self.cancel_file_operations(msg)
+        elif isinstance(msg, TaskMessage):
+            self.waiting_tasks.add_task(None, msg)
+            self.dispatch_tasks()
+        else:
+            for manager in self.managers:
+                if manager.is_running:
+                    manager.send_message(msg)
+
+    def dispatch_tasks(self):
+        """Send waiting tasks to processes that have room for them."""
+        while True:
+            manager = self._pick_manager()
+            if manager is None:
+                return
+            next_task = self.waiting_tasks.get_next_task()
+            if next_task is None:
+                return
+            msg = next_task[1]
+            manager.task_ids.add(msg.task_id)
+            self.task_managers[msg.task_id] = manager
+            manager.send_message(msg)
+
+    def _pick_manager(self):
+        best = None
+        for manager in self.managers:
+            if not manager.is_running:
+                continue
+            task_count = len(manager.task_ids)
+            if (task_count < self.task_limit and
+                    (best is None or task_count < len(best.task_ids))):
+                best = manager
+        return best
+
+    def process_started(self, manager):
+        """Called when one of our processes starts up or restarts."""
+        # if the process restarted, it lost the tasks that we sent it.
+        for task_id in sorted(manager.task_ids):
+            msg = _miro_task_queue.get_task(task_id)
+            if msg is not None:
+                manager.send_message(msg)
+        self.dispatch_tasks()
+
+    def task_finished(self, reply):
+        """Handle a TaskResult from one of our processes."""
+        self._forget_task(reply.task_id)
+        _miro_task_queue.process_result(reply)
+        self.dispatch_tasks()
+
+    def tasks_canceled(self, task_ids):
+        """Handle a TasksCanceled message from one of our processes."""
+        for task_id in task_ids:
+            self._forget_task(task_id)
+            _miro_task_queue.forget_task(task_id)
+        self.dispatch_tasks()
+
+    def _forget_task(self, task_id):
+        manager = self.task_managers.pop(task_id, None)
+        if manager is not None:
+            manager.task_ids.discard(task_id)
+
+    def cancel_file_operations(self, msg):
+        path_set = set(msg.paths)
+        for canceled in self.waiting_tasks.cancel_file_operations(path_set):
+            _miro_task_queue.forget_task(canceled.task_id)
+        running = [m for m in self.managers if m.is_running]
+        for manager in running:
+            manager.send_message(msg)
+        if not running:
+            _miro_task_queue.process_result(TaskResult(msg.task_id, None))
+
+_worker_pool = WorkerProcessPool()
+
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
+
+    :param thread_count: number of threads to run in each process
+    :param process_count: number of processes to run.  By default we use
+        default_process_count()
+    """
+    if process_count is None:
+        process_count = default_process_count()
+    _worker_pool.start(process_count, thread_count)
 
 def shutdown():
-    """Shutdown the worker process."""
-    _subprocess_manager.shutdown()
+    """Shutdown the worker processes."""
+    _worker_pool.shutdown()
 
 # API for sending tasks
 def send(msg, callback, errback):
@@ -513,6 +816,14 @@ def send(msg, callback, errback):
     """
     _miro_task_queue.add_task(msg, callback, errback)
 
+def pending_task_count(task_class=None):
+    """Get the number of tasks sent to the worker process that haven't
+    finished yet.
+
+    :param task_class: only count tasks of this class
+    """
+    return _miro_task_queue.count_tasks(task_class)
+
 def cancel_tasks_for_files(paths):
     """Cancel mutagen and movie data tasks for a list of paths."""
     msg = CancelFileOperations(paths)